@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Quality/speed sweep over the quantization types of a model.
+
+Quantizes an f16 model to every type supported by whisper-quantize (and to the given
+recipes), runs a fixed local audio corpus through each one and prints one table:
+
+    type     size MB   load ms     RTF   peak RSS MB   WER %
+
+- RTF: compute time / audio duration over the corpus (lower is faster)
+- peak RSS: of the process that loads the model and transcribes the corpus
+- WER: word error rate of the transcripts against those of the f16 model
+
+Every model runs in a fresh process, so the load time and the peak RSS are not skewed
+by the models measured before it. The quantized models are kept in --out-dir and only
+rebuilt when they are older than the source model.
+
+The corpus is a directory of 16 kHz mono 16-bit WAV files.
+
+Usage:
+    python bench_quant.py models/ggml-small.bin samples/ \\
+        --lib artifacts/whisper_small_xeon --quantize build/bin/whisper-quantize \\
+        [--types q4_0,q5_1,q8_0] [--recipe examples/quantize/recipes/small-mixed.txt] \\
+        [--threads 8] [--language en] [--beam-size 0] [--json results.json]
+"""
+
+import argparse
+import array
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bindings", "python"))
+
+import whisper_xeon as wx
+
+# the types accepted by whisper-quantize (examples/common-ggml.cpp)
+QUANT_TYPES = ("q4_0", "q4_1", "q5_0", "q5_1", "q8_0", "q2_k", "q3_k", "q4_k", "q5_k", "q6_k")
+
+# prefix of the result line printed by a worker process
+RESULT_PREFIX = "bench_quant: "
+
+
+def read_wav(path):
+    """Return the samples of a 16 kHz mono 16-bit WAV file as array('f')."""
+    with wave.open(path, "rb") as f:
+        if f.getframerate() != wx.SAMPLE_RATE or f.getnchannels() != 1 or f.getsampwidth() != 2:
+            raise ValueError("%s: expected 16 kHz mono 16-bit PCM, got %d Hz, %d channels, %d bytes per sample" % (
+                path, f.getframerate(), f.getnchannels(), f.getsampwidth()))
+        pcm = array.array("h", f.readframes(f.getnframes()))
+
+    if sys.byteorder != "little":
+        pcm.byteswap()
+
+    return array.array("f", (s / 32768.0 for s in pcm))
+
+
+def list_corpus(corpus_dir):
+    files = sorted(os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir) if name.lower().endswith(".wav"))
+    if not files:
+        raise SystemExit("no .wav files in %s" % corpus_dir)
+    return files
+
+
+def normalize(text):
+    """Lowercase words without punctuation, so that WER counts word changes only."""
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_errors(ref, hyp):
+    """Levenshtein distance between two lists of words."""
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1]
+
+
+def run_worker(args):
+    """Load one model, transcribe the corpus and print the measurements as one JSON line."""
+    wx.load_library(args.lib)
+
+    corpus = [(path, read_wav(path)) for path in list_corpus(args.corpus)]
+
+    t0  = time.perf_counter()
+    ctx = wx.Context(args.model)
+    t_load = time.perf_counter() - t0
+
+    strategy = wx.SAMPLING_BEAM_SEARCH if args.beam_size > 0 else wx.SAMPLING_GREEDY
+
+    params = wx.FullParams(strategy, language=args.language, print_progress=False)
+    params.n_threads = args.threads
+    if args.beam_size > 0:
+        params.beam_search_beam_size = args.beam_size
+
+    texts     = {}
+    t_compute = 0.0
+    t_audio   = 0.0
+
+    for path, pcm in corpus:
+        t0 = time.perf_counter()
+        segments = ctx.transcribe(pcm, params)
+        t_compute += time.perf_counter() - t0
+        t_audio   += len(pcm) / float(wx.SAMPLE_RATE)
+
+        texts[os.path.basename(path)] = "".join(segment.text for segment in segments)
+
+    ctx.close()
+
+    result = {
+        "load_ms":    1000.0 * t_load,
+        "rtf":        t_compute / t_audio,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "texts":      texts,
+    }
+
+    sys.stdout.write(RESULT_PREFIX + json.dumps(result) + "\n")
+
+
+def measure(args, model):
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker",
+           model, args.corpus,
+           "--lib", args.lib,
+           "--threads", str(args.threads),
+           "--language", args.language,
+           "--beam-size", str(args.beam_size)]
+
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    for line in out.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+
+    raise RuntimeError("%s: the benchmark failed (exit code %d)" % (model, out.returncode))
+
+
+def quantize(args, name, type_or_recipe):
+    """Build (or reuse) the model for one type or recipe, None if whisper-quantize fails."""
+    stem  = os.path.splitext(os.path.basename(args.model))[0]
+    model = os.path.join(args.out_dir, "%s-%s.bin" % (stem, name))
+
+    # rebuilt when the source model or the recipe changed since
+    inputs = [args.model]
+    if type_or_recipe not in QUANT_TYPES:
+        inputs.append(type_or_recipe)
+
+    if os.path.exists(model) and all(os.path.getmtime(model) >= os.path.getmtime(path) for path in inputs):
+        return model
+
+    cmd = [args.quantize, args.model, model, type_or_recipe, str(args.threads)]
+    if subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+        print("  ✗ %s: whisper-quantize failed" % name)
+        if os.path.exists(model):
+            os.remove(model)
+        return None
+
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("model",       help="f16 (or f32) model, the reference of the WER")
+    parser.add_argument("corpus",      help="directory of 16 kHz mono 16-bit WAV files")
+    parser.add_argument("--lib",       default=os.environ.get("WHISPER_LIB_DIR"), help="artifact directory or path of libwhisper.so")
+    parser.add_argument("--quantize",  default="build/bin/whisper-quantize", help="path of whisper-quantize")
+    parser.add_argument("--types",     default=",".join(QUANT_TYPES), help="comma separated types (default: all)")
+    parser.add_argument("--recipe",    action="append", default=[], help="recipe file to measure as well, may be repeated")
+    parser.add_argument("--out-dir",   default="models/sweep", help="directory of the quantized models")
+    parser.add_argument("--threads",   type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--language",  default="en")
+    parser.add_argument("--beam-size", type=int, default=0, help="beam search with this beam size, greedy if 0")
+    parser.add_argument("--json",      help="also write the results to this file")
+    parser.add_argument("--worker",    action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    corpus = list_corpus(args.corpus)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    candidates = [("f16", args.model)]
+    for name in [t.strip().lower() for t in args.types.split(",") if t.strip()]:
+        if name not in QUANT_TYPES:
+            raise SystemExit("unknown type '%s', expected one of %s" % (name, ", ".join(QUANT_TYPES)))
+        candidates.append((name, name))
+    for recipe in args.recipe:
+        candidates.append((os.path.splitext(os.path.basename(recipe))[0], recipe))
+
+    print("corpus: %d files, threads: %d, %s" % (len(corpus), args.threads,
+          "beam search %d" % args.beam_size if args.beam_size > 0 else "greedy"))
+
+    rows = []
+    ref  = None
+
+    for name, source in candidates:
+        model = args.model if name == "f16" else quantize(args, name, source)
+        if model is None:
+            continue
+
+        print("  %s ..." % name)
+        try:
+            result = measure(args, model)
+        except RuntimeError as e:
+            if ref is None:
+                raise
+            print("  ✗ %s" % e)
+            continue
+
+        if ref is None:
+            ref = {k: normalize(v) for k, v in result["texts"].items()}
+
+        n_words  = sum(len(words) for words in ref.values())
+        n_errors = sum(word_errors(ref[k], normalize(v)) for k, v in result["texts"].items())
+
+        rows.append({
+            "type":        name,
+            "size_mb":     os.path.getsize(model) / 1024.0 / 1024.0,
+            "load_ms":     result["load_ms"],
+            "rtf":         result["rtf"],
+            "peak_rss_mb": result["peak_rss_mb"],
+            "wer":         100.0 * n_errors / max(n_words, 1),
+            "texts":       result["texts"],
+        })
+
+    print("")
+    print("%-16s %9s %9s %7s %13s %7s" % ("type", "size MB", "load ms", "RTF", "peak RSS MB", "WER %"))
+    for row in rows:
+        print("%-16s %9.1f %9.1f %7.3f %13.1f %7.2f" % (
+            row["type"], row["size_mb"], row["load_ms"], row["rtf"], row["peak_rss_mb"], row["wer"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
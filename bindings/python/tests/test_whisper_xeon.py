@@ -0,0 +1,165 @@
+"""
+Tests of the whisper_xeon package against a built libwhisper.so and models/for-tests-ggml-tiny.bin.
+
+    WHISPER_LIB_DIR=build/src python3 -m pytest bindings/python/tests
+
+WHISPER_LIB_DIR is the directory of libwhisper.so (and of the libggml*.so it loads), as for load_library().
+The tests are skipped when the library cannot be loaded.
+"""
+
+import array
+import ctypes
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import whisper_xeon as wx
+
+MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "models", "for-tests-ggml-tiny.bin")
+
+
+@pytest.fixture(scope="module")
+def lib():
+    try:
+        return wx.load_library()
+    except OSError as e:
+        pytest.skip("libwhisper.so not found (set WHISPER_LIB_DIR): %s" % e)
+
+
+@pytest.fixture
+def ctx(lib):
+    ctx = wx.Context(MODEL, wx.ContextParams(use_gpu=False))
+    yield ctx
+    ctx.close()
+
+
+@pytest.mark.parametrize("getter, struct", [
+    ("whisper_context_params_fields", "ContextParams"),
+    ("whisper_full_params_fields",    "FullParams"),
+    ("whisper_token_data_fields",     "TokenData"),
+])
+def test_struct_layout(lib, getter, struct):
+    fn = getattr(lib, getter)
+
+    n_fields = ctypes.c_int(0)
+    size     = ctypes.c_size_t(0)
+    table    = fn(ctypes.byref(n_fields), ctypes.byref(size))
+
+    cls = getattr(lib, struct)
+    assert ctypes.sizeof(cls) == size.value
+    assert len(cls.field_names) == n_fields.value
+
+    for i in range(n_fields.value):
+        name = table[i].name.decode().replace(".", "_")
+        assert getattr(cls, name).offset == table[i].offset, name
+        assert getattr(cls, name).size   == table[i].size,   name
+
+
+def test_params_defaults(lib):
+    params = wx.FullParams(wx.SAMPLING_BEAM_SEARCH, n_threads=3)
+    assert params.n_threads == 3
+    assert params.beam_search_beam_size == 5
+    assert params.parallel_overlap_ms == 2000
+
+    with pytest.raises(AttributeError):
+        params.no_such_field = 1
+
+
+def test_float32_buffer_is_not_copied():
+    samples = array.array("f", [0.0]*1000)
+    ptr, n_samples, owner = wx.as_float_buffer(samples)
+    assert n_samples == 1000
+    assert ctypes.addressof(ptr.contents) == samples.buffer_info()[0]
+
+    ptr[3] = 0.5
+    assert samples[3] == 0.5
+
+
+def test_numpy_buffers():
+    np = pytest.importorskip("numpy")
+
+    samples = np.zeros(1000, dtype=np.float32)
+    ptr, n_samples, owner = wx.as_float_buffer(samples)
+    assert n_samples == 1000
+    assert ctypes.addressof(ptr.contents) == samples.ctypes.data
+
+    # float64 is converted, the values are kept
+    samples = np.linspace(-1.0, 1.0, 1000)
+    ptr, n_samples, owner = wx.as_float_buffer(samples)
+    assert n_samples == 1000
+    assert ctypes.addressof(ptr.contents) != samples.ctypes.data
+    assert np.allclose(np.ctypeslib.as_array(ptr, (n_samples,)), samples)
+
+
+def test_sequence_is_converted():
+    ptr, n_samples, owner = wx.as_float_buffer([0.25, -0.5, 1])
+    assert n_samples == 3
+    assert [ptr[i] for i in range(3)] == [0.25, -0.5, 1.0]
+
+
+def test_state_pool(ctx):
+    with ctx.new_state_pool(n_states=2) as pool:
+        assert pool.n_states == 2
+        assert pool.n_idle   == 2
+
+        a = pool.acquire()
+        with pool.acquire() as b:
+            assert pool.n_idle == 0
+            assert a._state != b._state
+
+            with pytest.raises(TimeoutError):
+                pool.acquire(timeout=0)
+
+        assert pool.n_idle == 1
+
+        a.close()
+        a.close()
+        assert pool.n_idle == 2
+
+        with pool.acquire() as state:
+            assert state.transcribe(array.array("f", [0.0]*wx.SAMPLE_RATE), wx.FullParams(n_threads=1, print_progress=False)) is not None
+
+
+def test_close_closes_children(lib):
+    ctx = wx.Context(MODEL, wx.ContextParams(use_gpu=False))
+
+    state   = ctx.new_state()
+    pool    = ctx.new_state_pool(n_states=1)
+    pooled  = pool.acquire()
+    encoder = ctx.new_encoder_batch(2)
+    decoder = ctx.new_decoder_batch(2)
+
+    ctx.close()
+
+    assert ctx._ctx       is None
+    assert state._state   is None
+    assert pooled._state  is None
+    assert pool._pool     is None
+    assert encoder._batch is None
+    assert decoder._batch is None
+
+    for use in (lambda: ctx.tokenize("a"), ctx.new_state, state.reset, pooled.reset, lambda: pool.n_idle,
+                lambda: encoder.encode([state]), decoder.step):
+        with pytest.raises(wx.WhisperError):
+            use()
+
+    # closing again is a no-op
+    ctx.close()
+    state.close()
+    pool.close()
+
+
+@pytest.mark.filterwarnings("error::pytest.PytestUnraisableExceptionWarning")
+def test_failed_init_does_not_raise_in_del(lib):
+    with pytest.raises(wx.WhisperError):
+        wx.Context(MODEL + ".missing")
+
+    ctx = wx.Context(MODEL, wx.ContextParams(use_gpu=False))
+    try:
+        with pytest.raises(wx.WhisperError):
+            ctx.new_encoder_batch(0)
+    finally:
+        ctx.close()
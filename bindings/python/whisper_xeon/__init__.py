@@ -0,0 +1,62 @@
+"""
+Python bindings for the Xeon builds of libwhisper.so.
+
+    import numpy as np
+    import whisper_xeon as wx
+
+    wx.load_library("whisper_small_xeon")
+
+    with wx.Context("whisper_small_xeon/ggml-small-q5_1.bin") as ctx:
+        params = wx.FullParams(wx.SAMPLING_GREEDY, language="en", print_progress=False)
+        for segment in ctx.transcribe(np.zeros(16000, dtype=np.float32), params):
+            print(segment.start, segment.end, segment.text)
+"""
+
+from ._lib import WhisperError, load_library
+from .whisper import (
+    GGML_TYPE_F16,
+    GGML_TYPE_Q4_0,
+    GGML_TYPE_Q8_0,
+    SAMPLE_RATE,
+    SAMPLING_GREEDY,
+    SAMPLING_BEAM_SEARCH,
+    Context,
+    ContextParams,
+    DecoderBatch,
+    EncoderBatch,
+    FullParams,
+    PooledState,
+    Segment,
+    State,
+    StatePool,
+    Token,
+    as_float_buffer,
+    lang_str,
+    system_info,
+    version,
+)
+
+__all__ = [
+    "GGML_TYPE_F16",
+    "GGML_TYPE_Q4_0",
+    "GGML_TYPE_Q8_0",
+    "SAMPLE_RATE",
+    "SAMPLING_GREEDY",
+    "SAMPLING_BEAM_SEARCH",
+    "Context",
+    "ContextParams",
+    "DecoderBatch",
+    "EncoderBatch",
+    "FullParams",
+    "PooledState",
+    "Segment",
+    "State",
+    "StatePool",
+    "Token",
+    "WhisperError",
+    "as_float_buffer",
+    "lang_str",
+    "load_library",
+    "system_info",
+    "version",
+]
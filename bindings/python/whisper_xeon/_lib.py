@@ -0,0 +1,206 @@
+"""
+Loading of libwhisper.so and the ctypes prototypes of the C API.
+
+The struct mirrors are not hard-coded here: they are generated at load time from the
+field tables exported by the library (whisper_*_fields), so a library built from a
+different whisper.h can never be driven with a stale layout.
+"""
+
+import ctypes
+import os
+import threading
+
+# order matters - libwhisper.so resolves its ggml symbols from these
+_DEPENDENCIES = ("libggml-base.so.0", "libggml-cpu.so.0", "libggml.so.0")
+
+# enum whisper_field_type -> ctypes type
+_FIELD_TYPES = (
+    ctypes.c_bool,     # WHISPER_FIELD_TYPE_BOOL
+    ctypes.c_int32,    # WHISPER_FIELD_TYPE_INT32
+    ctypes.c_int64,    # WHISPER_FIELD_TYPE_INT64
+    ctypes.c_float,    # WHISPER_FIELD_TYPE_FLOAT
+    ctypes.c_size_t,   # WHISPER_FIELD_TYPE_SIZE_T
+    ctypes.c_char_p,   # WHISPER_FIELD_TYPE_STRING
+    ctypes.c_void_p,   # WHISPER_FIELD_TYPE_PTR
+)
+
+
+class WhisperError(RuntimeError):
+    """Raised when the C library reports a failure."""
+
+
+class _FieldInfo(ctypes.Structure):
+    _fields_ = [
+        ("name",   ctypes.c_char_p),
+        ("type",   ctypes.c_int),
+        ("offset", ctypes.c_size_t),
+        ("size",   ctypes.c_size_t),
+    ]
+
+
+def _build_struct(lib, getter, name):
+    """Create a ctypes.Structure subclass matching the layout reported by the library."""
+    fn = getattr(lib, getter)
+    fn.restype  = ctypes.POINTER(_FieldInfo)
+    fn.argtypes = [ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_size_t)]
+
+    n_fields = ctypes.c_int(0)
+    size     = ctypes.c_size_t(0)
+    table    = fn(ctypes.byref(n_fields), ctypes.byref(size))
+
+    fields = []
+    names  = []
+    cur    = 0
+    for i in range(n_fields.value):
+        info  = table[i]
+        ctype = _FIELD_TYPES[info.type]
+        if ctypes.sizeof(ctype) != info.size or info.offset < cur:
+            raise WhisperError("%s: unexpected layout of field '%s'" % (name, info.name.decode()))
+        if info.offset > cur:
+            fields.append(("_pad%d" % i, ctypes.c_uint8 * (info.offset - cur)))
+        field = info.name.decode().replace(".", "_")
+        fields.append((field, ctype))
+        names.append(field)
+        cur = info.offset + info.size
+
+    if size.value > cur:
+        fields.append(("_pad_tail", ctypes.c_uint8 * (size.value - cur)))
+
+    struct = type(name, (ctypes.Structure,), {"_fields_": fields, "field_names": tuple(names)})
+    if ctypes.sizeof(struct) != size.value:
+        raise WhisperError("%s: size mismatch (%d != %d)" % (name, ctypes.sizeof(struct), size.value))
+
+    return struct
+
+
+def _setup(lib):
+    c_ctx   = ctypes.c_void_p
+    c_state = ctypes.c_void_p
+    c_pool  = ctypes.c_void_p
+    c_batch = ctypes.c_void_p
+    c_int   = ctypes.c_int
+
+    lib.ContextParams = _build_struct(lib, "whisper_context_params_fields", "ContextParams")
+    lib.FullParams    = _build_struct(lib, "whisper_full_params_fields",    "FullParams")
+    lib.TokenData     = _build_struct(lib, "whisper_token_data_fields",     "TokenData")
+
+    protos = {
+        "whisper_version":                        (ctypes.c_char_p, []),
+        "whisper_print_system_info":              (ctypes.c_char_p, []),
+        "whisper_lang_id":                        (c_int,           [ctypes.c_char_p]),
+        "whisper_lang_str":                       (ctypes.c_char_p, [c_int]),
+
+        "whisper_context_default_params_by_ref":  (ctypes.POINTER(lib.ContextParams), []),
+        "whisper_free_context_params":            (None,            [ctypes.POINTER(lib.ContextParams)]),
+        "whisper_full_default_params_by_ref":     (ctypes.POINTER(lib.FullParams), [c_int]),
+        "whisper_free_params":                    (None,            [ctypes.POINTER(lib.FullParams)]),
+
+        "whisper_init_from_file_with_params":     (c_ctx,           [ctypes.c_char_p, lib.ContextParams]),
+        "whisper_init_state":                     (c_state,         [c_ctx]),
+        "whisper_free":                           (None,            [c_ctx]),
+        "whisper_free_state":                     (None,            [c_state]),
+        "whisper_is_multilingual":                (c_int,           [c_ctx]),
+
+        "whisper_tokenize":                       (c_int,           [c_ctx, ctypes.c_char_p, ctypes.POINTER(c_int), c_int]),
+        "whisper_token_to_str":                   (ctypes.c_char_p, [c_ctx, c_int]),
+
+        "whisper_full":                           (c_int,           [c_ctx, lib.FullParams, ctypes.POINTER(ctypes.c_float), c_int]),
+        "whisper_full_with_state":                (c_int,           [c_ctx, c_state, lib.FullParams, ctypes.POINTER(ctypes.c_float), c_int]),
+        "whisper_full_parallel":                  (c_int,           [c_ctx, lib.FullParams, ctypes.POINTER(ctypes.c_float), c_int, c_int]),
+
+        "whisper_lang_detect_top_k":              (c_int,           [c_ctx, c_state, c_int, c_int, c_int, ctypes.POINTER(c_int), ctypes.POINTER(ctypes.c_float)]),
+
+        "whisper_state_reset":                    (None,            [c_state]),
+        "whisper_enc_cache_stats":                (None,            [c_ctx, ctypes.POINTER(ctypes.c_int64), ctypes.POINTER(ctypes.c_int64), ctypes.POINTER(ctypes.c_size_t)]),
+
+        "whisper_state_pool_init":                (c_pool,          [c_ctx, c_int, c_int]),
+        "whisper_state_pool_free":                (None,            [c_pool]),
+        "whisper_state_pool_acquire":             (c_state,         [c_pool, c_int]),
+        "whisper_state_pool_release":             (None,            [c_pool, c_state]),
+        "whisper_state_pool_n_states":            (c_int,           [c_pool]),
+        "whisper_state_pool_n_idle":              (c_int,           [c_pool]),
+
+        "whisper_encoder_batch_init":             (c_batch,         [c_ctx, c_int]),
+        "whisper_encoder_batch_free":             (None,            [c_batch]),
+        "whisper_encode_batch":                   (c_int,           [c_batch, ctypes.POINTER(c_state), ctypes.POINTER(c_int), c_int, c_int]),
+        "whisper_lang_detect_batch":              (c_int,           [c_batch, ctypes.POINTER(c_state), ctypes.POINTER(c_int), c_int, c_int, ctypes.POINTER(c_int), ctypes.POINTER(ctypes.c_float)]),
+
+        "whisper_decoder_batch_init":             (c_batch,         [c_ctx, c_int, c_int]),
+        "whisper_decoder_batch_free":             (None,            [c_batch]),
+        "whisper_decoder_batch_add":              (c_int,           [c_batch, c_state, lib.FullParams]),
+        "whisper_decoder_batch_step":             (c_int,           [c_batch, c_int]),
+        "whisper_decoder_batch_status":           (c_int,           [c_batch, c_int]),
+        "whisper_decoder_batch_remove":           (None,            [c_batch, c_int]),
+
+        "whisper_pcm_to_mel_append_with_state":   (c_int,           [c_ctx, c_state, ctypes.POINTER(ctypes.c_float), c_int, c_int]),
+        "whisper_pcm_to_mel_reset_with_state":    (None,            [c_state]),
+
+        "whisper_full_n_segments_from_state":     (c_int,           [c_state]),
+        "whisper_full_lang_id_from_state":        (c_int,           [c_state]),
+        "whisper_full_get_segment_t0_from_state": (ctypes.c_int64,  [c_state, c_int]),
+        "whisper_full_get_segment_t1_from_state": (ctypes.c_int64,  [c_state, c_int]),
+        "whisper_full_get_segment_text_from_state":              (ctypes.c_char_p, [c_state, c_int]),
+        "whisper_full_get_segment_no_speech_prob_from_state":    (ctypes.c_float,  [c_state, c_int]),
+        "whisper_full_get_segment_speaker_turn_next_from_state": (ctypes.c_bool,   [c_state, c_int]),
+        "whisper_full_n_tokens_from_state":       (c_int,           [c_state, c_int]),
+        "whisper_full_get_token_text_from_state": (ctypes.c_char_p, [c_ctx, c_state, c_int, c_int]),
+        "whisper_full_get_token_data_from_state": (lib.TokenData,   [c_state, c_int, c_int]),
+
+        "whisper_full_n_segments":                (c_int,           [c_ctx]),
+        "whisper_full_lang_id":                   (c_int,           [c_ctx]),
+        "whisper_full_get_segment_t0":            (ctypes.c_int64,  [c_ctx, c_int]),
+        "whisper_full_get_segment_t1":            (ctypes.c_int64,  [c_ctx, c_int]),
+        "whisper_full_get_segment_text":          (ctypes.c_char_p, [c_ctx, c_int]),
+        "whisper_full_get_segment_no_speech_prob":    (ctypes.c_float, [c_ctx, c_int]),
+        "whisper_full_get_segment_speaker_turn_next": (ctypes.c_bool,  [c_ctx, c_int]),
+        "whisper_full_n_tokens":                  (c_int,           [c_ctx, c_int]),
+        "whisper_full_get_token_text":            (ctypes.c_char_p, [c_ctx, c_int, c_int]),
+        "whisper_full_get_token_data":            (lib.TokenData,   [c_ctx, c_int, c_int]),
+    }
+
+    for fname, (restype, argtypes) in protos.items():
+        fn = getattr(lib, fname)
+        fn.restype  = restype
+        fn.argtypes = argtypes
+
+    return lib
+
+
+_lib      = None
+_lib_lock = threading.Lock()
+
+
+def load_library(path=None):
+    """
+    Load libwhisper.so and return the configured ctypes handle.
+
+    path may point to the library itself or to an artifact directory (e.g. whisper_small_xeon/).
+    If omitted, $WHISPER_LIB_DIR is used, falling back to the system loader search path.
+    The library is loaded once per process; later calls return the same handle.
+    """
+    global _lib
+
+    with _lib_lock:
+        if _lib is not None:
+            return _lib
+
+        if path is None:
+            path = os.environ.get("WHISPER_LIB_DIR")
+
+        lib_path = "libwhisper.so"
+        if path is not None:
+            if os.path.isdir(path):
+                lib_dir  = path
+                lib_path = os.path.join(path, "libwhisper.so")
+            else:
+                lib_dir  = os.path.dirname(path)
+                lib_path = path
+
+            for dep in _DEPENDENCIES:
+                dep_path = os.path.join(lib_dir, dep)
+                if os.path.exists(dep_path):
+                    ctypes.CDLL(dep_path, mode=ctypes.RTLD_GLOBAL)
+
+        _lib = _setup(ctypes.CDLL(lib_path))
+
+        return _lib
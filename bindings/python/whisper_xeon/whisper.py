@@ -0,0 +1,667 @@
+"""
+Typed Python objects over the whisper C API.
+
+Audio is passed to the library without copying whenever the input exposes a C-contiguous,
+writable float32 buffer (numpy.float32 arrays, array.array('f'), bytearray-backed memoryviews, ...).
+Anything else is converted to float32 once.
+"""
+
+import array
+import ctypes
+import sys
+import weakref
+
+from dataclasses import dataclass, field
+from typing import List
+
+from ._lib import WhisperError, load_library
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SAMPLE_RATE = 16000
+
+SAMPLING_GREEDY      = 0
+SAMPLING_BEAM_SEARCH = 1
+
+# enum ggml_type values of the KV cache types (ContextParams.kv_self_type / kv_cross_type)
+GGML_TYPE_F16  = 1
+GGML_TYPE_Q4_0 = 2
+GGML_TYPE_Q8_0 = 8
+
+_FLOAT32_FORMATS = ("f", "=f", "<f" if sys.byteorder == "little" else ">f")
+
+
+def as_float_buffer(samples):
+    """
+    Return (pointer, n_samples, owner) for the given PCM samples.
+
+    The pointer aliases the memory of samples when it is a writable, C-contiguous float32 buffer.
+    Otherwise the samples are copied into a new float32 array, in one step for buffers of other
+    types (e.g. float64 numpy arrays) when numpy is installed. owner must be kept alive for as
+    long as the pointer is used.
+    """
+    try:
+        view = memoryview(samples)
+    except TypeError:
+        view = None
+
+    if view is not None and view.format in _FLOAT32_FORMATS:
+        if view.c_contiguous and not view.readonly:
+            if view.ndim != 1:
+                view = view.cast("B").cast("f")
+            n_samples = view.nbytes // 4
+            owner = (ctypes.c_float * n_samples).from_buffer(view)
+            return ctypes.cast(owner, ctypes.POINTER(ctypes.c_float)), n_samples, owner
+
+        # read-only or strided float32 - a single memcpy
+        data = array.array("f")
+        data.frombytes(view.tobytes())
+    elif view is not None and numpy is not None:
+        # buffers of other types (float64, int16, ...) - one conversion by numpy
+        data = numpy.ascontiguousarray(samples, dtype=numpy.float32)
+        if data.ndim != 1:
+            data = data.reshape(-1)
+        if not data.flags.writeable:
+            data = data.copy()
+    else:
+        # sequences (lists, ...), or buffers of other types without numpy - convert element by element
+        data = array.array("f", samples)
+
+    n_samples = len(data)
+    owner = (ctypes.c_float * n_samples).from_buffer(data)
+
+    return ctypes.cast(owner, ctypes.POINTER(ctypes.c_float)), n_samples, owner
+
+
+class _Params(object):
+    """Attribute access over a library-generated params struct. Nested members use '_', e.g. greedy_best_of."""
+
+    __slots__ = ("_struct", "_keep")
+
+    def __init__(self, struct, **kwargs):
+        object.__setattr__(self, "_struct", struct)
+        object.__setattr__(self, "_keep",   {})
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        if name not in type(self._struct).field_names:
+            raise AttributeError(name)
+        value = getattr(self._struct, name)
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def __setattr__(self, name, value):
+        if name not in type(self._struct).field_names:
+            raise AttributeError("unknown parameter '%s'" % name)
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        if isinstance(value, bytes):
+            # the struct only stores the pointer - keep the bytes alive
+            self._keep[name] = value
+        else:
+            self._keep.pop(name, None)
+        setattr(self._struct, name, value)
+
+    def __dir__(self):
+        return list(type(self._struct).field_names)
+
+    def __repr__(self):
+        fields = ", ".join("%s=%r" % (name, getattr(self, name)) for name in type(self._struct).field_names)
+        return "%s(%s)" % (type(self).__name__, fields)
+
+
+class ContextParams(_Params):
+    """Mirror of struct whisper_context_params, initialized with the library defaults."""
+
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        lib = load_library()
+        ptr = lib.whisper_context_default_params_by_ref()
+        try:
+            struct = lib.ContextParams.from_buffer_copy(ptr.contents)
+        finally:
+            lib.whisper_free_context_params(ptr)
+        super(ContextParams, self).__init__(struct, **kwargs)
+
+
+class FullParams(_Params):
+    """Mirror of struct whisper_full_params, initialized with the library defaults for the strategy."""
+
+    __slots__ = ()
+
+    def __init__(self, strategy=SAMPLING_GREEDY, **kwargs):
+        lib = load_library()
+        ptr = lib.whisper_full_default_params_by_ref(strategy)
+        try:
+            struct = lib.FullParams.from_buffer_copy(ptr.contents)
+        finally:
+            lib.whisper_free_params(ptr)
+        super(FullParams, self).__init__(struct, **kwargs)
+
+
+@dataclass
+class Token:
+    id:    int
+    text:  str
+    p:     float
+    plog:  float
+    pt:    float
+    ptsum: float
+    tid:   int
+    t0:    int    # token-level timestamps, only set with token_timestamps
+    t1:    int
+    t_dtw: int
+    vlen:  float
+
+
+@dataclass
+class Segment:
+    t0:                int   # start time in units of 10 ms
+    t1:                int   # end time in units of 10 ms
+    text:              str
+    no_speech_prob:    float
+    speaker_turn_next: bool
+    tokens:            List[Token] = field(default_factory=list)
+
+    @property
+    def start(self):
+        return self.t0/100.0
+
+    @property
+    def end(self):
+        return self.t1/100.0
+
+
+def _read_results(lib, ctx, state, with_tokens):
+    if state is None:
+        n_segments = lib.whisper_full_n_segments(ctx)
+        get_t0     = lambda i: lib.whisper_full_get_segment_t0(ctx, i)
+        get_t1     = lambda i: lib.whisper_full_get_segment_t1(ctx, i)
+        get_text   = lambda i: lib.whisper_full_get_segment_text(ctx, i)
+        get_nsp    = lambda i: lib.whisper_full_get_segment_no_speech_prob(ctx, i)
+        get_turn   = lambda i: lib.whisper_full_get_segment_speaker_turn_next(ctx, i)
+        n_tokens   = lambda i: lib.whisper_full_n_tokens(ctx, i)
+        get_ttext  = lambda i, j: lib.whisper_full_get_token_text(ctx, i, j)
+        get_tdata  = lambda i, j: lib.whisper_full_get_token_data(ctx, i, j)
+    else:
+        n_segments = lib.whisper_full_n_segments_from_state(state)
+        get_t0     = lambda i: lib.whisper_full_get_segment_t0_from_state(state, i)
+        get_t1     = lambda i: lib.whisper_full_get_segment_t1_from_state(state, i)
+        get_text   = lambda i: lib.whisper_full_get_segment_text_from_state(state, i)
+        get_nsp    = lambda i: lib.whisper_full_get_segment_no_speech_prob_from_state(state, i)
+        get_turn   = lambda i: lib.whisper_full_get_segment_speaker_turn_next_from_state(state, i)
+        n_tokens   = lambda i: lib.whisper_full_n_tokens_from_state(state, i)
+        get_ttext  = lambda i, j: lib.whisper_full_get_token_text_from_state(ctx, state, i, j)
+        get_tdata  = lambda i, j: lib.whisper_full_get_token_data_from_state(state, i, j)
+
+    segments = []
+    for i in range(n_segments):
+        segment = Segment(
+            t0                = get_t0(i),
+            t1                = get_t1(i),
+            text              = get_text(i).decode("utf-8", errors="replace"),
+            no_speech_prob    = get_nsp(i),
+            speaker_turn_next = get_turn(i),
+        )
+        if with_tokens:
+            for j in range(n_tokens(i)):
+                data = get_tdata(i, j)
+                segment.tokens.append(Token(
+                    id    = data.id,
+                    text  = get_ttext(i, j).decode("utf-8", errors="replace"),
+                    p     = data.p,
+                    plog  = data.plog,
+                    pt    = data.pt,
+                    ptsum = data.ptsum,
+                    tid   = data.tid,
+                    t0    = data.t0,
+                    t1    = data.t1,
+                    t_dtw = data.t_dtw,
+                    vlen  = data.vlen,
+                ))
+        segments.append(segment)
+
+    return segments
+
+
+class Context(object):
+    """
+    A loaded model (struct whisper_context) together with its default state.
+
+    The default state is not thread safe - use new_state() to get one State per worker thread.
+
+    close() first closes the states, state pools and batches created from the context that are still open, as
+    they use its weights. Using them afterwards raises WhisperError.
+    """
+
+    def __init__(self, model_path, params=None, lib_path=None):
+        self._ctx      = None
+        self._children = weakref.WeakSet()
+
+        self._lib = load_library(lib_path)
+        if params is None:
+            params = ContextParams()
+
+        self._ctx = self._lib.whisper_init_from_file_with_params(model_path.encode("utf-8"), params._struct)
+        if not self._ctx:
+            raise WhisperError("failed to load model '%s'" % model_path)
+
+    def close(self):
+        if self._ctx:
+            # the batches first, they hold states of the context
+            children = sorted(self._children, key=lambda child: not isinstance(child, (EncoderBatch, DecoderBatch)))
+            for child in children:
+                child.close()
+
+            self._lib.whisper_free(self._ctx)
+            self._ctx = None
+
+    def _handle(self):
+        if not self._ctx:
+            raise WhisperError("the context is closed")
+        return self._ctx
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def is_multilingual(self):
+        return bool(self._lib.whisper_is_multilingual(self._handle()))
+
+    def tokenize(self, text):
+        """The token ids of text (str or UTF-8 bytes), without special tokens."""
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+
+        n = -self._lib.whisper_tokenize(self._handle(), text, None, 0)
+        tokens = (ctypes.c_int * n)()
+        if self._lib.whisper_tokenize(self._handle(), text, tokens, n) != n:
+            raise WhisperError("whisper_tokenize failed")
+        return list(tokens)
+
+    def token_to_bytes(self, token):
+        """The bytes of a token - they are not always valid UTF-8 on their own."""
+        return self._lib.whisper_token_to_str(self._handle(), token)
+
+    def new_state(self):
+        return State(self)
+
+    def new_state_pool(self, n_states=0, n_threads=1):
+        return StatePool(self, n_states, n_threads)
+
+    def new_encoder_batch(self, n_max):
+        return EncoderBatch(self, n_max)
+
+    def new_decoder_batch(self, n_max_requests, n_max_tokens=0):
+        return DecoderBatch(self, n_max_requests, n_max_tokens)
+
+    def transcribe(self, samples, params=None, n_processors=1, with_tokens=False):
+        """Run whisper_full (or whisper_full_parallel) on the default state and return the segments."""
+        if params is None:
+            params = FullParams()
+
+        ptr, n_samples, owner = as_float_buffer(samples)
+        if n_processors > 1:
+            ret = self._lib.whisper_full_parallel(self._handle(), params._struct, ptr, n_samples, n_processors)
+        else:
+            ret = self._lib.whisper_full(self._handle(), params._struct, ptr, n_samples)
+        del owner
+        if ret != 0:
+            raise WhisperError("whisper_full failed (%d)" % ret)
+
+        return _read_results(self._lib, self._handle(), None, with_tokens)
+
+    @property
+    def lang_id(self):
+        return self._lib.whisper_full_lang_id(self._handle())
+
+    def enc_cache_stats(self):
+        """(hits, misses, bytes in use) of the encoder cache - see ContextParams.enc_cache_size."""
+        n_hit  = ctypes.c_int64(0)
+        n_miss = ctypes.c_int64(0)
+        size   = ctypes.c_size_t(0)
+        self._lib.whisper_enc_cache_stats(self._handle(), ctypes.byref(n_hit), ctypes.byref(n_miss), ctypes.byref(size))
+        return n_hit.value, n_miss.value, size.value
+
+
+class State(object):
+    """An independent decoding state (struct whisper_state) sharing the weights of a Context."""
+
+    def __init__(self, context, _handle=None):
+        self._state   = None
+        self._context = context
+        self._lib     = context._lib
+        self._state   = _handle if _handle is not None else self._lib.whisper_init_state(context._handle())
+        if not self._state:
+            raise WhisperError("failed to initialize whisper state")
+        if _handle is None:
+            context._children.add(self)
+
+    def close(self):
+        if self._state:
+            self._context._children.discard(self)
+            self._lib.whisper_free_state(self._state)
+            self._state = None
+
+    def _handle(self):
+        if not self._state:
+            raise WhisperError("the state is closed")
+        return self._state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def append_audio(self, samples, n_threads=1):
+        """
+        Append a chunk of audio to the streamed spectrogram of the state (whisper_pcm_to_mel_append_with_state).
+
+        Only the mel frames touched by the new samples are computed. transcribe(None) decodes the audio
+        appended so far.
+        """
+        ptr, n_samples, owner = as_float_buffer(samples)
+        ret = self._lib.whisper_pcm_to_mel_append_with_state(self._context._handle(), self._handle(), ptr, n_samples, n_threads)
+        del owner
+        if ret != 0:
+            raise WhisperError("whisper_pcm_to_mel_append_with_state failed (%d)" % ret)
+
+    def reset_audio(self):
+        """Drop the streamed audio, the next append_audio() starts a new spectrogram."""
+        self._lib.whisper_pcm_to_mel_reset_with_state(self._handle())
+
+    def reset(self):
+        """Drop the results, timings and streamed audio of the previous request (whisper_state_reset), keeping the allocations."""
+        self._lib.whisper_state_reset(self._handle())
+
+    def transcribe(self, samples, params=None, with_tokens=False):
+        """
+        Run whisper_full_with_state and return the segments.
+
+        With samples=None the spectrogram already in the state (see append_audio()) is decoded.
+        """
+        if params is None:
+            params = FullParams()
+
+        if samples is None:
+            ptr, n_samples, owner = None, 0, None
+        else:
+            ptr, n_samples, owner = as_float_buffer(samples)
+        ret = self._lib.whisper_full_with_state(self._context._handle(), self._handle(), params._struct, ptr, n_samples)
+        del owner
+        if ret != 0:
+            raise WhisperError("whisper_full_with_state failed (%d)" % ret)
+
+        return _read_results(self._lib, self._context._handle(), self._handle(), with_tokens)
+
+    def detect_language(self, k=5, offset_ms=0, n_threads=1):
+        """
+        The k most probable languages of the audio in the state at offset_ms, as [(lang_str, probability), ...].
+
+        Only the logits of the language tokens are computed. A window that is already encoded is not encoded again.
+        """
+        ids   = (ctypes.c_int   * k)()
+        probs = (ctypes.c_float * k)()
+        n = self._lib.whisper_lang_detect_top_k(self._context._handle(), self._handle(), offset_ms, n_threads, k, ids, probs)
+        if n < 0:
+            raise WhisperError("whisper_lang_detect_top_k failed (%d)" % n)
+
+        return [(lang_str(ids[i]), probs[i]) for i in range(n)]
+
+    @property
+    def lang_id(self):
+        return self._lib.whisper_full_lang_id_from_state(self._handle())
+
+
+class PooledState(State):
+    """A State checked out of a StatePool. close() (or leaving the with block) returns it to the pool."""
+
+    def __init__(self, pool, handle):
+        self._state = None
+        self._pool  = pool
+        super(PooledState, self).__init__(pool._context, handle)
+        pool._children.add(self)
+
+    def close(self):
+        if self._state:
+            self._pool._children.discard(self)
+            self._lib.whisper_state_pool_release(self._pool._pool, self._state)
+            self._state = None
+
+
+class StatePool(object):
+    """
+    Preallocated states sharing the weights of one Context (struct whisper_state_pool).
+
+    n_states <= 0 creates one state per n_threads cores. acquire() blocks while all states are checked out,
+    which caps the number of concurrent requests. Released states keep their KV caches and schedulers.
+
+        pool = ctx.new_state_pool(n_threads=4)
+        with pool.acquire() as state:
+            segments = state.transcribe(pcm, params)
+    """
+
+    def __init__(self, context, n_states=0, n_threads=1):
+        self._pool     = None
+        self._children = weakref.WeakSet()
+        self._context  = context
+        self._lib      = context._lib
+        self._pool     = self._lib.whisper_state_pool_init(context._handle(), n_states, n_threads)
+        if not self._pool:
+            raise WhisperError("failed to initialize the state pool")
+        context._children.add(self)
+
+    def acquire(self, timeout=None):
+        """Check out an idle state. Raises TimeoutError if none becomes idle within timeout seconds."""
+        timeout_ms = -1 if timeout is None else max(0, int(timeout*1000))
+        handle = self._lib.whisper_state_pool_acquire(self._handle(), timeout_ms)
+        if not handle:
+            raise TimeoutError("no idle whisper state within %s s" % timeout)
+        return PooledState(self, handle)
+
+    @property
+    def n_states(self):
+        return self._lib.whisper_state_pool_n_states(self._handle())
+
+    @property
+    def n_idle(self):
+        return self._lib.whisper_state_pool_n_idle(self._handle())
+
+    def close(self):
+        if self._pool:
+            # the states that are still checked out go back to the pool first
+            for state in list(self._children):
+                state.close()
+
+            self._context._children.discard(self)
+            self._lib.whisper_state_pool_free(self._pool)
+            self._pool = None
+
+    def _handle(self):
+        if not self._pool:
+            raise WhisperError("the state pool is closed")
+        return self._pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class EncoderBatch(object):
+    """
+    Batched encoder (struct whisper_encoder_batch): encodes the spectrograms of several states as one graph.
+
+    The states must already hold their audio (State.append_audio()). transcribe(None) then decodes without
+    encoding the first window again.
+
+        batch = ctx.new_encoder_batch(4)
+        for state, pcm in zip(states, requests):
+            state.reset_audio()
+            state.append_audio(pcm)
+        batch.encode(states, n_threads=8)
+        results = [state.transcribe(None, params) for state in states]
+    """
+
+    def __init__(self, context, n_max):
+        self._batch   = None
+        self._context = context
+        self._lib     = context._lib
+        self._batch   = self._lib.whisper_encoder_batch_init(context._handle(), n_max)
+        if not self._batch:
+            raise WhisperError("failed to initialize the batched encoder")
+        context._children.add(self)
+
+    def encode(self, states, offsets=None, n_threads=1):
+        """Encode the window at offsets[i] (in mel frames, default 0) of every state into its cross-attention cache."""
+        handles = (ctypes.c_void_p * len(states))(*[state._handle() for state in states])
+        c_offsets = None
+        if offsets is not None:
+            c_offsets = (ctypes.c_int * len(states))(*offsets)
+        ret = self._lib.whisper_encode_batch(self._handle(), handles, c_offsets, len(states), n_threads)
+        if ret != 0:
+            raise WhisperError("whisper_encode_batch failed (%d)" % ret)
+
+    def detect_language(self, states, offsets=None, n_threads=1):
+        """
+        Language identification of the window at offsets[i] of every state in one pass (whisper_lang_detect_batch).
+
+        Windows that are not encoded yet are encoded as a batch and stay encoded for transcribe(None). Returns the
+        most probable language of each state as a lang_str.
+        """
+        handles = (ctypes.c_void_p * len(states))(*[state._handle() for state in states])
+        c_offsets = None
+        if offsets is not None:
+            c_offsets = (ctypes.c_int * len(states))(*offsets)
+        ids = (ctypes.c_int * len(states))()
+        ret = self._lib.whisper_lang_detect_batch(self._handle(), handles, c_offsets, len(states), n_threads, ids, None)
+        if ret != 0:
+            raise WhisperError("whisper_lang_detect_batch failed (%d)" % ret)
+
+        return [lang_str(lang_id) for lang_id in ids]
+
+    def close(self):
+        if self._batch:
+            self._context._children.discard(self)
+            self._lib.whisper_encoder_batch_free(self._batch)
+            self._batch = None
+
+    def _handle(self):
+        if not self._batch:
+            raise WhisperError("the batched encoder is closed")
+        return self._batch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+class DecoderBatch(object):
+    """
+    Continuous batching decoder (struct whisper_decoder_batch): decodes the encoded window of many states with
+    one decoder call per step over a shared KV cache. Requests join between two steps and leave when finished.
+
+    Greedy sampling of one window per request only. A request with status() == -1 has to be decoded again
+    with State.transcribe(None, params), which has the temperature fallback.
+
+        batch = ctx.new_decoder_batch(8)
+        ids = [batch.add(state, params) for state in encoded_states]
+        while batch.step(n_threads=8) > 0:
+            pass  # add() new requests here
+        results = [batch.segments(i) for i in ids]
+    """
+
+    def __init__(self, context, n_max_requests, n_max_tokens=0):
+        self._batch   = None
+        self._context = context
+        self._lib     = context._lib
+        self._states  = {}
+        self._batch   = self._lib.whisper_decoder_batch_init(context._handle(), n_max_requests, n_max_tokens)
+        if not self._batch:
+            raise WhisperError("failed to initialize the batched decoder")
+        context._children.add(self)
+
+    def add(self, state, params):
+        """Queue the window in the cross-attention cache of state and return the id of the request."""
+        id = self._lib.whisper_decoder_batch_add(self._handle(), state._handle(), params._struct)
+        if id < 0:
+            raise WhisperError("whisper_decoder_batch_add failed (the batch is full or the parameters are not supported)")
+        self._states[id] = state
+        return id
+
+    def step(self, n_threads=1):
+        """Decode one token of every running request. Returns the number of requests that are not finished."""
+        ret = self._lib.whisper_decoder_batch_step(self._handle(), n_threads)
+        if ret < 0:
+            raise WhisperError("whisper_decoder_batch_step failed (%d)" % ret)
+        return ret
+
+    def status(self, id):
+        """0 - running, 1 - done, -1 - failed."""
+        return self._lib.whisper_decoder_batch_status(self._handle(), id)
+
+    def segments(self, id, with_tokens=False):
+        """The segments of a finished request."""
+        return _read_results(self._lib, self._context._handle(), self._states[id]._handle(), with_tokens)
+
+    def remove(self, id):
+        """Release the id and its part of the KV cache."""
+        self._lib.whisper_decoder_batch_remove(self._handle(), id)
+        self._states.pop(id, None)
+
+    def close(self):
+        if self._batch:
+            self._context._children.discard(self)
+            self._lib.whisper_decoder_batch_free(self._batch)
+            self._batch = None
+            self._states.clear()
+
+    def _handle(self):
+        if not self._batch:
+            raise WhisperError("the batched decoder is closed")
+        return self._batch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def lang_str(lang_id):
+    value = load_library().whisper_lang_str(lang_id)
+    return value.decode("utf-8") if value is not None else None
+
+
+def system_info():
+    return load_library().whisper_print_system_info().decode("utf-8")
+
+
+def version():
+    return load_library().whisper_version().decode("utf-8")
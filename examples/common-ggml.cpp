@@ -1,7 +1,17 @@
 #include "common-ggml.h"
 
-#include <regex>
+#include <algorithm>
+#include <atomic>
+#include <cctype>
+#include <cmath>
+#include <condition_variable>
+#include <deque>
 #include <map>
+#include <memory>
+#include <mutex>
+#include <regex>
+#include <sstream>
+#include <thread>
 
 static const std::map<std::string, enum ggml_ftype> GGML_FTYPE_MAP = {
     {"q4_0", GGML_FTYPE_MOSTLY_Q4_0},
@@ -38,12 +48,542 @@ enum ggml_ftype ggml_parse_ftype(const char * str) {
     return ftype;
 }
 
+bool ggml_common_is_ftype(const char * str) {
+    if (GGML_FTYPE_MAP.count(str) > 0) {
+        return true;
+    }
+
+    if (str[0] == '\0') {
+        return false;
+    }
+
+    for (const char * p = str; *p; ++p) {
+        if (!isdigit((unsigned char) *p)) {
+            return false;
+        }
+    }
+
+    return true;
+}
+
+namespace {
+
+// a tensor of the model file on its way through ggml_common_quantize()
+struct ggml_common_tensor {
+    int32_t n_dims = 0;
+    int32_t ttype  = 0; // type in the input file
+    int32_t ne[4]  = { 1, 1, 1, 1 };
+
+    std::string name;
+
+    ggml_type type      = GGML_TYPE_COUNT; // type in the output file
+    ggml_type type_rule = GGML_TYPE_COUNT; // type of the matching rule, when it does not fit the rows
+
+    std::vector<uint8_t> data; // the data of the input file, replaced by the converted data
+
+    // error of the conversion
+    double err_sum2 = 0.0;
+    double src_sum2 = 0.0;
+    float  err_max  = 0.0f;
+
+    bool convert() const { return type != (ggml_type) ttype; }
+};
+
+// bounded FIFO between two stages of the pipeline, so that the memory use does not depend on the size of the model
+// push() blocks while the queue is full, pop() while it is empty. nullptr marks the end of the stream
+class ggml_common_queue {
+public:
+    explicit ggml_common_queue(size_t n_max) : n_max(n_max) {}
+
+    void push(std::unique_ptr<ggml_common_tensor> t) {
+        std::unique_lock<std::mutex> lock(mutex);
+        cv.wait(lock, [&]() { return items.size() < n_max; });
+        items.push_back(std::move(t));
+        cv.notify_all();
+    }
+
+    std::unique_ptr<ggml_common_tensor> pop() {
+        std::unique_lock<std::mutex> lock(mutex);
+        cv.wait(lock, [&]() { return !items.empty(); });
+        std::unique_ptr<ggml_common_tensor> t = std::move(items.front());
+        items.pop_front();
+        cv.notify_all();
+        return t;
+    }
+
+private:
+    const size_t n_max;
+
+    std::mutex              mutex;
+    std::condition_variable cv;
+
+    std::deque<std::unique_ptr<ggml_common_tensor>> items;
+};
+
+// the rules and the skipped names, with their regexes compiled once
+struct ggml_common_recipe {
+    std::vector<std::pair<std::regex, ggml_type>> rules;
+    std::vector<std::regex>                       skip;
+
+    ggml_common_recipe(const std::vector<ggml_common_quant_rule> & rules, const std::vector<std::string> & to_skip) {
+        for (const auto & rule : rules) {
+            this->rules.emplace_back(std::regex(rule.pattern), rule.type);
+        }
+        for (const auto & s : to_skip) {
+            skip.emplace_back(s);
+        }
+    }
+};
+
+}
+
+static bool ggml_common_is_float(ggml_type type) {
+    return type == GGML_TYPE_F32 || type == GGML_TYPE_F16;
+}
+
+// read the header of the next tensor, false at the end of the file or if the header is invalid (finp is then not at eof)
+// with has_pad, the name is followed by an int32 n_pad and n_pad bytes, which are skipped
+static bool ggml_common_read_header(std::ifstream & finp, ggml_common_tensor & t, bool has_pad) {
+    t = ggml_common_tensor();
+
+    int32_t length;
+
+    finp.read(reinterpret_cast<char *>(&t.n_dims), sizeof(t.n_dims));
+    finp.read(reinterpret_cast<char *>(&length),   sizeof(length));
+    finp.read(reinterpret_cast<char *>(&t.ttype),  sizeof(t.ttype));
+
+    if (finp.eof()) {
+        return false;
+    }
+
+    if (t.n_dims < 0 || t.n_dims > 4 || length < 0) {
+        fprintf(stderr, "%s: invalid tensor header (n_dims = %d, length = %d)\n", __func__, t.n_dims, length);
+        return false;
+    }
+
+    for (int i = 0; i < t.n_dims; ++i) {
+        finp.read (reinterpret_cast<char *>(&t.ne[i]), sizeof(t.ne[i]));
+    }
+
+    t.name.resize(length);
+    finp.read (&t.name[0], length);
+
+    // drop the '\0' padding of the names written by earlier versions
+    t.name.erase(t.name.find_last_not_of('\0') + 1);
+
+    if (has_pad) {
+        int32_t n_pad = 0;
+        finp.read(reinterpret_cast<char *>(&n_pad), sizeof(n_pad));
+
+        if (n_pad < 0) {
+            fprintf(stderr, "%s: invalid padding %d of tensor '%s'\n", __func__, n_pad, t.name.c_str());
+            return false;
+        }
+
+        finp.seekg(n_pad, std::ios::cur);
+    }
+
+    return true;
+}
+
+// the type used instead of type when the rows of n_per_row values are not a multiple of its block size
+// the k-quants need multiples of 256, which e.g. the 384 wide tensors of the tiny models are not
+static ggml_type ggml_common_fallback_type(ggml_type type, int64_t n_per_row) {
+    if (n_per_row % ggml_blck_size(type) == 0) {
+        return type;
+    }
+
+    switch (type) {
+        case GGML_TYPE_Q2_K:
+        case GGML_TYPE_Q3_K: type = GGML_TYPE_Q4_0; break;
+        case GGML_TYPE_Q4_K: type = GGML_TYPE_Q5_0; break;
+        case GGML_TYPE_Q5_K: type = GGML_TYPE_Q5_1; break;
+        case GGML_TYPE_Q6_K: type = GGML_TYPE_Q8_0; break;
+        default:             type = GGML_TYPE_F16;  break;
+    }
+
+    return n_per_row % ggml_blck_size(type) == 0 ? type : GGML_TYPE_F16;
+}
+
+// set the type of t in the output file
+static bool ggml_common_select_type(const ggml_common_recipe & recipe, ggml_common_tensor & t) {
+    if (t.ttype < 0 || t.ttype >= GGML_TYPE_COUNT || ggml_blck_size((ggml_type) t.ttype) == 0) {
+        fprintf(stderr, "%s: tensor '%s' has invalid type %d\n", __func__, t.name.c_str(), t.ttype);
+        return false;
+    }
+
+    t.type = (ggml_type) t.ttype;
+
+    // convert only 2D tensors
+    if (t.n_dims != 2) {
+        return true;
+    }
+
+    for (const auto & re : recipe.skip) {
+        if (std::regex_match(t.name, re)) {
+            return true;
+        }
+    }
+
+    for (const auto & rule : recipe.rules) {
+        if (std::regex_match(t.name, rule.first)) {
+            t.type = rule.second;
+            break;
+        }
+    }
+
+    const ggml_type type = ggml_common_fallback_type(t.type, t.ne[0]);
+    if (type != t.type) {
+        t.type_rule = t.type;
+        t.type      = type;
+    }
+
+    if (t.convert() && !ggml_common_is_float((ggml_type) t.ttype)) {
+        fprintf(stderr, "%s: unsupported ttype %d (%s) for integer quantization\n", __func__, t.ttype, ggml_type_name((ggml_type) t.ttype));
+        return false;
+    }
+
+    return true;
+}
+
+static ggml_type ggml_common_parse_type(const std::string & str) {
+    std::string name = str;
+    std::transform(name.begin(), name.end(), name.begin(), ::tolower);
+
+    for (int i = 0; i < GGML_TYPE_COUNT; ++i) {
+        const ggml_type type = (ggml_type) i;
+        if (ggml_blck_size(type) == 0 || ggml_quantize_requires_imatrix(type)) {
+            continue;
+        }
+        if (!ggml_is_quantized(type) && type != GGML_TYPE_F32 && type != GGML_TYPE_F16 && type != GGML_TYPE_BF16) {
+            continue;
+        }
+
+        std::string type_name = ggml_type_name(type);
+        std::transform(type_name.begin(), type_name.end(), type_name.begin(), ::tolower);
+
+        if (name == type_name) {
+            return type;
+        }
+    }
+
+    return GGML_TYPE_COUNT;
+}
+
+bool ggml_common_read_recipe(const std::string & fname, std::vector<ggml_common_quant_rule> & rules) {
+    std::ifstream fin(fname);
+    if (!fin) {
+        fprintf(stderr, "%s: failed to open '%s'\n", __func__, fname.c_str());
+        return false;
+    }
+
+    rules.clear();
+
+    std::string line;
+    for (int i = 1; std::getline(fin, line); ++i) {
+        std::istringstream iss(line);
+
+        std::string pattern;
+        std::string type_name;
+        std::string rest;
+
+        if (!(iss >> pattern) || pattern[0] == '#') {
+            continue;
+        }
+
+        iss >> type_name >> rest;
+
+        const ggml_type type = ggml_common_parse_type(type_name);
+        if (type == GGML_TYPE_COUNT || (!rest.empty() && rest[0] != '#')) {
+            fprintf(stderr, "%s: %s:%d: expected '<regex> <type>', got '%s'\n", __func__, fname.c_str(), i, line.c_str());
+            return false;
+        }
+
+        try {
+            std::regex re(pattern);
+        } catch (const std::regex_error & e) {
+            fprintf(stderr, "%s: %s:%d: invalid regex '%s': %s\n", __func__, fname.c_str(), i, pattern.c_str(), e.what());
+            return false;
+        }
+
+        rules.push_back({ pattern, type });
+    }
+
+    if (rules.empty()) {
+        fprintf(stderr, "%s: no rules in '%s'\n", __func__, fname.c_str());
+        return false;
+    }
+
+    return true;
+}
+
+bool ggml_common_quantize_types(
+        std::ifstream & finp,
+        const std::vector<ggml_common_quant_rule> & rules,
+        const std::vector<std::string> & to_skip,
+        std::vector<std::pair<std::string, ggml_type>> & types,
+        bool has_pad) {
+    const ggml_common_recipe recipe(rules, to_skip);
+
+    const std::streampos pos = finp.tellg();
+
+    types.clear();
+
+    bool ok = true;
+
+    ggml_common_tensor t;
+    while (ok) {
+        if (!ggml_common_read_header(finp, t, has_pad)) {
+            ok = finp.eof();
+            break;
+        }
+
+        ok = ggml_common_select_type(recipe, t);
+        if (ok) {
+            types.emplace_back(t.name, t.type);
+
+            finp.seekg(ggml_row_size((ggml_type) t.ttype, t.ne[0])*t.ne[1]*t.ne[2]*t.ne[3], std::ios::cur);
+        }
+    }
+
+    finp.clear();
+    finp.seekg(pos);
+
+    return ok;
+}
+
+// convert the n_rows rows of f32 or f16 data of t to t.type, in blocks of rows on n_threads threads
+static void ggml_common_quantize_rows(ggml_common_tensor & t, uint8_t * dst, int n_threads) {
+    const int64_t n_per_row = t.ne[0];
+    const int64_t n_rows    = t.ne[1];
+
+    // ~256k values per block, enough to amortize the scheduling
+    const int64_t n_rows_block = std::max<int64_t>(1, (256*1024)/n_per_row);
+    const size_t  row_size     = ggml_row_size(t.type, n_per_row);
+
+    // f32 is exact, the other types are converted back to measure the error
+    const ggml_to_float_t to_float = t.type == GGML_TYPE_F32 ? nullptr : ggml_get_type_traits(t.type)->to_float;
+
+    const uint8_t * src = t.data.data();
+
+    std::atomic<int64_t> next(0);
+    std::mutex           mutex;
+
+    const auto worker = [&]() {
+        std::vector<float> f32;
+        std::vector<float> out;
+
+        double err_sum2 = 0.0;
+        double src_sum2 = 0.0;
+        float  err_max  = 0.0f;
+
+        while (true) {
+            const int64_t r0 = next.fetch_add(n_rows_block);
+            if (r0 >= n_rows) {
+                break;
+            }
+
+            const int64_t nr = std::min(n_rows_block, n_rows - r0);
+            const int64_t n  = nr*n_per_row;
+
+            const float * x = reinterpret_cast<const float *>(src) + r0*n_per_row;
+
+            if (t.ttype == GGML_TYPE_F16) {
+                f32.resize(n);
+                ggml_fp16_to_fp32_row(reinterpret_cast<const ggml_fp16_t *>(src) + r0*n_per_row, f32.data(), n);
+                x = f32.data();
+            }
+
+            ggml_quantize_chunk(t.type, x, dst + r0*row_size, 0, nr, n_per_row, nullptr);
+
+            if (to_float) {
+                out.resize(n);
+                to_float(dst + r0*row_size, out.data(), n);
+
+                for (int64_t i = 0; i < n; ++i) {
+                    const float err = out[i] - x[i];
+
+                    err_sum2 += (double) err*err;
+                    src_sum2 += (double) x[i]*x[i];
+                    err_max   = std::max(err_max, std::fabs(err));
+                }
+            }
+        }
+
+        std::lock_guard<std::mutex> lock(mutex);
+
+        t.err_sum2 += err_sum2;
+        t.src_sum2 += src_sum2;
+        t.err_max   = std::max(t.err_max, err_max);
+    };
+
+    const int n_workers = (int) std::min<int64_t>(n_threads, (n_rows + n_rows_block - 1)/n_rows_block);
+
+    std::vector<std::thread> workers;
+    for (int i = 1; i < n_workers; ++i) {
+        workers.emplace_back(worker);
+    }
+
+    worker();
+
+    for (auto & w : workers) {
+        w.join();
+    }
+}
+
+bool ggml_common_quantize(
+        std::ifstream & finp,
+        std::ofstream & fout,
+        const std::vector<ggml_common_quant_rule> & rules,
+        const std::vector<std::string> & to_skip,
+        int n_threads,
+        bool has_pad) {
+    if (n_threads <= 0) {
+        n_threads = std::max(1u, std::thread::hardware_concurrency());
+    }
+
+    const ggml_common_recipe recipe(rules, to_skip);
+
+    size_t total_size_org = 0;
+    size_t total_size_new = 0;
+
+    // number of tensors and bytes per output type
+    std::map<ggml_type, std::pair<int, size_t>> type_stats;
+
+    std::atomic<bool> failed(false);
+
+    ggml_common_queue q_read (2);
+    ggml_common_queue q_write(2);
+
+    // read-ahead: the next tensors are read while the current one is quantized
+    std::thread reader([&]() {
+        while (!failed) {
+            std::unique_ptr<ggml_common_tensor> t(new ggml_common_tensor);
+
+            if (!ggml_common_read_header(finp, *t, has_pad)) {
+                failed = !finp.eof();
+                break;
+            }
+
+            if (!ggml_common_select_type(recipe, *t)) {
+                failed = true;
+                break;
+            }
+
+            t->data.resize(ggml_row_size((ggml_type) t->ttype, t->ne[0])*t->ne[1]*t->ne[2]*t->ne[3]);
+            finp.read(reinterpret_cast<char *>(t->data.data()), t->data.size());
+
+            q_read.push(std::move(t));
+        }
+
+        q_read.push(nullptr);
+    });
+
+    // write-behind: the quantized tensors are written in order while the next ones are quantized
+    std::thread writer([&]() {
+        while (auto t = q_write.pop()) {
+            if (failed) {
+                continue;
+            }
+
+            const int32_t nelements = t->ne[0]*t->ne[1]*t->ne[2]*t->ne[3];
+
+            printf("%64s - [%5d, %5d, %5d], type = %6s", t->name.data(), t->ne[0], t->ne[1], t->ne[2], ggml_type_name((ggml_type) t->ttype));
+
+            const std::string name   = t->name;
+            const int32_t     ttype  = t->type;
+
+            const int32_t length = t->name.size();
+
+            // the padding after the name makes the tensor data start at an aligned file offset
+            // this allows the loader to map the data directly instead of copying it
+            const int64_t offs  = (int64_t) fout.tellp() + (4 + t->n_dims)*sizeof(int32_t) + length;
+            const int32_t n_pad = (GGML_COMMON_TENSOR_ALIGNMENT - offs % GGML_COMMON_TENSOR_ALIGNMENT) % GGML_COMMON_TENSOR_ALIGNMENT;
+
+            const char pad[GGML_COMMON_TENSOR_ALIGNMENT] = { 0 };
+
+            fout.write(reinterpret_cast<const char *>(&t->n_dims), sizeof(t->n_dims));
+            fout.write(reinterpret_cast<const char *>(&length),    sizeof(length));
+            fout.write(reinterpret_cast<const char *>(&ttype),     sizeof(ttype));
+            for (int i = 0; i < t->n_dims; ++i) {
+                fout.write(reinterpret_cast<const char *>(&t->ne[i]), sizeof(t->ne[i]));
+            }
+            fout.write(&t->name[0], length);
+            fout.write(reinterpret_cast<const char *>(&n_pad),     sizeof(n_pad));
+            fout.write(pad, n_pad);
+
+            fout.write(reinterpret_cast<const char *>(t->data.data()), t->data.size());
+
+            if (!fout) {
+                fprintf(stderr, "%s: failed to write tensor '%s'\n", __func__, name.c_str());
+                failed = true;
+                continue;
+            }
+
+            if (t->convert()) {
+                printf(" -> %6s, size = %8.2f MB -> %8.2f MB", ggml_type_name(t->type), nelements * sizeof(float)/1024.0/1024.0, t->data.size()/1024.0/1024.0);
+                if (t->src_sum2 > 0.0) {
+                    const double n = nelements;
+                    printf(", rmse = %.2e (%6.3f%%), max = %.2e", sqrt(t->err_sum2/n), 100.0*sqrt(t->err_sum2/t->src_sum2), t->err_max);
+                }
+                if (t->type_rule != GGML_TYPE_COUNT) {
+                    printf(" (%s does not fit rows of %d)", ggml_type_name(t->type_rule), t->ne[0]);
+                }
+                printf("\n");
+            } else {
+                printf(", size = %8.3f MB\n", t->data.size()/1024.0/1024.0);
+            }
+
+            total_size_new += t->data.size();
+            total_size_org += nelements * sizeof(float);
+
+            type_stats[t->type].first  += 1;
+            type_stats[t->type].second += t->data.size();
+        }
+    });
+
+    // quantize the tensors in the order of the file, each one on n_threads threads
+    std::vector<uint8_t> work;
+
+    while (auto t = q_read.pop()) {
+        if (t->convert() && !failed) {
+            work.resize(t->ne[1]*ggml_row_size(t->type, t->ne[0]));
+
+            ggml_common_quantize_rows(*t, work.data(), n_threads);
+
+            t->data.swap(work);
+        }
+
+        q_write.push(std::move(t));
+    }
+
+    q_write.push(nullptr);
+
+    reader.join();
+    writer.join();
+
+    if (failed) {
+        return false;
+    }
+
+    printf("%s: model size  = %8.2f MB\n", __func__, total_size_org/1024.0/1024.0);
+    printf("%s: quant size  = %8.2f MB\n", __func__, total_size_new/1024.0/1024.0);
+
+    for (const auto & it : type_stats) {
+        printf("%s: %11s = %8.2f MB (%d tensors)\n", __func__, ggml_type_name(it.first), it.second.second/1024.0/1024.0, it.second.first);
+    }
+
+    return true;
+}
+
 bool ggml_common_quantize_0(
         std::ifstream & finp,
         std::ofstream & fout,
         const ggml_ftype ftype,
         const std::vector<std::string> & to_quant,
-        const std::vector<std::string> & to_skip) {
+        const std::vector<std::string> & to_skip,
+        int n_threads,
+        bool has_pad) {
 
     ggml_type qtype = GGML_TYPE_F32;
 
@@ -84,157 +624,10 @@ bool ggml_common_quantize_0(
         return false;
     }
 
-    size_t total_size_org = 0;
-    size_t total_size_new = 0;
-
-    std::vector<float> work;
-
-    std::vector<uint8_t>     data_u8;
-    std::vector<ggml_fp16_t> data_f16;
-    std::vector<float>       data_f32;
-
-    while (true) {
-        int32_t n_dims;
-        int32_t length;
-        int32_t ttype;
-
-        finp.read(reinterpret_cast<char *>(&n_dims), sizeof(n_dims));
-        finp.read(reinterpret_cast<char *>(&length), sizeof(length));
-        finp.read(reinterpret_cast<char *>(&ttype),  sizeof(ttype));
-
-        if (finp.eof()) {
-            break;
-        }
-
-        int32_t nelements = 1;
-        int32_t ne[4] = { 1, 1, 1, 1 };
-        for (int i = 0; i < n_dims; ++i) {
-            finp.read (reinterpret_cast<char *>(&ne[i]), sizeof(ne[i]));
-            nelements *= ne[i];
-        }
-
-        std::string name(length, 0);
-        finp.read (&name[0], length);
-
-        printf("%64s - [%5d, %5d, %5d], type = %6s ", name.data(), ne[0], ne[1], ne[2], ggml_type_name((ggml_type) ttype));
-
-        bool quantize = false;
-
-        // check if we should quantize this tensor
-        for (const auto & s : to_quant) {
-            if (std::regex_match(name, std::regex(s))) {
-                quantize = true;
-                break;
-            }
-        }
-
-        // check if we should skip this tensor
-        for (const auto & s : to_skip) {
-            if (std::regex_match(name, std::regex(s))) {
-                quantize = false;
-                break;
-            }
-        }
-
-        // quantize only 2D tensors
-        quantize &= (n_dims == 2);
-
-        if (quantize) {
-            if (ttype != GGML_TYPE_F32 && ttype != GGML_TYPE_F16) {
-                fprintf(stderr, "%s: unsupported ttype %d (%s) for integer quantization\n", __func__, ttype, ggml_type_name((ggml_type) ttype));
-                return false;
-            }
-
-            if (ttype == GGML_TYPE_F16) {
-                data_f16.resize(nelements);
-                finp.read(reinterpret_cast<char *>(data_f16.data()), nelements * sizeof(ggml_fp16_t));
-                data_f32.resize(nelements);
-                for (int i = 0; i < nelements; ++i) {
-                    data_f32[i] = ggml_fp16_to_fp32(data_f16[i]);
-                }
-            } else {
-                data_f32.resize(nelements);
-                finp.read(reinterpret_cast<char *>(data_f32.data()), nelements * sizeof(float));
-            }
-
-            ttype = qtype;
-        } else {
-            const int bpe = (ttype == 0) ? sizeof(float) : sizeof(uint16_t);
-
-            data_u8.resize(nelements*bpe);
-            finp.read(reinterpret_cast<char *>(data_u8.data()), nelements * bpe);
-        }
-
-        fout.write(reinterpret_cast<char *>(&n_dims), sizeof(n_dims));
-        fout.write(reinterpret_cast<char *>(&length), sizeof(length));
-        fout.write(reinterpret_cast<char *>(&ttype),  sizeof(ttype));
-        for (int i = 0; i < n_dims; ++i) {
-            fout.write(reinterpret_cast<char *>(&ne[i]), sizeof(ne[i]));
-        }
-        fout.write(&name[0], length);
-
-        if (quantize) {
-            work.resize(nelements); // for quantization
-
-            size_t cur_size = 0;
-            switch ((ggml_type) ttype) {
-                case GGML_TYPE_Q4_0:
-                case GGML_TYPE_Q4_1:
-                case GGML_TYPE_Q5_0:
-                case GGML_TYPE_Q5_1:
-                case GGML_TYPE_Q8_0:
-                case GGML_TYPE_Q2_K:
-                case GGML_TYPE_Q3_K:
-                case GGML_TYPE_Q4_K:
-                case GGML_TYPE_Q5_K:
-                case GGML_TYPE_Q6_K:
-                    {
-                        cur_size = ggml_quantize_chunk((ggml_type) ttype, data_f32.data(), work.data(), 0, nelements/ne[0], ne[0], nullptr);
-                    } break;
-                case GGML_TYPE_F32:
-                case GGML_TYPE_F16:
-                case GGML_TYPE_I8:
-                case GGML_TYPE_I16:
-                case GGML_TYPE_I32:
-                case GGML_TYPE_I64:
-                case GGML_TYPE_F64:
-                case GGML_TYPE_Q8_1:
-                case GGML_TYPE_Q8_K:
-                case GGML_TYPE_IQ2_XXS:
-                case GGML_TYPE_IQ2_XS:
-                case GGML_TYPE_IQ2_S:
-                case GGML_TYPE_IQ3_XXS:
-                case GGML_TYPE_IQ3_S:
-                case GGML_TYPE_IQ1_S:
-                case GGML_TYPE_IQ4_NL:
-                case GGML_TYPE_IQ4_XS:
-                case GGML_TYPE_IQ1_M:
-                case GGML_TYPE_BF16:
-                case GGML_TYPE_TQ1_0:
-                case GGML_TYPE_TQ2_0:
-                case GGML_TYPE_MXFP4:
-                case GGML_TYPE_COUNT:
-                    {
-                        fprintf(stderr, "%s: unsupported quantization type %d (%s)\n", __func__, ttype, ggml_type_name((ggml_type) ttype));
-                        return false;
-                    }
-            }
-
-            fout.write(reinterpret_cast<char *>(work.data()), cur_size);
-            total_size_new += cur_size;
-
-            printf("size = %8.2f MB -> %8.2f MB\n", nelements * sizeof(float)/1024.0/1024.0, cur_size/1024.0/1024.0);
-        } else {
-            printf("size = %8.3f MB\n", data_u8.size()/1024.0/1024.0);
-            fout.write(reinterpret_cast<char *>(data_u8.data()), data_u8.size());
-            total_size_new += data_u8.size();
-        }
-
-        total_size_org += nelements * sizeof(float);
+    std::vector<ggml_common_quant_rule> rules;
+    for (const auto & s : to_quant) {
+        rules.push_back({ s, qtype });
     }
 
-    printf("%s: model size  = %8.2f MB\n", __func__, total_size_org/1024.0/1024.0);
-    printf("%s: quant size  = %8.2f MB | ftype = %d (%s)\n", __func__, total_size_new/1024.0/1024.0, ftype, ggml_type_name(qtype));
-
-    return true;
+    return ggml_common_quantize(finp, fout, rules, to_skip, n_threads, has_pad);
 }
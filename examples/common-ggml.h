@@ -3,16 +3,59 @@
 #include "ggml.h"
 
 #include <fstream>
-#include <vector>
 #include <string>
+#include <utility>
+#include <vector>
+
+// alignment of the tensor data in the files written by ggml_common_quantize()
+// matches the ggml CPU buffers, so that a loader can use the data of a mapped file in place
+// the name of each tensor is followed by an int32 n_pad and n_pad zero bytes, the caller flags this in its header
+#define GGML_COMMON_TENSOR_ALIGNMENT 32
 
 enum ggml_ftype ggml_parse_ftype(const char * str);
 
+// str is a type that ggml_parse_ftype() accepts: one of the names of ggml_print_ftypes() or a number
+bool ggml_common_is_ftype(const char * str);
+
 void ggml_print_ftypes(FILE * fp = stderr);
 
+// a rule of a quantization recipe: the 2D tensors whose name matches pattern are written as type
+struct ggml_common_quant_rule {
+    std::string pattern;
+    ggml_type   type;
+};
+
+// read a recipe file - one "<regex> <type>" rule per line, e.g. "decoder\.token_embedding\.weight q8_0"
+// empty lines and lines starting with '#' are ignored
+bool ggml_common_read_recipe(const std::string & fname, std::vector<ggml_common_quant_rule> & rules);
+
+// the name and the type in the output of ggml_common_quantize() of every tensor of finp
+// only the tensor headers are read, finp is left where it was
+// has_pad - the tensor names of finp are followed by a padding, as in the output of ggml_common_quantize()
+bool ggml_common_quantize_types(
+        std::ifstream & finp,
+        const std::vector<ggml_common_quant_rule> & rules,
+        const std::vector<std::string> & to_skip,
+        std::vector<std::pair<std::string, ggml_type>> & types,
+        bool has_pad = false);
+
+// write the tensors of finp to fout, each 2D tensor in the type of the first rule that matches its name
+// tensors that match no rule or one of to_skip are copied. rows that do not fit the block size of a
+// k-quant are written in the nearest legacy type. prints the size and the error of every converted tensor
+bool ggml_common_quantize(
+        std::ifstream & finp,
+        std::ofstream & fout,
+        const std::vector<ggml_common_quant_rule> & rules,
+        const std::vector<std::string> & to_skip,
+        int n_threads = 0,    // 0 - all cores
+        bool has_pad = false); // see ggml_common_quantize_types()
+
+// all the tensors matching to_quant in the type of ftype
 bool ggml_common_quantize_0(
         std::ifstream & finp,
         std::ofstream & fout,
         const ggml_ftype ftype,
         const std::vector<std::string> & to_quant,
-        const std::vector<std::string> & to_skip);
+        const std::vector<std::string> & to_skip,
+        int n_threads = 0,    // 0 - all cores
+        bool has_pad = false); // see ggml_common_quantize_types()
@@ -1,12 +1,15 @@
 #include "ggml.h"
 #include "ggml-backend.h"
 
+#include "whisper.h"
+
 #include "common.h"
 #include "common-ggml.h"
 
 #include <cassert>
 #include <cmath>
 #include <cstdio>
+#include <cstdlib>
 #include <cstring>
 #include <fstream>
 #include <map>
@@ -36,8 +39,13 @@ struct whisper_filters {
     std::vector<float> data;
 };
 
-// quantize a model
-static bool whisper_model_quantize(const std::string & fname_inp, const std::string & fname_out, ggml_ftype ftype) {
+// quantize a model, either all the tensors to ftype or each one to the type of the rules of a recipe
+static bool whisper_model_quantize(
+        const std::string & fname_inp,
+        const std::string & fname_out,
+        ggml_ftype ftype,
+        const std::vector<ggml_common_quant_rule> & rules,
+        int n_threads) {
     gpt_vocab vocab;
 
     printf("%s: loading model from '%s'\n", __func__, fname_inp.c_str());
@@ -68,6 +76,9 @@ static bool whisper_model_quantize(const std::string & fname_inp, const std::str
 
     whisper_hparams hparams;
 
+    bool has_types_src = false;
+    bool has_pad_src   = false;
+
     // load hparams
     {
         finp.read((char *) &hparams.n_vocab,       sizeof(hparams.n_vocab));
@@ -82,8 +93,17 @@ static bool whisper_model_quantize(const std::string & fname_inp, const std::str
         finp.read((char *) &hparams.n_mels,        sizeof(hparams.n_mels));
         finp.read((char *) &hparams.ftype,         sizeof(hparams.ftype));
 
-        const int32_t qntvr_src =    hparams.ftype / GGML_QNT_VERSION_FACTOR;
-        const int32_t ftype_dst = GGML_QNT_VERSION * GGML_QNT_VERSION_FACTOR + ftype;
+        has_types_src = (hparams.ftype & WHISPER_FTYPE_TENSOR_TYPES) != 0;
+        has_pad_src   = (hparams.ftype & WHISPER_FTYPE_ALIGNED)      != 0;
+
+        const int32_t ftype_src = hparams.ftype & ~(WHISPER_FTYPE_TENSOR_TYPES | WHISPER_FTYPE_ALIGNED);
+        const int32_t qntvr_src = ftype_src / GGML_QNT_VERSION_FACTOR;
+
+        // with a recipe, the ftype of the source is kept and the loader takes the type of each tensor from the table
+        // the tensor data of the output is always aligned (see ggml_common_quantize())
+        const int32_t ftype_dst = rules.empty() ?
+            (GGML_QNT_VERSION * GGML_QNT_VERSION_FACTOR + ftype) | WHISPER_FTYPE_ALIGNED :
+            (GGML_QNT_VERSION * GGML_QNT_VERSION_FACTOR + ftype_src % GGML_QNT_VERSION_FACTOR) | WHISPER_FTYPE_TENSOR_TYPES | WHISPER_FTYPE_ALIGNED;
 
         fprintf(stderr, "%s: n_vocab       = %d\n", __func__, hparams.n_vocab);
         fprintf(stderr, "%s: n_audio_ctx   = %d\n", __func__, hparams.n_audio_ctx);
@@ -165,7 +185,81 @@ static bool whisper_model_quantize(const std::string & fname_inp, const std::str
         "decoder.positional_embedding",
     };
 
-    if (!ggml_common_quantize_0(finp, fout, ftype, { ".*" }, to_skip)) {
+    // drop the tensor types of a mixed-precision source, they are written again below if needed
+    if (has_types_src) {
+        int32_t n_types = 0;
+        finp.read((char *) &n_types, sizeof(n_types));
+
+        for (int i = 0; i < n_types; i++) {
+            int32_t len;
+            finp.read((char *) &len, sizeof(len));
+            finp.seekg(len + sizeof(int32_t), std::ios::cur);
+        }
+    }
+
+    // the type of each tensor, read by the loader before the tensors are created. it is needed with a recipe, and when
+    // the rows of some tensors do not fit a k-quant (e.g. the 384 wide tensors of tiny) and fall back to another type
+    {
+        std::vector<ggml_common_quant_rule> rules_types = rules;
+
+        ggml_type qtype = GGML_TYPE_COUNT;
+
+        switch (ftype) {
+            case GGML_FTYPE_MOSTLY_Q2_K:
+            case GGML_FTYPE_MOSTLY_Q3_K:
+            case GGML_FTYPE_MOSTLY_Q4_K:
+            case GGML_FTYPE_MOSTLY_Q5_K:
+            case GGML_FTYPE_MOSTLY_Q6_K:
+                qtype = ggml_ftype_to_ggml_type(ftype);
+                rules_types.push_back({ ".*", qtype });
+                break;
+            default:
+                break;
+        }
+
+        std::vector<std::pair<std::string, ggml_type>> types;
+        if (!rules_types.empty() && !ggml_common_quantize_types(finp, rules_types, to_skip, types, has_pad_src)) {
+            fprintf(stderr, "%s: failed to read the tensors of '%s'\n", __func__, fname_inp.c_str());
+            return false;
+        }
+
+        bool has_types = !rules.empty();
+        for (const auto & it : types) {
+            has_types = has_types || (ggml_is_quantized(it.second) && it.second != qtype);
+        }
+
+        if (has_types && rules.empty()) {
+            fprintf(stderr, "%s: some rows do not fit %s, the file lists the type of each tensor\n", __func__, ggml_type_name(qtype));
+
+            // set the flag in the header written above
+            const int32_t ftype_dst = (GGML_QNT_VERSION * GGML_QNT_VERSION_FACTOR + ftype) | WHISPER_FTYPE_TENSOR_TYPES | WHISPER_FTYPE_ALIGNED;
+
+            const std::streampos pos = fout.tellp();
+            fout.seekp(sizeof(uint32_t) + 10*sizeof(int32_t));
+            fout.write((const char *) &ftype_dst, sizeof(ftype_dst));
+            fout.seekp(pos);
+        }
+
+        if (has_types) {
+            const int32_t n_types = types.size();
+            fout.write((const char *) &n_types, sizeof(n_types));
+
+            for (const auto & it : types) {
+                const int32_t len  = it.first.size();
+                const int32_t type = it.second;
+
+                fout.write((const char *) &len, sizeof(len));
+                fout.write(it.first.data(), len);
+                fout.write((const char *) &type, sizeof(type));
+            }
+        }
+    }
+
+    const bool ok = rules.empty() ?
+        ggml_common_quantize_0(finp, fout, ftype, { ".*" }, to_skip, n_threads, has_pad_src) :
+        ggml_common_quantize  (finp, fout, rules,          to_skip, n_threads, has_pad_src);
+
+    if (!ok) {
         fprintf(stderr, "%s: failed to quantize model '%s'\n", __func__, fname_inp.c_str());
         return false;
     }
@@ -179,9 +273,10 @@ static bool whisper_model_quantize(const std::string & fname_inp, const std::str
 int main(int argc, char ** argv) {
     ggml_backend_load_all();
 
-    if (argc != 4) {
-        fprintf(stderr, "usage: %s model-f32.bin model-quant.bin type\n", argv[0]);
+    if (argc != 4 && argc != 5) {
+        fprintf(stderr, "usage: %s model-f32.bin model-quant.bin type|recipe.txt [n_threads]\n", argv[0]);
         ggml_print_ftypes(stderr);
+        fprintf(stderr, "  recipe.txt: one '<tensor name regex> <type>' per line, the first match applies\n");
         return 1;
     }
 
@@ -195,7 +290,24 @@ int main(int argc, char ** argv) {
     const std::string fname_inp = argv[1];
     const std::string fname_out = argv[2];
 
-    const ggml_ftype ftype = ggml_parse_ftype(argv[3]);
+    ggml_ftype ftype = GGML_FTYPE_UNKNOWN;
+
+    // the type of all the tensors, or a recipe file. a type name wins over a file of the same name
+    std::vector<ggml_common_quant_rule> rules;
+    if (ggml_common_is_ftype(argv[3])) {
+        ftype = ggml_parse_ftype(argv[3]);
+    } else if (std::ifstream(argv[3]).good()) {
+        if (!ggml_common_read_recipe(argv[3], rules)) {
+            return 1;
+        }
+    } else {
+        fprintf(stderr, "%s: '%s' is neither a type nor a readable recipe file\n", __func__, argv[3]);
+        ggml_print_ftypes(stderr);
+        return 1;
+    }
+
+    // 0 - all cores
+    const int n_threads = argc > 4 ? atoi(argv[4]) : 0;
 
     const int64_t t_main_start_us = ggml_time_us();
 
@@ -205,7 +317,7 @@ int main(int argc, char ** argv) {
     {
         const int64_t t_start_us = ggml_time_us();
 
-        if (!whisper_model_quantize(fname_inp, fname_out, ggml_ftype(ftype))) {
+        if (!whisper_model_quantize(fname_inp, fname_out, ftype, rules, n_threads)) {
             fprintf(stderr, "%s: failed to quantize model from '%s'\n", __func__, fname_inp.c_str());
             return 1;
         }
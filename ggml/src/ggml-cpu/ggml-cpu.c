@@ -2840,6 +2840,7 @@ struct ggml_cplan ggml_graph_plan(
                         const int64_t ne20 = node->src[2]->ne[0]; // DV
 
                         cur = sizeof(float)*(1*ne10 + 2*ne20)*n_tasks; // 1x head size K + 2x head size V (per thread)
+                        cur = MAX(cur, sizeof(float)*GGML_FA_TILE_WORK_SIZE(ne10, ne20)*n_tasks);
                     } break;
                 case GGML_OP_FLASH_ATTN_BACK:
                     {
@@ -8093,6 +8093,258 @@ static void ggml_compute_forward_flash_attn_ext_f16_one_chunk(
     }
 }
 
+// converts a row of K or V to F32
+static inline void ggml_fa_row_to_f32(ggml_type type, ggml_to_float_t to_float, const char * x, float * y, int64_t n) {
+    if (type == GGML_TYPE_F16) {
+        ggml_cpu_fp16_to_fp32((const ggml_fp16_t *) x, y, n);
+    } else if (type == GGML_TYPE_F32) {
+        memcpy(y, x, n*sizeof(float));
+    } else {
+        to_float(x, y, n);
+    }
+}
+
+// s[j] = dot(q, k_j) for the GGML_FA_TILE_KV keys of a block, from the keys transposed to KT[DK][GGML_FA_TILE_KV]:
+// the scores of the block stay in registers and no horizontal sum is needed
+static inline void ggml_fa_tile_scores(int64_t DK, const float * GGML_RESTRICT q, const float * GGML_RESTRICT KT, float * GGML_RESTRICT s) {
+    float acc[GGML_FA_TILE_KV] = { 0.0f };
+
+    for (int64_t d = 0; d < DK; ++d) {
+        const float   qd = q[d];
+        const float * kt = KT + d*GGML_FA_TILE_KV;
+
+        for (int j = 0; j < GGML_FA_TILE_KV; ++j) {
+            acc[j] += qd*kt[j];
+        }
+    }
+
+    memcpy(s, acc, sizeof(acc));
+}
+
+// o += sum_j p[j]*v_j over the nkv values of a block, 4 values per pass over o
+static inline void ggml_fa_tile_accumulate(int64_t DV, int64_t nkv, const float * GGML_RESTRICT p, const float * GGML_RESTRICT V, float * GGML_RESTRICT o) {
+    int64_t j = 0;
+    for (; j + 3 < nkv; j += 4) {
+        const float p0 = p[j + 0];
+        const float p1 = p[j + 1];
+        const float p2 = p[j + 2];
+        const float p3 = p[j + 3];
+
+        const float * v0 = V + (j + 0)*DV;
+        const float * v1 = V + (j + 1)*DV;
+        const float * v2 = V + (j + 2)*DV;
+        const float * v3 = V + (j + 3)*DV;
+
+        for (int64_t d = 0; d < DV; ++d) {
+            o[d] += p0*v0[d] + p1*v1[d] + p2*v2[d] + p3*v3[d];
+        }
+    }
+
+    for (; j < nkv; ++j) {
+        ggml_vec_mad_f32(DV, o, V + j*DV, p[j]);
+    }
+}
+
+// whether the tiled kernel runs this op: no ALiBi, softcap or sinks, and enough queries to amortize the conversion of
+// the keys and values - a single query (a decoding step) is faster with the kernel above
+static bool ggml_compute_forward_flash_attn_ext_use_tiled(const ggml_tensor * dst) {
+    const ggml_tensor * q = dst->src[0];
+    const ggml_tensor * k = dst->src[1];
+    const ggml_tensor * v = dst->src[2];
+
+    float max_bias      = 0.0f;
+    float logit_softcap = 0.0f;
+
+    memcpy(&max_bias,      (const float *) dst->op_params + 1, sizeof(float));
+    memcpy(&logit_softcap, (const float *) dst->op_params + 2, sizeof(float));
+
+    const auto can_convert = [](ggml_type type) {
+        return type == GGML_TYPE_F16 || type == GGML_TYPE_F32 || ggml_get_type_traits(type)->to_float != nullptr;
+    };
+
+    return q->ne[1] >= GGML_FA_TILE_Q/4 && q->type == GGML_TYPE_F32 && dst->src[4] == nullptr &&
+        max_bias == 0.0f && logit_softcap == 0.0f && can_convert(k->type) && can_convert(v->type);
+}
+
+// tiled flash attention: the scores of a block of queries against a block of keys are computed at once, with one
+// vectorized softmax per query and block. each block of keys and values is converted to F32 once for all queries of
+// the block and the output is accumulated in F32
+// not in upstream ggml, see GGML_FA_TILE_Q in ops.h
+static void ggml_compute_forward_flash_attn_ext_f16_tiled(
+        const ggml_compute_params * params,
+        ggml_tensor * dst) {
+    const ggml_tensor * q     = dst->src[0];
+    const ggml_tensor * k     = dst->src[1];
+    const ggml_tensor * v     = dst->src[2];
+    const ggml_tensor * mask  = dst->src[3];
+
+    GGML_TENSOR_LOCALS(int64_t, neq, q,   ne)
+    GGML_TENSOR_LOCALS(size_t,  nbq, q,   nb)
+    GGML_TENSOR_LOCALS(int64_t, nek, k,   ne)
+    GGML_TENSOR_LOCALS(size_t,  nbk, k,   nb)
+    GGML_TENSOR_LOCALS(int64_t, nev, v,   ne)
+    GGML_TENSOR_LOCALS(size_t,  nbv, v,   nb)
+    GGML_TENSOR_LOCALS(int64_t, ne,  dst, ne)
+    GGML_TENSOR_LOCALS(size_t,  nb,  dst, nb)
+
+    const int64_t DK = nek0;
+    const int64_t DV = nev0;
+
+    // broadcast factors
+    const int64_t rk2 = neq2/nek2;
+    const int64_t rk3 = neq3/nek3;
+
+    const int64_t rv2 = neq2/nev2;
+    const int64_t rv3 = neq3/nev3;
+
+    float scale = 1.0f;
+    memcpy(&scale, (float *) dst->op_params + 0, sizeof(float));
+
+    ggml_to_float_t const k_to_float = ggml_get_type_traits(k->type)->to_float;
+    ggml_to_float_t const v_to_float = ggml_get_type_traits(v->type)->to_float;
+
+    const int ith = params->ith;
+    const int nth = params->nth;
+
+    float * K32 = (float *) params->wdata + ith*(GGML_FA_TILE_WORK_SIZE(DK, DV) + CACHE_LINE_SIZE_F32);
+    float * KT  = K32 + GGML_FA_TILE_KV*DK;             // [DK][GGML_FA_TILE_KV] keys transposed
+    float * V32 = KT  + GGML_FA_TILE_KV*DK;             // [GGML_FA_TILE_KV][DV]
+    float * S   = V32 + GGML_FA_TILE_KV*DV;             // [GGML_FA_TILE_Q][GGML_FA_TILE_KV] scores, then probabilities
+    float * O   = S   + GGML_FA_TILE_Q*GGML_FA_TILE_KV; // [GGML_FA_TILE_Q][DV] output accumulators
+    float * M   = O   + GGML_FA_TILE_Q*DV;              // [GGML_FA_TILE_Q] maximum score of each query
+    float * L   = M   + GGML_FA_TILE_Q;                 // [GGML_FA_TILE_Q] sum of exp(score - M) of each query
+
+    // a chunk is a block of queries of one head
+    const int64_t n_q_tiles = (neq1 + GGML_FA_TILE_Q - 1)/GGML_FA_TILE_Q;
+    const int64_t nchunk    = n_q_tiles*neq2*neq3;
+
+    if (ith == 0) {
+        ggml_threadpool_chunk_set(params->threadpool, nth);
+    }
+
+    ggml_barrier(params->threadpool);
+
+    for (int64_t chunk = ith; chunk < nchunk; chunk = ggml_threadpool_chunk_add(params->threadpool, 1)) {
+        const int64_t iq3 = chunk/(neq2*n_q_tiles);
+        const int64_t iq2 = (chunk - iq3*neq2*n_q_tiles)/n_q_tiles;
+        const int64_t iq0 = (chunk - iq3*neq2*n_q_tiles - iq2*n_q_tiles)*GGML_FA_TILE_Q;
+        const int64_t nq  = MIN(GGML_FA_TILE_Q, neq1 - iq0);
+
+        const int64_t ik2 = iq2/rk2;
+        const int64_t ik3 = iq3/rk3;
+        const int64_t iv2 = iq2/rv2;
+        const int64_t iv3 = iq3/rv3;
+
+        memset(O, 0, nq*DV*sizeof(float));
+        for (int64_t r = 0; r < nq; ++r) {
+            M[r] = -INFINITY;
+            L[r] = 0.0f;
+        }
+
+        for (int64_t ic0 = 0; ic0 < nek1; ic0 += GGML_FA_TILE_KV) {
+            const int64_t nkv = MIN(GGML_FA_TILE_KV, nek1 - ic0);
+
+            // skip the blocks of keys that are masked for all queries (e.g. the future of causal attention)
+            if (mask) {
+                bool any = false;
+                for (int64_t r = 0; r < nq && !any; ++r) {
+                    const ggml_fp16_t * mp = (const ggml_fp16_t *) ((const char *) mask->data +
+                        (iq0 + r)*mask->nb[1] + (iq2%mask->ne[2])*mask->nb[2] + (iq3%mask->ne[3])*mask->nb[3]);
+                    for (int64_t j = 0; j < nkv; ++j) {
+                        if (GGML_CPU_FP16_TO_FP32(mp[ic0 + j]) != -INFINITY) {
+                            any = true;
+                            break;
+                        }
+                    }
+                }
+                if (!any) {
+                    continue;
+                }
+            }
+
+            for (int64_t j = 0; j < nkv; ++j) {
+                ggml_fa_row_to_f32(k->type, k_to_float, (const char *) k->data + (ic0 + j)*nbk1 + ik2*nbk2 + ik3*nbk3, K32 + j*DK, DK);
+            }
+
+            // the keys past the end of the last block score 0 and are dropped below
+            for (int64_t d = 0; d < DK; ++d) {
+                float * kt = KT + d*GGML_FA_TILE_KV;
+                for (int64_t j = 0; j < nkv; ++j) {
+                    kt[j] = K32[j*DK + d];
+                }
+                for (int64_t j = nkv; j < GGML_FA_TILE_KV; ++j) {
+                    kt[j] = 0.0f;
+                }
+            }
+
+            // the queries that see no key of the block
+            bool skip[GGML_FA_TILE_Q];
+            bool any_row = false;
+
+            for (int64_t r = 0; r < nq; ++r) {
+                const float * pq = (const float *) ((const char *) q->data + (iq0 + r)*nbq1 + iq2*nbq2 + iq3*nbq3);
+                const ggml_fp16_t * mp = mask ? (const ggml_fp16_t *) ((const char *) mask->data +
+                    (iq0 + r)*mask->nb[1] + (iq2%mask->ne[2])*mask->nb[2] + (iq3%mask->ne[3])*mask->nb[3]) : NULL;
+
+                float * s = S + r*GGML_FA_TILE_KV;
+
+                ggml_fa_tile_scores(DK, pq, KT, s);
+
+                float smax = -INFINITY;
+                for (int64_t j = 0; j < nkv; ++j) {
+                    s[j] = s[j]*scale + (mp ? GGML_CPU_FP16_TO_FP32(mp[ic0 + j]) : 0.0f);
+                    smax = MAX(smax, s[j]);
+                }
+
+                skip[r] = smax == -INFINITY;
+                if (skip[r]) {
+                    continue;
+                }
+
+                const float Mnew = MAX(M[r], smax);
+                const float ms   = expf(M[r] - Mnew);
+
+                const ggml_float sum = ggml_vec_soft_max_f32(nkv, s, s, Mnew);
+
+                if (ms != 1.0f) {
+                    ggml_vec_scale_f32(DV, O + r*DV, ms);
+                }
+
+                L[r] = L[r]*ms + (float) sum;
+                M[r] = Mnew;
+
+                any_row = true;
+            }
+
+            if (!any_row) {
+                continue;
+            }
+
+            for (int64_t j = 0; j < nkv; ++j) {
+                ggml_fa_row_to_f32(v->type, v_to_float, (const char *) v->data + (ic0 + j)*nbv1 + iv2*nbv2 + iv3*nbv3, V32 + j*DV, DV);
+            }
+
+            for (int64_t r = 0; r < nq; ++r) {
+                if (skip[r]) {
+                    continue;
+                }
+
+                ggml_fa_tile_accumulate(DV, nkv, S + r*GGML_FA_TILE_KV, V32, O + r*DV);
+            }
+        }
+
+        for (int64_t r = 0; r < nq; ++r) {
+            float * o = O + r*DV;
+
+            const float S_inv = L[r] == 0.0f ? 0.0f : 1.0f/L[r];
+            ggml_vec_scale_f32(DV, o, S_inv);
+
+            // permute(0, 2, 1, 3)
+            memcpy((char *) dst->data + (iq3*ne2*ne1 + iq2 + (iq0 + r)*ne1)*nb1, o, nb1);
+        }
+    }
+}
+
 static void ggml_compute_forward_flash_attn_ext_f16(
         const ggml_compute_params * params,
         ggml_tensor * dst) {
@@ -8186,7 +8438,11 @@ void ggml_compute_forward_flash_attn_ext(
         case GGML_PREC_F32:
             {
                 // uses F32 accumulators
-                ggml_compute_forward_flash_attn_ext_f16(params, dst);
+                if (ggml_compute_forward_flash_attn_ext_use_tiled(dst)) {
+                    ggml_compute_forward_flash_attn_ext_f16_tiled(params, dst);
+                } else {
+                    ggml_compute_forward_flash_attn_ext_f16(params, dst);
+                }
             } break;
         default:
             {
@@ -23,6 +23,17 @@ static const size_t CACHE_LINE_SIZE_F32 = CACHE_LINE_SIZE/sizeof(float);
 // Work buffer size for im2col operations in CONV2D
 #define GGML_IM2COL_WORK_SIZE (16 * 1024 * 1024)
 
+// Tiles of the flash attention kernel for many queries (encoder, prompts): blocks of GGML_FA_TILE_Q queries of a head
+// run against blocks of GGML_FA_TILE_KV keys and values converted to F32 once per block
+// NOTE: the tiled kernel is a local change to the vendored ggml (see "Vendored ggml" in README.md) - keep it when
+//       syncing ggml, tests/test-flash-attn.cpp checks it against the mul_mat + soft_max path
+#define GGML_FA_TILE_Q  32
+#define GGML_FA_TILE_KV 64
+
+// F32 work buffer of the tiled flash attention kernel, per thread
+#define GGML_FA_TILE_WORK_SIZE(DK, DV) \
+    (GGML_FA_TILE_KV*(2*(DK) + (DV)) + GGML_FA_TILE_Q*(GGML_FA_TILE_KV + (DV) + 2))
+
 #ifdef __cplusplus
 extern "C" {
 #endif
@@ -35,6 +35,15 @@
 #define WHISPER_HOP_LENGTH  160
 #define WHISPER_CHUNK_SIZE  30
 
+// flag of hparams.ftype in the model files whose vocab is followed by the type of each tensor
+// (mixed-precision models written by whisper-quantize from a recipe)
+#define WHISPER_FTYPE_TENSOR_TYPES 0x10000
+
+// flag of hparams.ftype in the model files whose tensor names are followed by an int32 n_pad and n_pad zero bytes,
+// so that the tensor data is aligned for use in place from a mapped file (written by whisper-quantize)
+// loaders that do not know the flag reject these files because of the invalid ftype
+#define WHISPER_FTYPE_ALIGNED      0x20000
+
 #ifdef __cplusplus
 extern "C" {
 #endif
@@ -126,6 +135,18 @@ extern "C" {
         struct whisper_aheads dtw_aheads;
 
         size_t dtw_mem_size; // TODO: remove
+
+        // the fields below are not in upstream whisper.cpp. they are appended so that the offsets of the fields above
+        // stay the same, but the size of the struct differs: obtain it from whisper_context_default_params() and
+        // rebuild code that allocates it itself against this header
+        bool  use_mmap;    // map the model file and let CPU weights alias it (whisper_init_from_file* only)
+        int   n_max_decoders; // size the KV cache of every state for this many decoders (beam_size / best_of) up front,
+                              // so it is never recreated during decoding. 1 - grow on demand
+        size_t enc_cache_size;    // bytes of encoder results kept for re-encoded audio windows (retries, language
+                                  // detection followed by whisper_full, ...), shared by all states. 0 - disabled
+        enum ggml_type kv_self_type;  // storage of the self-attention (decoder) KV cache: GGML_TYPE_F16, _Q8_0 or _Q4_0
+        enum ggml_type kv_cross_type; // storage of the cross-attention (encoder output) KV cache: same types
+                                      // the V caches are quantized with flash_attn only, otherwise they stay F16
     };
 
     typedef struct whisper_token_data {
@@ -264,6 +285,28 @@ extern "C" {
                     const char * device,
                     const char * cache_dir);
 
+    // Drop everything a previous request left in the state (results, timings, streamed audio, KV cache cells)
+    // so it can be reused for an unrelated request. Nothing is (re)allocated: the KV caches and schedulers are kept.
+    // With whisper_context_params.n_max_decoders set, a state can be reused indefinitely without allocator traffic.
+    WHISPER_API void whisper_state_reset(struct whisper_state * state);
+
+    // Pool of preallocated states that share the weights of one context, for serving concurrent requests.
+    // n_states <= 0 creates one state per n_threads cores, which also caps the number of concurrent requests.
+    // whisper_state_pool_acquire() checks out an idle state, waiting up to timeout_ms for one to become idle
+    // (timeout_ms < 0 waits forever) and returns NULL on timeout.
+    // whisper_state_pool_release() resets the state (see whisper_state_reset()) and returns it to the pool.
+    // Acquire and release are thread-safe. All states must be released before whisper_state_pool_free().
+    struct whisper_state_pool;
+
+    WHISPER_API struct whisper_state_pool * whisper_state_pool_init(struct whisper_context * ctx, int n_states, int n_threads);
+    WHISPER_API void                        whisper_state_pool_free(struct whisper_state_pool * pool);
+
+    WHISPER_API struct whisper_state * whisper_state_pool_acquire(struct whisper_state_pool * pool, int timeout_ms);
+    WHISPER_API void                   whisper_state_pool_release(struct whisper_state_pool * pool, struct whisper_state * state);
+
+    WHISPER_API int whisper_state_pool_n_states(struct whisper_state_pool * pool);
+    WHISPER_API int whisper_state_pool_n_idle  (struct whisper_state_pool * pool);
+
     // Frees all allocated memory
     WHISPER_API void whisper_free      (struct whisper_context * ctx);
     WHISPER_API void whisper_free_state(struct whisper_state * state);
@@ -286,6 +329,30 @@ extern "C" {
                                int   n_samples,
                                int   n_threads);
 
+    // Incremental version of whisper_pcm_to_mel() for audio that arrives in chunks (e.g. live streams).
+    // Appends n_samples of RAW PCM audio to the stream of the state and computes only the mel frames that
+    // the new samples affect. Afterwards the state holds the same spectrogram as a single whisper_pcm_to_mel()
+    // call over all samples appended since the last reset, so it can be passed to whisper_encode() or to
+    // whisper_full() with n_samples == 0.
+    // whisper_pcm_to_mel() and whisper_set_mel() reset the stream.
+    // Returns 0 on success
+    WHISPER_API int whisper_pcm_to_mel_append(
+            struct whisper_context * ctx,
+                       const float * samples,
+                               int   n_samples,
+                               int   n_threads);
+
+    WHISPER_API int whisper_pcm_to_mel_append_with_state(
+            struct whisper_context * ctx,
+              struct whisper_state * state,
+                       const float * samples,
+                               int   n_samples,
+                               int   n_threads);
+
+    // Discard the audio of the stream, the next whisper_pcm_to_mel_append() starts a new spectrogram
+    WHISPER_API void whisper_pcm_to_mel_reset(struct whisper_context * ctx);
+    WHISPER_API void whisper_pcm_to_mel_reset_with_state(struct whisper_state * state);
+
     // This can be used to set a custom log mel spectrogram inside the default state of the provided whisper context.
     // Use this instead of whisper_pcm_to_mel() if you want to provide your own log mel spectrogram.
     // n_mel must be 80
@@ -318,6 +385,26 @@ extern "C" {
                                int   offset,
                                int   n_threads);
 
+    // Batched encoder for serving: runs the encoder over the mel windows of several states (e.g. one per request)
+    // as a single graph, so the matrix multiplications with the weights are shared by all windows.
+    // whisper_encoder_batch_init() reserves the compute buffer for up to n_max windows of the full audio context.
+    // whisper_encode_batch() encodes the window at offsets[i] (NULL - all 0) of the spectrogram of states[i] and
+    // stores the result in its cross-attention cache - like whisper_encode_with_state() on each state. All states
+    // must use the same audio context. A following whisper_full_with_state() with n_samples == 0 (the spectrogram
+    // already in the state) does not encode the first window again.
+    // Not thread safe for the same batch or states. Returns 0 on success
+    struct whisper_encoder_batch;
+
+    WHISPER_API struct whisper_encoder_batch * whisper_encoder_batch_init(struct whisper_context * ctx, int n_max);
+    WHISPER_API void                           whisper_encoder_batch_free(struct whisper_encoder_batch * batch);
+
+    WHISPER_API int whisper_encode_batch(
+      struct whisper_encoder_batch * batch,
+              struct whisper_state ** states,
+                         const int * offsets,
+                               int   n_states,
+                               int   n_threads);
+
     // Run the Whisper decoder to obtain the logits and probabilities for the next token.
     // Make sure to call whisper_encode() first.
     // tokens + n_tokens is the provided context for the decoder.
@@ -343,7 +430,10 @@ extern "C" {
     // The tokens pointer must be large enough to hold the resulting tokens.
     // Returns the number of tokens on success, no more than n_max_tokens
     // Returns a negative number on failure - the number of tokens that would have been returned
-    // TODO: not sure if correct
+    // The text is split with the GPT-2 pre-tokenizer and each part is encoded with byte-level BPE, as in the
+    // reference tokenizer. Some older model files (e.g. models/for-tests-ggml-*.bin) store the tokens that are
+    // partial UTF-8 sequences as U+FFFD, so merges through them are skipped - for some scripts this gives a few
+    // more tokens than the reference. The files written by convert-pt-to-ggml.py keep all tokens and match it
     WHISPER_API int whisper_tokenize(
             struct whisper_context * ctx,
                         const char * text,
@@ -352,7 +442,7 @@ extern "C" {
 
     // Return the number of tokens in the provided text
     // Equivalent to: -whisper_tokenize(ctx, text, NULL, 0)
-    int whisper_token_count(struct whisper_context * ctx, const char * text);
+    WHISPER_API int whisper_token_count(struct whisper_context * ctx, const char * text);
 
     // Largest language id (i.e. number of available languages - 1)
     WHISPER_API int whisper_lang_max_id(void);
@@ -388,6 +478,43 @@ extern "C" {
                                int   n_threads,
                              float * lang_probs);
 
+    // The k most probable languages of the mel data at offset_ms, most probable first: their ids in lang_ids and their
+    // probabilities in lang_probs (either can be NULL). Only the logits of the language tokens are computed, not the
+    // whole vocabulary. The window is not encoded again if it already is in the cross-attention cache of the state
+    // Returns the number of languages written (at most k) or negative on failure
+    WHISPER_API int whisper_lang_detect_top_k(
+            struct whisper_context * ctx,
+              struct whisper_state * state,
+                               int   offset_ms,
+                               int   n_threads,
+                               int   k,
+                               int * lang_ids,
+                             float * lang_probs);
+
+    // Batched language identification: the language of the window at offsets[i] (mel frames, NULL - all 0) of each
+    // state. The windows that are not encoded yet are encoded with whisper_encode_batch(), then the language tokens of
+    // all states are scored together. The encoder results stay in the states, so a following whisper_full_with_state()
+    // with n_samples == 0 does not encode these windows again. states[0] hosts the decoder calls (its self-attention
+    // cache is cleared). If not NULL, lang_ids[i] receives the top language id of state i and lang_probs (n_states x
+    // (whisper_lang_max_id() + 1)) the probabilities of all languages. Returns 0 on success
+    WHISPER_API int whisper_lang_detect_batch(
+      struct whisper_encoder_batch * batch,
+            struct whisper_state ** states,
+                       const int * offsets,
+                               int   n_states,
+                               int   n_threads,
+                               int * lang_ids,
+                             float * lang_probs);
+
+    // The audio context that audio_ctx_auto uses for a window of n_frames mel frames (10 ms each): the 2 frames per
+    // position of the window, plus a margin after the audio, at least a minimum, rounded up to a bucket, so that windows
+    // of similar length share the same graph shapes. The margin, minimum and bucket are the audio_ctx_auto_* fields of
+    // params, or conservative defaults when params is NULL or a field is 0. The defaults are the same for all model
+    // sizes and were not measured: check the WER on your own audio with audio_ctx_auto on and off before lowering them.
+    // With flash attention on a GPU the buckets are rounded up to the 256 positions the audio is padded to there, on
+    // CPU they are used as is. Returns at most whisper_n_audio_ctx()
+    WHISPER_API int whisper_audio_ctx_auto(struct whisper_context * ctx, const struct whisper_full_params * params, int n_frames);
+
     WHISPER_API int whisper_n_len           (struct whisper_context * ctx); // mel length
     WHISPER_API int whisper_n_len_from_state(struct whisper_state * state); // mel length
     WHISPER_API int whisper_n_vocab         (struct whisper_context * ctx);
@@ -416,6 +543,7 @@ extern "C" {
     WHISPER_API float * whisper_get_logits_from_state(struct whisper_state * state);
 
     // Token Id -> String. Uses the vocabulary in the provided context
+    // Returns "" for an invalid token id
     WHISPER_API const char * whisper_token_to_str(struct whisper_context * ctx, whisper_token token);
     WHISPER_API const char * whisper_model_type_readable(struct whisper_context * ctx);
 
@@ -446,6 +574,10 @@ extern "C" {
     WHISPER_API void whisper_print_timings(struct whisper_context * ctx);
     WHISPER_API void whisper_reset_timings(struct whisper_context * ctx);
 
+    // Encoder cache (whisper_context_params.enc_cache_size): the encodings that were reused, the ones that were
+    // computed and the bytes in use. Any of the pointers can be NULL
+    WHISPER_API void whisper_enc_cache_stats(struct whisper_context * ctx, int64_t * n_hit, int64_t * n_miss, size_t * size);
+
     // Print system information
     WHISPER_API const char * whisper_print_system_info(void);
 
@@ -588,6 +720,21 @@ extern "C" {
         const char * vad_model_path;              // Path to VAD model
 
         whisper_vad_params vad_params;
+
+        // the fields below are not in upstream whisper.cpp and are appended, see whisper_context_params.use_mmap
+
+        // run the encoder of each window over the audio it holds only, see whisper_audio_ctx_auto()
+        // windows shorter than 30 s (short clips, the end of a recording) are encoded faster. overrides audio_ctx
+        bool audio_ctx_auto;
+        int  audio_ctx_auto_margin; // positions kept after the audio of a window (0 = default, 128)
+        int  audio_ctx_auto_min;    // smallest audio context                     (0 = default, 384)
+        int  audio_ctx_auto_bucket; // the audio context is a multiple of it      (0 = default, 128)
+
+        // whisper_full_parallel() chunking
+        struct {
+            int overlap_ms; // audio decoded by both chunks around each split, merged on the common tokens (0 = no overlap)
+            int search_ms;  // each split moves to the quietest point within +-search_ms of the equal-sized position (0 = equal-sized chunks)
+        } parallel;
     };
 
     // NOTE: this function allocates memory, and it is the responsibility of the caller to free the pointer - see whisper_free_context_params & whisper_free_params()
@@ -597,6 +744,32 @@ extern "C" {
     WHISPER_API struct whisper_full_params * whisper_full_default_params_by_ref(enum whisper_sampling_strategy strategy);
     WHISPER_API struct whisper_full_params   whisper_full_default_params       (enum whisper_sampling_strategy strategy);
 
+    // Struct layout introspection for FFI bindings (see bindings/python)
+    // Bindings should build their mirror of the public structs from these tables instead of hard-coding the
+    // field offsets and the padding of the current ABI
+    enum whisper_field_type {
+        WHISPER_FIELD_TYPE_BOOL,
+        WHISPER_FIELD_TYPE_INT32,  // int, enums
+        WHISPER_FIELD_TYPE_INT64,
+        WHISPER_FIELD_TYPE_FLOAT,
+        WHISPER_FIELD_TYPE_SIZE_T,
+        WHISPER_FIELD_TYPE_STRING, // const char *
+        WHISPER_FIELD_TYPE_PTR,    // any other pointer (callbacks, user data, arrays)
+    };
+
+    typedef struct whisper_field_info {
+        const char * name;         // members of nested structs are flattened with a dot, e.g. "greedy.best_of"
+        enum whisper_field_type type;
+        size_t offset;
+        size_t size;
+    } whisper_field_info;
+
+    // Returns the field table of the struct and stores the number of entries in n_fields
+    // The struct size (including tail padding) is returned in size
+    WHISPER_API const struct whisper_field_info * whisper_context_params_fields(int * n_fields, size_t * size);
+    WHISPER_API const struct whisper_field_info * whisper_full_params_fields   (int * n_fields, size_t * size);
+    WHISPER_API const struct whisper_field_info * whisper_token_data_fields    (int * n_fields, size_t * size);
+
     // Run the entire model: PCM -> log mel spectrogram -> encoder -> decoder -> text
     // Not thread safe for same context
     // Uses the specified decoding strategy to obtain the text.
@@ -616,8 +789,13 @@ extern "C" {
     // Split the input audio in chunks and process each chunk separately using whisper_full_with_state()
     // Result is stored in the default state of the context
     // Not thread safe if executed in parallel on the same context.
-    // It seems this approach can offer some speedup in some cases.
-    // However, the transcription accuracy can be worse at the beginning and end of each chunk.
+    // The audio is cut in windows of at most 30 s (at least n_processors of them) that n_processors states take
+    // from a shared queue, so a window that needs temperature fallbacks does not leave the other cores idle.
+    // The results are reassembled in order and the timings of the default state are the totals over all states.
+    // Without no_context, a window is prompted with the text of the previous one only if the same state decoded it.
+    // The splits are placed in low-energy regions and neighbouring chunks overlap, the overlap is decoded twice and
+    // the duplicate text is dropped (see whisper_full_params.parallel). With both disabled, the transcription
+    // accuracy can be worse at the beginning and end of each chunk.
     WHISPER_API int whisper_full_parallel(
                 struct whisper_context * ctx,
             struct whisper_full_params   params,
@@ -625,6 +803,39 @@ extern "C" {
                                    int   n_samples,
                                    int   n_processors);
 
+    // Continuous batching decoder for serving: decodes the current window of many independent requests (one state
+    // each, already encoded e.g. with whisper_encode_batch()) with a single decoder call per step, over one shared
+    // self-attention KV cache. Requests join between two steps and leave as soon as they are finished, so the
+    // batch stays full while the requests have different lengths.
+    // whisper_decoder_batch_add() queues a request and returns its id (-1 - the batch is full or the parameters are
+    // not supported). The prompt is built as in whisper_full() and a multilingual model needs params.language.
+    // whisper_decoder_batch_step() prefills the queued requests that fit in n_max_tokens and samples one token for
+    // every running request. Returns the number of requests that are not finished yet, or < 0 on error.
+    // whisper_decoder_batch_status() returns 0 while the request runs, 1 when its segments are available through
+    // the whisper_full_get_segment_*_from_state() functions of its state and -1 if it failed (a repetition loop,
+    // or a result whisper_full() would decode again at a higher temperature: entropy_thold, logprob_thold) - decode
+    // it again with whisper_full_with_state(), which has the temperature fallback.
+    // whisper_decoder_batch_remove() releases the id and its part of the KV cache.
+    // Only greedy sampling of a single window per request (the one in kv_cross), without token timestamps.
+    // Not thread safe for the same batch or states
+    struct whisper_decoder_batch;
+
+    WHISPER_API struct whisper_decoder_batch * whisper_decoder_batch_init(
+                struct whisper_context * ctx,
+                                   int   n_max_requests,
+                                   int   n_max_tokens);
+
+    WHISPER_API void whisper_decoder_batch_free(struct whisper_decoder_batch * batch);
+
+    WHISPER_API int whisper_decoder_batch_add(
+          struct whisper_decoder_batch * batch,
+                  struct whisper_state * state,
+            struct whisper_full_params   params);
+
+    WHISPER_API int  whisper_decoder_batch_step  (struct whisper_decoder_batch * batch, int n_threads);
+    WHISPER_API int  whisper_decoder_batch_status(struct whisper_decoder_batch * batch, int id);
+    WHISPER_API void whisper_decoder_batch_remove(struct whisper_decoder_batch * batch, int id);
+
     // Number of generated text segments
     // A segment can be a few words, a sentence, or even a paragraph.
     WHISPER_API int whisper_full_n_segments           (struct whisper_context * ctx);
@@ -0,0 +1,332 @@
+#pragma once
+
+#include <cstdint>
+
+// character classes of the GPT-2 pre-tokenizer regex used by the whisper tokenizer:
+//
+//   's|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+
+//
+// the table holds the first code point of every run of code points with the same class
+// generated with the Python regex module (the reference tokenizer uses the same Unicode properties):
+//
+//   cls = lambda ch: 1 if regex.match(r'\p{L}', ch) else 2 if regex.match(r'\p{N}', ch) else 3 if regex.match(r'\s', ch) else 0
+//   runs = [c for c in range(0x110000) if c == 0 or cls(chr(c)) != cls(chr(c - 1))]   # surrogates: 0
+
+enum whisper_unicode_class {
+    WHISPER_UNICODE_OTHER  = 0,
+    WHISPER_UNICODE_LETTER = 1, // \p{L}
+    WHISPER_UNICODE_NUMBER = 2, // \p{N}
+    WHISPER_UNICODE_SPACE  = 3, // \s
+};
+
+struct whisper_unicode_run {
+    uint32_t cp0; // first code point of the run
+    uint8_t  cls; // whisper_unicode_class
+};
+
+static const whisper_unicode_run whisper_unicode_runs[] = {
+    { 0x000000, 0 }, { 0x000009, 3 }, { 0x00000E, 0 }, { 0x000020, 3 }, { 0x000021, 0 }, { 0x000030, 2 },
+    { 0x00003A, 0 }, { 0x000041, 1 }, { 0x00005B, 0 }, { 0x000061, 1 }, { 0x00007B, 0 }, { 0x000085, 3 },
+    { 0x000086, 0 }, { 0x0000A0, 3 }, { 0x0000A1, 0 }, { 0x0000AA, 1 }, { 0x0000AB, 0 }, { 0x0000B2, 2 },
+    { 0x0000B4, 0 }, { 0x0000B5, 1 }, { 0x0000B6, 0 }, { 0x0000B9, 2 }, { 0x0000BA, 1 }, { 0x0000BB, 0 },
+    { 0x0000BC, 2 }, { 0x0000BF, 0 }, { 0x0000C0, 1 }, { 0x0000D7, 0 }, { 0x0000D8, 1 }, { 0x0000F7, 0 },
+    { 0x0000F8, 1 }, { 0x0002C2, 0 }, { 0x0002C6, 1 }, { 0x0002D2, 0 }, { 0x0002E0, 1 }, { 0x0002E5, 0 },
+    { 0x0002EC, 1 }, { 0x0002ED, 0 }, { 0x0002EE, 1 }, { 0x0002EF, 0 }, { 0x000370, 1 }, { 0x000375, 0 },
+    { 0x000376, 1 }, { 0x000378, 0 }, { 0x00037A, 1 }, { 0x00037E, 0 }, { 0x00037F, 1 }, { 0x000380, 0 },
+    { 0x000386, 1 }, { 0x000387, 0 }, { 0x000388, 1 }, { 0x00038B, 0 }, { 0x00038C, 1 }, { 0x00038D, 0 },
+    { 0x00038E, 1 }, { 0x0003A2, 0 }, { 0x0003A3, 1 }, { 0x0003F6, 0 }, { 0x0003F7, 1 }, { 0x000482, 0 },
+    { 0x00048A, 1 }, { 0x000530, 0 }, { 0x000531, 1 }, { 0x000557, 0 }, { 0x000558, 1 }, { 0x00055A, 0 },
+    { 0x000560, 1 }, { 0x000589, 0 }, { 0x00058B, 1 }, { 0x00058D, 0 }, { 0x0005D0, 1 }, { 0x0005EB, 0 },
+    { 0x0005EF, 1 }, { 0x0005F3, 0 }, { 0x000620, 1 }, { 0x00064B, 0 }, { 0x000660, 2 }, { 0x00066A, 0 },
+    { 0x00066E, 1 }, { 0x000670, 0 }, { 0x000671, 1 }, { 0x0006D4, 0 }, { 0x0006D5, 1 }, { 0x0006D6, 0 },
+    { 0x0006E5, 1 }, { 0x0006E7, 0 }, { 0x0006EE, 1 }, { 0x0006F0, 2 }, { 0x0006FA, 1 }, { 0x0006FD, 0 },
+    { 0x0006FF, 1 }, { 0x000700, 0 }, { 0x000710, 1 }, { 0x000711, 0 }, { 0x000712, 1 }, { 0x000730, 0 },
+    { 0x00074D, 1 }, { 0x0007A6, 0 }, { 0x0007B1, 1 }, { 0x0007B2, 0 }, { 0x0007C0, 2 }, { 0x0007CA, 1 },
+    { 0x0007EB, 0 }, { 0x0007F4, 1 }, { 0x0007F6, 0 }, { 0x0007FA, 1 }, { 0x0007FB, 0 }, { 0x000800, 1 },
+    { 0x000816, 0 }, { 0x00081A, 1 }, { 0x00081B, 0 }, { 0x000824, 1 }, { 0x000825, 0 }, { 0x000828, 1 },
+    { 0x000829, 0 }, { 0x000840, 1 }, { 0x000859, 0 }, { 0x000860, 1 }, { 0x00086B, 0 }, { 0x000870, 1 },
+    { 0x000888, 0 }, { 0x000889, 1 }, { 0x000890, 0 }, { 0x0008A0, 1 }, { 0x0008CA, 0 }, { 0x000904, 1 },
+    { 0x00093A, 0 }, { 0x00093D, 1 }, { 0x00093E, 0 }, { 0x000950, 1 }, { 0x000951, 0 }, { 0x000958, 1 },
+    { 0x000962, 0 }, { 0x000966, 2 }, { 0x000970, 0 }, { 0x000971, 1 }, { 0x000981, 0 }, { 0x000985, 1 },
+    { 0x00098D, 0 }, { 0x00098F, 1 }, { 0x000991, 0 }, { 0x000993, 1 }, { 0x0009A9, 0 }, { 0x0009AA, 1 },
+    { 0x0009B1, 0 }, { 0x0009B2, 1 }, { 0x0009B3, 0 }, { 0x0009B6, 1 }, { 0x0009BA, 0 }, { 0x0009BD, 1 },
+    { 0x0009BE, 0 }, { 0x0009CE, 1 }, { 0x0009CF, 0 }, { 0x0009DC, 1 }, { 0x0009DE, 0 }, { 0x0009DF, 1 },
+    { 0x0009E2, 0 }, { 0x0009E6, 2 }, { 0x0009F0, 1 }, { 0x0009F2, 0 }, { 0x0009F4, 2 }, { 0x0009FA, 0 },
+    { 0x0009FC, 1 }, { 0x0009FD, 0 }, { 0x000A05, 1 }, { 0x000A0B, 0 }, { 0x000A0F, 1 }, { 0x000A11, 0 },
+    { 0x000A13, 1 }, { 0x000A29, 0 }, { 0x000A2A, 1 }, { 0x000A31, 0 }, { 0x000A32, 1 }, { 0x000A34, 0 },
+    { 0x000A35, 1 }, { 0x000A37, 0 }, { 0x000A38, 1 }, { 0x000A3A, 0 }, { 0x000A59, 1 }, { 0x000A5D, 0 },
+    { 0x000A5E, 1 }, { 0x000A5F, 0 }, { 0x000A66, 2 }, { 0x000A70, 0 }, { 0x000A72, 1 }, { 0x000A75, 0 },
+    { 0x000A85, 1 }, { 0x000A8E, 0 }, { 0x000A8F, 1 }, { 0x000A92, 0 }, { 0x000A93, 1 }, { 0x000AA9, 0 },
+    { 0x000AAA, 1 }, { 0x000AB1, 0 }, { 0x000AB2, 1 }, { 0x000AB4, 0 }, { 0x000AB5, 1 }, { 0x000ABA, 0 },
+    { 0x000ABD, 1 }, { 0x000ABE, 0 }, { 0x000AD0, 1 }, { 0x000AD1, 0 }, { 0x000AE0, 1 }, { 0x000AE2, 0 },
+    { 0x000AE6, 2 }, { 0x000AF0, 0 }, { 0x000AF9, 1 }, { 0x000AFA, 0 }, { 0x000B05, 1 }, { 0x000B0D, 0 },
+    { 0x000B0F, 1 }, { 0x000B11, 0 }, { 0x000B13, 1 }, { 0x000B29, 0 }, { 0x000B2A, 1 }, { 0x000B31, 0 },
+    { 0x000B32, 1 }, { 0x000B34, 0 }, { 0x000B35, 1 }, { 0x000B3A, 0 }, { 0x000B3D, 1 }, { 0x000B3E, 0 },
+    { 0x000B5C, 1 }, { 0x000B5E, 0 }, { 0x000B5F, 1 }, { 0x000B62, 0 }, { 0x000B66, 2 }, { 0x000B70, 0 },
+    { 0x000B71, 1 }, { 0x000B72, 2 }, { 0x000B78, 0 }, { 0x000B83, 1 }, { 0x000B84, 0 }, { 0x000B85, 1 },
+    { 0x000B8B, 0 }, { 0x000B8E, 1 }, { 0x000B91, 0 }, { 0x000B92, 1 }, { 0x000B96, 0 }, { 0x000B99, 1 },
+    { 0x000B9B, 0 }, { 0x000B9C, 1 }, { 0x000B9D, 0 }, { 0x000B9E, 1 }, { 0x000BA0, 0 }, { 0x000BA3, 1 },
+    { 0x000BA5, 0 }, { 0x000BA8, 1 }, { 0x000BAB, 0 }, { 0x000BAE, 1 }, { 0x000BBA, 0 }, { 0x000BD0, 1 },
+    { 0x000BD1, 0 }, { 0x000BE6, 2 }, { 0x000BF3, 0 }, { 0x000C05, 1 }, { 0x000C0D, 0 }, { 0x000C0E, 1 },
+    { 0x000C11, 0 }, { 0x000C12, 1 }, { 0x000C29, 0 }, { 0x000C2A, 1 }, { 0x000C3A, 0 }, { 0x000C3D, 1 },
+    { 0x000C3E, 0 }, { 0x000C58, 1 }, { 0x000C5B, 0 }, { 0x000C5C, 1 }, { 0x000C5E, 0 }, { 0x000C60, 1 },
+    { 0x000C62, 0 }, { 0x000C66, 2 }, { 0x000C70, 0 }, { 0x000C78, 2 }, { 0x000C7F, 0 }, { 0x000C80, 1 },
+    { 0x000C81, 0 }, { 0x000C85, 1 }, { 0x000C8D, 0 }, { 0x000C8E, 1 }, { 0x000C91, 0 }, { 0x000C92, 1 },
+    { 0x000CA9, 0 }, { 0x000CAA, 1 }, { 0x000CB4, 0 }, { 0x000CB5, 1 }, { 0x000CBA, 0 }, { 0x000CBD, 1 },
+    { 0x000CBE, 0 }, { 0x000CDC, 1 }, { 0x000CDF, 0 }, { 0x000CE0, 1 }, { 0x000CE2, 0 }, { 0x000CE6, 2 },
+    { 0x000CF0, 0 }, { 0x000CF1, 1 }, { 0x000CF3, 0 }, { 0x000D04, 1 }, { 0x000D0D, 0 }, { 0x000D0E, 1 },
+    { 0x000D11, 0 }, { 0x000D12, 1 }, { 0x000D3B, 0 }, { 0x000D3D, 1 }, { 0x000D3E, 0 }, { 0x000D4E, 1 },
+    { 0x000D4F, 0 }, { 0x000D54, 1 }, { 0x000D57, 0 }, { 0x000D58, 2 }, { 0x000D5F, 1 }, { 0x000D62, 0 },
+    { 0x000D66, 2 }, { 0x000D79, 0 }, { 0x000D7A, 1 }, { 0x000D80, 0 }, { 0x000D85, 1 }, { 0x000D97, 0 },
+    { 0x000D9A, 1 }, { 0x000DB2, 0 }, { 0x000DB3, 1 }, { 0x000DBC, 0 }, { 0x000DBD, 1 }, { 0x000DBE, 0 },
+    { 0x000DC0, 1 }, { 0x000DC7, 0 }, { 0x000DE6, 2 }, { 0x000DF0, 0 }, { 0x000E01, 1 }, { 0x000E31, 0 },
+    { 0x000E32, 1 }, { 0x000E34, 0 }, { 0x000E40, 1 }, { 0x000E47, 0 }, { 0x000E50, 2 }, { 0x000E5A, 0 },
+    { 0x000E81, 1 }, { 0x000E83, 0 }, { 0x000E84, 1 }, { 0x000E85, 0 }, { 0x000E86, 1 }, { 0x000E8B, 0 },
+    { 0x000E8C, 1 }, { 0x000EA4, 0 }, { 0x000EA5, 1 }, { 0x000EA6, 0 }, { 0x000EA7, 1 }, { 0x000EB1, 0 },
+    { 0x000EB2, 1 }, { 0x000EB4, 0 }, { 0x000EBD, 1 }, { 0x000EBE, 0 }, { 0x000EC0, 1 }, { 0x000EC5, 0 },
+    { 0x000EC6, 1 }, { 0x000EC7, 0 }, { 0x000ED0, 2 }, { 0x000EDA, 0 }, { 0x000EDC, 1 }, { 0x000EE0, 0 },
+    { 0x000F00, 1 }, { 0x000F01, 0 }, { 0x000F20, 2 }, { 0x000F34, 0 }, { 0x000F40, 1 }, { 0x000F48, 0 },
+    { 0x000F49, 1 }, { 0x000F6D, 0 }, { 0x000F88, 1 }, { 0x000F8D, 0 }, { 0x001000, 1 }, { 0x00102B, 0 },
+    { 0x00103F, 1 }, { 0x001040, 2 }, { 0x00104A, 0 }, { 0x001050, 1 }, { 0x001056, 0 }, { 0x00105A, 1 },
+    { 0x00105E, 0 }, { 0x001061, 1 }, { 0x001062, 0 }, { 0x001065, 1 }, { 0x001067, 0 }, { 0x00106E, 1 },
+    { 0x001071, 0 }, { 0x001075, 1 }, { 0x001082, 0 }, { 0x00108E, 1 }, { 0x00108F, 0 }, { 0x001090, 2 },
+    { 0x00109A, 0 }, { 0x0010A0, 1 }, { 0x0010C6, 0 }, { 0x0010C7, 1 }, { 0x0010C8, 0 }, { 0x0010CD, 1 },
+    { 0x0010CE, 0 }, { 0x0010D0, 1 }, { 0x0010FB, 0 }, { 0x0010FC, 1 }, { 0x001249, 0 }, { 0x00124A, 1 },
+    { 0x00124E, 0 }, { 0x001250, 1 }, { 0x001257, 0 }, { 0x001258, 1 }, { 0x001259, 0 }, { 0x00125A, 1 },
+    { 0x00125E, 0 }, { 0x001260, 1 }, { 0x001289, 0 }, { 0x00128A, 1 }, { 0x00128E, 0 }, { 0x001290, 1 },
+    { 0x0012B1, 0 }, { 0x0012B2, 1 }, { 0x0012B6, 0 }, { 0x0012B8, 1 }, { 0x0012BF, 0 }, { 0x0012C0, 1 },
+    { 0x0012C1, 0 }, { 0x0012C2, 1 }, { 0x0012C6, 0 }, { 0x0012C8, 1 }, { 0x0012D7, 0 }, { 0x0012D8, 1 },
+    { 0x001311, 0 }, { 0x001312, 1 }, { 0x001316, 0 }, { 0x001318, 1 }, { 0x00135B, 0 }, { 0x001369, 2 },
+    { 0x00137D, 0 }, { 0x001380, 1 }, { 0x001390, 0 }, { 0x0013A0, 1 }, { 0x0013F6, 0 }, { 0x0013F8, 1 },
+    { 0x0013FE, 0 }, { 0x001401, 1 }, { 0x00166D, 0 }, { 0x00166F, 1 }, { 0x001680, 3 }, { 0x001681, 1 },
+    { 0x00169B, 0 }, { 0x0016A0, 1 }, { 0x0016EB, 0 }, { 0x0016EE, 2 }, { 0x0016F1, 1 }, { 0x0016F9, 0 },
+    { 0x001700, 1 }, { 0x001712, 0 }, { 0x00171F, 1 }, { 0x001732, 0 }, { 0x001740, 1 }, { 0x001752, 0 },
+    { 0x001760, 1 }, { 0x00176D, 0 }, { 0x00176E, 1 }, { 0x001771, 0 }, { 0x001780, 1 }, { 0x0017B4, 0 },
+    { 0x0017D7, 1 }, { 0x0017D8, 0 }, { 0x0017DC, 1 }, { 0x0017DD, 0 }, { 0x0017E0, 2 }, { 0x0017EA, 0 },
+    { 0x0017F0, 2 }, { 0x0017FA, 0 }, { 0x001810, 2 }, { 0x00181A, 0 }, { 0x001820, 1 }, { 0x001879, 0 },
+    { 0x001880, 1 }, { 0x001885, 0 }, { 0x001887, 1 }, { 0x0018A9, 0 }, { 0x0018AA, 1 }, { 0x0018AB, 0 },
+    { 0x0018B0, 1 }, { 0x0018F6, 0 }, { 0x001900, 1 }, { 0x00191F, 0 }, { 0x001946, 2 }, { 0x001950, 1 },
+    { 0x00196E, 0 }, { 0x001970, 1 }, { 0x001975, 0 }, { 0x001980, 1 }, { 0x0019AC, 0 }, { 0x0019B0, 1 },
+    { 0x0019CA, 0 }, { 0x0019D0, 2 }, { 0x0019DB, 0 }, { 0x001A00, 1 }, { 0x001A17, 0 }, { 0x001A20, 1 },
+    { 0x001A55, 0 }, { 0x001A80, 2 }, { 0x001A8A, 0 }, { 0x001A90, 2 }, { 0x001A9A, 0 }, { 0x001AA7, 1 },
+    { 0x001AA8, 0 }, { 0x001B05, 1 }, { 0x001B34, 0 }, { 0x001B45, 1 }, { 0x001B4D, 0 }, { 0x001B50, 2 },
+    { 0x001B5A, 0 }, { 0x001B83, 1 }, { 0x001BA1, 0 }, { 0x001BAE, 1 }, { 0x001BB0, 2 }, { 0x001BBA, 1 },
+    { 0x001BE6, 0 }, { 0x001C00, 1 }, { 0x001C24, 0 }, { 0x001C40, 2 }, { 0x001C4A, 0 }, { 0x001C4D, 1 },
+    { 0x001C50, 2 }, { 0x001C5A, 1 }, { 0x001C7E, 0 }, { 0x001C80, 1 }, { 0x001C8B, 0 }, { 0x001C90, 1 },
+    { 0x001CBB, 0 }, { 0x001CBD, 1 }, { 0x001CC0, 0 }, { 0x001CE9, 1 }, { 0x001CED, 0 }, { 0x001CEE, 1 },
+    { 0x001CF4, 0 }, { 0x001CF5, 1 }, { 0x001CF7, 0 }, { 0x001CFA, 1 }, { 0x001CFB, 0 }, { 0x001D00, 1 },
+    { 0x001DC0, 0 }, { 0x001E00, 1 }, { 0x001F16, 0 }, { 0x001F18, 1 }, { 0x001F1E, 0 }, { 0x001F20, 1 },
+    { 0x001F46, 0 }, { 0x001F48, 1 }, { 0x001F4E, 0 }, { 0x001F50, 1 }, { 0x001F58, 0 }, { 0x001F59, 1 },
+    { 0x001F5A, 0 }, { 0x001F5B, 1 }, { 0x001F5C, 0 }, { 0x001F5D, 1 }, { 0x001F5E, 0 }, { 0x001F5F, 1 },
+    { 0x001F7E, 0 }, { 0x001F80, 1 }, { 0x001FB5, 0 }, { 0x001FB6, 1 }, { 0x001FBD, 0 }, { 0x001FBE, 1 },
+    { 0x001FBF, 0 }, { 0x001FC2, 1 }, { 0x001FC5, 0 }, { 0x001FC6, 1 }, { 0x001FCD, 0 }, { 0x001FD0, 1 },
+    { 0x001FD4, 0 }, { 0x001FD6, 1 }, { 0x001FDC, 0 }, { 0x001FE0, 1 }, { 0x001FED, 0 }, { 0x001FF2, 1 },
+    { 0x001FF5, 0 }, { 0x001FF6, 1 }, { 0x001FFD, 0 }, { 0x002000, 3 }, { 0x00200B, 0 }, { 0x002028, 3 },
+    { 0x00202A, 0 }, { 0x00202F, 3 }, { 0x002030, 0 }, { 0x00205F, 3 }, { 0x002060, 0 }, { 0x002070, 2 },
+    { 0x002071, 1 }, { 0x002072, 0 }, { 0x002074, 2 }, { 0x00207A, 0 }, { 0x00207F, 1 }, { 0x002080, 2 },
+    { 0x00208A, 0 }, { 0x00208F, 1 }, { 0x0020A0, 0 }, { 0x002102, 1 }, { 0x002103, 0 }, { 0x002107, 1 },
+    { 0x002108, 0 }, { 0x00210A, 1 }, { 0x002114, 0 }, { 0x002115, 1 }, { 0x002116, 0 }, { 0x002119, 1 },
+    { 0x00211E, 0 }, { 0x002124, 1 }, { 0x002125, 0 }, { 0x002126, 1 }, { 0x002127, 0 }, { 0x002128, 1 },
+    { 0x002129, 0 }, { 0x00212A, 1 }, { 0x00212E, 0 }, { 0x00212F, 1 }, { 0x00213A, 0 }, { 0x00213C, 1 },
+    { 0x002140, 0 }, { 0x002145, 1 }, { 0x00214A, 0 }, { 0x00214E, 1 }, { 0x00214F, 0 }, { 0x002150, 2 },
+    { 0x002183, 1 }, { 0x002185, 2 }, { 0x00218A, 0 }, { 0x002460, 2 }, { 0x00249C, 0 }, { 0x0024EA, 2 },
+    { 0x002500, 0 }, { 0x002776, 2 }, { 0x002794, 0 }, { 0x002C00, 1 }, { 0x002CE5, 0 }, { 0x002CEB, 1 },
+    { 0x002CEF, 0 }, { 0x002CF2, 1 }, { 0x002CF4, 0 }, { 0x002CFD, 2 }, { 0x002CFE, 0 }, { 0x002D00, 1 },
+    { 0x002D26, 0 }, { 0x002D27, 1 }, { 0x002D28, 0 }, { 0x002D2D, 1 }, { 0x002D2E, 0 }, { 0x002D30, 1 },
+    { 0x002D68, 0 }, { 0x002D6F, 1 }, { 0x002D70, 0 }, { 0x002D80, 1 }, { 0x002D97, 0 }, { 0x002DA0, 1 },
+    { 0x002DA7, 0 }, { 0x002DA8, 1 }, { 0x002DAF, 0 }, { 0x002DB0, 1 }, { 0x002DB7, 0 }, { 0x002DB8, 1 },
+    { 0x002DBF, 0 }, { 0x002DC0, 1 }, { 0x002DC7, 0 }, { 0x002DC8, 1 }, { 0x002DCF, 0 }, { 0x002DD0, 1 },
+    { 0x002DD7, 0 }, { 0x002DD8, 1 }, { 0x002DDF, 0 }, { 0x002E2F, 1 }, { 0x002E30, 0 }, { 0x003000, 3 },
+    { 0x003001, 0 }, { 0x003005, 1 }, { 0x003007, 2 }, { 0x003008, 0 }, { 0x003021, 2 }, { 0x00302A, 0 },
+    { 0x003031, 1 }, { 0x003036, 0 }, { 0x003038, 2 }, { 0x00303B, 1 }, { 0x00303D, 0 }, { 0x003041, 1 },
+    { 0x003097, 0 }, { 0x00309D, 1 }, { 0x0030A0, 0 }, { 0x0030A1, 1 }, { 0x0030FB, 0 }, { 0x0030FC, 1 },
+    { 0x003100, 0 }, { 0x003105, 1 }, { 0x003130, 0 }, { 0x003131, 1 }, { 0x00318F, 0 }, { 0x003192, 2 },
+    { 0x003196, 0 }, { 0x0031A0, 1 }, { 0x0031C0, 0 }, { 0x0031F0, 1 }, { 0x003200, 0 }, { 0x003220, 2 },
+    { 0x00322A, 0 }, { 0x003248, 2 }, { 0x003250, 0 }, { 0x003251, 2 }, { 0x003260, 0 }, { 0x003280, 2 },
+    { 0x00328A, 0 }, { 0x0032B1, 2 }, { 0x0032C0, 0 }, { 0x003400, 1 }, { 0x004DC0, 0 }, { 0x004E00, 1 },
+    { 0x00A48D, 0 }, { 0x00A4D0, 1 }, { 0x00A4FE, 0 }, { 0x00A500, 1 }, { 0x00A60D, 0 }, { 0x00A610, 1 },
+    { 0x00A620, 2 }, { 0x00A62A, 1 }, { 0x00A62C, 0 }, { 0x00A640, 1 }, { 0x00A66F, 0 }, { 0x00A67F, 1 },
+    { 0x00A69E, 0 }, { 0x00A6A0, 1 }, { 0x00A6E6, 2 }, { 0x00A6F0, 0 }, { 0x00A717, 1 }, { 0x00A720, 0 },
+    { 0x00A722, 1 }, { 0x00A789, 0 }, { 0x00A78B, 1 }, { 0x00A7DE, 0 }, { 0x00A7E2, 1 }, { 0x00A7E3, 0 },
+    { 0x00A7F1, 1 }, { 0x00A802, 0 }, { 0x00A803, 1 }, { 0x00A806, 0 }, { 0x00A807, 1 }, { 0x00A80B, 0 },
+    { 0x00A80C, 1 }, { 0x00A823, 0 }, { 0x00A830, 2 }, { 0x00A836, 0 }, { 0x00A840, 1 }, { 0x00A874, 0 },
+    { 0x00A882, 1 }, { 0x00A8B4, 0 }, { 0x00A8D0, 2 }, { 0x00A8DA, 0 }, { 0x00A8F2, 1 }, { 0x00A8F8, 0 },
+    { 0x00A8FB, 1 }, { 0x00A8FC, 0 }, { 0x00A8FD, 1 }, { 0x00A8FF, 0 }, { 0x00A900, 2 }, { 0x00A90A, 1 },
+    { 0x00A926, 0 }, { 0x00A930, 1 }, { 0x00A947, 0 }, { 0x00A960, 1 }, { 0x00A97D, 0 }, { 0x00A984, 1 },
+    { 0x00A9B3, 0 }, { 0x00A9CF, 1 }, { 0x00A9D0, 2 }, { 0x00A9DA, 0 }, { 0x00A9E0, 1 }, { 0x00A9E5, 0 },
+    { 0x00A9E6, 1 }, { 0x00A9F0, 2 }, { 0x00A9FA, 1 }, { 0x00A9FF, 0 }, { 0x00AA00, 1 }, { 0x00AA29, 0 },
+    { 0x00AA40, 1 }, { 0x00AA43, 0 }, { 0x00AA44, 1 }, { 0x00AA4C, 0 }, { 0x00AA50, 2 }, { 0x00AA5A, 0 },
+    { 0x00AA60, 1 }, { 0x00AA77, 0 }, { 0x00AA7A, 1 }, { 0x00AA7B, 0 }, { 0x00AA7E, 1 }, { 0x00AAB0, 0 },
+    { 0x00AAB1, 1 }, { 0x00AAB2, 0 }, { 0x00AAB5, 1 }, { 0x00AAB7, 0 }, { 0x00AAB9, 1 }, { 0x00AABE, 0 },
+    { 0x00AAC0, 1 }, { 0x00AAC1, 0 }, { 0x00AAC2, 1 }, { 0x00AAC3, 0 }, { 0x00AADB, 1 }, { 0x00AADE, 0 },
+    { 0x00AAE0, 1 }, { 0x00AAEB, 0 }, { 0x00AAF2, 1 }, { 0x00AAF5, 0 }, { 0x00AB01, 1 }, { 0x00AB07, 0 },
+    { 0x00AB09, 1 }, { 0x00AB0F, 0 }, { 0x00AB11, 1 }, { 0x00AB17, 0 }, { 0x00AB20, 1 }, { 0x00AB27, 0 },
+    { 0x00AB28, 1 }, { 0x00AB2F, 0 }, { 0x00AB30, 1 }, { 0x00AB5B, 0 }, { 0x00AB5C, 1 }, { 0x00AB6A, 0 },
+    { 0x00AB6C, 1 }, { 0x00AB6E, 0 }, { 0x00AB70, 1 }, { 0x00ABE3, 0 }, { 0x00ABF0, 2 }, { 0x00ABFA, 0 },
+    { 0x00AC00, 1 }, { 0x00D7A4, 0 }, { 0x00D7B0, 1 }, { 0x00D7C7, 0 }, { 0x00D7CB, 1 }, { 0x00D7FC, 0 },
+    { 0x00F900, 1 }, { 0x00FA6E, 0 }, { 0x00FA70, 1 }, { 0x00FADA, 0 }, { 0x00FB00, 1 }, { 0x00FB07, 0 },
+    { 0x00FB13, 1 }, { 0x00FB18, 0 }, { 0x00FB1D, 1 }, { 0x00FB1E, 0 }, { 0x00FB1F, 1 }, { 0x00FB29, 0 },
+    { 0x00FB2A, 1 }, { 0x00FB37, 0 }, { 0x00FB38, 1 }, { 0x00FB3D, 0 }, { 0x00FB3E, 1 }, { 0x00FB3F, 0 },
+    { 0x00FB40, 1 }, { 0x00FB42, 0 }, { 0x00FB43, 1 }, { 0x00FB45, 0 }, { 0x00FB46, 1 }, { 0x00FBB2, 0 },
+    { 0x00FBD3, 1 }, { 0x00FD3E, 0 }, { 0x00FD50, 1 }, { 0x00FD90, 0 }, { 0x00FD92, 1 }, { 0x00FDC8, 0 },
+    { 0x00FDF0, 1 }, { 0x00FDFC, 0 }, { 0x00FE70, 1 }, { 0x00FE75, 0 }, { 0x00FE76, 1 }, { 0x00FEFD, 0 },
+    { 0x00FF10, 2 }, { 0x00FF1A, 0 }, { 0x00FF21, 1 }, { 0x00FF3B, 0 }, { 0x00FF41, 1 }, { 0x00FF5B, 0 },
+    { 0x00FF66, 1 }, { 0x00FFBF, 0 }, { 0x00FFC2, 1 }, { 0x00FFC8, 0 }, { 0x00FFCA, 1 }, { 0x00FFD0, 0 },
+    { 0x00FFD2, 1 }, { 0x00FFD8, 0 }, { 0x00FFDA, 1 }, { 0x00FFDD, 0 }, { 0x010000, 1 }, { 0x01000C, 0 },
+    { 0x01000D, 1 }, { 0x010027, 0 }, { 0x010028, 1 }, { 0x01003B, 0 }, { 0x01003C, 1 }, { 0x01003E, 0 },
+    { 0x01003F, 1 }, { 0x01004E, 0 }, { 0x010050, 1 }, { 0x01005E, 0 }, { 0x010080, 1 }, { 0x0100FB, 0 },
+    { 0x010107, 2 }, { 0x010134, 0 }, { 0x010140, 2 }, { 0x010179, 0 }, { 0x01018A, 2 }, { 0x01018C, 0 },
+    { 0x010280, 1 }, { 0x01029D, 0 }, { 0x0102A0, 1 }, { 0x0102D1, 0 }, { 0x0102E1, 2 }, { 0x0102FC, 0 },
+    { 0x010300, 1 }, { 0x010320, 2 }, { 0x010324, 0 }, { 0x01032D, 1 }, { 0x010341, 2 }, { 0x010342, 1 },
+    { 0x01034A, 2 }, { 0x01034B, 0 }, { 0x010350, 1 }, { 0x010376, 0 }, { 0x010380, 1 }, { 0x01039E, 0 },
+    { 0x0103A0, 1 }, { 0x0103C4, 0 }, { 0x0103C8, 1 }, { 0x0103D0, 0 }, { 0x0103D1, 2 }, { 0x0103D6, 0 },
+    { 0x010400, 1 }, { 0x01049E, 0 }, { 0x0104A0, 2 }, { 0x0104AA, 0 }, { 0x0104B0, 1 }, { 0x0104D4, 0 },
+    { 0x0104D8, 1 }, { 0x0104FC, 0 }, { 0x010500, 1 }, { 0x010528, 0 }, { 0x010530, 1 }, { 0x010564, 0 },
+    { 0x010570, 1 }, { 0x01057B, 0 }, { 0x01057C, 1 }, { 0x01058B, 0 }, { 0x01058C, 1 }, { 0x010593, 0 },
+    { 0x010594, 1 }, { 0x010596, 0 }, { 0x010597, 1 }, { 0x0105A2, 0 }, { 0x0105A3, 1 }, { 0x0105B2, 0 },
+    { 0x0105B3, 1 }, { 0x0105BA, 0 }, { 0x0105BB, 1 }, { 0x0105BD, 0 }, { 0x0105C0, 1 }, { 0x0105F4, 0 },
+    { 0x010600, 1 }, { 0x010737, 0 }, { 0x010740, 1 }, { 0x010756, 0 }, { 0x010760, 1 }, { 0x010768, 0 },
+    { 0x010780, 1 }, { 0x010786, 0 }, { 0x010787, 1 }, { 0x0107B1, 0 }, { 0x0107B2, 1 }, { 0x0107C0, 0 },
+    { 0x010800, 1 }, { 0x010806, 0 }, { 0x010808, 1 }, { 0x010809, 0 }, { 0x01080A, 1 }, { 0x010836, 0 },
+    { 0x010837, 1 }, { 0x010839, 0 }, { 0x01083C, 1 }, { 0x01083D, 0 }, { 0x01083F, 1 }, { 0x010856, 0 },
+    { 0x010858, 2 }, { 0x010860, 1 }, { 0x010877, 0 }, { 0x010879, 2 }, { 0x010880, 1 }, { 0x01089F, 0 },
+    { 0x0108A7, 2 }, { 0x0108B0, 0 }, { 0x0108E0, 1 }, { 0x0108F3, 0 }, { 0x0108F4, 1 }, { 0x0108F6, 0 },
+    { 0x0108FB, 2 }, { 0x010900, 1 }, { 0x010916, 2 }, { 0x01091C, 0 }, { 0x010920, 1 }, { 0x01093A, 0 },
+    { 0x010940, 1 }, { 0x01095A, 0 }, { 0x010980, 1 }, { 0x0109B8, 0 }, { 0x0109BC, 2 }, { 0x0109BE, 1 },
+    { 0x0109C0, 2 }, { 0x0109D0, 0 }, { 0x0109D2, 2 }, { 0x010A00, 1 }, { 0x010A01, 0 }, { 0x010A10, 1 },
+    { 0x010A14, 0 }, { 0x010A15, 1 }, { 0x010A18, 0 }, { 0x010A19, 1 }, { 0x010A36, 0 }, { 0x010A40, 2 },
+    { 0x010A49, 0 }, { 0x010A60, 1 }, { 0x010A7D, 2 }, { 0x010A7F, 0 }, { 0x010A80, 1 }, { 0x010A9D, 2 },
+    { 0x010AA0, 0 }, { 0x010AC0, 1 }, { 0x010AC8, 0 }, { 0x010AC9, 1 }, { 0x010AE5, 0 }, { 0x010AEB, 2 },
+    { 0x010AF0, 0 }, { 0x010B00, 1 }, { 0x010B36, 0 }, { 0x010B40, 1 }, { 0x010B56, 0 }, { 0x010B58, 2 },
+    { 0x010B60, 1 }, { 0x010B73, 0 }, { 0x010B78, 2 }, { 0x010B80, 1 }, { 0x010B92, 0 }, { 0x010BA9, 2 },
+    { 0x010BB0, 0 }, { 0x010C00, 1 }, { 0x010C49, 0 }, { 0x010C80, 1 }, { 0x010CB3, 0 }, { 0x010CC0, 1 },
+    { 0x010CF3, 0 }, { 0x010CFA, 2 }, { 0x010D00, 1 }, { 0x010D24, 0 }, { 0x010D30, 2 }, { 0x010D3A, 0 },
+    { 0x010D40, 2 }, { 0x010D4A, 1 }, { 0x010D66, 0 }, { 0x010D6F, 1 }, { 0x010D86, 0 }, { 0x010E60, 2 },
+    { 0x010E7F, 0 }, { 0x010E80, 1 }, { 0x010EAA, 0 }, { 0x010EB0, 1 }, { 0x010EB2, 0 }, { 0x010EC2, 1 },
+    { 0x010EC8, 0 }, { 0x010ED9, 1 }, { 0x010EEF, 0 }, { 0x010F00, 1 }, { 0x010F1D, 2 }, { 0x010F27, 1 },
+    { 0x010F28, 0 }, { 0x010F30, 1 }, { 0x010F46, 0 }, { 0x010F51, 2 }, { 0x010F55, 0 }, { 0x010F70, 1 },
+    { 0x010F82, 0 }, { 0x010FB0, 1 }, { 0x010FC5, 2 }, { 0x010FCC, 0 }, { 0x010FE0, 1 }, { 0x010FF7, 0 },
+    { 0x011003, 1 }, { 0x011038, 0 }, { 0x011052, 2 }, { 0x011070, 0 }, { 0x011071, 1 }, { 0x011073, 0 },
+    { 0x011075, 1 }, { 0x011076, 0 }, { 0x011083, 1 }, { 0x0110B0, 0 }, { 0x0110D0, 1 }, { 0x0110E9, 0 },
+    { 0x0110F0, 2 }, { 0x0110FA, 0 }, { 0x011103, 1 }, { 0x011127, 0 }, { 0x011136, 2 }, { 0x011140, 0 },
+    { 0x011144, 1 }, { 0x011145, 0 }, { 0x011147, 1 }, { 0x011148, 0 }, { 0x011150, 1 }, { 0x011173, 0 },
+    { 0x011176, 1 }, { 0x011177, 0 }, { 0x011183, 1 }, { 0x0111B3, 0 }, { 0x0111C1, 1 }, { 0x0111C5, 0 },
+    { 0x0111D0, 2 }, { 0x0111DA, 1 }, { 0x0111DB, 0 }, { 0x0111DC, 1 }, { 0x0111DD, 0 }, { 0x0111E1, 2 },
+    { 0x0111F5, 0 }, { 0x011200, 1 }, { 0x011212, 0 }, { 0x011213, 1 }, { 0x01122C, 0 }, { 0x01123F, 1 },
+    { 0x011241, 0 }, { 0x011280, 1 }, { 0x011287, 0 }, { 0x011288, 1 }, { 0x011289, 0 }, { 0x01128A, 1 },
+    { 0x01128E, 0 }, { 0x01128F, 1 }, { 0x01129E, 0 }, { 0x01129F, 1 }, { 0x0112A9, 0 }, { 0x0112B0, 1 },
+    { 0x0112DF, 0 }, { 0x0112F0, 2 }, { 0x0112FA, 0 }, { 0x011305, 1 }, { 0x01130D, 0 }, { 0x01130F, 1 },
+    { 0x011311, 0 }, { 0x011313, 1 }, { 0x011329, 0 }, { 0x01132A, 1 }, { 0x011331, 0 }, { 0x011332, 1 },
+    { 0x011334, 0 }, { 0x011335, 1 }, { 0x01133A, 0 }, { 0x01133D, 1 }, { 0x01133E, 0 }, { 0x011350, 1 },
+    { 0x011351, 0 }, { 0x01135D, 1 }, { 0x011362, 0 }, { 0x011380, 1 }, { 0x01138A, 0 }, { 0x01138B, 1 },
+    { 0x01138C, 0 }, { 0x01138E, 1 }, { 0x01138F, 0 }, { 0x011390, 1 }, { 0x0113B6, 0 }, { 0x0113B7, 1 },
+    { 0x0113B8, 0 }, { 0x0113D1, 1 }, { 0x0113D2, 0 }, { 0x0113D3, 1 }, { 0x0113D4, 0 }, { 0x011400, 1 },
+    { 0x011435, 0 }, { 0x011447, 1 }, { 0x01144B, 0 }, { 0x011450, 2 }, { 0x01145A, 0 }, { 0x01145F, 1 },
+    { 0x011462, 0 }, { 0x011480, 1 }, { 0x0114B0, 0 }, { 0x0114C4, 1 }, { 0x0114C6, 0 }, { 0x0114C7, 1 },
+    { 0x0114C8, 0 }, { 0x0114D0, 2 }, { 0x0114DA, 0 }, { 0x011580, 1 }, { 0x0115AF, 0 }, { 0x0115D8, 1 },
+    { 0x0115DC, 0 }, { 0x011600, 1 }, { 0x011630, 0 }, { 0x011644, 1 }, { 0x011645, 0 }, { 0x011650, 2 },
+    { 0x01165A, 0 }, { 0x011680, 1 }, { 0x0116AB, 0 }, { 0x0116B8, 1 }, { 0x0116B9, 0 }, { 0x0116C0, 2 },
+    { 0x0116CA, 0 }, { 0x0116D0, 2 }, { 0x0116E4, 0 }, { 0x011700, 1 }, { 0x01171B, 0 }, { 0x011730, 2 },
+    { 0x01173C, 0 }, { 0x011740, 1 }, { 0x011747, 0 }, { 0x011800, 1 }, { 0x01182C, 0 }, { 0x0118A0, 1 },
+    { 0x0118E0, 2 }, { 0x0118F3, 0 }, { 0x0118FF, 1 }, { 0x011907, 0 }, { 0x011909, 1 }, { 0x01190A, 0 },
+    { 0x01190C, 1 }, { 0x011914, 0 }, { 0x011915, 1 }, { 0x011917, 0 }, { 0x011918, 1 }, { 0x011930, 0 },
+    { 0x01193F, 1 }, { 0x011940, 0 }, { 0x011941, 1 }, { 0x011942, 0 }, { 0x011950, 2 }, { 0x01195A, 0 },
+    { 0x0119A0, 1 }, { 0x0119A8, 0 }, { 0x0119AA, 1 }, { 0x0119D1, 0 }, { 0x0119E1, 1 }, { 0x0119E2, 0 },
+    { 0x0119E3, 1 }, { 0x0119E4, 0 }, { 0x011A00, 1 }, { 0x011A01, 0 }, { 0x011A0B, 1 }, { 0x011A33, 0 },
+    { 0x011A3A, 1 }, { 0x011A3B, 0 }, { 0x011A50, 1 }, { 0x011A51, 0 }, { 0x011A5C, 1 }, { 0x011A8A, 0 },
+    { 0x011A9D, 1 }, { 0x011A9E, 0 }, { 0x011AB0, 1 }, { 0x011AF9, 0 }, { 0x011B0A, 1 }, { 0x011B0B, 0 },
+    { 0x011BC0, 1 }, { 0x011BE1, 0 }, { 0x011BF0, 2 }, { 0x011BFA, 0 }, { 0x011C00, 1 }, { 0x011C09, 0 },
+    { 0x011C0A, 1 }, { 0x011C2F, 0 }, { 0x011C40, 1 }, { 0x011C41, 0 }, { 0x011C50, 2 }, { 0x011C6D, 0 },
+    { 0x011C72, 1 }, { 0x011C90, 0 }, { 0x011D00, 1 }, { 0x011D07, 0 }, { 0x011D08, 1 }, { 0x011D0A, 0 },
+    { 0x011D0B, 1 }, { 0x011D31, 0 }, { 0x011D46, 1 }, { 0x011D47, 0 }, { 0x011D50, 2 }, { 0x011D5A, 0 },
+    { 0x011D60, 1 }, { 0x011D66, 0 }, { 0x011D67, 1 }, { 0x011D69, 0 }, { 0x011D6A, 1 }, { 0x011D8A, 0 },
+    { 0x011D98, 1 }, { 0x011D99, 0 }, { 0x011DA0, 2 }, { 0x011DAA, 0 }, { 0x011DB0, 1 }, { 0x011DDC, 0 },
+    { 0x011DE0, 2 }, { 0x011DEA, 0 }, { 0x011DF1, 1 }, { 0x011DF2, 0 }, { 0x011EE0, 1 }, { 0x011EF3, 0 },
+    { 0x011F02, 1 }, { 0x011F03, 0 }, { 0x011F04, 1 }, { 0x011F11, 0 }, { 0x011F12, 1 }, { 0x011F34, 0 },
+    { 0x011F50, 2 }, { 0x011F5A, 0 }, { 0x011FB0, 1 }, { 0x011FB1, 0 }, { 0x011FC0, 2 }, { 0x011FD5, 0 },
+    { 0x012000, 1 }, { 0x01239A, 0 }, { 0x012400, 2 }, { 0x012470, 0 }, { 0x012475, 2 }, { 0x012480, 1 },
+    { 0x012544, 0 }, { 0x012550, 2 }, { 0x012687, 0 }, { 0x012F90, 1 }, { 0x012FF1, 0 }, { 0x013000, 1 },
+    { 0x013430, 0 }, { 0x013441, 1 }, { 0x013447, 0 }, { 0x013460, 1 }, { 0x0143FB, 0 }, { 0x014400, 1 },
+    { 0x014647, 0 }, { 0x016100, 1 }, { 0x01611E, 0 }, { 0x016130, 2 }, { 0x01613A, 0 }, { 0x016800, 1 },
+    { 0x016A39, 0 }, { 0x016A40, 1 }, { 0x016A5F, 0 }, { 0x016A60, 2 }, { 0x016A6A, 0 }, { 0x016A70, 1 },
+    { 0x016ABF, 0 }, { 0x016AC0, 2 }, { 0x016ACA, 0 }, { 0x016AD0, 1 }, { 0x016AEE, 0 }, { 0x016B00, 1 },
+    { 0x016B30, 0 }, { 0x016B40, 1 }, { 0x016B44, 0 }, { 0x016B50, 2 }, { 0x016B5A, 0 }, { 0x016B5B, 2 },
+    { 0x016B62, 0 }, { 0x016B63, 1 }, { 0x016B78, 0 }, { 0x016B7D, 1 }, { 0x016B90, 0 }, { 0x016D40, 1 },
+    { 0x016D6D, 0 }, { 0x016D70, 2 }, { 0x016D7A, 0 }, { 0x016E40, 1 }, { 0x016E80, 2 }, { 0x016E97, 0 },
+    { 0x016EA0, 1 }, { 0x016EB9, 0 }, { 0x016EBB, 1 }, { 0x016ED4, 0 }, { 0x016F00, 1 }, { 0x016F4B, 0 },
+    { 0x016F50, 1 }, { 0x016F51, 0 }, { 0x016F93, 1 }, { 0x016FA0, 0 }, { 0x016FE0, 1 }, { 0x016FE2, 0 },
+    { 0x016FE3, 1 }, { 0x016FE4, 0 }, { 0x016FF2, 1 }, { 0x016FF4, 2 }, { 0x016FF7, 0 }, { 0x017000, 1 },
+    { 0x018CDB, 0 }, { 0x018CFF, 1 }, { 0x018D21, 0 }, { 0x018D80, 1 }, { 0x018DF3, 0 }, { 0x018E00, 1 },
+    { 0x019192, 0 }, { 0x0191A0, 1 }, { 0x0191D3, 0 }, { 0x01AFF0, 1 }, { 0x01AFF4, 0 }, { 0x01AFF5, 1 },
+    { 0x01AFFC, 0 }, { 0x01AFFD, 1 }, { 0x01AFFF, 0 }, { 0x01B000, 1 }, { 0x01B129, 0 }, { 0x01B132, 1 },
+    { 0x01B133, 0 }, { 0x01B150, 1 }, { 0x01B153, 0 }, { 0x01B155, 1 }, { 0x01B156, 0 }, { 0x01B164, 1 },
+    { 0x01B169, 0 }, { 0x01B170, 1 }, { 0x01B2FC, 0 }, { 0x01BC00, 1 }, { 0x01BC6B, 0 }, { 0x01BC70, 1 },
+    { 0x01BC7D, 0 }, { 0x01BC80, 1 }, { 0x01BC89, 0 }, { 0x01BC90, 1 }, { 0x01BC9A, 0 }, { 0x01CCF0, 2 },
+    { 0x01CCFA, 0 }, { 0x01D2C0, 2 }, { 0x01D2D4, 0 }, { 0x01D2E0, 2 }, { 0x01D2F4, 0 }, { 0x01D360, 2 },
+    { 0x01D379, 0 }, { 0x01D400, 1 }, { 0x01D455, 0 }, { 0x01D456, 1 }, { 0x01D49D, 0 }, { 0x01D49E, 1 },
+    { 0x01D4A0, 0 }, { 0x01D4A2, 1 }, { 0x01D4A3, 0 }, { 0x01D4A5, 1 }, { 0x01D4A7, 0 }, { 0x01D4A9, 1 },
+    { 0x01D4AD, 0 }, { 0x01D4AE, 1 }, { 0x01D4BA, 0 }, { 0x01D4BB, 1 }, { 0x01D4BC, 0 }, { 0x01D4BD, 1 },
+    { 0x01D4C4, 0 }, { 0x01D4C5, 1 }, { 0x01D506, 0 }, { 0x01D507, 1 }, { 0x01D50B, 0 }, { 0x01D50D, 1 },
+    { 0x01D515, 0 }, { 0x01D516, 1 }, { 0x01D51D, 0 }, { 0x01D51E, 1 }, { 0x01D53A, 0 }, { 0x01D53B, 1 },
+    { 0x01D53F, 0 }, { 0x01D540, 1 }, { 0x01D545, 0 }, { 0x01D546, 1 }, { 0x01D547, 0 }, { 0x01D54A, 1 },
+    { 0x01D551, 0 }, { 0x01D552, 1 }, { 0x01D6A7, 0 }, { 0x01D6A8, 1 }, { 0x01D6C1, 0 }, { 0x01D6C2, 1 },
+    { 0x01D6DB, 0 }, { 0x01D6DC, 1 }, { 0x01D6FB, 0 }, { 0x01D6FC, 1 }, { 0x01D715, 0 }, { 0x01D716, 1 },
+    { 0x01D735, 0 }, { 0x01D736, 1 }, { 0x01D74F, 0 }, { 0x01D750, 1 }, { 0x01D76F, 0 }, { 0x01D770, 1 },
+    { 0x01D789, 0 }, { 0x01D78A, 1 }, { 0x01D7A9, 0 }, { 0x01D7AA, 1 }, { 0x01D7C3, 0 }, { 0x01D7C4, 1 },
+    { 0x01D7CC, 0 }, { 0x01D7CE, 2 }, { 0x01D800, 0 }, { 0x01DF00, 1 }, { 0x01DF82, 0 }, { 0x01DF90, 1 },
+    { 0x01DF97, 0 }, { 0x01DFCD, 1 }, { 0x01E000, 0 }, { 0x01E030, 1 }, { 0x01E06E, 0 }, { 0x01E100, 1 },
+    { 0x01E12D, 0 }, { 0x01E137, 1 }, { 0x01E13E, 0 }, { 0x01E140, 2 }, { 0x01E14A, 0 }, { 0x01E14E, 1 },
+    { 0x01E14F, 0 }, { 0x01E290, 1 }, { 0x01E2AE, 0 }, { 0x01E2C0, 1 }, { 0x01E2EC, 0 }, { 0x01E2F0, 2 },
+    { 0x01E2FA, 0 }, { 0x01E4D0, 1 }, { 0x01E4EC, 0 }, { 0x01E4F0, 2 }, { 0x01E4FA, 0 }, { 0x01E5D0, 1 },
+    { 0x01E5EE, 0 }, { 0x01E5F0, 1 }, { 0x01E5F1, 2 }, { 0x01E5FB, 0 }, { 0x01E6C0, 1 }, { 0x01E6DF, 0 },
+    { 0x01E6E0, 1 }, { 0x01E6E3, 0 }, { 0x01E6E4, 1 }, { 0x01E6E6, 0 }, { 0x01E6E7, 1 }, { 0x01E6EE, 0 },
+    { 0x01E6F0, 1 }, { 0x01E6F5, 0 }, { 0x01E6FE, 1 }, { 0x01E700, 0 }, { 0x01E7E0, 1 }, { 0x01E7E7, 0 },
+    { 0x01E7E8, 1 }, { 0x01E7EC, 0 }, { 0x01E7ED, 1 }, { 0x01E7EF, 0 }, { 0x01E7F0, 1 }, { 0x01E7FF, 0 },
+    { 0x01E800, 1 }, { 0x01E8C5, 0 }, { 0x01E8C7, 2 }, { 0x01E8D0, 0 }, { 0x01E900, 1 }, { 0x01E944, 0 },
+    { 0x01E94B, 1 }, { 0x01E94C, 0 }, { 0x01E950, 2 }, { 0x01E95A, 0 }, { 0x01EC71, 2 }, { 0x01ECAC, 0 },
+    { 0x01ECAD, 2 }, { 0x01ECB0, 0 }, { 0x01ECB1, 2 }, { 0x01ECB5, 0 }, { 0x01ED01, 2 }, { 0x01ED2E, 0 },
+    { 0x01ED2F, 2 }, { 0x01ED3E, 0 }, { 0x01EE00, 1 }, { 0x01EE04, 0 }, { 0x01EE05, 1 }, { 0x01EE20, 0 },
+    { 0x01EE21, 1 }, { 0x01EE23, 0 }, { 0x01EE24, 1 }, { 0x01EE25, 0 }, { 0x01EE27, 1 }, { 0x01EE28, 0 },
+    { 0x01EE29, 1 }, { 0x01EE33, 0 }, { 0x01EE34, 1 }, { 0x01EE38, 0 }, { 0x01EE39, 1 }, { 0x01EE3A, 0 },
+    { 0x01EE3B, 1 }, { 0x01EE3C, 0 }, { 0x01EE42, 1 }, { 0x01EE43, 0 }, { 0x01EE47, 1 }, { 0x01EE48, 0 },
+    { 0x01EE49, 1 }, { 0x01EE4A, 0 }, { 0x01EE4B, 1 }, { 0x01EE4C, 0 }, { 0x01EE4D, 1 }, { 0x01EE50, 0 },
+    { 0x01EE51, 1 }, { 0x01EE53, 0 }, { 0x01EE54, 1 }, { 0x01EE55, 0 }, { 0x01EE57, 1 }, { 0x01EE58, 0 },
+    { 0x01EE59, 1 }, { 0x01EE5A, 0 }, { 0x01EE5B, 1 }, { 0x01EE5C, 0 }, { 0x01EE5D, 1 }, { 0x01EE5E, 0 },
+    { 0x01EE5F, 1 }, { 0x01EE60, 0 }, { 0x01EE61, 1 }, { 0x01EE63, 0 }, { 0x01EE64, 1 }, { 0x01EE65, 0 },
+    { 0x01EE67, 1 }, { 0x01EE6B, 0 }, { 0x01EE6C, 1 }, { 0x01EE73, 0 }, { 0x01EE74, 1 }, { 0x01EE78, 0 },
+    { 0x01EE79, 1 }, { 0x01EE7D, 0 }, { 0x01EE7E, 1 }, { 0x01EE7F, 0 }, { 0x01EE80, 1 }, { 0x01EE8A, 0 },
+    { 0x01EE8B, 1 }, { 0x01EE9C, 0 }, { 0x01EEA1, 1 }, { 0x01EEA4, 0 }, { 0x01EEA5, 1 }, { 0x01EEAA, 0 },
+    { 0x01EEAB, 1 }, { 0x01EEBC, 0 }, { 0x01F100, 2 }, { 0x01F10D, 0 }, { 0x01FBF0, 2 }, { 0x01FBFA, 0 },
+    { 0x020000, 1 }, { 0x02A6E0, 0 }, { 0x02A700, 1 }, { 0x02B81F, 0 }, { 0x02B820, 1 }, { 0x02CEAE, 0 },
+    { 0x02CEB0, 1 }, { 0x02EBE1, 0 }, { 0x02EBF0, 1 }, { 0x02EE5E, 0 }, { 0x02F800, 1 }, { 0x02FA1E, 0 },
+    { 0x030000, 1 }, { 0x03134B, 0 }, { 0x031350, 1 }, { 0x03347A, 0 }, { 0x03D000, 1 }, { 0x03FC40, 0 },
+};
+
+static whisper_unicode_class whisper_unicode_class_of(uint32_t cp) {
+    if (cp < 0x80) {
+        if ((cp >= 'a' && cp <= 'z') || (cp >= 'A' && cp <= 'Z')) {
+            return WHISPER_UNICODE_LETTER;
+        }
+        if (cp >= '0' && cp <= '9') {
+            return WHISPER_UNICODE_NUMBER;
+        }
+        if (cp == ' ' || (cp >= '\t' && cp <= '\r')) {
+            return WHISPER_UNICODE_SPACE;
+        }
+        return WHISPER_UNICODE_OTHER;
+    }
+
+    // last run starting at or before cp
+    int i0 = 0;
+    int i1 = sizeof(whisper_unicode_runs)/sizeof(whisper_unicode_runs[0]);
+    while (i1 - i0 > 1) {
+        const int im = (i0 + i1)/2;
+        if (whisper_unicode_runs[im].cp0 <= cp) {
+            i0 = im;
+        } else {
+            i1 = im;
+        }
+    }
+
+    return (whisper_unicode_class) whisper_unicode_runs[i0].cls;
+}
@@ -1,5 +1,6 @@
 #include "whisper.h"
 #include "whisper-arch.h"
+#include "whisper-unicode.h"
 
 #include "ggml.h"
 #include "ggml-cpp.h"
@@ -18,26 +19,40 @@
 #include <algorithm>
 #include <cassert>
 #include <cfloat>
+#include <chrono>
 #define _USE_MATH_DEFINES
 #include <cmath>
 #include <climits>
+#include <condition_variable>
 #include <cstdarg>
+#include <cstddef>
 #include <cstdio>
 #include <cstring>
+#include <deque>
 #include <fstream>
 #include <functional>
 #include <map>
+#include <memory>
+#include <mutex>
 #include <random>
 #include <regex>
 #include <set>
 #include <string>
 #include <thread>
+#include <tuple>
 #include <vector>
 
 #ifdef _MSC_VER
 #include <codecvt>
 #endif
 
+#if defined(__unix__) || defined(__APPLE__)
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#endif
+
 #if defined(WHISPER_BIG_ENDIAN)
 template<typename T>
 static T byteswap(T value) {
@@ -141,6 +156,11 @@ static void whisper_log_callback_default(ggml_log_level level, const char * text
 
 #define WHISPER_MAX_DECODERS 8
 
+// default of whisper_context_params.flash_attn, set by the WHISPER_FLASH_ATTN CMake option
+#ifndef WHISPER_FLASH_ATTN_DEFAULT
+#define WHISPER_FLASH_ATTN_DEFAULT 1
+#endif
+
 // temperature below which we condition on past text history
 static constexpr float WHISPER_HISTORY_CONDITIONING_TEMP_CUTOFF = 0.5f;
 
@@ -277,6 +297,20 @@ static const std::map<e_model, std::string> g_model_name = {
     { MODEL_LARGE,    "large"    },
 };
 
+// default audio_ctx_auto margins, the whisper_full_params.audio_ctx_auto_* fields override them:
+//
+//   n_margin - encoder positions (20 ms each) kept after the audio of a window. the models were trained on 30 s
+//              windows, mostly ending in silence, and can drop or make up the last words without a margin
+//   n_min    - smallest audio context, the cross-attention over a handful of positions is not reliable
+//   n_bucket - the audio context is rounded up to a multiple of n_bucket
+//
+// these are conservative guesses for all model sizes, not measured values: 2.56 s of margin and at least 7.68 s of
+// context. check the WER of your own audio with audio_ctx_auto on and off before lowering them. the encoder time is
+// about linear in the audio context, e.g. a 5 s clip is encoded over 384 positions instead of 1500
+static const int WHISPER_AUDIO_CTX_AUTO_MARGIN = 128;
+static const int WHISPER_AUDIO_CTX_AUTO_MIN    = 384;
+static const int WHISPER_AUDIO_CTX_AUTO_BUCKET = 128;
+
 static const std::map<std::string, std::pair<int, std::string>> g_lang = {
     { "en",  { 0,  "english",         } },
     { "zh",  { 1,  "chinese",         } },
@@ -416,24 +450,82 @@ struct whisper_mel {
     int n_len_org;
     int n_mel;
 
+    // band j of frame i is data[j*n_stride + i] for the stored frames i < n_len_data
+    // the frames [n_len_data, n_len) are the zero-padded tail and all have the value v_tail
+    int   n_stride   = 0;
+    int   n_len_data = 0;
+    float v_tail     = 0.0f;
+
     std::vector<float> data;
 };
 
+// state of whisper_pcm_to_mel_append_with_state()
+struct whisper_mel_stream {
+    int64_t n_samples = 0; // samples appended since the last reset
+    int     n_final   = 0; // leading frames that later samples can no longer change
+
+    // padded signal starting at the first frame that is not final (sample n_final*WHISPER_HOP_LENGTH)
+    std::vector<float> pcm;
+
+    // log10 mel values before the clamping and normalization, same layout as whisper_mel::data
+    std::vector<float> raw;
+
+    float max_final = -INFINITY; // max of raw over the final frames
+    float mmax      = NAN;       // clamp value used for the mel currently in the state
+};
+
+// work buffers of one mel worker, kept in the state and reused across calls
+struct whisper_mel_scratch {
+    std::vector<float> fft_in;
+    std::vector<float> fft_out;
+    std::vector<float> fft_scratch;
+
+    // power spectra of a block of frames
+    std::vector<float> power;
+};
+
 struct whisper_filters {
     int32_t n_mel;
     int32_t n_fft;
 
     std::vector<float> data;
+
+    // non-zero range [k_beg, k_end) of each filter - the filterbank is mostly zeros
+    std::vector<int32_t> k_beg;
+    std::vector<int32_t> k_end;
 };
 
 struct whisper_vocab {
-    using id    = int32_t;
-    using token = std::string;
+    using id = int32_t;
 
     int n_vocab = 51864;
 
-    std::map<token, id> token_to_id;
-    std::map<id, token> id_to_token;
+    // the tokens are stored back to back, each followed by a 0
+    std::string          token_data;
+    std::vector<int32_t> token_offs;  // token i starts at token_data[token_offs[i]], n_tokens() + 1 entries
+    std::vector<id>      token_index; // open addressing hash table of the token ids, -1 if empty - see whisper_token_find()
+    std::vector<id>      token_byte;  // the token of each byte, for the tokenizer
+    bool                 token_raw = false; // every byte is a token - see whisper_vocab_init_index()
+
+    int n_tokens() const {
+        return (int) token_offs.size() - 1;
+    }
+
+    // the text of a token, 0-terminated
+    const char * token_text(id i) const {
+        return token_data.data() + token_offs[i];
+    }
+
+    // the length of the text of a token, without the terminating 0
+    size_t token_size(id i) const {
+        return token_offs[i + 1] - token_offs[i] - 1;
+    }
+
+    void add_token(const char * text, size_t n) {
+        token_data.append(text, n);
+        token_data.push_back(0);
+        token_offs.push_back(token_data.size());
+    }
 
     // reference: https://github.com/openai/whisper/blob/248b6cb124225dd263bb9bd32d060b6517e067f8/whisper/tokenizer.py#L334-L349
     id token_eot        = 50256;
@@ -539,8 +631,27 @@ struct whisper_sched {
     ggml_backend_sched_t sched = nullptr;
 
     std::vector<uint8_t> meta;
+
+    // the graph of the last call, still allocated in sched - a call with the same shape key only sets the inputs
+    // again (see whisper_decode_internal). built in meta, so building another graph replaces it
+    ggml_cgraph *        graph = nullptr;
+    std::vector<int64_t> graph_key;
+
+    int64_t n_graph_reuse    = 0;
+    int64_t n_graph_build    = 0;
+    int64_t t_graph_build_us = 0;
 };
 
+// drop the kept graph, e.g. when the tensors it uses are reallocated
+static void whisper_sched_graph_reset(struct whisper_sched & allocr) {
+    if (allocr.graph != nullptr) {
+        ggml_backend_sched_reset(allocr.sched);
+    }
+
+    allocr.graph = nullptr;
+    allocr.graph_key.clear();
+}
+
 static size_t whisper_sched_size(struct whisper_sched & allocr) {
     size_t size = allocr.meta.size();
     for (int i = 0; i < ggml_backend_sched_get_n_backends(allocr.sched); ++i) {
@@ -555,6 +666,8 @@ static bool whisper_sched_graph_init(struct whisper_sched & allocr, std::vector<
     auto & sched = allocr.sched;
     auto & meta  = allocr.meta;
 
+    whisper_sched_graph_reset(allocr);
+
     sched = ggml_backend_sched_new(backends.data(), nullptr, backends.size(), WHISPER_MAX_NODES, false, true);
 
     meta.resize(ggml_tensor_overhead()*WHISPER_MAX_NODES + ggml_graph_overhead());
@@ -813,12 +926,64 @@ struct whisper_decoder {
     std::vector<float> logits;
     std::vector<float> logprobs;
 
+    // the most probable token after the last whisper_process_logits() (-1 - none)
+    int id_best = -1;
+
     // work container used to avoid memory allocations
     std::vector<whisper_pair<double, whisper_vocab::id>> logits_id;
 
+    // cumulative distribution of probs, work container for sampling at t > 0.0
+    std::vector<double> cdf;
+
     mutable std::mt19937 rng; // used for sampling at t > 0.0
 };
 
+// the tokens suppressed at every step of a decoding, one bit per token
+// depends only on the decoding parameters, see whisper_logits_mask_init()
+struct whisper_logits_mask {
+    std::vector<uint64_t> base; // before whisper_full_params.logits_filter_callback
+    std::vector<uint64_t> post; // after it (suppress_regex, suppress_nst)
+};
+
+// the post masks of the whisper_full_params seen by a context
+// building one means matching suppress_regex against the whole vocabulary, while most callers use the same params
+struct whisper_logits_mask_cache {
+    std::mutex mutex;
+
+    // (suppress_regex, suppress_regex != nullptr, suppress_nst) -> mask
+    std::map<std::tuple<std::string, bool, bool>, std::vector<uint64_t>> post;
+};
+
+// the cross-attention K/V computed by the encoder for recently encoded mel windows, evicted least recently used first
+// see whisper_context_params.enc_cache_size
+struct whisper_enc_cache {
+    struct entry {
+        uint64_t hash;
+        int      n_ctx;
+
+        std::vector<float>   mel; // the encoded window, compared on a hit in case of a hash collision
+        std::vector<uint8_t> k;
+        std::vector<uint8_t> v;
+
+        int64_t t_used;
+
+        size_t size() const {
+            return mel.size()*sizeof(float) + k.size() + v.size();
+        }
+    };
+
+    std::mutex mutex;
+
+    // the K/V are copied to and from the states without the lock
+    std::vector<std::shared_ptr<entry>> entries;
+
+    size_t  size  = 0; // bytes held by the entries
+    int64_t clock = 0;
+
+    int64_t n_hit  = 0;
+    int64_t n_miss = 0;
+};
+
 // [EXPERIMENTAL] Token-level timestamps with DTW
 struct whisper_aheads_masks {
     std::vector<struct ggml_tensor *> m;    // One mask per text layer.
@@ -862,10 +1027,18 @@ struct whisper_state {
 
     whisper_mel mel;
 
+    // one entry per mel worker
+    std::vector<whisper_mel_scratch> mel_scratch;
+
+    whisper_mel_stream mel_stream;
+
     whisper_batch batch;
 
     whisper_decoder decoders[WHISPER_MAX_DECODERS];
 
+    // the suppressed tokens for the parameters of the current decoding
+    whisper_logits_mask logits_mask;
+
     std::vector<ggml_backend_t> backends;
 
     // - stores meta info about the intermediate tensors into the `meta` buffers
@@ -882,6 +1055,11 @@ struct whisper_state {
     std::vector<float> inp_mel;
     std::vector<float> inp_mask;
 
+    std::vector<int32_t> inp_kv_idxs;
+
+    // shape key of the decoder graph, see whisper_sched::graph_key
+    std::vector<int64_t> graph_key;
+
     // decode output (2-dimensional array: [n_tokens][n_vocab])
     std::vector<float> logits;
 
@@ -920,6 +1098,14 @@ struct whisper_state {
     // [EXPERIMENTAL] speed-up techniques
     int32_t exp_n_audio_ctx = 0; // 0 - use default
 
+    // the mel offset and the audio context of the window whose encoding is in kv_cross (-1 - none)
+    // whisper_full_with_state() does not encode this window again, e.g. after whisper_encode_batch()
+    int enc_mel_offset = -1;
+    int enc_n_ctx      = 0;
+
+    // the decoder computes the logits of the language tokens only, for language identification
+    bool logits_lang = false;
+
     whisper_vad_context * vad_context = nullptr;
 
     struct vad_segment_info {
@@ -934,6 +1120,177 @@ struct whisper_state {
     std::vector<vad_time_mapping> vad_mapping_table;
 };
 
+// persistent worker threads, shared by all states of a context
+//
+// parallel_for(n, fn) calls fn(0) .. fn(n - 1) and returns after all of them have finished
+// fn(0) always runs on the calling thread, which then helps with the remaining indices - a task
+// can therefore start a nested parallel_for() without waiting for a free worker
+// threads are spawned on demand so that a job always finds n - 1 idle workers and are joined when
+// the context is freed
+struct whisper_thread_pool {
+    struct job {
+        const std::function<void(int)> * fn = nullptr;
+
+        int n      = 0;
+        int n_done = 0; // guarded by the pool mutex
+
+        std::atomic<int> next{1};
+    };
+
+    std::mutex              mutex;
+    std::condition_variable cv_work;
+    std::condition_variable cv_done;
+
+    std::deque<std::shared_ptr<job>> queue;
+    std::vector<std::thread>         workers;
+
+    int  n_idle = 0;
+    bool stop   = false;
+
+    whisper_thread_pool() = default;
+    whisper_thread_pool(const whisper_thread_pool &) = delete;
+    whisper_thread_pool & operator=(const whisper_thread_pool &) = delete;
+
+    ~whisper_thread_pool() {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            stop = true;
+        }
+        cv_work.notify_all();
+
+        for (auto & worker : workers) {
+            worker.join();
+        }
+    }
+
+    void parallel_for(int n, const std::function<void(int)> & fn) {
+        if (n <= 1) {
+            if (n == 1) {
+                fn(0);
+            }
+            return;
+        }
+
+        auto j = std::make_shared<job>();
+        j->fn = &fn;
+        j->n  = n;
+
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+
+            const int n_spawn = (n - 1) - (n_idle - (int) queue.size());
+            for (int i = 0; i < n_spawn; ++i) {
+                workers.emplace_back(&whisper_thread_pool::worker_main, this);
+            }
+
+            for (int i = 0; i < n - 1; ++i) {
+                queue.push_back(j);
+            }
+        }
+        cv_work.notify_all();
+
+        fn(0);
+        run(*j, 1);
+
+        std::unique_lock<std::mutex> lock(mutex);
+        cv_done.wait(lock, [&] { return j->n_done == j->n; });
+    }
+
+private:
+    // claim and run indices of the job until none are left
+    void run(job & j, int n_run) {
+        for (int i = j.next++; i < j.n; i = j.next++) {
+            (*j.fn)(i);
+            ++n_run;
+        }
+
+        if (n_run > 0) {
+            std::lock_guard<std::mutex> lock(mutex);
+            j.n_done += n_run;
+            if (j.n_done == j.n) {
+                cv_done.notify_all();
+            }
+        }
+    }
+
+    void worker_main() {
+        std::unique_lock<std::mutex> lock(mutex);
+
+        while (true) {
+            ++n_idle;
+            cv_work.wait(lock, [this] { return stop || !queue.empty(); });
+            --n_idle;
+
+            if (stop) {
+                return;
+            }
+
+            // the entries of a finished job are stale - run() returns without touching fn
+            std::shared_ptr<job> j = std::move(queue.front());
+            queue.pop_front();
+
+            lock.unlock();
+            run(*j, 0);
+            lock.lock();
+        }
+    }
+};
+
+// read-only shared mapping of a model file
+// host buffer weights alias the mapping, so all processes that load the same file share the page cache copy
+struct whisper_mmap {
+    void * addr = nullptr;
+    size_t size = 0;
+    size_t pos  = 0; // read position of the model loader
+
+    whisper_mmap() = default;
+    whisper_mmap(const whisper_mmap &) = delete;
+    whisper_mmap & operator=(const whisper_mmap &) = delete;
+
+    // returns nullptr if the file cannot be mapped on this platform
+    static whisper_mmap * open(const char * path) {
+#if defined(_POSIX_MAPPED_FILES) && !defined(WHISPER_BIG_ENDIAN)
+        const int fd = ::open(path, O_RDONLY);
+        if (fd < 0) {
+            return nullptr;
+        }
+
+        struct stat st;
+        if (fstat(fd, &st) != 0 || st.st_size <= 0) {
+            ::close(fd);
+            return nullptr;
+        }
+
+        void * addr = mmap(nullptr, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+        ::close(fd);
+
+        if (addr == MAP_FAILED) {
+            return nullptr;
+        }
+
+        // the whole file is read during the load anyway
+        posix_madvise(addr, st.st_size, POSIX_MADV_WILLNEED);
+
+        whisper_mmap * mapping = new whisper_mmap;
+        mapping->addr = addr;
+        mapping->size = st.st_size;
+
+        return mapping;
+#else
+        (void) path;
+        return nullptr;
+#endif
+    }
+
+    ~whisper_mmap() {
+#if defined(_POSIX_MAPPED_FILES) && !defined(WHISPER_BIG_ENDIAN)
+        if (addr) {
+            munmap(addr, size);
+        }
+#endif
+    }
+};
+
 struct whisper_context {
     int64_t t_load_us  = 0;
     int64_t t_start_us = 0;
@@ -941,6 +1298,16 @@ struct whisper_context {
     ggml_type wtype = ggml_type::GGML_TYPE_F16; // weight type (FP32 / FP16 / QX)
     ggml_type itype = ggml_type::GGML_TYPE_F16; // intermediate type (FP32 or FP16)
 
+    // types of the KV caches, see whisper_context_params.kv_self_type and kv_cross_type
+    ggml_type kv_self_type_k  = GGML_TYPE_F16;
+    ggml_type kv_self_type_v  = GGML_TYPE_F16;
+    ggml_type kv_cross_type_k = GGML_TYPE_F16;
+    ggml_type kv_cross_type_v = GGML_TYPE_F16;
+
+    // the audio positions of the encoder self-attention and of the cross-attention are padded to this with flash
+    // attention, see whisper_audio_ctx_get_padding()
+    int audio_ctx_pad = 1;
+
     whisper_context_params params;
 
     whisper_model model;
@@ -948,6 +1315,18 @@ struct whisper_context {
 
     whisper_state * state = nullptr;
 
+    // worker threads for the mel spectrogram, the per-decoder sampling and whisper_full_parallel()
+    whisper_thread_pool pool;
+
+    // suppression masks shared by all states, see whisper_logits_mask_init()
+    whisper_logits_mask_cache logits_mask_cache;
+
+    // encoder results shared by all states, see whisper_encode_internal()
+    whisper_enc_cache enc_cache;
+
+    // the model file, if it was loaded with use_mmap - must outlive the weight buffers
+    std::unique_ptr<whisper_mmap> mapping;
+
     std::string path_model; // populated by whisper_init_from_file_with_params()
 };
 
@@ -965,10 +1344,100 @@ static void read_safe(whisper_model_loader * loader, T & dest) {
     BYTESWAP_VALUE(dest);
 }
 
+// FNV-1a
+static uint32_t whisper_token_hash(const char * text, size_t n) {
+    uint32_t h = 2166136261u;
+    for (size_t i = 0; i < n; ++i) {
+        h = (h ^ (uint8_t) text[i])*16777619u;
+    }
+    return h;
+}
+
+// id of the token text[0, n), -1 if there is none
+// a token that appears several times in the vocabulary maps to its last id
+static whisper_vocab::id whisper_token_find(const whisper_vocab & vocab, const char * text, size_t n) {
+    const uint32_t mask = vocab.token_index.size() - 1;
+
+    for (uint32_t i = whisper_token_hash(text, n) & mask; ; i = (i + 1) & mask) {
+        const whisper_vocab::id id = vocab.token_index[i];
+        if (id < 0) {
+            return -1;
+        }
+
+        if (vocab.token_size(id) == n && memcmp(vocab.token_text(id), text, n) == 0) {
+            return id;
+        }
+    }
+}
+
+static whisper_vocab::id whisper_token_find(const whisper_vocab & vocab, const std::string & text) {
+    return whisper_token_find(vocab, text.data(), text.size());
+}
+
+// builds the hash table of the tokens added with whisper_vocab::add_token()
+static void whisper_vocab_init_index(whisper_vocab & vocab) {
+    const int n_tokens = vocab.n_tokens();
+
+    // load factor <= 0.5
+    size_t n_slots = 1;
+    while (n_slots < 2*(size_t) n_tokens) {
+        n_slots *= 2;
+    }
+
+    vocab.token_index.assign(n_slots, -1);
+
+    const uint32_t mask = n_slots - 1;
+    for (int id = 0; id < n_tokens; ++id) {
+        const char * text = vocab.token_text(id);
+        const size_t n    = vocab.token_size(id);
+
+        uint32_t i = whisper_token_hash(text, n) & mask;
+        while (vocab.token_index[i] >= 0) {
+            const whisper_vocab::id other = vocab.token_index[i];
+            if (vocab.token_size(other) == n && memcmp(vocab.token_text(other), text, n) == 0) {
+                break;
+            }
+            i = (i + 1) & mask;
+        }
+        vocab.token_index[i] = id;
+    }
+
+    // the models converted by convert-pt-to-ggml.py store the tokens as raw bytes, so every byte is a token
+    // some older files (e.g. the for-tests-ggml-*.bin models) store the tokens that are not valid UTF-8 as U+FFFD
+    // instead, including the bytes 0x80 - 0xFF. in the tiktoken vocabularies, the first 256 tokens are the bytes in
+    // the order of GPT-2's bytes_to_unicode(), so their ids are known anyway
+    // ref: https://github.com/openai/gpt-2/blob/a74da5d99abaaba920de8131d64da2862a8f213b/src/encoder.py#L9-L28
+    vocab.token_byte.assign(256, -1);
+
+    vocab.token_raw = true;
+    for (int b = 0; b < 256; ++b) {
+        const char c = (char) b;
+
+        vocab.token_byte[b] = whisper_token_find(vocab, &c, 1);
+        vocab.token_raw     = vocab.token_raw && vocab.token_byte[b] >= 0;
+    }
+
+    if (!vocab.token_raw) {
+        int id = 0;
+        for (int b = 0; b < 256; ++b) {
+            vocab.token_byte[b] = -1;
+            if ((b >= '!' && b <= '~') || (b >= 0xA1 && b <= 0xAC) || b >= 0xAE) {
+                vocab.token_byte[b] = id++;
+            }
+        }
+        for (int b = 0; b < 256; ++b) {
+            if (vocab.token_byte[b] < 0) {
+                vocab.token_byte[b] = id++;
+            }
+        }
+    }
+}
+
 static bool whisper_kv_cache_init(
              struct whisper_kv_cache & cache,
                       ggml_backend_t   backend,
-                           ggml_type   wtype,
+                           ggml_type   type_k,
+                           ggml_type   type_v,
                              int64_t   n_text_state,
                              int64_t   n_text_layer,
                                  int   n_ctx) {
@@ -996,8 +1465,8 @@ static bool whisper_kv_cache_init(
         return false;
     }
 
-    cache.k = ggml_new_tensor_1d(ctx, wtype, n_elements);
-    cache.v = ggml_new_tensor_1d(ctx, wtype, n_elements);
+    cache.k = ggml_new_tensor_1d(ctx, type_k, n_elements);
+    cache.v = ggml_new_tensor_1d(ctx, type_v, n_elements);
 
     cache.buffer = ggml_backend_alloc_ctx_tensors(ctx, backend);
     if (!cache.buffer) {
@@ -1012,10 +1481,40 @@ static bool whisper_kv_cache_init(
     return true;
 }
 
+// the types the KV caches can be stored in
+static bool whisper_kv_type_supported(ggml_type type) {
+    return type == GGML_TYPE_F16 || type == GGML_TYPE_Q8_0 || type == GGML_TYPE_Q4_0;
+}
+
 static void whisper_kv_cache_free(struct whisper_kv_cache & cache) {
     ggml_backend_buffer_free(cache.buffer);
 }
 
+// (re)allocate the unified self-attention KV cache for n_decoders decoders
+// on failure, the state has no self-attention KV cache and the next call tries again
+static bool whisper_kv_self_init(whisper_context & wctx, whisper_state & wstate, int n_decoders) {
+    // the kept decoder graph writes to the old cache
+    whisper_sched_graph_reset(wstate.sched_decode);
+
+    whisper_kv_cache_free(wstate.kv_self);
+    wstate.kv_self.buffer = nullptr;
+    wstate.kv_self_n_dec  = 0;
+
+    // overallocate to workaround KV cache fragmentation issues
+    const int factor = n_decoders > 1 ? n_decoders + 2 : 1;
+
+    if (!whisper_kv_cache_init(wstate.kv_self, wstate.backends[0], wctx.kv_self_type_k, wctx.kv_self_type_v,
+                wctx.model.hparams.n_text_state,
+                wctx.model.hparams.n_text_layer,
+                GGML_PAD(wctx.model.hparams.n_text_ctx, 256)*factor)) {
+        return false;
+    }
+
+    wstate.kv_self_n_dec = n_decoders;
+
+    return true;
+}
+
 static bool whisper_kv_cache_find_slot(
            struct whisper_kv_cache & cache,
         const struct whisper_batch & batch) {
@@ -1136,9 +1635,11 @@ static void whisper_kv_cache_seq_cp(
     }
 }
 
+// the decoder attends to the KV cache in blocks of cells - the graph keeps its shape until the cache grows into the
+// next block, so that consecutive decoding steps reuse it (see whisper_decode_internal). the extra cells are masked
 static uint32_t whisper_kv_cache_get_padding(const struct whisper_context & wctx) {
     if (!wctx.params.flash_attn || !wctx.params.use_gpu) {
-        return 1u;
+        return 32u;
     }
 
 #ifdef GGML_USE_METAL
@@ -1153,7 +1654,25 @@ static uint32_t whisper_kv_cache_get_padding(const struct whisper_context & wctx
     }
 #endif
 
-    return 1u;
+    return 32u;
+}
+
+// the flash attention kernels of the GPU backends read the keys of the encoder self-attention and of the cross-attention
+// in blocks of 256 audio positions - the positions are padded to it there, and the padding keys are not masked. the CPU
+// kernel reads any number of keys, so on CPU nothing is padded and no padding key is attended to
+static int whisper_audio_ctx_get_padding(const whisper_context_params & params) {
+    if (!params.flash_attn || !params.use_gpu) {
+        return 1;
+    }
+
+    for (size_t i = 0; i < ggml_backend_dev_count(); ++i) {
+        const enum ggml_backend_dev_type dev_type = ggml_backend_dev_type(ggml_backend_dev_get(i));
+        if (dev_type == GGML_BACKEND_DEVICE_TYPE_GPU || dev_type == GGML_BACKEND_DEVICE_TYPE_IGPU) {
+            return 256;
+        }
+    }
+
+    return 1;
 }
 
 // [EXPERIMENTAL] Token-level timestamps with DTW
@@ -1478,10 +1997,21 @@ static ggml_backend_buffer_type_t select_weight_buft(const whisper_hparams & hpa
 //   - hparams
 //   - pre-computed mel filters
 //   - vocab
-//   - weights
+//   - tensor types (only if hparams.ftype has the WHISPER_FTYPE_TENSOR_TYPES flag)
+//   - weights: n_dims, name length, type, dims, name, [n_pad, n_pad zero bytes,] data
+//     (the padding only if hparams.ftype has the WHISPER_FTYPE_ALIGNED flag)
 //
 // see the convert-pt-to-ggml.py script for details
 //
+// tensor names in files written by earlier versions of whisper-quantize are padded with '\0' instead
+static std::string whisper_tensor_name(const char * data, size_t length) {
+    while (length > 0 && data[length - 1] == '\0') {
+        --length;
+    }
+
+    return std::string(data, length);
+}
+
 static bool whisper_model_load(struct whisper_model_loader * loader, whisper_context & wctx) {
     WHISPER_LOG_INFO("%s: loading model\n", __func__);
 
@@ -1492,6 +2022,9 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
     auto & model = wctx.model;
     auto & vocab = wctx.vocab;
 
+    bool has_types = false;
+    bool has_pad   = false;
+
     // verify magic
     {
         uint32_t magic;
@@ -1546,6 +2079,11 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
             }
         }
 
+        has_types = (hparams.ftype & WHISPER_FTYPE_TENSOR_TYPES) != 0;
+        has_pad   = (hparams.ftype & WHISPER_FTYPE_ALIGNED)      != 0;
+
+        hparams.ftype &= ~(WHISPER_FTYPE_TENSOR_TYPES | WHISPER_FTYPE_ALIGNED);
+
         const int32_t qntvr = hparams.ftype / GGML_QNT_VERSION_FACTOR;
 
         hparams.ftype %= GGML_QNT_VERSION_FACTOR;
@@ -1583,6 +2121,20 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
         filters.data.resize(filters.n_mel * filters.n_fft);
         loader->read(loader->context, filters.data.data(), filters.data.size() * sizeof(float));
         BYTESWAP_FILTERS(filters);
+
+        filters.k_beg.resize(filters.n_mel, 0);
+        filters.k_end.resize(filters.n_mel, 0);
+        for (int j = 0; j < filters.n_mel; j++) {
+            const float * row = filters.data.data() + j*filters.n_fft;
+            for (int k = 0; k < filters.n_fft; k++) {
+                if (row[k] != 0.0f) {
+                    if (filters.k_end[j] == 0) {
+                        filters.k_beg[j] = k;
+                    }
+                    filters.k_end[j] = k + 1;
+                }
+            }
+        }
     }
 
     // load vocab
@@ -1601,24 +2153,26 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
 
         tmp.reserve(128);
 
+        // ~8 bytes per token, including the terminating 0
+        vocab.token_data.reserve(8*(size_t) std::max(n_vocab, model.hparams.n_vocab));
+        vocab.token_offs.reserve(std::max(n_vocab, model.hparams.n_vocab) + 1);
+        vocab.token_offs.assign(1, 0);
+
         for (int i = 0; i < n_vocab; i++) {
             uint32_t len;
             read_safe(loader, len);
 
+            tmp.resize(len);
             if (len > 0) {
-                tmp.resize(len);
                 loader->read(loader->context, &tmp[0], tmp.size()); // read to buffer
-                word.assign(&tmp[0], tmp.size());
             } else {
                 // seems like we have an empty-string token in multi-language models (i = 50256)
                 //WHISPER_LOG_WARN("%s: warning: empty-string token in vocab, i = %d\n", __func__, i);
-                word = "";
             }
 
-            vocab.token_to_id[word] = i;
-            vocab.id_to_token[i] = word;
+            vocab.add_token(tmp.data(), tmp.size());
 
-            //printf("%s: vocab[%d] = '%s'\n", __func__, i, word.c_str());
+            //printf("%s: vocab[%d] = '%s'\n", __func__, i, vocab.token_text(i));
         }
 
         vocab.n_vocab = model.hparams.n_vocab;
@@ -1666,12 +2220,55 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
                 } else {
                     word = "[_extra_token_" + std::to_string(i) + "]";
                 }
-                vocab.token_to_id[word] = i;
-                vocab.id_to_token[i] = word;
+                vocab.add_token(word.data(), word.size());
             }
         }
 
         WHISPER_LOG_INFO("%s: n_langs       = %d\n", __func__, vocab.num_languages());
+
+        whisper_vocab_init_index(vocab);
+    }
+
+    // the type of each tensor of a mixed-precision model, instead of wtype
+    std::map<std::string, ggml_type> tensor_types;
+
+    if (has_types) {
+        int32_t n_types = 0;
+        read_safe(loader, n_types);
+
+        std::vector<char> tmp;
+
+        for (int i = 0; i < n_types; i++) {
+            int32_t len;
+            read_safe(loader, len);
+
+            tmp.resize(len);
+            loader->read(loader->context, tmp.data(), tmp.size());
+
+            int32_t type;
+            read_safe(loader, type);
+
+            if (type < 0 || type >= GGML_TYPE_COUNT || ggml_blck_size(ggml_type(type)) == 0) {
+                WHISPER_LOG_ERROR("%s: invalid type %d of tensor '%s'\n", __func__, type, whisper_tensor_name(tmp.data(), tmp.size()).c_str());
+                return false;
+            }
+
+            tensor_types[whisper_tensor_name(tmp.data(), tmp.size())] = ggml_type(type);
+        }
+
+        WHISPER_LOG_INFO("%s: tensor types  = %d\n", __func__, n_types);
+    }
+
+    // the meta tensors of the types that differ from the default ones
+    ggml_context_ptr ctx_types;
+    {
+        ggml_init_params params = {
+            /*.mem_size   =*/ (tensor_types.size() + 1) * ggml_tensor_overhead(),
+            /*.mem_buffer =*/ nullptr,
+            /*.no_alloc   =*/ true,
+        };
+
+        ctx_types.reset(ggml_init(params));
     }
 
     const ggml_type wtype = wctx.wtype;
@@ -1712,6 +2309,13 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
     buft_list_t buft_list = make_buft_list(wctx.params);
 
     auto create_tensor = [&](asr_tensor type, asr_system system, ggml_tensor * meta, int layer = 0) -> ggml_tensor * {
+        const std::string name = format(ASR_TENSOR_NAMES.at(system).at(type), layer);
+
+        const auto it_type = tensor_types.find(name);
+        if (it_type != tensor_types.end() && it_type->second != meta->type) {
+            meta = ggml_new_tensor(ctx_types.get(), it_type->second, GGML_MAX_DIMS, meta->ne);
+        }
+
         ggml_op op = ASR_TENSOR_INFO.at(type);
         ggml_backend_buffer_type_t buft = select_weight_buft(hparams, meta, op, buft_list);
         if (!buft) {
@@ -1721,7 +2325,7 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
         ggml_context * ctx = get_ctx(buft);
         ggml_tensor * tensor = ggml_dup_tensor(ctx, meta);
 
-        model.tensors[format(ASR_TENSOR_NAMES.at(system).at(type), layer)] = tensor;
+        model.tensors[name] = tensor;
 
         return tensor;
     };
@@ -1845,51 +2449,151 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
         ggml_free(ctx);
     }
 
-    // allocate tensors in the backend buffers
-    for (auto & p : ctx_map) {
-        ggml_backend_buffer_type_t buft = p.first;
-        ggml_context * ctx = p.second;
-        ggml_backend_buffer_t buf = ggml_backend_alloc_ctx_tensors_from_buft(ctx, buft);
-        if (buf) {
-            model.buffers.emplace_back(buf);
+    // with a mapped model file, the tensors of the CPU buffer whose data is suitably aligned in the file alias the
+    // mapping instead of being allocated and read. files written by whisper-quantize are fully aligned, older files
+    // usually only partially - their remaining tensors are loaded as usual
+    ggml_backend_buffer_t buf_mmap = nullptr;
 
-            size_t size_main = ggml_backend_buffer_get_size(buf);
-            WHISPER_LOG_INFO("%s: %12s total size = %8.2f MB\n", __func__, ggml_backend_buffer_name(buf), size_main / 1e6);
+    if (wctx.mapping && ctx_map.count(ggml_backend_cpu_buffer_type()) > 0) {
+        const whisper_mmap & mapping = *wctx.mapping;
+
+        ggml_backend_buffer_type_t buft = ggml_backend_cpu_buffer_type();
+        ggml_context * ctx = ctx_map[buft];
+
+        const size_t align = ggml_backend_buft_get_alignment(buft);
+
+        std::set<ggml_tensor *> candidates;
+        for (ggml_tensor * t = ggml_get_first_tensor(ctx); t != nullptr; t = ggml_get_next_tensor(ctx, t)) {
+            candidates.insert(t);
         }
-    }
 
-    // load weights
-    {
-        size_t total_size = 0;
+        buf_mmap = ggml_backend_cpu_buffer_from_ptr(mapping.addr, mapping.size);
 
-        model.n_loaded = 0;
+        char * base = (char *) mapping.addr;
 
-        std::vector<char> read_buf;
+        int    n_mapped    = 0;
+        size_t size_mapped = 0;
 
-        while (true) {
-            int32_t n_dims;
-            int32_t length;
-            int32_t ttype;
+        // walk the tensor records without touching the data - any inconsistency is reported by the load loop below
+        size_t pos = mapping.pos;
+        while (pos + 3*sizeof(int32_t) <= mapping.size) {
+            int32_t hdr[3]; // n_dims, length, ttype
+            memcpy(hdr, base + pos, sizeof(hdr));
+            pos += sizeof(hdr);
 
-            read_safe(loader, n_dims);
-            read_safe(loader, length);
-            read_safe(loader, ttype);
+            const int32_t n_dims = hdr[0];
+            const int32_t length = hdr[1];
+            const int32_t ttype  = hdr[2];
 
-            if (loader->eof(loader->context)) {
+            if (n_dims < 0 || n_dims > 4 || length < 0 || pos + n_dims*sizeof(int32_t) + length > mapping.size) {
                 break;
             }
+            pos += n_dims*sizeof(int32_t);
 
-            int32_t nelements = 1;
-            int32_t ne[4] = { 1, 1, 1, 1 };
+            const std::string name = whisper_tensor_name(base + pos, length);
+            pos += length;
+
+            if (has_pad) {
+                int32_t n_pad;
+                if (pos + sizeof(n_pad) > mapping.size) {
+                    break;
+                }
+                memcpy(&n_pad, base + pos, sizeof(n_pad));
+                if (n_pad < 0) {
+                    break;
+                }
+                pos += sizeof(n_pad) + n_pad;
+            }
+
+            auto it = model.tensors.find(name);
+            if (it == model.tensors.end()) {
+                break;
+            }
+
+            ggml_tensor * tensor = it->second;
+
+            const size_t nbytes = ggml_nbytes(tensor);
+            if (pos + nbytes > mapping.size) {
+                break;
+            }
+
+            if (ttype == tensor->type && pos % align == 0 && tensor->data == nullptr && candidates.count(tensor) > 0) {
+                ggml_backend_tensor_alloc(buf_mmap, tensor, base + pos);
+
+                n_mapped    += 1;
+                size_mapped += nbytes;
+            }
+
+            pos += nbytes;
+        }
+
+        if (n_mapped > 0) {
+            model.buffers.emplace_back(buf_mmap);
+
+            WHISPER_LOG_INFO("%s: %12s mapped size = %8.2f MB (%d tensors)\n", __func__, "mmap", size_mapped / 1e6, n_mapped);
+        } else {
+            ggml_backend_buffer_free(buf_mmap);
+            buf_mmap = nullptr;
+        }
+    }
+
+    // allocate tensors in the backend buffers
+    for (auto & p : ctx_map) {
+        ggml_backend_buffer_type_t buft = p.first;
+        ggml_context * ctx = p.second;
+        ggml_backend_buffer_t buf = ggml_backend_alloc_ctx_tensors_from_buft(ctx, buft);
+        if (buf) {
+            model.buffers.emplace_back(buf);
+
+            size_t size_main = ggml_backend_buffer_get_size(buf);
+            WHISPER_LOG_INFO("%s: %12s total size = %8.2f MB\n", __func__, ggml_backend_buffer_name(buf), size_main / 1e6);
+        }
+    }
+
+    // load weights
+    {
+        size_t total_size = 0;
+
+        model.n_loaded = 0;
+
+        std::vector<char> read_buf;
+
+        while (true) {
+            int32_t n_dims;
+            int32_t length;
+            int32_t ttype;
+
+            read_safe(loader, n_dims);
+            read_safe(loader, length);
+            read_safe(loader, ttype);
+
+            if (loader->eof(loader->context)) {
+                break;
+            }
+
+            int32_t nelements = 1;
+            int32_t ne[4] = { 1, 1, 1, 1 };
             for (int i = 0; i < n_dims; ++i) {
                 read_safe(loader, ne[i]);
                 nelements *= ne[i];
             }
 
-            std::string name;
             std::vector<char> tmp(length); // create a buffer
             loader->read(loader->context, &tmp[0], tmp.size()); // read to buffer
-            name.assign(&tmp[0], tmp.size());
+            const std::string name = whisper_tensor_name(tmp.data(), tmp.size());
+
+            if (has_pad) {
+                int32_t n_pad;
+                read_safe(loader, n_pad);
+
+                if (n_pad < 0) {
+                    WHISPER_LOG_ERROR("%s: tensor '%s' has invalid padding %d in model file\n", __func__, name.data(), n_pad);
+                    return false;
+                }
+
+                tmp.resize(n_pad);
+                loader->read(loader->context, tmp.data(), tmp.size());
+            }
 
             if (model.tensors.find(name) == model.tensors.end()) {
                 WHISPER_LOG_ERROR("%s: unknown tensor '%s' in model file\n", __func__, name.data());
@@ -1919,7 +2623,10 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
                 return false;
             }
 
-            if (ggml_backend_buffer_is_host(tensor->buffer)) {
+            if (buf_mmap && tensor->buffer == buf_mmap) {
+                // the tensor aliases the mapped file, skip its data
+                wctx.mapping->pos += ggml_nbytes(tensor);
+            } else if (ggml_backend_buffer_is_host(tensor->buffer)) {
                 // for the CPU and Metal backend, we can read directly into the tensor
                 loader->read(loader->context, tensor->data, ggml_nbytes(tensor));
                 BYTESWAP_TENSOR(tensor);
@@ -2052,7 +2759,7 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
 
     WHISPER_ASSERT(!!kv_pad.buffer);
 
-    const int n_ctx_pad = GGML_PAD(n_ctx, 256);
+    const int n_ctx_pad = GGML_PAD(n_ctx, wctx.audio_ctx_pad);
 
     struct ggml_init_params params = {
         /*.mem_size   =*/ wstate.sched_encode.meta.size(),
@@ -2281,7 +2988,7 @@ static struct ggml_cgraph * whisper_build_graph_cross(
 
     const int n_state_head = n_state/n_head;
 
-    const int n_ctx_pad = GGML_PAD(n_ctx, 256);
+    const int n_ctx_pad = GGML_PAD(n_ctx, wctx.audio_ctx_pad);
 
     struct ggml_init_params params = {
         /*.mem_size   =*/ wstate.sched_cross.meta.size(),
@@ -2319,15 +3026,15 @@ static struct ggml_cgraph * whisper_build_graph_cross(
 
         if (wctx.params.flash_attn) {
             k = ggml_view_1d(ctx0, wstate.kv_cross.k, n_state*n_ctx,
-                    (ggml_element_size(wstate.kv_cross.k)*n_state)*(il*n_ctx_pad));
+                    ggml_row_size(wstate.kv_cross.k->type, n_state)*(il*n_ctx_pad));
 
             v = ggml_view_1d(ctx0, wstate.kv_cross.v, n_state*n_ctx,
-                    (ggml_element_size(wstate.kv_cross.v)*n_state)*(il*n_ctx_pad));
+                    ggml_row_size(wstate.kv_cross.v->type, n_state)*(il*n_ctx_pad));
         } else {
             Vcross = ggml_transpose(ctx0, ggml_reshape_2d(ctx0, Vcross, n_state, n_ctx));
 
             k = ggml_view_1d(ctx0, wstate.kv_cross.k, n_state*n_ctx,
-                    (ggml_element_size(wstate.kv_cross.k)*n_state)*(il*n_ctx));
+                    ggml_row_size(wstate.kv_cross.k->type, n_state)*(il*n_ctx));
 
             v = ggml_view_2d(ctx0, wstate.kv_cross.v, n_ctx, n_state,
                     (   n_ctx)*ggml_element_size(wstate.kv_cross.v),
@@ -2345,185 +3052,93 @@ static struct ggml_cgraph * whisper_build_graph_cross(
     return gf;
 }
 
-// evaluate the encoder with the given state
-//
-// given audio recording (more specifically, its log mel spectrogram), runs forward pass of the encoder
-// part of the transformer model and returns the encoded features
-//
-//   - wctx:      the model
-//   - wstate:     the state of the encoder
-//   - n_threads:  number of threads to use
-//   - mel_offset: offset in the mel spectrogram (i.e. audio offset)
-//
-static bool whisper_encode_internal(
-        whisper_context & wctx,
-          whisper_state & wstate,
-              const int   mel_offset,
-              const int   n_threads,
-    ggml_abort_callback   abort_callback,
-                   void * abort_callback_data) {
-    const int64_t t_start_us = ggml_time_us();
-
-    // conv
-    {
-        auto & sched = wstate.sched_conv.sched;
+struct whisper_encoder_batch {
+    whisper_context * ctx = nullptr;
 
-        ggml_cgraph * gf = whisper_build_graph_conv(wctx, wstate);
+    int n_max = 0;
 
-        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
-            // should never happen as we pre-allocate the memory
-            return false;
-        }
+    std::vector<ggml_backend_t> backends;
 
-        struct ggml_tensor * mel = ggml_graph_get_tensor(gf, "mel");
+    whisper_sched sched;
 
-        // set the input
-        {
-            const auto & mel_inp = wstate.mel;
-            const int n_ctx      = wstate.exp_n_audio_ctx > 0 ? wstate.exp_n_audio_ctx : wctx.model.hparams.n_audio_ctx;
+    std::vector<float> inp_mel;
+};
 
-            assert(mel->type == GGML_TYPE_F32);
-            assert(mel_inp.n_mel == wctx.model.hparams.n_mels);
+// conv + encoder + cross over the mel windows of n_states states, stacked along a batch dimension
+// the windows share every matrix multiplication with the weights, only the self-attention is done per window
+// the cross-attention K/V of window i are written to the KV cache of states[i]
+// with states == nullptr, the graph only computes them (worst case for the allocator)
+static struct ggml_cgraph * whisper_build_graph_encoder_batch(
+        whisper_context & wctx,
+  whisper_encoder_batch & batch,
+         whisper_state ** states,
+                    int   n_states,
+                    int   n_ctx) {
+    const auto & model   = wctx.model;
+    const auto & hparams = model.hparams;
 
-            wstate.inp_mel.resize(ggml_nelements(mel));
+    const int n_state = hparams.n_audio_state;
+    const int n_head  = hparams.n_audio_head;
+    const int n_layer = hparams.n_audio_layer;
+    const int n_mels  = hparams.n_mels;
 
-            float * dst = wstate.inp_mel.data();
-            memset(dst, 0, ggml_nbytes(mel));
+    const int n_state_head = n_state/n_head;
 
-            const int i0 = std::min(mel_offset,           mel_inp.n_len);
-            const int i1 = std::min(mel_offset + 2*n_ctx, mel_inp.n_len);
+    const int n_ctx_pad = GGML_PAD(n_ctx, wctx.audio_ctx_pad);
 
-            for (int j = 0; j < mel_inp.n_mel; ++j) {
-                for (int i = i0; i < i1; ++i) {
-                    dst[j*2*n_ctx + (i - i0)] = mel_inp.data[j*mel_inp.n_len + i];
-                }
-            }
+    struct ggml_init_params params = {
+        /*.mem_size   =*/ batch.sched.meta.size(),
+        /*.mem_buffer =*/ batch.sched.meta.data(),
+        /*.no_alloc   =*/ true,
+    };
 
-            ggml_backend_tensor_set(mel, wstate.inp_mel.data(), 0, ggml_nelements(mel)*sizeof(float));
-        }
+    struct ggml_context * ctx0 = ggml_init(params);
 
-        if (!whisper_encode_external(wstate)) {
-            if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
-                return false;
-            }
-        } else {
-            ggml_backend_sched_reset(sched);
+    ggml_cgraph * gf = ggml_new_graph_custom(ctx0, WHISPER_MAX_NODES, false);
 
-#if defined(WHISPER_USE_COREML)
-            whisper_coreml_encode(wstate.ctx_coreml, mel->ne[0], mel->ne[1], (float *) mel->data, (float *) wstate.embd_enc->data);
-#elif defined(WHISPER_USE_OPENVINO)
-            whisper_openvino_encode(wstate.ctx_openvino, mel, wstate.embd_enc);
-#endif
-        }
-    }
+    struct ggml_tensor * mel = ggml_new_tensor_3d(ctx0, GGML_TYPE_F32, 2*n_ctx, n_mels, n_states);
+    ggml_set_name(mel, "mel");
+    ggml_set_input(mel);
 
-    // encoder
-    if (!whisper_encode_external(wstate)) {
-        auto & sched = wstate.sched_encode.sched;
+    struct ggml_tensor * cur = nullptr;
 
-        ggml_cgraph * gf = whisper_build_graph_encoder(wctx, wstate);
+    // with more than one input, the result of ggml_conv_1d() is laid out as [OL, N, OC] instead of [OL, OC, N]
+    const auto conv_1d_ph = [&](struct ggml_tensor * w, struct ggml_tensor * x, int s) {
+        struct ggml_tensor * r = ggml_conv_1d_ph(ctx0, w, x, s, 1);
 
-        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
-            // should never happen as we pre-allocate the memory
-            return false;
-        }
+        r = ggml_reshape_3d(ctx0, r, r->ne[0], n_states, r->ne[1]);
 
-        if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
-            return false;
-        }
-    }
+        return ggml_cont(ctx0, ggml_permute(ctx0, r, 0, 2, 1, 3));
+    };
 
-    // cross
+    // convolution + gelu
     {
-        auto & sched = wstate.sched_cross.sched;
+        cur = conv_1d_ph(model.e_conv_1_w, mel, 1);
+        cur = ggml_add(ctx0, cur, model.e_conv_1_b);
 
-        ggml_cgraph * gf = whisper_build_graph_cross(wctx, wstate);
+        cur = ggml_gelu(ctx0, cur);
 
-        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
-            // should never happen as we pre-allocate the memory
-            return false;
-        }
+        cur = conv_1d_ph(model.e_conv_2_w, cur, 2);
+        cur = ggml_add(ctx0, cur, model.e_conv_2_b);
 
-        if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
-            return false;
-        }
+        cur = ggml_gelu(ctx0, cur);
     }
 
-    wstate.t_encode_us += ggml_time_us() - t_start_us;
-    wstate.n_encode++;
-
-    return !(abort_callback && abort_callback(abort_callback_data));
-}
-
-static struct ggml_cgraph * whisper_build_graph_decoder(
-         whisper_context & wctx,
-         whisper_state   & wstate,
-     const whisper_batch & batch,
-                    bool   save_alignment_heads_QKs,
-                    bool   worst_case) {
-    const auto & model   = wctx.model;
-    const auto & hparams = model.hparams;
-
-    auto & kv_self = wstate.kv_self;
-
-    WHISPER_ASSERT(!!kv_self.buffer);
-
-    const int n_ctx   = kv_self.size;
-    const int n_state = hparams.n_text_state;
-    const int n_head  = hparams.n_text_head;
-    const int n_layer = hparams.n_text_layer;
-
-    const int n_state_head = n_state/n_head;
-
-    const int n_tokens    = batch.n_tokens;
-    const int n_audio_ctx = wstate.exp_n_audio_ctx > 0 ? wstate.exp_n_audio_ctx : hparams.n_audio_ctx;
-
-    const int n_audio_ctx_pad = GGML_PAD(n_audio_ctx, 256);
-
-    const int32_t n_kv    = worst_case ? n_ctx            : kv_self.n;
-    const int32_t kv_head = worst_case ? n_ctx - n_tokens : kv_self.head;
-
-    //WHISPER_LOG_DEBUG("%s: n_past = %d, n_tokens = %d, n_audio_ctx = %d, n_ctx = %d\n", __func__, n_past, n_tokens, n_audio_ctx, n_ctx);
-
-    struct ggml_init_params params = {
-        /*.mem_size   =*/ wstate.sched_decode.meta.size(),
-        /*.mem_buffer =*/ wstate.sched_decode.meta.data(),
-        /*.no_alloc   =*/ true,
-    };
-
-    struct ggml_context * ctx0 = ggml_init(params);
-
-    ggml_cgraph * gf = ggml_new_graph_custom(ctx0, WHISPER_MAX_NODES, false);
-
-    struct ggml_tensor * embd = ggml_new_tensor_1d(ctx0, GGML_TYPE_I32, n_tokens);
-    ggml_set_name(embd, "embd");
-    ggml_set_input(embd);
-
-    struct ggml_tensor * position = ggml_new_tensor_1d(ctx0, GGML_TYPE_I32, n_tokens);
-    ggml_set_name(position, "position");
-    ggml_set_input(position);
-
-    const float KQscale = pow(float(n_state_head), -0.25);
+    const float KQscale = 1.0f/sqrtf(float(n_state_head));
 
-    struct ggml_tensor * KQ_mask = ggml_new_tensor_3d(ctx0, GGML_TYPE_F32, n_kv, GGML_PAD(n_tokens, GGML_KQ_MASK_PAD), 1);
-    ggml_set_name(KQ_mask, "KQ_mask");
-    ggml_set_input(KQ_mask);
+    {
+        const size_t e_pe_stride = model.e_pe->ne[0]*ggml_element_size(model.e_pe);
 
-    struct ggml_tensor * KQ_mask_f16 = ggml_cast(ctx0, KQ_mask, GGML_TYPE_F16);
+        struct ggml_tensor * e_pe = ggml_view_2d(ctx0, model.e_pe, model.e_pe->ne[0], n_ctx, e_pe_stride, 0);
 
-    // token encoding + position encoding
-    struct ggml_tensor * cur =
-        ggml_add(ctx0,
-                ggml_get_rows(ctx0, model.d_te, embd),
-                ggml_get_rows(ctx0, model.d_pe, position));
+        cur = ggml_add(ctx0, ggml_cont(ctx0, ggml_transpose(ctx0, cur)), e_pe);
+        cur = ggml_reshape_2d(ctx0, cur, n_state, n_ctx*n_states);
+    }
 
     struct ggml_tensor * inpL = cur;
 
-    // [EXPERIMENTAL] Token-level timestamps with DTW
-    struct ggml_tensor * aheads_cross_QKs = nullptr;
-
     for (int il = 0; il < n_layer; ++il) {
-        const auto & layer = model.layers_decoder[il];
+        const auto & layer = model.layers_encoder[il];
 
         // norm
         {
@@ -2531,9 +3146,7 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
 
             // cur = ln_0_w*cur + ln_0_b
             cur = ggml_add(ctx0,
-                    ggml_mul(ctx0,
-                        cur,
-                        layer.attn_ln_0_w),
+                    ggml_mul(ctx0, cur, layer.attn_ln_0_w),
                     layer.attn_ln_0_b);
         }
 
@@ -2543,96 +3156,70 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
                     layer.attn_q_w,
                     cur);
 
-            Qcur = ggml_add(ctx0,
-                        Qcur,
-                        layer.attn_q_b);
-
-            Qcur = ggml_scale(ctx0, Qcur, KQscale);
+            Qcur = ggml_add(ctx0, Qcur, layer.attn_q_b);
 
             // note: no bias for Key
             struct ggml_tensor * Kcur = ggml_mul_mat(ctx0,
                     layer.attn_k_w,
                     cur);
 
-            Kcur = ggml_scale(ctx0, Kcur, KQscale);
+            struct ggml_tensor * Vcur = ggml_mul_mat(ctx0,
+                    layer.attn_v_w,
+                    cur);
 
-            // store key and value to memory
-            {
-                struct ggml_tensor * Vcur = ggml_mul_mat(ctx0,
-                        layer.attn_v_w,
-                        cur);
+            Vcur = ggml_add(ctx0, Vcur, layer.attn_v_b);
 
-                Vcur = ggml_add(ctx0,
-                            Vcur,
-                            layer.attn_v_b);
+            // ------
 
-                struct ggml_tensor * k;
-                struct ggml_tensor * v;
+            struct ggml_tensor * Q =
+                ggml_permute(ctx0,
+                        ggml_reshape_4d(ctx0, Qcur, n_state_head, n_head, n_ctx, n_states),
+                        0, 2, 1, 3);
 
-                if (wctx.params.flash_attn) {
-                    k = ggml_view_1d(ctx0, kv_self.k, n_tokens*n_state,
-                            (ggml_element_size(kv_self.k)*n_state)*(il*n_ctx + kv_head));
+            if (wctx.params.flash_attn) {
+                // [n_state_head, n_ctx_pad, n_head, n_states] in wctx.itype, as the kv_pad views of the single state
+                // encoder. the padding keys are zero, as the unused part of kv_pad
+                const auto kv_fa = [&](struct ggml_tensor * x) {
+                    x = ggml_permute(ctx0, ggml_reshape_4d(ctx0, x, n_state_head, n_head, n_ctx, n_states), 0, 2, 1, 3);
+                    if (n_ctx_pad > n_ctx) {
+                        x = ggml_pad(ctx0, ggml_cont(ctx0, x), 0, n_ctx_pad - n_ctx, 0, 0);
+                    }
+                    return ggml_cast(ctx0, x, wctx.itype);
+                };
 
-                    v = ggml_view_1d(ctx0, kv_self.v, n_tokens*n_state,
-                            (ggml_element_size(kv_self.v)*n_state)*(il*n_ctx + kv_head));
-                } else {
-                    Vcur = ggml_transpose(ctx0, ggml_reshape_2d(ctx0, Vcur, n_state, n_tokens));
+                struct ggml_tensor * K = kv_fa(Kcur);
+                struct ggml_tensor * V = kv_fa(Vcur);
 
-                    k = ggml_view_1d(ctx0, kv_self.k, n_tokens*n_state,
-                            (ggml_element_size(kv_self.k)*n_state)*(il*n_ctx + kv_head));
-
-                    v = ggml_view_2d(ctx0, kv_self.v, n_tokens, n_state,
-                            (   n_ctx)*ggml_element_size(kv_self.v),
-                            (il*n_ctx)*ggml_element_size(kv_self.v)*n_state + kv_head*ggml_element_size(kv_self.v));
-                }
-
-                ggml_build_forward_expand(gf, ggml_cpy(ctx0, Kcur, k));
-                ggml_build_forward_expand(gf, ggml_cpy(ctx0, Vcur, v));
-            }
-
-            // ------
-
-            struct ggml_tensor * Q =
-                ggml_permute(ctx0,
-                        ggml_reshape_3d(ctx0, Qcur, n_state_head, n_head, n_tokens),
-                        0, 2, 1, 3);
-
-            struct ggml_tensor * K =
-                ggml_view_3d(ctx0, kv_self.k,
-                        n_state_head, n_kv, n_head,
-                        ggml_element_size(kv_self.k)*n_state,
-                        ggml_element_size(kv_self.k)*n_state_head,
-                        ggml_element_size(kv_self.k)*n_state*n_ctx*il);
-
-            if (wctx.params.flash_attn) {
-                struct ggml_tensor * V =
-                    ggml_view_3d(ctx0, kv_self.v,
-                            n_state_head, n_kv, n_head,
-                            ggml_element_size(kv_self.v)*n_state,
-                            ggml_element_size(kv_self.v)*n_state_head,
-                            ggml_element_size(kv_self.v)*n_state*n_ctx*il);
-
-                cur = ggml_flash_attn_ext(ctx0, Q, K, V, KQ_mask_f16, 1.0f, 0.0f, 0.0f);
+                cur = ggml_flash_attn_ext(ctx0, Q, K, V, nullptr, KQscale, 0.0f, 0.0f);
 
-                cur = ggml_reshape_2d(ctx0, cur, n_state, n_tokens);
+                cur = ggml_reshape_2d(ctx0, cur, n_state, n_ctx*n_states);
             } else {
+                struct ggml_tensor * K =
+                    ggml_permute(ctx0,
+                            ggml_cast(ctx0,
+                                ggml_reshape_4d(ctx0, Kcur, n_state_head, n_head, n_ctx, n_states),
+                                wctx.itype),
+                            0, 2, 1, 3);
+
                 // K * Q
                 struct ggml_tensor * KQ = ggml_mul_mat(ctx0, K, Q);
 
-                struct ggml_tensor * KQ_soft_max = ggml_soft_max_ext(ctx0, KQ, KQ_mask, 1.0f, 0.0f);
+                struct ggml_tensor * KQ_soft_max = ggml_soft_max_ext(ctx0, KQ, nullptr, KQscale, 0.0f);
 
                 struct ggml_tensor * V =
-                    ggml_view_3d(ctx0, kv_self.v,
-                            n_kv, n_state_head, n_head,
-                            n_ctx*ggml_element_size(kv_self.v),
-                            n_ctx*ggml_element_size(kv_self.v)*n_state_head,
-                            n_ctx*ggml_element_size(kv_self.v)*n_state*il);
+                    ggml_cast(ctx0,
+                            ggml_permute(ctx0,
+                                ggml_reshape_4d(ctx0,
+                                    Vcur,
+                                    n_state_head, n_head, n_ctx, n_states),
+                                1, 2, 0, 3),
+                            wctx.itype);
 
                 struct ggml_tensor * KQV = ggml_mul_mat(ctx0, V, KQ_soft_max);
 
                 struct ggml_tensor * KQV_merged = ggml_permute(ctx0, KQV, 0, 2, 1, 3);
 
-                cur = ggml_cont_2d(ctx0, KQV_merged, n_state, n_tokens);
+                cur = ggml_cont_2d(ctx0, KQV_merged, n_state, n_ctx*n_states);
             }
         }
 
@@ -2642,120 +3229,11 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
                     layer.attn_ln_1_w,
                     cur);
 
-            cur = ggml_add(ctx0,
-                    cur,
-                    layer.attn_ln_1_b);
-        }
-
-        // add the input
-        struct ggml_tensor * inpCA = ggml_add(ctx0, cur, inpL);
-
-        // norm
-        {
-            cur = ggml_norm(ctx0, inpCA, hparams.eps); // note: we use inpCA here
-
-            // cur = ln_0_w*cur + ln_0_b
-            cur = ggml_add(ctx0,
-                    ggml_mul(ctx0,
-                        cur,
-                        layer.cross_attn_ln_0_w),
-                    layer.cross_attn_ln_0_b);
-        }
-
-        // cross-attention
-        {
-            struct ggml_tensor * Qcur = ggml_mul_mat(ctx0,
-                    layer.cross_attn_q_w,
-                    cur);
-
-            Qcur = ggml_add(ctx0,
-                        Qcur,
-                        layer.cross_attn_q_b);
-
-            struct ggml_tensor * Q =
-                ggml_permute(ctx0,
-                        ggml_reshape_3d(ctx0, Qcur, n_state_head, n_head, n_tokens),
-                        0, 2, 1, 3);
-
-            if (wctx.params.flash_attn) {
-                struct ggml_tensor * Kcross =
-                    ggml_view_3d(ctx0, wstate.kv_cross.k,
-                            n_state_head, n_audio_ctx_pad, n_head,
-                            ggml_element_size(wstate.kv_cross.k)*n_state,
-                            ggml_element_size(wstate.kv_cross.k)*n_state_head,
-                            ggml_element_size(wstate.kv_cross.k)*n_state*n_audio_ctx_pad*il);
-
-                struct ggml_tensor * Vcross =
-                    ggml_view_3d(ctx0, wstate.kv_cross.v,
-                            n_state_head, n_audio_ctx_pad, n_head,
-                            ggml_element_size(wstate.kv_cross.v)*n_state,
-                            ggml_element_size(wstate.kv_cross.v)*n_state_head,
-                            ggml_element_size(wstate.kv_cross.v)*n_state*n_audio_ctx_pad*il);
-
-                cur = ggml_flash_attn_ext(ctx0, Q, Kcross, Vcross, nullptr, KQscale, 0.0f, 0.0f);
-
-                cur = ggml_reshape_2d(ctx0, cur, n_state, n_tokens);
-            } else {
-                struct ggml_tensor * Kcross =
-                    ggml_view_3d(ctx0, wstate.kv_cross.k,
-                            n_state_head, n_audio_ctx, n_head,
-                            ggml_element_size(wstate.kv_cross.k)*n_state,
-                            ggml_element_size(wstate.kv_cross.k)*n_state_head,
-                            ggml_element_size(wstate.kv_cross.k)*n_state*n_audio_ctx*il);
-
-                struct ggml_tensor * Vcross =
-                    ggml_view_3d(ctx0, wstate.kv_cross.v,
-                            n_audio_ctx, n_state_head, n_head,
-                            n_audio_ctx*ggml_element_size(wstate.kv_cross.v),
-                            n_audio_ctx*ggml_element_size(wstate.kv_cross.v)*n_state_head,
-                            n_audio_ctx*ggml_element_size(wstate.kv_cross.v)*n_state*il);
-
-                // ------
-
-                // K * Q
-                struct ggml_tensor * KQ = ggml_mul_mat(ctx0, Kcross, Q);
-
-                struct ggml_tensor * KQ_soft_max = ggml_soft_max_ext(ctx0, KQ, nullptr, KQscale, 0.0f);
-
-                // [EXPERIMENTAL] Token-level timestamps with DTW
-                if (wctx.params.dtw_token_timestamps) {
-                    if (wstate.aheads_masks.m[il] != nullptr) {
-                        struct ggml_tensor * aheads_KQs = ggml_reshape_2d(ctx0, KQ_soft_max, KQ_soft_max->ne[0] * KQ_soft_max->ne[1], KQ_soft_max->ne[2]);
-                        aheads_KQs = ggml_transpose(ctx0, aheads_KQs);
-                        aheads_KQs = ggml_cont(ctx0, aheads_KQs);
-                        aheads_KQs = ggml_mul_mat(ctx0, wstate.aheads_masks.m[il], aheads_KQs);
-                        aheads_KQs = ggml_transpose(ctx0, aheads_KQs);
-                        aheads_KQs = ggml_cont(ctx0, aheads_KQs);
-                        aheads_KQs = ggml_reshape_3d(ctx0, aheads_KQs, KQ_soft_max->ne[0], KQ_soft_max->ne[1], wstate.aheads_masks.m[il]->ne[1]);
-                        if (aheads_cross_QKs == NULL) {
-                            aheads_cross_QKs = aheads_KQs;
-                        } else {
-                            aheads_cross_QKs = ggml_concat(ctx0, aheads_cross_QKs, aheads_KQs, 2);
-                        }
-                    }
-                }
-
-                struct ggml_tensor * KQV = ggml_mul_mat(ctx0, Vcross, KQ_soft_max);
-
-                struct ggml_tensor * KQV_merged = ggml_permute(ctx0, KQV, 0, 2, 1, 3);
-
-                cur = ggml_cont_2d(ctx0, KQV_merged, n_state, n_tokens);
-            }
-        }
-
-        // projection
-        {
-            cur = ggml_mul_mat(ctx0,
-                    layer.cross_attn_ln_1_w,
-                    cur);
-
-            cur = ggml_add(ctx0,
-                    cur,
-                    layer.cross_attn_ln_1_b);
+            cur = ggml_add(ctx0, cur, layer.attn_ln_1_b);
         }
 
         // add the input
-        cur = ggml_add(ctx0, cur, inpCA);
+        cur = ggml_add(ctx0, cur, inpL);
 
         struct ggml_tensor * inpFF = cur;
 
@@ -2767,9 +3245,7 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
 
                 // cur = mlp_ln_w*cur + mlp_ln_b
                 cur = ggml_add(ctx0,
-                        ggml_mul(ctx0,
-                            cur,
-                            layer.mlp_ln_w),
+                        ggml_mul(ctx0, cur, layer.mlp_ln_w),
                         layer.mlp_ln_b);
             }
 
@@ -2778,9 +3254,7 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
                     layer.mlp_0_w,
                     cur);
 
-            cur = ggml_add(ctx0,
-                    cur,
-                    layer.mlp_0_b);
+            cur = ggml_add(ctx0, cur, layer.mlp_0_b);
 
             // GELU activation
             cur = ggml_gelu(ctx0, cur);
@@ -2790,9 +3264,7 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
                     layer.mlp_1_w,
                     cur);
 
-            cur = ggml_add(ctx0,
-                    cur,
-                    layer.mlp_1_b);
+            cur = ggml_add(ctx0, cur, layer.mlp_1_b);
         }
 
         inpL = ggml_add(ctx0, cur, inpFF);
@@ -2804,5093 +3276,8183 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
     {
         cur = ggml_norm(ctx0, cur, hparams.eps);
 
+        // cur = ln_f_g*cur + ln_f_b
         cur = ggml_add(ctx0,
-                ggml_mul(ctx0,
-                    cur,
-                    model.d_ln_w),
-                model.d_ln_b);
+                ggml_mul(ctx0, cur, model.e_ln_w),
+                model.e_ln_b);
     }
 
-    // compute logits only for the last token
-    // comment this line to compute logits for all n_tokens
-    // might be useful in the future
-    //cur = ggml_view_2d(ctx0, cur, cur->ne[0], 1, cur->nb[1], (cur->ne[1] - 1)*cur->nb[1]);
+    // cross
+    const float Kscale = pow(float(n_state_head), -0.25);
 
-    struct ggml_tensor * logits = ggml_mul_mat(ctx0, model.d_te, cur);
+    for (int il = 0; il < model.hparams.n_text_layer; ++il) {
+        auto & layer = model.layers_decoder[il];
 
-    // [EXPERIMENTAL] Token-level timestamps with DTW
-    if (wctx.params.dtw_token_timestamps && aheads_cross_QKs != nullptr) {
-        aheads_cross_QKs = ggml_transpose(ctx0, aheads_cross_QKs);
-        aheads_cross_QKs = ggml_cont(ctx0, aheads_cross_QKs);
-        if (save_alignment_heads_QKs) {
-            ggml_build_forward_expand(gf, aheads_cross_QKs);
-            wstate.aheads_cross_QKs = aheads_cross_QKs;
+        struct ggml_tensor * Kcross = ggml_mul_mat(ctx0,
+                layer.cross_attn_k_w,
+                cur);
+
+        Kcross = ggml_scale(ctx0, Kcross, Kscale);
+
+        struct ggml_tensor * Vcross = ggml_mul_mat(ctx0,
+                layer.cross_attn_v_w,
+                cur);
+
+        Vcross = ggml_add(ctx0,
+                    Vcross,
+                    layer.cross_attn_v_b);
+
+        if (states == nullptr) {
+            ggml_build_forward_expand(gf, Kcross);
+            ggml_build_forward_expand(gf, Vcross);
+            continue;
         }
-    }
 
-    ggml_build_forward_expand(gf, logits);
+        for (int ib = 0; ib < n_states; ++ib) {
+            auto & kv_cross = states[ib]->kv_cross;
+
+            struct ggml_tensor * Kb = ggml_view_2d(ctx0, Kcross, n_state, n_ctx, Kcross->nb[1], ib*n_ctx*Kcross->nb[1]);
+            struct ggml_tensor * Vb = ggml_view_2d(ctx0, Vcross, n_state, n_ctx, Vcross->nb[1], ib*n_ctx*Vcross->nb[1]);
+
+            struct ggml_tensor * k;
+            struct ggml_tensor * v;
+
+            // same layout as whisper_build_graph_cross()
+            if (wctx.params.flash_attn) {
+                k = ggml_view_1d(ctx0, kv_cross.k, n_state*n_ctx,
+                        ggml_row_size(kv_cross.k->type, n_state)*(il*n_ctx_pad));
+
+                v = ggml_view_1d(ctx0, kv_cross.v, n_state*n_ctx,
+                        ggml_row_size(kv_cross.v->type, n_state)*(il*n_ctx_pad));
+            } else {
+                Vb = ggml_transpose(ctx0, Vb);
+
+                k = ggml_view_1d(ctx0, kv_cross.k, n_state*n_ctx,
+                        ggml_row_size(kv_cross.k->type, n_state)*(il*n_ctx));
+
+                v = ggml_view_2d(ctx0, kv_cross.v, n_ctx, n_state,
+                        (   n_ctx)*ggml_element_size(kv_cross.v),
+                        (il*n_ctx)*ggml_element_size(kv_cross.v)*n_state);
+            }
+
+            ggml_build_forward_expand(gf, ggml_cpy(ctx0, Kb, k));
+            ggml_build_forward_expand(gf, ggml_cpy(ctx0, Vb, v));
+        }
+    }
 
     ggml_free(ctx0);
 
     return gf;
 }
 
-// evaluate the decoder
-//
-// given text prompt + audio features -> computes the logits for the next token
-//
-//   - model:      the model
-//   - n_threads:  number of threads to use
-//   - tokens:     text prompt
-//   - n_tokens:   number of tokens in the prompt
-//   - n_past:     number of past tokens to prefix the prompt with
-//
-static bool whisper_decode_internal(
-        whisper_context & wctx,
-          whisper_state & wstate,
-    const whisper_batch & batch,
-              const int   n_threads,
-                   bool   save_alignment_heads_QKs,
-    ggml_abort_callback   abort_callback,
-                   void * abort_callback_data) {
-    const int64_t t_start_us = ggml_time_us();
-
-    const auto & model   = wctx.model;
-    const auto & hparams = model.hparams;
+// the encoder input: 2*n_ctx frames of the spectrogram starting at mel_offset, zero past the end
+static void whisper_mel_window(const whisper_mel & mel_inp, int mel_offset, int n_ctx, float * dst) {
+    memset(dst, 0, 2*n_ctx*mel_inp.n_mel*sizeof(float));
 
-    const int n_vocab  = hparams.n_vocab;
-    const int n_tokens = batch.n_tokens;
+    const int i0 = std::min(mel_offset,           mel_inp.n_len);
+    const int i1 = std::min(mel_offset + 2*n_ctx, mel_inp.n_len);
 
-    auto & logits_out = wstate.logits;
+    const int i1_data = std::max(i0, std::min(i1, mel_inp.n_len_data));
 
-    struct ggml_tensor * logits;
+    for (int j = 0; j < mel_inp.n_mel; ++j) {
+        for (int i = i0; i < i1_data; ++i) {
+            dst[j*2*n_ctx + (i - i0)] = mel_inp.data[j*mel_inp.n_stride + i];
+        }
+        for (int i = i1_data; i < i1; ++i) {
+            dst[j*2*n_ctx + (i - i0)] = mel_inp.v_tail;
+        }
+    }
+}
 
-    // find KV slot for the batch
-    {
-        auto & kv_self = wstate.kv_self;
+// bytes of kv_cross.k / kv_cross.v written by whisper_build_graph_cross() for n_ctx audio positions
+static size_t whisper_kv_cross_size(const whisper_context & wctx, const ggml_tensor * t, int n_ctx) {
+    const auto & hparams = wctx.model.hparams;
 
-        if (!whisper_kv_cache_find_slot(kv_self, batch)) {
-            return false;
-        }
+    const size_t n_ctx_layer = wctx.params.flash_attn ? GGML_PAD(n_ctx, wctx.audio_ctx_pad) : n_ctx;
 
-        const uint32_t pad = whisper_kv_cache_get_padding(wctx);
-        kv_self.n = std::min(kv_self.size, std::max(pad, GGML_PAD(whisper_kv_cache_cell_max(kv_self), pad)));
+    return ggml_row_size(t->type, hparams.n_text_state)*((hparams.n_text_layer - 1)*n_ctx_layer + n_ctx);
+}
 
-        //kv_self.n = std::min((int32_t) hparams.n_text_ctx, std::max(32, whisper_kv_cache_cell_max(kv_self)));
-        //printf("n_tokens = %5d, kv_self.head = %5d, kv_self.n = %5d, seq_id = %5d\n", batch.n_tokens, kv_self.head, kv_self.n, batch.seq_id[0][0]);
+// FNV-1a over the bits of the mel window
+static uint64_t whisper_enc_cache_hash(const std::vector<float> & mel, int n_ctx) {
+    uint64_t h = 1469598103934665603ull ^ (uint64_t) n_ctx;
+    for (const float x : mel) {
+        uint32_t u;
+        memcpy(&u, &x, sizeof(u));
+        h = (h ^ u)*1099511628211ull;
     }
+    return h;
+}
 
-    // decoder
-    {
-        auto & sched = wstate.sched_decode.sched;
+// restores the kv_cross of the window in wstate.inp_mel, returns false if it is not cached
+static bool whisper_enc_cache_load(whisper_context & wctx, whisper_state & wstate, uint64_t hash, int n_ctx) {
+    auto & cache = wctx.enc_cache;
 
-        ggml_cgraph * gf = whisper_build_graph_decoder(wctx, wstate, batch, save_alignment_heads_QKs, false);
+    std::shared_ptr<whisper_enc_cache::entry> hit;
+    {
+        std::lock_guard<std::mutex> lock(cache.mutex);
 
-        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
-            // should never happen as we pre-allocate the memory
-            return false;
+        for (const auto & e : cache.entries) {
+            if (e->hash == hash && e->n_ctx == n_ctx && e->mel == wstate.inp_mel) {
+                e->t_used = ++cache.clock;
+                hit = e;
+                break;
+            }
         }
 
-        // set the inputs
-        {
-            struct ggml_tensor * embd = ggml_graph_get_tensor(gf, "embd");
-            ggml_backend_tensor_set(embd, batch.token, 0, n_tokens*ggml_element_size(embd));
+        if (hit) {
+            cache.n_hit++;
+        } else {
+            cache.n_miss++;
         }
+    }
 
-        {
-            struct ggml_tensor * position = ggml_graph_get_tensor(gf, "position");
-            for (int i = 0; i < n_tokens; ++i) {
-                const int32_t val = batch.pos[i];
-                ggml_backend_tensor_set(position, &val, i*sizeof(int32_t), sizeof(int32_t));
-            }
-        }
+    if (!hit) {
+        return false;
+    }
 
-        {
-            struct ggml_tensor * KQ_mask = ggml_graph_get_tensor(gf, "KQ_mask");
+    ggml_backend_tensor_set(wstate.kv_cross.k, hit->k.data(), 0, hit->k.size());
+    ggml_backend_tensor_set(wstate.kv_cross.v, hit->v.data(), 0, hit->v.size());
 
-            auto & kv_self = wstate.kv_self;
+    return true;
+}
 
-            const int32_t n_kv = kv_self.n;
+// adds the kv_cross of the window in wstate.inp_mel, evicting the least recently used entries beyond the budget
+static void whisper_enc_cache_store(whisper_context & wctx, const whisper_state & wstate, uint64_t hash, int n_ctx) {
+    auto & cache = wctx.enc_cache;
 
-            wstate.inp_mask.resize(ggml_nelements(KQ_mask));
+    const size_t size_max = wctx.params.enc_cache_size;
 
-            float * data = wstate.inp_mask.data();
-            memset(data, 0, ggml_nbytes(KQ_mask));
+    auto e = std::make_shared<whisper_enc_cache::entry>();
 
-            for (int h = 0; h < 1; ++h) {
-                for (int j = 0; j < n_tokens; ++j) {
-                    const whisper_pos    pos    = batch.pos[j];
-                    const whisper_seq_id seq_id = batch.seq_id[j][0];
+    e->hash  = hash;
+    e->n_ctx = n_ctx;
+    e->mel   = wstate.inp_mel;
 
-                    for (int i = 0; i < n_kv; ++i) {
-                        if (!kv_self.cells[i].has_seq_id(seq_id) || kv_self.cells[i].pos > pos) {
-                            data[h*(n_kv*n_tokens) + j*n_kv + i] = -INFINITY;
-                        }
-                    }
-                }
+    e->k.resize(whisper_kv_cross_size(wctx, wstate.kv_cross.k, n_ctx));
+    e->v.resize(whisper_kv_cross_size(wctx, wstate.kv_cross.v, n_ctx));
 
-                for (int i = n_tokens; i < GGML_PAD(n_tokens, GGML_KQ_MASK_PAD); ++i) {
-                    for (int j = 0; j < n_kv; ++j) {
-                        data[h*(n_kv*n_tokens) + i*n_kv + j] = -INFINITY;
-                    }
-                }
-            }
+    if (e->size() > size_max) {
+        return;
+    }
 
-            ggml_backend_tensor_set(KQ_mask, wstate.inp_mask.data(), 0, ggml_nelements(KQ_mask)*sizeof(float));
-        }
+    ggml_backend_tensor_get(wstate.kv_cross.k, e->k.data(), 0, e->k.size());
+    ggml_backend_tensor_get(wstate.kv_cross.v, e->v.data(), 0, e->v.size());
 
-        logits = ggml_graph_node(gf, -1);
+    std::lock_guard<std::mutex> lock(cache.mutex);
 
-        if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
-            return false;
+    // another state may have encoded the same window in the meantime
+    for (const auto & other : cache.entries) {
+        if (other->hash == hash && other->n_ctx == n_ctx && other->mel == e->mel) {
+            return;
         }
     }
 
-    logits_out.resize(n_tokens*n_vocab);
-    for (int i = 0; i < n_tokens; i++) {
-        if (batch.logits[i] == 0) {
-            continue;
-        }
-        ggml_backend_tensor_get(logits, logits_out.data() + (n_vocab*i), sizeof(float)*(n_vocab*i), sizeof(float)*n_vocab);
-    }
+    while (cache.size + e->size() > size_max) {
+        auto lru = std::min_element(cache.entries.begin(), cache.entries.end(),
+                [](const std::shared_ptr<whisper_enc_cache::entry> & a, const std::shared_ptr<whisper_enc_cache::entry> & b) {
+                    return a->t_used < b->t_used;
+                });
 
-    if (batch.n_tokens > 1) {
-        //printf("%s: used_mem = %f MB, %f MB, %f MB %f MB %f MB\n", __func__,
-        //        ggml_used_mem(ctx0)/1e6,
-        //        wstate.get_buf_max_mem(0)/1e6,
-        //        wstate.get_buf_max_mem(1)/1e6,
-        //        wstate.get_buf_max_mem(2)/1e6,
-        //        wstate.get_buf_max_mem(3)/1e6);
+        cache.size -= (*lru)->size();
+        cache.entries.erase(lru);
     }
 
-    if (batch.n_tokens == 1) {
-        wstate.t_decode_us += ggml_time_us() - t_start_us;
-        wstate.n_decode++;
-    } else if (batch.n_tokens < 16) {
-        wstate.t_batchd_us += ggml_time_us() - t_start_us;
-        wstate.n_batchd += n_tokens;
-    } else {
-        wstate.t_prompt_us += ggml_time_us() - t_start_us;
-        wstate.n_prompt += n_tokens;
-    }
+    e->t_used = ++cache.clock;
 
-    return !(abort_callback && abort_callback(abort_callback_data));
+    cache.size += e->size();
+    cache.entries.push_back(std::move(e));
 }
 
-//  500 -> 00:05.000
-// 6000 -> 01:00.000
-static std::string to_timestamp(int64_t t, bool comma = false) {
-    int64_t msec = t * 10;
-    int64_t hr = msec / (1000 * 60 * 60);
-    msec = msec - hr * (1000 * 60 * 60);
-    int64_t min = msec / (1000 * 60);
-    msec = msec - min * (1000 * 60);
-    int64_t sec = msec / 1000;
-    msec = msec - sec * 1000;
+// evaluate the encoder with the given state
+//
+// given audio recording (more specifically, its log mel spectrogram), runs forward pass of the encoder
+// part of the transformer model and returns the encoded features
+//
+//   - wctx:      the model
+//   - wstate:     the state of the encoder
+//   - n_threads:  number of threads to use
+//   - mel_offset: offset in the mel spectrogram (i.e. audio offset)
+//
+static bool whisper_encode_internal(
+        whisper_context & wctx,
+          whisper_state & wstate,
+              const int   mel_offset,
+              const int   n_threads,
+    ggml_abort_callback   abort_callback,
+                   void * abort_callback_data) {
+    const int64_t t_start_us = ggml_time_us();
 
-    char buf[32];
-    snprintf(buf, sizeof(buf), "%02d:%02d:%02d%s%03d", (int) hr, (int) min, (int) sec, comma ? "," : ".", (int) msec);
+    wstate.enc_mel_offset = -1;
 
-    return std::string(buf);
-}
+    const int n_ctx = wstate.exp_n_audio_ctx > 0 ? wstate.exp_n_audio_ctx : wctx.model.hparams.n_audio_ctx;
 
-#define SIN_COS_N_COUNT WHISPER_N_FFT
-namespace {
-struct whisper_global_cache {
-    // In FFT, we frequently use sine and cosine operations with the same values.
-    // We can use precalculated values to speed up the process.
-    float sin_vals[SIN_COS_N_COUNT];
-    float cos_vals[SIN_COS_N_COUNT];
+    assert(wstate.mel.n_mel == wctx.model.hparams.n_mels);
 
-    // Hann window (Use cosf to eliminate difference)
-    // ref: https://pytorch.org/docs/stable/generated/torch.hann_window.html
-    // ref: https://github.com/openai/whisper/blob/main/whisper/audio.py#L147
-    float hann_window[WHISPER_N_FFT];
+    wstate.inp_mel.resize(2*n_ctx*wstate.mel.n_mel);
 
-    whisper_global_cache() {
-        fill_sin_cos_table();
-        fill_hann_window(sizeof(hann_window)/sizeof(hann_window[0]), true, hann_window);
+    whisper_mel_window(wstate.mel, mel_offset, n_ctx, wstate.inp_mel.data());
+
+    const bool     use_cache = wctx.params.enc_cache_size > 0;
+    const uint64_t hash      = use_cache ? whisper_enc_cache_hash(wstate.inp_mel, n_ctx) : 0;
+
+    if (use_cache && whisper_enc_cache_load(wctx, wstate, hash, n_ctx)) {
+        wstate.enc_mel_offset = mel_offset;
+        wstate.enc_n_ctx      = n_ctx;
+
+        return !(abort_callback && abort_callback(abort_callback_data));
     }
 
-    void fill_sin_cos_table() {
-        for (int i = 0; i < SIN_COS_N_COUNT; i++) {
-            double theta = (2 * M_PI * i) / SIN_COS_N_COUNT;
-            sin_vals[i] = sinf(theta);
-            cos_vals[i] = cosf(theta);
+    // conv
+    {
+        auto & sched = wstate.sched_conv.sched;
+
+        ggml_cgraph * gf = whisper_build_graph_conv(wctx, wstate);
+
+        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
+            // should never happen as we pre-allocate the memory
+            return false;
         }
-    }
 
-    void fill_hann_window(int length, bool periodic, float * output) {
-        int offset = -1;
-        if (periodic) {
-            offset = 0;
+        struct ggml_tensor * mel = ggml_graph_get_tensor(gf, "mel");
+
+        // set the input
+        {
+            assert(mel->type == GGML_TYPE_F32);
+            assert(ggml_nelements(mel) == (int64_t) wstate.inp_mel.size());
+
+            ggml_backend_tensor_set(mel, wstate.inp_mel.data(), 0, ggml_nelements(mel)*sizeof(float));
         }
-        for (int i = 0; i < length; i++) {
-            output[i] = 0.5 * (1.0 - cosf((2.0 * M_PI * i) / (length + offset)));
+
+        if (!whisper_encode_external(wstate)) {
+            if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
+                return false;
+            }
+        } else {
+            ggml_backend_sched_reset(sched);
+
+#if defined(WHISPER_USE_COREML)
+            whisper_coreml_encode(wstate.ctx_coreml, mel->ne[0], mel->ne[1], (float *) mel->data, (float *) wstate.embd_enc->data);
+#elif defined(WHISPER_USE_OPENVINO)
+            whisper_openvino_encode(wstate.ctx_openvino, mel, wstate.embd_enc);
+#endif
         }
     }
-} global_cache;
-}
 
-// naive Discrete Fourier Transform
-// input is real-valued
-// output is complex-valued
-static void dft(const float* in, int N, float* out) {
-    const int sin_cos_step = SIN_COS_N_COUNT / N;
+    // encoder
+    if (!whisper_encode_external(wstate)) {
+        auto & sched = wstate.sched_encode.sched;
 
-    for (int k = 0; k < N; k++) {
-        float re = 0;
-        float im = 0;
+        ggml_cgraph * gf = whisper_build_graph_encoder(wctx, wstate);
 
-        for (int n = 0; n < N; n++) {
-            int idx = (k * n * sin_cos_step) % (SIN_COS_N_COUNT); // t = 2*M_PI*k*n/N
-            re += in[n]*global_cache.cos_vals[idx]; // cos(t)
-            im -= in[n]*global_cache.sin_vals[idx]; // sin(t)
+        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
+            // should never happen as we pre-allocate the memory
+            return false;
         }
 
-        out[k*2 + 0] = re;
-        out[k*2 + 1] = im;
+        if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
+            return false;
+        }
     }
-}
 
-// Cooley-Tukey FFT
-// poor man's implementation - use something better
-// input is real-valued
-// output is complex-valued
-static void fft(float* in, int N, float* out) {
-    if (N == 1) {
-        out[0] = in[0];
-        out[1] = 0;
-        return;
-    }
+    // cross
+    {
+        auto & sched = wstate.sched_cross.sched;
 
-    const int half_N = N / 2;
-    if (N - half_N*2 == 1) {
-        dft(in, N, out);
-        return;
-    }
+        ggml_cgraph * gf = whisper_build_graph_cross(wctx, wstate);
 
-    float* even = in + N;
-    for (int i = 0; i < half_N; ++i) {
-        even[i]= in[2*i];
-    }
-    float* even_fft = out + 2 * N;
-    fft(even, half_N, even_fft);
+        if (!ggml_backend_sched_alloc_graph(sched, gf)) {
+            // should never happen as we pre-allocate the memory
+            return false;
+        }
 
-    float* odd = even;
-    for (int i = 0; i < half_N; ++i) {
-        odd[i] = in[2*i + 1];
+        if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
+            return false;
+        }
     }
-    float* odd_fft = even_fft + N;
-    fft(odd, half_N, odd_fft);
 
-    const int sin_cos_step = SIN_COS_N_COUNT / N;
-    for (int k = 0; k < half_N; k++) {
-        int idx = k * sin_cos_step; // t = 2*M_PI*k/N
-        float re = global_cache.cos_vals[idx]; // cos(t)
-        float im = -global_cache.sin_vals[idx]; // sin(t)
+    if (use_cache) {
+        whisper_enc_cache_store(wctx, wstate, hash, n_ctx);
+    }
 
-        float re_odd = odd_fft[2*k + 0];
-        float im_odd = odd_fft[2*k + 1];
+    wstate.t_encode_us += ggml_time_us() - t_start_us;
+    wstate.n_encode++;
 
-        out[2*k + 0] = even_fft[2*k + 0] + re*re_odd - im*im_odd;
-        out[2*k + 1] = even_fft[2*k + 1] + re*im_odd + im*re_odd;
+    wstate.enc_mel_offset = mel_offset;
+    wstate.enc_n_ctx      = n_ctx;
 
-        out[2*(k + half_N) + 0] = even_fft[2*k + 0] - re*re_odd + im*im_odd;
-        out[2*(k + half_N) + 1] = even_fft[2*k + 1] - re*im_odd - im*re_odd;
-    }
+    return !(abort_callback && abort_callback(abort_callback_data));
 }
 
-static void log_mel_spectrogram_worker_thread(int ith, const float * hann, const std::vector<float> & samples,
-                                              int n_samples, int frame_size, int frame_step, int n_threads,
-                                              const whisper_filters & filters, whisper_mel & mel) {
-    std::vector<float> fft_in(frame_size * 2, 0.0);
-    std::vector<float> fft_out(frame_size * 2 * 2 * 2);
+// the tokens [i0, i0 + n_tokens) of a batch attend to the audio features in kv_cross
+// (continuous batching of independent requests, see whisper_decoder_batch)
+struct whisper_cross_span {
+    const whisper_kv_cache * kv_cross;
 
-    int n_fft = filters.n_fft;
-    int i = ith;
+    int n_audio_ctx;
+    int i0;
+    int n_tokens;
+};
 
-    // make sure n_fft == 1 + (WHISPER_N_FFT / 2), bin_0 to bin_nyquist
-    assert(n_fft == 1 + (frame_size / 2));
+static struct ggml_cgraph * whisper_build_graph_decoder(
+         whisper_context & wctx,
+         whisper_state   & wstate,
+     const whisper_batch & batch,
+                    bool   save_alignment_heads_QKs,
+                    bool   worst_case,
+    const std::vector<whisper_cross_span> * spans = nullptr) {
+    const auto & model   = wctx.model;
+    const auto & hparams = model.hparams;
 
-    // calculate FFT only when fft_in are not all zero
-    for (; i < std::min(n_samples / frame_step + 1, mel.n_len); i += n_threads) {
-        const int offset = i * frame_step;
+    auto & kv_self = wstate.kv_self;
 
-        // apply Hann window (~10% faster)
-        for (int j = 0; j < std::min(frame_size, n_samples - offset); j++) {
-            fft_in[j] = hann[j] * samples[offset + j];
-        }
+    WHISPER_ASSERT(!!kv_self.buffer);
 
-        // fill the rest with zeros
-        if (n_samples - offset < frame_size) {
-            std::fill(fft_in.begin() + (n_samples - offset), fft_in.end(), 0.0);
-        }
+    const int n_ctx   = kv_self.size;
+    const int n_state = hparams.n_text_state;
+    const int n_head  = hparams.n_text_head;
+    const int n_layer = hparams.n_text_layer;
 
-        // FFT
-        fft(fft_in.data(), frame_size, fft_out.data());
+    const int n_state_head = n_state/n_head;
 
-        // Calculate modulus^2 of complex numbers
-        // Use pow(fft_out[2 * j + 0], 2) + pow(fft_out[2 * j + 1], 2) causes inference quality problem? Interesting.
-        for (int j = 0; j < n_fft; j++) {
-            fft_out[j] = (fft_out[2 * j + 0] * fft_out[2 * j + 0] + fft_out[2 * j + 1] * fft_out[2 * j + 1]);
-        }
+    const int n_tokens = batch.n_tokens;
 
-        // mel spectrogram
-        for (int j = 0; j < mel.n_mel; j++) {
-            double sum = 0.0;
-            // unroll loop (suggested by GH user @lunixbochs)
-            int k = 0;
-            for (k = 0; k < n_fft - 3; k += 4) {
-                sum +=
-                        fft_out[k + 0] * filters.data[j * n_fft + k + 0] +
-                        fft_out[k + 1] * filters.data[j * n_fft + k + 1] +
-                        fft_out[k + 2] * filters.data[j * n_fft + k + 2] +
-                        fft_out[k + 3] * filters.data[j * n_fft + k + 3];
-            }
-            // handle n_fft remainder
-            for (; k < n_fft; k++) {
-                sum += fft_out[k] * filters.data[j * n_fft + k];
-            }
-            sum = log10(std::max(sum, 1e-10));
-            mel.data[j * mel.n_len + i] = sum;
-        }
-    }
+    const int32_t n_kv = worst_case ? n_ctx : kv_self.n;
 
-    // Otherwise fft_out are all zero
-    double sum = log10(1e-10);
-    for (; i < mel.n_len; i += n_threads) {
-        for (int j = 0; j < mel.n_mel; j++) {
-            mel.data[j * mel.n_len + i] = sum;
-        }
-    }
-}
+    //WHISPER_LOG_DEBUG("%s: n_past = %d, n_tokens = %d, n_audio_ctx = %d, n_ctx = %d\n", __func__, n_past, n_tokens, n_audio_ctx, n_ctx);
 
-// ref: https://github.com/openai/whisper/blob/main/whisper/audio.py#L110-L157
-static bool log_mel_spectrogram(
-              whisper_state & wstate,
-              const float * samples,
-              const int   n_samples,
-              const int   /*sample_rate*/,
-              const int   frame_size,
-              const int   frame_step,
-              const int   n_mel,
-              const int   n_threads,
-              const whisper_filters & filters,
-              const bool   debug,
-              whisper_mel & mel) {
-    const int64_t t_start_us = ggml_time_us();
+    struct ggml_init_params params = {
+        /*.mem_size   =*/ wstate.sched_decode.meta.size(),
+        /*.mem_buffer =*/ wstate.sched_decode.meta.data(),
+        /*.no_alloc   =*/ true,
+    };
 
-    // Hann window
-    WHISPER_ASSERT(frame_size == WHISPER_N_FFT && "Unsupported frame_size");
-    const float * hann = global_cache.hann_window;
+    struct ggml_context * ctx0 = ggml_init(params);
 
-    // Calculate the length of padding
-    int64_t stage_1_pad = WHISPER_SAMPLE_RATE * 30;
-    int64_t stage_2_pad = frame_size / 2;
+    ggml_cgraph * gf = ggml_new_graph_custom(ctx0, WHISPER_MAX_NODES, false);
 
-    // Initialize a vector and copy data from C array to it.
-    std::vector<float> samples_padded;
-    samples_padded.resize(n_samples + stage_1_pad + stage_2_pad * 2);
-    std::copy(samples, samples + n_samples, samples_padded.begin() + stage_2_pad);
+    struct ggml_tensor * embd = ggml_new_tensor_1d(ctx0, GGML_TYPE_I32, n_tokens);
+    ggml_set_name(embd, "embd");
+    ggml_set_input(embd);
 
-    // pad 30 seconds of zeros at the end of audio (480,000 samples) + reflective pad 200 samples at the end of audio
-    std::fill(samples_padded.begin() + n_samples + stage_2_pad, samples_padded.begin() + n_samples + stage_1_pad + 2 * stage_2_pad, 0);
+    struct ggml_tensor * position = ggml_new_tensor_1d(ctx0, GGML_TYPE_I32, n_tokens);
+    ggml_set_name(position, "position");
+    ggml_set_input(position);
 
-    // reflective pad 200 samples at the beginning of audio
-    std::reverse_copy(samples + 1, samples + 1 + stage_2_pad, samples_padded.begin());
+    const float KQscale = pow(float(n_state_head), -0.25);
 
-    mel.n_mel     = n_mel;
-    // https://github.com/pytorch/pytorch/blob/main/aten/src/ATen/native/SpectralOps.cpp#L936
-    // Calculate number of frames + remove the last frame
-    mel.n_len     = (samples_padded.size() - frame_size) / frame_step;
-    // Calculate semi-padded sample length to ensure compatibility
-    mel.n_len_org = 1 + (n_samples + stage_2_pad - frame_size) / frame_step;
-    mel.data.resize(mel.n_mel * mel.n_len);
+    struct ggml_tensor * KQ_mask = ggml_new_tensor_3d(ctx0, GGML_TYPE_F32, n_kv, GGML_PAD(n_tokens, GGML_KQ_MASK_PAD), 1);
+    ggml_set_name(KQ_mask, "KQ_mask");
+    ggml_set_input(KQ_mask);
 
-    {
-        std::vector<std::thread> workers(n_threads - 1);
-        for (int iw = 0; iw < n_threads - 1; ++iw) {
-            workers[iw] = std::thread(
-                    log_mel_spectrogram_worker_thread, iw + 1, hann, std::cref(samples_padded),
-                    n_samples + stage_2_pad, frame_size, frame_step, n_threads,
-                    std::cref(filters), std::ref(mel));
-        }
+    struct ggml_tensor * KQ_mask_f16 = ggml_cast(ctx0, KQ_mask, GGML_TYPE_F16);
 
-        // main thread
-        log_mel_spectrogram_worker_thread(0, hann, samples_padded, n_samples + stage_2_pad, frame_size, frame_step, n_threads, filters, mel);
+    // the cells of the KV cache the keys and values of the tokens are stored in - inputs, so that the graph does not
+    // depend on the position of the batch in the cache and can be reused by the next call (see whisper_decode_internal)
+    // the values are stored transposed without flash attention, one element per row
+    struct ggml_tensor * kv_idxs = ggml_new_tensor_1d(ctx0, GGML_TYPE_I32, n_tokens);
+    ggml_set_name(kv_idxs, "kv_idxs");
+    ggml_set_input(kv_idxs);
 
-        for (int iw = 0; iw < n_threads - 1; ++iw) {
-            workers[iw].join();
-        }
+    struct ggml_tensor * kv_idxs_v = kv_idxs;
+    if (!wctx.params.flash_attn) {
+        kv_idxs_v = ggml_new_tensor_1d(ctx0, GGML_TYPE_I32, n_tokens*n_state);
+        ggml_set_name(kv_idxs_v, "kv_idxs_v");
+        ggml_set_input(kv_idxs_v);
     }
 
-    // clamping and normalization
-    double mmax = -1e20;
-    for (int i = 0; i < mel.n_mel*mel.n_len; i++) {
-        if (mel.data[i] > mmax) {
-            mmax = mel.data[i];
-        }
-    }
+    // token encoding + position encoding
+    struct ggml_tensor * cur =
+        ggml_add(ctx0,
+                ggml_get_rows(ctx0, model.d_te, embd),
+                ggml_get_rows(ctx0, model.d_pe, position));
 
-    mmax -= 8.0;
+    struct ggml_tensor * inpL = cur;
 
-    for (int i = 0; i < mel.n_mel*mel.n_len; i++) {
-        if (mel.data[i] < mmax) {
-            mel.data[i] = mmax;
-        }
+    // [EXPERIMENTAL] Token-level timestamps with DTW
+    struct ggml_tensor * aheads_cross_QKs = nullptr;
 
-        mel.data[i] = (mel.data[i] + 4.0)/4.0;
-    }
-
-    wstate.t_mel_us += ggml_time_us() - t_start_us;
-
-    // Dump log_mel_spectrogram
-    if (debug) {
-        std::ofstream outFile("log_mel_spectrogram.json");
-        outFile << "[";
-        for (uint64_t i = 0; i < mel.data.size() - 1; i++) {
-            outFile << mel.data[i] << ", ";
-        }
-        outFile << mel.data[mel.data.size() - 1] << "]";
-        outFile.close();
-    }
+    // cross-attention of the n_q queries in Qcur to the n_audio_ctx audio features in kv_cross
+    const auto build_cross_attn = [&](const whisper_kv_cache & kv_cross, int n_audio_ctx, struct ggml_tensor * Qcur, int n_q, int il) -> struct ggml_tensor * {
+        const int n_audio_ctx_pad = GGML_PAD(n_audio_ctx, wctx.audio_ctx_pad);
 
-    return true;
-}
+        struct ggml_tensor * Q =
+            ggml_permute(ctx0,
+                    ggml_reshape_3d(ctx0, Qcur, n_state_head, n_head, n_q),
+                    0, 2, 1, 3);
 
-// split text into tokens
-//
-// ref: https://github.com/openai/gpt-2/blob/a74da5d99abaaba920de8131d64da2862a8f213b/src/encoder.py#L53
-//
-// Regex (Python):
-// r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
-//
-// Regex (C++):
-// R"('s|'t|'re|'ve|'m|'ll|'d| ?[[:alpha:]]+| ?[[:digit:]]+| ?[^\s[:alpha:][:digit:]]+|\s+(?!\S)|\s+)"
-//
-static std::vector<whisper_vocab::id> tokenize(const whisper_vocab & vocab, const std::string & text) {
-    std::vector<std::string> words;
+        if (wctx.params.flash_attn) {
+            struct ggml_tensor * Kcross =
+                ggml_view_3d(ctx0, kv_cross.k,
+                        n_state_head, n_audio_ctx_pad, n_head,
+                        ggml_row_size(kv_cross.k->type, n_state),
+                        ggml_row_size(kv_cross.k->type, n_state_head),
+                        ggml_row_size(kv_cross.k->type, n_state)*n_audio_ctx_pad*il);
+
+            struct ggml_tensor * Vcross =
+                ggml_view_3d(ctx0, kv_cross.v,
+                        n_state_head, n_audio_ctx_pad, n_head,
+                        ggml_row_size(kv_cross.v->type, n_state),
+                        ggml_row_size(kv_cross.v->type, n_state_head),
+                        ggml_row_size(kv_cross.v->type, n_state)*n_audio_ctx_pad*il);
+
+            struct ggml_tensor * out = ggml_flash_attn_ext(ctx0, Q, Kcross, Vcross, nullptr, KQscale, 0.0f, 0.0f);
+
+            return ggml_reshape_2d(ctx0, out, n_state, n_q);
+        } else {
+            struct ggml_tensor * Kcross =
+                ggml_view_3d(ctx0, kv_cross.k,
+                        n_state_head, n_audio_ctx, n_head,
+                        ggml_row_size(kv_cross.k->type, n_state),
+                        ggml_row_size(kv_cross.k->type, n_state_head),
+                        ggml_row_size(kv_cross.k->type, n_state)*n_audio_ctx*il);
+
+            struct ggml_tensor * Vcross =
+                ggml_view_3d(ctx0, kv_cross.v,
+                        n_audio_ctx, n_state_head, n_head,
+                        n_audio_ctx*ggml_element_size(kv_cross.v),
+                        n_audio_ctx*ggml_element_size(kv_cross.v)*n_state_head,
+                        n_audio_ctx*ggml_element_size(kv_cross.v)*n_state*il);
 
-    // first split the text into words
-    {
-        std::string str = text;
-        std::string pat = R"('s|'t|'re|'ve|'m|'ll|'d| ?[[:alpha:]]+| ?[[:digit:]]+| ?[^\s[:alpha:][:digit:]]+|\s+(?!\S)|\s+)";
+            // ------
 
-        std::regex re(pat);
-        std::smatch m;
+            // K * Q
+            struct ggml_tensor * KQ = ggml_mul_mat(ctx0, Kcross, Q);
 
-        while (std::regex_search(str, m, re)) {
-            for (auto x : m) {
-                words.push_back(x);
-            }
-            str = m.suffix();
-        }
-    }
+            struct ggml_tensor * KQ_soft_max = ggml_soft_max_ext(ctx0, KQ, nullptr, KQscale, 0.0f);
 
-    // find the longest tokens that form the words:
-    std::vector<whisper_vocab::id> tokens;
-    for (const auto & word : words) {
-        if (word.empty()) continue;
-
-        int i = 0;
-        int n = word.size();
-        while (i < n) {
-            int j = n;
-            bool found = false;
-            while (j > i) {
-                auto sub = word.substr(i, j-i);
-                auto it = vocab.token_to_id.find(sub);
-                if (it != vocab.token_to_id.end()) {
-                    tokens.push_back(it->second);
-                    i = j;
-                    found = true;
-                    break;
+            // [EXPERIMENTAL] Token-level timestamps with DTW
+            if (wctx.params.dtw_token_timestamps && spans == nullptr) {
+                if (wstate.aheads_masks.m[il] != nullptr) {
+                    struct ggml_tensor * aheads_KQs = ggml_reshape_2d(ctx0, KQ_soft_max, KQ_soft_max->ne[0] * KQ_soft_max->ne[1], KQ_soft_max->ne[2]);
+                    aheads_KQs = ggml_transpose(ctx0, aheads_KQs);
+                    aheads_KQs = ggml_cont(ctx0, aheads_KQs);
+                    aheads_KQs = ggml_mul_mat(ctx0, wstate.aheads_masks.m[il], aheads_KQs);
+                    aheads_KQs = ggml_transpose(ctx0, aheads_KQs);
+                    aheads_KQs = ggml_cont(ctx0, aheads_KQs);
+                    aheads_KQs = ggml_reshape_3d(ctx0, aheads_KQs, KQ_soft_max->ne[0], KQ_soft_max->ne[1], wstate.aheads_masks.m[il]->ne[1]);
+                    if (aheads_cross_QKs == NULL) {
+                        aheads_cross_QKs = aheads_KQs;
+                    } else {
+                        aheads_cross_QKs = ggml_concat(ctx0, aheads_cross_QKs, aheads_KQs, 2);
+                    }
                 }
-                --j;
             }
-            if (!found) {
-                WHISPER_LOG_ERROR("unknown token\n");
-                ++i;
-            }
-        }
-    }
-
-    return tokens;
-}
 
-//
-// interface implementation
-//
+            struct ggml_tensor * KQV = ggml_mul_mat(ctx0, Vcross, KQ_soft_max);
 
-#ifdef WHISPER_USE_COREML
-// replace .bin with -encoder.mlmodelc
-static std::string whisper_get_coreml_path_encoder(std::string path_bin) {
-    auto pos = path_bin.rfind('.');
-    if (pos != std::string::npos) {
-        path_bin = path_bin.substr(0, pos);
-    }
+            struct ggml_tensor * KQV_merged = ggml_permute(ctx0, KQV, 0, 2, 1, 3);
 
-    // match "-qx_x"
-    pos = path_bin.rfind('-');
-    if (pos != std::string::npos) {
-        auto sub = path_bin.substr(pos);
-        if (sub.size() == 5 && sub[1] == 'q' && sub[3] == '_') {
-            path_bin = path_bin.substr(0, pos);
+            return ggml_cont_2d(ctx0, KQV_merged, n_state, n_q);
         }
-    }
-
-    path_bin += "-encoder.mlmodelc";
+    };
 
-    return path_bin;
-}
-#endif
+    for (int il = 0; il < n_layer; ++il) {
+        const auto & layer = model.layers_decoder[il];
 
-#ifdef WHISPER_USE_OPENVINO
-// replace .bin with-encoder-openvino.xml
-static std::string whisper_openvino_get_path_encoder(std::string path_bin) {
-    auto pos = path_bin.rfind('.');
-    if (pos != std::string::npos) {
-        path_bin = path_bin.substr(0, pos);
-    }
+        // norm
+        {
+            cur = ggml_norm(ctx0, inpL, hparams.eps);
 
-    path_bin += "-encoder-openvino.xml";
+            // cur = ln_0_w*cur + ln_0_b
+            cur = ggml_add(ctx0,
+                    ggml_mul(ctx0,
+                        cur,
+                        layer.attn_ln_0_w),
+                    layer.attn_ln_0_b);
+        }
 
-    return path_bin;
-}
+        // self-attention
+        {
+            struct ggml_tensor * Qcur = ggml_mul_mat(ctx0,
+                    layer.attn_q_w,
+                    cur);
 
-static std::string whisper_openvino_get_path_cache(std::string path_bin) {
-    auto pos = path_bin.rfind('.');
-    if (pos != std::string::npos) {
-        path_bin = path_bin.substr(0, pos);
-    }
+            Qcur = ggml_add(ctx0,
+                        Qcur,
+                        layer.attn_q_b);
 
-    path_bin += "-encoder-openvino-cache";
+            Qcur = ggml_scale(ctx0, Qcur, KQscale);
 
-    return path_bin;
-}
-#endif
+            // note: no bias for Key
+            struct ggml_tensor * Kcur = ggml_mul_mat(ctx0,
+                    layer.attn_k_w,
+                    cur);
 
-struct whisper_state * whisper_init_state(whisper_context * ctx) {
-    whisper_state * state = new whisper_state;
+            Kcur = ggml_scale(ctx0, Kcur, KQscale);
 
-    state->backends = whisper_backend_init(ctx->params);
-    if (state->backends.empty()) {
-        WHISPER_LOG_ERROR("%s: whisper_backend_init() failed\n", __func__);
-        whisper_free_state(state);
-        return nullptr;
-    }
+            // store key and value to memory
+            {
+                struct ggml_tensor * Vcur = ggml_mul_mat(ctx0,
+                        layer.attn_v_w,
+                        cur);
 
-    // at this point, we don't know yet how many decoders will be used
-    // later during decoding, if more decoders are used, we will recreate the KV cache respectively
-    state->kv_self_n_dec = 1;
-    if (!whisper_kv_cache_init(state->kv_self, state->backends[0], ctx->itype,
-                ctx->model.hparams.n_text_state,
-                ctx->model.hparams.n_text_layer,
-                GGML_PAD(ctx->model.hparams.n_text_ctx, 256))) {
-        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
-        whisper_free_state(state);
-        return nullptr;
-    }
+                Vcur = ggml_add(ctx0,
+                            Vcur,
+                            layer.attn_v_b);
 
-    {
-        const size_t memory_size = ggml_nbytes(state->kv_self.k) + ggml_nbytes(state->kv_self.v);
-        WHISPER_LOG_INFO("%s: kv self size  = %7.2f MB\n", __func__, memory_size / 1e6);
-    }
+                struct ggml_tensor * k = ggml_view_2d(ctx0, kv_self.k, n_state, n_ctx,
+                        ggml_row_size(kv_self.k->type, n_state),
+                        ggml_row_size(kv_self.k->type, n_state)*n_ctx*il);
 
-    if (!whisper_kv_cache_init(state->kv_cross, state->backends[0], ctx->itype,
-                ctx->model.hparams.n_text_state,
-                ctx->model.hparams.n_text_layer,
-                GGML_PAD(ctx->model.hparams.n_audio_ctx, 256))) {
-        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for cross-attention cache\n", __func__);
-        whisper_free_state(state);
-        return nullptr;
-    }
+                struct ggml_tensor * v;
 
-    {
-        const size_t memory_size = ggml_nbytes(state->kv_cross.k) + ggml_nbytes(state->kv_cross.v);
-        WHISPER_LOG_INFO("%s: kv cross size = %7.2f MB\n", __func__, memory_size / 1e6);
-    }
+                if (wctx.params.flash_attn) {
+                    v = ggml_view_2d(ctx0, kv_self.v, n_state, n_ctx,
+                            ggml_row_size(kv_self.v->type, n_state),
+                            ggml_row_size(kv_self.v->type, n_state)*n_ctx*il);
+                } else {
+                    Vcur = ggml_reshape_2d(ctx0, Vcur, 1, n_state*n_tokens);
 
-    if (!whisper_kv_cache_init(state->kv_pad, state->backends[0], ctx->itype,
-                ctx->model.hparams.n_audio_state,
-                1,
-                GGML_PAD(ctx->model.hparams.n_audio_ctx, 256))) {
-        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
-        whisper_free_state(state);
-        return nullptr;
-    }
+                    v = ggml_view_2d(ctx0, kv_self.v, 1, n_state*n_ctx,
+                            ggml_element_size(kv_self.v),
+                            ggml_row_size(kv_self.v->type, n_state)*n_ctx*il);
+                }
 
-    {
-        const size_t memory_size = ggml_nbytes(state->kv_pad.k) + ggml_nbytes(state->kv_pad.v);
-        WHISPER_LOG_INFO("%s: kv pad  size  = %7.2f MB\n", __func__, memory_size / 1e6);
-    }
+                ggml_build_forward_expand(gf, ggml_set_rows(ctx0, k, Kcur, kv_idxs));
+                ggml_build_forward_expand(gf, ggml_set_rows(ctx0, v, Vcur, kv_idxs_v));
+            }
 
-    // [EXPERIMENTAL] Token-level timestamps with DTW
-    if (ctx->params.dtw_token_timestamps) {
-        if (!aheads_masks_init(ctx->params, ctx->model.hparams, state->aheads_masks, state->backends[0])) {
-            WHISPER_LOG_ERROR("%s: aheads_masks_init() failed for alignment heads masks\n", __func__);
-            whisper_free_state(state);
-            return nullptr;
-        }
-        const size_t memory_size = aheads_masks_nbytes(state->aheads_masks);
-        WHISPER_LOG_INFO("%s: alignment heads masks size = %ld B\n", __func__, memory_size);
-    }
+            // ------
 
-#ifdef WHISPER_USE_COREML
-    const auto path_coreml = whisper_get_coreml_path_encoder(ctx->path_model);
+            struct ggml_tensor * Q =
+                ggml_permute(ctx0,
+                        ggml_reshape_3d(ctx0, Qcur, n_state_head, n_head, n_tokens),
+                        0, 2, 1, 3);
 
-    WHISPER_LOG_INFO("%s: loading Core ML model from '%s'\n", __func__, path_coreml.c_str());
-    WHISPER_LOG_INFO("%s: first run on a device may take a while ...\n", __func__);
+            struct ggml_tensor * K =
+                ggml_view_3d(ctx0, kv_self.k,
+                        n_state_head, n_kv, n_head,
+                        ggml_row_size(kv_self.k->type, n_state),
+                        ggml_row_size(kv_self.k->type, n_state_head),
+                        ggml_row_size(kv_self.k->type, n_state)*n_ctx*il);
 
-    state->ctx_coreml = whisper_coreml_init(path_coreml.c_str());
-    if (!state->ctx_coreml) {
-        WHISPER_LOG_ERROR("%s: failed to load Core ML model from '%s'\n", __func__, path_coreml.c_str());
-#ifndef WHISPER_COREML_ALLOW_FALLBACK
-        whisper_free_state(state);
-        return nullptr;
-#endif
-    } else {
-        WHISPER_LOG_INFO("%s: Core ML model loaded\n", __func__);
-    }
-#endif
+            if (wctx.params.flash_attn) {
+                struct ggml_tensor * V =
+                    ggml_view_3d(ctx0, kv_self.v,
+                            n_state_head, n_kv, n_head,
+                            ggml_row_size(kv_self.v->type, n_state),
+                            ggml_row_size(kv_self.v->type, n_state_head),
+                            ggml_row_size(kv_self.v->type, n_state)*n_ctx*il);
 
-    state->logits.reserve(ctx->vocab.n_vocab * ctx->model.hparams.n_text_ctx);
+                cur = ggml_flash_attn_ext(ctx0, Q, K, V, KQ_mask_f16, 1.0f, 0.0f, 0.0f);
 
-    state->batch = whisper_batch_init(ctx->model.hparams.n_text_ctx, WHISPER_MAX_DECODERS);
+                cur = ggml_reshape_2d(ctx0, cur, n_state, n_tokens);
+            } else {
+                // K * Q
+                struct ggml_tensor * KQ = ggml_mul_mat(ctx0, K, Q);
 
-    // TAGS: WHISPER_DECODER_INIT
-    state->decoders[0].sequence.tokens.reserve(ctx->model.hparams.n_text_ctx);
+                struct ggml_tensor * KQ_soft_max = ggml_soft_max_ext(ctx0, KQ, KQ_mask, 1.0f, 0.0f);
 
-    state->decoders[0].probs.reserve    (ctx->vocab.n_vocab);
-    state->decoders[0].logits.reserve   (ctx->vocab.n_vocab);
-    state->decoders[0].logprobs.reserve (ctx->vocab.n_vocab);
-    state->decoders[0].logits_id.reserve(ctx->model.hparams.n_vocab);
+                struct ggml_tensor * V =
+                    ggml_view_3d(ctx0, kv_self.v,
+                            n_kv, n_state_head, n_head,
+                            n_ctx*ggml_element_size(kv_self.v),
+                            n_ctx*ggml_element_size(kv_self.v)*n_state_head,
+                            n_ctx*ggml_element_size(kv_self.v)*n_state*il);
 
-    state->decoders[0].rng = std::mt19937(0);
+                struct ggml_tensor * KQV = ggml_mul_mat(ctx0, V, KQ_soft_max);
 
-    // conv allocator
-    {
-        bool ok = whisper_sched_graph_init(state->sched_conv, state->backends,
-                [&]() {
-                    return whisper_build_graph_conv(*ctx, *state);
-                });
+                struct ggml_tensor * KQV_merged = ggml_permute(ctx0, KQV, 0, 2, 1, 3);
 
-        if (!ok) {
-            WHISPER_LOG_ERROR("%s: failed to init conv allocator\n", __func__);
-            whisper_free_state(state);
-            return nullptr;
+                cur = ggml_cont_2d(ctx0, KQV_merged, n_state, n_tokens);
+            }
         }
 
-        WHISPER_LOG_INFO("%s: compute buffer (conv)   = %7.2f MB\n", __func__, whisper_sched_size(state->sched_conv) / 1e6);
-    }
-
-    // encoder allocator
-    if (!whisper_encode_external(*state)) {
-        bool ok = whisper_sched_graph_init(state->sched_encode, state->backends,
-                [&]() {
-                    return whisper_build_graph_encoder(*ctx, *state);
-                });
+        // projection
+        {
+            cur = ggml_mul_mat(ctx0,
+                    layer.attn_ln_1_w,
+                    cur);
 
-        if (!ok) {
-            WHISPER_LOG_ERROR("%s: failed to init encoder allocator\n", __func__);
-            whisper_free_state(state);
-            return nullptr;
+            cur = ggml_add(ctx0,
+                    cur,
+                    layer.attn_ln_1_b);
         }
 
-        WHISPER_LOG_INFO("%s: compute buffer (encode) = %7.2f MB\n", __func__, whisper_sched_size(state->sched_encode) / 1e6);
-    }
+        // add the input
+        struct ggml_tensor * inpCA = ggml_add(ctx0, cur, inpL);
 
-    // cross allocator
-    {
-        bool ok = whisper_sched_graph_init(state->sched_cross, state->backends,
-                [&]() {
-                    return whisper_build_graph_cross(*ctx, *state);
-                });
+        // norm
+        {
+            cur = ggml_norm(ctx0, inpCA, hparams.eps); // note: we use inpCA here
 
-        if (!ok) {
-            WHISPER_LOG_ERROR("%s: failed to init cross allocator\n", __func__);
-            whisper_free_state(state);
-            return nullptr;
+            // cur = ln_0_w*cur + ln_0_b
+            cur = ggml_add(ctx0,
+                    ggml_mul(ctx0,
+                        cur,
+                        layer.cross_attn_ln_0_w),
+                    layer.cross_attn_ln_0_b);
         }
 
-        WHISPER_LOG_INFO("%s: compute buffer (cross)  = %7.2f MB\n", __func__, whisper_sched_size(state->sched_cross) / 1e6);
-    }
+        // cross-attention
+        {
+            struct ggml_tensor * Qcur = ggml_mul_mat(ctx0,
+                    layer.cross_attn_q_w,
+                    cur);
 
-    // decoder allocator
-    {
-        bool ok = whisper_sched_graph_init(state->sched_decode, state->backends,
-                [&]() {
-                    const auto & hparams = ctx->model.hparams;
+            Qcur = ggml_add(ctx0,
+                        Qcur,
+                        layer.cross_attn_q_b);
 
-                    // TODO: make sure this is the worst-case scenario
-                    const int n_tokens = hparams.n_text_ctx;
-                    const int n_past   = 0;
+            if (spans == nullptr) {
+                cur = build_cross_attn(wstate.kv_cross, wstate.exp_n_audio_ctx > 0 ? wstate.exp_n_audio_ctx : hparams.n_audio_ctx, Qcur, n_tokens, il);
+            } else {
+                cur = nullptr;
+                for (const auto & span : *spans) {
+                    struct ggml_tensor * Qspan = ggml_view_2d(ctx0, Qcur, n_state, span.n_tokens, Qcur->nb[1], span.i0*Qcur->nb[1]);
+                    struct ggml_tensor * out   = build_cross_attn(*span.kv_cross, span.n_audio_ctx, Qspan, span.n_tokens, il);
 
-                    whisper_batch_prep_legacy(state->batch, nullptr, n_tokens, n_past, 0);
+                    cur = cur == nullptr ? out : ggml_concat(ctx0, cur, out, 1);
+                }
+            }
+        }
 
-                    return whisper_build_graph_decoder(*ctx, *state, state->batch, ctx->params.dtw_token_timestamps, true);
-                });
+        // projection
+        {
+            cur = ggml_mul_mat(ctx0,
+                    layer.cross_attn_ln_1_w,
+                    cur);
 
-        if (!ok) {
-            WHISPER_LOG_ERROR("%s: failed to init decoder allocator\n", __func__);
-            whisper_free_state(state);
-            return nullptr;
+            cur = ggml_add(ctx0,
+                    cur,
+                    layer.cross_attn_ln_1_b);
         }
 
-        WHISPER_LOG_INFO("%s: compute buffer (decode) = %7.2f MB\n", __func__, whisper_sched_size(state->sched_decode) / 1e6);
-    }
+        // add the input
+        cur = ggml_add(ctx0, cur, inpCA);
 
-    return state;
-}
+        struct ggml_tensor * inpFF = cur;
 
-int whisper_ctx_init_openvino_encoder_with_state(
-        struct whisper_context * ctx,
-          struct whisper_state * state,
-                    const char * model_path,
-                    const char * device,
-                    const char * cache_dir) {
-#ifndef WHISPER_USE_OPENVINO
-    (void)(ctx);
-    (void)(state);
-    (void)(model_path);
-    (void)(device);
-    (void)(cache_dir);
+        // feed-forward network
+        {
+            // norm
+            {
+                cur = ggml_norm(ctx0, inpFF, hparams.eps);
 
-    return 1;
-#else
-    if (!model_path && ctx->path_model.empty()) {
-        WHISPER_LOG_ERROR("%s: model_path is nullptr, and ctx has no model_path set.\n", __func__);
-        return 1;
-    }
+                // cur = mlp_ln_w*cur + mlp_ln_b
+                cur = ggml_add(ctx0,
+                        ggml_mul(ctx0,
+                            cur,
+                            layer.mlp_ln_w),
+                        layer.mlp_ln_b);
+            }
 
-    std::string path_encoder;
-    if (!model_path) {
-        //if model_path is not set, attempt to find it in the same directory as ggml-<model>.bin model
-        path_encoder = whisper_openvino_get_path_encoder(ctx->path_model);
-    } else {
-        path_encoder = model_path;
-    }
+            // fully connected
+            cur = ggml_mul_mat(ctx0,
+                    layer.mlp_0_w,
+                    cur);
 
-    std::string path_cache;
-    if (!cache_dir) {
-        //if cache_dir is not set, set it as a dir residing next to ggml-<model>.bin
-        path_cache = whisper_openvino_get_path_cache(ctx->path_model);
-    } else {
-        path_cache = cache_dir;
-    }
+            cur = ggml_add(ctx0,
+                    cur,
+                    layer.mlp_0_b);
 
-    WHISPER_LOG_INFO("%s: loading OpenVINO model from '%s'\n", __func__, path_encoder.c_str());
-    WHISPER_LOG_INFO("%s: first run on a device may take a while ...\n", __func__);
+            // GELU activation
+            cur = ggml_gelu(ctx0, cur);
 
-    state->ctx_openvino = whisper_openvino_init(path_encoder.c_str(), device, path_cache.c_str());
-    if (!state->ctx_openvino) {
-        WHISPER_LOG_ERROR("%s: failed to init OpenVINO encoder from '%s'\n", __func__, path_encoder.c_str());
-        return 1;
-    } else {
-        WHISPER_LOG_INFO("%s: OpenVINO model loaded\n", __func__);
-    }
+            // projection
+            cur = ggml_mul_mat(ctx0,
+                    layer.mlp_1_w,
+                    cur);
 
-    return 0;
-#endif
-}
+            cur = ggml_add(ctx0,
+                    cur,
+                    layer.mlp_1_b);
+        }
 
-int whisper_ctx_init_openvino_encoder(
-        struct whisper_context * ctx,
-                    const char * model_path,
-                    const char * device,
-                    const char * cache_dir) {
-    return whisper_ctx_init_openvino_encoder_with_state(ctx, ctx->state, model_path, device, cache_dir);
-}
+        inpL = ggml_add(ctx0, cur, inpFF);
+    }
 
-struct whisper_context_params whisper_context_default_params() {
-    struct whisper_context_params result = {
-        /*.use_gpu              =*/ true,
-        /*.flash_attn           =*/ true,
-        /*.gpu_device           =*/ 0,
+    cur = inpL;
 
-        /*.dtw_token_timestamps =*/ false,
-        /*.dtw_aheads_preset    =*/ WHISPER_AHEADS_NONE,
-        /*.dtw_n_top            =*/ -1,
-        /*.dtw_aheads           =*/ {
-            /*.n_heads          =*/ 0,
-            /*.heads            =*/ NULL,
-        },
-        /*.dtw_mem_size         =*/ 1024*1024*128,
-    };
-    return result;
-}
+    // norm
+    {
+        cur = ggml_norm(ctx0, cur, hparams.eps);
 
-struct whisper_context * whisper_init_from_file_with_params_no_state(const char * path_model, struct whisper_context_params params) {
-    WHISPER_LOG_INFO("%s: loading model from '%s'\n", __func__, path_model);
-#ifdef _MSC_VER
-    // Convert UTF-8 path to wide string (UTF-16) for Windows, resolving character encoding issues.
-    std::wstring_convert<std::codecvt_utf8<wchar_t>> converter;
-    std::wstring path_model_wide = converter.from_bytes(path_model);
-    auto fin = std::ifstream(path_model_wide, std::ios::binary);
-#else
-    auto fin = std::ifstream(path_model, std::ios::binary);
-#endif
-    if (!fin) {
-        WHISPER_LOG_ERROR("%s: failed to open '%s'\n", __func__, path_model);
-        return nullptr;
+        cur = ggml_add(ctx0,
+                ggml_mul(ctx0,
+                    cur,
+                    model.d_ln_w),
+                model.d_ln_b);
     }
 
-    whisper_model_loader loader = {};
-
-    loader.context = &fin;
+    // compute logits only for the last token
+    // comment this line to compute logits for all n_tokens
+    // might be useful in the future
+    //cur = ggml_view_2d(ctx0, cur, cur->ne[0], 1, cur->nb[1], (cur->ne[1] - 1)*cur->nb[1]);
 
-    loader.read = [](void * ctx, void * output, size_t read_size) {
-        std::ifstream * fin = (std::ifstream*)ctx;
-        fin->read((char *)output, read_size);
-        return read_size;
-    };
+    struct ggml_tensor * d_te = model.d_te;
+    if (wstate.logits_lang) {
+        d_te = ggml_view_2d(ctx0, model.d_te, model.d_te->ne[0], wctx.vocab.num_languages(), model.d_te->nb[1], (wctx.vocab.token_sot + 1)*model.d_te->nb[1]);
+    }
 
-    loader.eof = [](void * ctx) {
-        std::ifstream * fin = (std::ifstream*)ctx;
-        return fin->eof();
-    };
+    struct ggml_tensor * logits = ggml_mul_mat(ctx0, d_te, cur);
 
-    loader.close = [](void * ctx) {
-        std::ifstream * fin = (std::ifstream*)ctx;
-        fin->close();
-    };
+    // [EXPERIMENTAL] Token-level timestamps with DTW
+    if (wctx.params.dtw_token_timestamps && aheads_cross_QKs != nullptr) {
+        aheads_cross_QKs = ggml_transpose(ctx0, aheads_cross_QKs);
+        aheads_cross_QKs = ggml_cont(ctx0, aheads_cross_QKs);
+        if (save_alignment_heads_QKs) {
+            ggml_build_forward_expand(gf, aheads_cross_QKs);
+            wstate.aheads_cross_QKs = aheads_cross_QKs;
+        }
+    }
 
-    auto ctx = whisper_init_with_params_no_state(&loader, params);
+    ggml_build_forward_expand(gf, logits);
 
-    if (ctx) {
-        ctx->path_model = path_model;
-    }
+    ggml_free(ctx0);
 
-    return ctx;
+    return gf;
 }
 
-struct whisper_context * whisper_init_from_buffer_with_params_no_state(void * buffer, size_t buffer_size, struct whisper_context_params params) {
-    struct buf_context {
-        uint8_t* buffer;
-        size_t size;
-        size_t current_offset;
-    };
-
-    buf_context ctx = { reinterpret_cast<uint8_t*>(buffer), buffer_size, 0 };
+// evaluate the decoder
+//
+// given text prompt + audio features -> computes the logits for the next token
+//
+//   - model:      the model
+//   - n_threads:  number of threads to use
+//   - tokens:     text prompt
+//   - n_tokens:   number of tokens in the prompt
+//   - n_past:     number of past tokens to prefix the prompt with
+//
+static bool whisper_decode_internal(
+        whisper_context & wctx,
+          whisper_state & wstate,
+    const whisper_batch & batch,
+              const int   n_threads,
+                   bool   save_alignment_heads_QKs,
+    ggml_abort_callback   abort_callback,
+                   void * abort_callback_data,
+    const std::vector<whisper_cross_span> * spans = nullptr) {
+    const int64_t t_start_us = ggml_time_us();
 
-    WHISPER_LOG_INFO("%s: loading model from buffer\n", __func__);
+    const auto & model   = wctx.model;
+    const auto & hparams = model.hparams;
 
-    whisper_model_loader loader = {};
+    const int n_logits = wstate.logits_lang ? wctx.vocab.num_languages() : hparams.n_vocab;
+    const int n_tokens = batch.n_tokens;
 
-    loader.context = &ctx;
+    auto & logits_out = wstate.logits;
 
-    loader.read = [](void * ctx, void * output, size_t read_size) {
-        buf_context * buf = reinterpret_cast<buf_context *>(ctx);
+    struct ggml_tensor * logits;
 
-        size_t size_to_copy = buf->current_offset + read_size < buf->size ? read_size : buf->size - buf->current_offset;
-
-        memcpy(output, buf->buffer + buf->current_offset, size_to_copy);
-        buf->current_offset += size_to_copy;
-
-        return size_to_copy;
-    };
-
-    loader.eof = [](void * ctx) {
-        buf_context * buf = reinterpret_cast<buf_context *>(ctx);
-
-        return buf->current_offset >= buf->size;
-    };
-
-    loader.close = [](void * /*ctx*/) { };
+    // find KV slot for the batch
+    {
+        auto & kv_self = wstate.kv_self;
 
-    return whisper_init_with_params_no_state(&loader, params);
-}
+        if (!whisper_kv_cache_find_slot(kv_self, batch)) {
+            return false;
+        }
 
-struct whisper_context * whisper_init_with_params_no_state(struct whisper_model_loader * loader, struct whisper_context_params params) {
-    ggml_time_init();
+        const uint32_t pad = whisper_kv_cache_get_padding(wctx);
+        kv_self.n = std::min(kv_self.size, std::max(pad, GGML_PAD(whisper_kv_cache_cell_max(kv_self), pad)));
 
-    if (params.flash_attn && params.dtw_token_timestamps) {
-        WHISPER_LOG_WARN("%s: dtw_token_timestamps is not supported with flash_attn - disabling\n", __func__);
-        params.dtw_token_timestamps = false;
+        //kv_self.n = std::min((int32_t) hparams.n_text_ctx, std::max(32, whisper_kv_cache_cell_max(kv_self)));
+        //printf("n_tokens = %5d, kv_self.head = %5d, kv_self.n = %5d, seq_id = %5d\n", batch.n_tokens, kv_self.head, kv_self.n, batch.seq_id[0][0]);
     }
 
-    WHISPER_LOG_INFO("%s: use gpu    = %d\n", __func__, params.use_gpu);
-    WHISPER_LOG_INFO("%s: flash attn = %d\n", __func__, params.flash_attn);
-    WHISPER_LOG_INFO("%s: gpu_device = %d\n", __func__, params.gpu_device);
-    WHISPER_LOG_INFO("%s: dtw        = %d\n", __func__, params.dtw_token_timestamps);
-    WHISPER_LOG_INFO("%s: devices    = %zu\n", __func__, ggml_backend_dev_count());
-    WHISPER_LOG_INFO("%s: backends   = %zu\n", __func__, ggml_backend_reg_count());
+    // decoder
+    {
+        auto & allocr = wstate.sched_decode;
+        auto & sched  = allocr.sched;
 
-    whisper_context * ctx = new whisper_context;
-    ctx->params = params;
+        // the shape of the graph - the decoding steps of a window differ only in their inputs, until the KV cache
+        // grows into the next block of cells (kv_self.n)
+        auto & key = wstate.graph_key;
+        {
+            key.clear();
 
-    if (!whisper_model_load(loader, *ctx)) {
-        loader->close(loader->context);
-        WHISPER_LOG_ERROR("%s: failed to load model\n", __func__);
-        delete ctx;
-        return nullptr;
-    }
+            key.push_back(batch.n_tokens);
+            key.push_back(wstate.kv_self.n);
+            key.push_back((intptr_t) wstate.kv_self.k);
+            key.push_back(save_alignment_heads_QKs);
+            key.push_back(wstate.logits_lang);
 
-    loader->close(loader->context);
+            if (spans == nullptr) {
+                key.push_back((intptr_t) wstate.kv_cross.k);
+                key.push_back(wstate.exp_n_audio_ctx);
+            } else {
+                for (const auto & span : *spans) {
+                    key.push_back((intptr_t) span.kv_cross->k);
+                    key.push_back(span.n_audio_ctx);
+                    key.push_back(span.i0);
+                    key.push_back(span.n_tokens);
+                }
+            }
+        }
 
-    return ctx;
-}
+        ggml_cgraph * gf = nullptr;
 
-struct whisper_context * whisper_init_from_file_with_params(const char * path_model, struct whisper_context_params params) {
-    whisper_context * ctx = whisper_init_from_file_with_params_no_state(path_model, params);
-    if (!ctx) {
-        return nullptr;
-    }
+        if (allocr.graph != nullptr && allocr.graph_key == key) {
+            gf = allocr.graph;
 
-    ctx->state = whisper_init_state(ctx);
-    if (!ctx->state) {
-        whisper_free(ctx);
-        return nullptr;
-    }
+            allocr.n_graph_reuse++;
+        } else {
+            const int64_t t_build_us = ggml_time_us();
 
-    return ctx;
-}
+            whisper_sched_graph_reset(allocr);
 
-struct whisper_context * whisper_init_from_buffer_with_params(void * buffer, size_t buffer_size, struct whisper_context_params params) {
-    whisper_context * ctx = whisper_init_from_buffer_with_params_no_state(buffer, buffer_size, params);
-    if (!ctx) {
-        return nullptr;
-    }
+            gf = whisper_build_graph_decoder(wctx, wstate, batch, save_alignment_heads_QKs, false, spans);
 
-    ctx->state = whisper_init_state(ctx);
-    if (!ctx->state) {
-        whisper_free(ctx);
-        return nullptr;
-    }
+            if (!ggml_backend_sched_alloc_graph(sched, gf)) {
+                // should never happen as we pre-allocate the memory
+                return false;
+            }
 
-    return ctx;
-}
+            allocr.graph = gf;
+            allocr.graph_key.swap(key);
 
-struct whisper_context * whisper_init_with_params(struct whisper_model_loader * loader, struct whisper_context_params params) {
-    whisper_context * ctx = whisper_init_with_params_no_state(loader, params);
-    if (!ctx) {
-        return nullptr;
-    }
+            allocr.n_graph_build++;
+            allocr.t_graph_build_us += ggml_time_us() - t_build_us;
+        }
 
-    ctx->state = whisper_init_state(ctx);
-    if (!ctx->state) {
-        whisper_free(ctx);
-        return nullptr;
-    }
+        // set the inputs
+        {
+            const int32_t kv_head = wstate.kv_self.head;
+            const int32_t n_ctx   = wstate.kv_self.size;
 
-    return ctx;
-}
+            struct ggml_tensor * kv_idxs = ggml_graph_get_tensor(gf, "kv_idxs");
 
-struct whisper_context * whisper_init_from_file(const char * path_model) {
-    return whisper_init_from_file_with_params(path_model, whisper_context_default_params());
-}
+            wstate.inp_kv_idxs.resize(n_tokens*hparams.n_text_state);
 
-struct whisper_context * whisper_init_from_buffer(void * buffer, size_t buffer_size) {
-    return whisper_init_from_buffer_with_params(buffer, buffer_size, whisper_context_default_params());
-}
+            for (int i = 0; i < n_tokens; ++i) {
+                wstate.inp_kv_idxs[i] = kv_head + i;
+            }
 
-struct whisper_context * whisper_init(struct whisper_model_loader * loader) {
-    return whisper_init_with_params(loader, whisper_context_default_params());
-}
+            ggml_backend_tensor_set(kv_idxs, wstate.inp_kv_idxs.data(), 0, n_tokens*sizeof(int32_t));
 
-struct whisper_context * whisper_init_from_file_no_state(const char * path_model) {
-    return whisper_init_from_file_with_params_no_state(path_model, whisper_context_default_params());
-}
+            struct ggml_tensor * kv_idxs_v = ggml_graph_get_tensor(gf, "kv_idxs_v");
 
-struct whisper_context * whisper_init_from_buffer_no_state(void * buffer, size_t buffer_size) {
-    return whisper_init_from_buffer_with_params_no_state(buffer, buffer_size, whisper_context_default_params());
-}
+            if (kv_idxs_v != nullptr) {
+                const int n_state = hparams.n_text_state;
 
-struct whisper_context * whisper_init_no_state(struct whisper_model_loader * loader) {
-    return whisper_init_with_params_no_state(loader, whisper_context_default_params());
-}
+                // element s of the value of token i is at [s, kv_head + i] of the transposed cache
+                for (int i = 0; i < n_tokens; ++i) {
+                    for (int j = 0; j < n_state; ++j) {
+                        wstate.inp_kv_idxs[i*n_state + j] = j*n_ctx + kv_head + i;
+                    }
+                }
 
-void whisper_free_state(struct whisper_state * state) {
-    if (state) {
-        whisper_kv_cache_free(state->kv_self);
-        whisper_kv_cache_free(state->kv_cross);
-        whisper_kv_cache_free(state->kv_pad);
+                ggml_backend_tensor_set(kv_idxs_v, wstate.inp_kv_idxs.data(), 0, n_tokens*n_state*sizeof(int32_t));
+            }
+        }
 
-#ifdef WHISPER_USE_COREML
-        if (state->ctx_coreml != nullptr) {
-            whisper_coreml_free(state->ctx_coreml);
-            state->ctx_coreml = nullptr;
+        {
+            struct ggml_tensor * embd = ggml_graph_get_tensor(gf, "embd");
+            ggml_backend_tensor_set(embd, batch.token, 0, n_tokens*ggml_element_size(embd));
         }
-#endif
 
-#ifdef WHISPER_USE_OPENVINO
-        if (state->ctx_openvino != nullptr) {
-            whisper_openvino_free(state->ctx_openvino);
-            state->ctx_openvino = nullptr;
+        {
+            struct ggml_tensor * position = ggml_graph_get_tensor(gf, "position");
+            for (int i = 0; i < n_tokens; ++i) {
+                const int32_t val = batch.pos[i];
+                ggml_backend_tensor_set(position, &val, i*sizeof(int32_t), sizeof(int32_t));
+            }
         }
-#endif
 
-        whisper_batch_free(state->batch);
+        {
+            struct ggml_tensor * KQ_mask = ggml_graph_get_tensor(gf, "KQ_mask");
 
-        ggml_backend_sched_free(state->sched_conv.sched);
-        ggml_backend_sched_free(state->sched_encode.sched);
-        ggml_backend_sched_free(state->sched_cross.sched);
-        ggml_backend_sched_free(state->sched_decode.sched);
+            auto & kv_self = wstate.kv_self;
 
-        for (auto & backend : state->backends) {
-            ggml_backend_free(backend);
-        }
+            const int32_t n_kv = kv_self.n;
 
-        // [EXPERIMENTAL] Token-level timestamps with DTW
-        aheads_masks_free(state->aheads_masks);
+            wstate.inp_mask.resize(ggml_nelements(KQ_mask));
 
-        if (state->vad_context != nullptr) {
-            whisper_vad_free(state->vad_context);
-            state->vad_context = nullptr;
-        }
+            float * data = wstate.inp_mask.data();
+            memset(data, 0, ggml_nbytes(KQ_mask));
 
-        delete state;
-    }
-}
+            for (int h = 0; h < 1; ++h) {
+                for (int j = 0; j < n_tokens; ++j) {
+                    const whisper_pos    pos    = batch.pos[j];
+                    const whisper_seq_id seq_id = batch.seq_id[j][0];
 
-void whisper_free(struct whisper_context * ctx) {
-    if (ctx) {
-        for (ggml_context * context : ctx->model.ctxs) {
-            ggml_free(context);
-        }
+                    for (int i = 0; i < n_kv; ++i) {
+                        if (!kv_self.cells[i].has_seq_id(seq_id) || kv_self.cells[i].pos > pos) {
+                            data[h*(n_kv*n_tokens) + j*n_kv + i] = -INFINITY;
+                        }
+                    }
+                }
 
-        for (ggml_backend_buffer_t buf : ctx->model.buffers) {
-            ggml_backend_buffer_free(buf);
+                for (int i = n_tokens; i < GGML_PAD(n_tokens, GGML_KQ_MASK_PAD); ++i) {
+                    for (int j = 0; j < n_kv; ++j) {
+                        data[h*(n_kv*n_tokens) + i*n_kv + j] = -INFINITY;
+                    }
+                }
+            }
+
+            ggml_backend_tensor_set(KQ_mask, wstate.inp_mask.data(), 0, ggml_nelements(KQ_mask)*sizeof(float));
         }
 
-        whisper_free_state(ctx->state);
+        logits = ggml_graph_node(gf, -1);
 
-        delete ctx;
+        // the graph stays allocated for the next call
+        if (!ggml_graph_compute_helper(sched, gf, n_threads, false)) {
+            allocr.graph = nullptr;
+            allocr.graph_key.clear();
+            return false;
+        }
     }
-}
 
-void whisper_free_context_params(struct whisper_context_params * params) {
-    if (params) {
-        delete params;
+    logits_out.resize(n_tokens*n_logits);
+    for (int i = 0; i < n_tokens; i++) {
+        if (batch.logits[i] == 0) {
+            continue;
+        }
+        ggml_backend_tensor_get(logits, logits_out.data() + (n_logits*i), sizeof(float)*(n_logits*i), sizeof(float)*n_logits);
     }
-}
 
-void whisper_free_params(struct whisper_full_params * params) {
-    if (params) {
-        delete params;
+    if (batch.n_tokens > 1) {
+        //printf("%s: used_mem = %f MB, %f MB, %f MB %f MB %f MB\n", __func__,
+        //        ggml_used_mem(ctx0)/1e6,
+        //        wstate.get_buf_max_mem(0)/1e6,
+        //        wstate.get_buf_max_mem(1)/1e6,
+        //        wstate.get_buf_max_mem(2)/1e6,
+        //        wstate.get_buf_max_mem(3)/1e6);
     }
-}
 
-int whisper_pcm_to_mel_with_state(struct whisper_context * ctx, struct whisper_state * state, const float * samples, int n_samples, int n_threads) {
-    if (!log_mel_spectrogram(*state, samples, n_samples, WHISPER_SAMPLE_RATE, WHISPER_N_FFT, WHISPER_HOP_LENGTH, ctx->model.filters.n_mel, n_threads, ctx->model.filters, false, state->mel)) {
-        WHISPER_LOG_ERROR("%s: failed to compute mel spectrogram\n", __func__);
-        return -1;
+    if (batch.n_tokens == 1) {
+        wstate.t_decode_us += ggml_time_us() - t_start_us;
+        wstate.n_decode++;
+    } else if (batch.n_tokens < 16) {
+        wstate.t_batchd_us += ggml_time_us() - t_start_us;
+        wstate.n_batchd += n_tokens;
+    } else {
+        wstate.t_prompt_us += ggml_time_us() - t_start_us;
+        wstate.n_prompt += n_tokens;
     }
 
-    return 0;
+    return !(abort_callback && abort_callback(abort_callback_data));
 }
 
-int whisper_pcm_to_mel(struct whisper_context * ctx, const float * samples, int n_samples, int n_threads) {
-    return whisper_pcm_to_mel_with_state(ctx, ctx->state, samples, n_samples, n_threads);
+//  500 -> 00:05.000
+// 6000 -> 01:00.000
+static std::string to_timestamp(int64_t t, bool comma = false) {
+    int64_t msec = t * 10;
+    int64_t hr = msec / (1000 * 60 * 60);
+    msec = msec - hr * (1000 * 60 * 60);
+    int64_t min = msec / (1000 * 60);
+    msec = msec - min * (1000 * 60);
+    int64_t sec = msec / 1000;
+    msec = msec - sec * 1000;
+
+    char buf[32];
+    snprintf(buf, sizeof(buf), "%02d:%02d:%02d%s%03d", (int) hr, (int) min, (int) sec, comma ? "," : ".", (int) msec);
+
+    return std::string(buf);
 }
 
-int whisper_set_mel_with_state(
-        struct whisper_context * ctx,
-          struct whisper_state * state,
-                   const float * data,
-                           int   n_len,
-                           int   n_mel) {
-    if (n_mel != ctx->model.filters.n_mel) {
-        WHISPER_LOG_ERROR("%s: invalid number of mel bands: %d (expected %d)\n", __func__, n_mel, ctx->model.filters.n_mel);
-        return -1;
-    }
+#define SIN_COS_N_COUNT WHISPER_N_FFT
+#define WHISPER_FFT_MAX_STAGES 16
+namespace {
+struct whisper_global_cache {
+    // In FFT, we frequently use sine and cosine operations with the same values.
+    // We can use precalculated values to speed up the process.
+    float sin_vals[SIN_COS_N_COUNT];
+    float cos_vals[SIN_COS_N_COUNT];
 
-    state->mel.n_len     = n_len;
-    state->mel.n_len_org = n_len;
-    state->mel.n_mel     = n_mel;
+    // Hann window (Use cosf to eliminate difference)
+    // ref: https://pytorch.org/docs/stable/generated/torch.hann_window.html
+    // ref: https://github.com/openai/whisper/blob/main/whisper/audio.py#L147
+    float hann_window[WHISPER_N_FFT];
 
-    state->mel.data.resize(n_len*n_mel);
-    memcpy(state->mel.data.data(), data, n_len*n_mel*sizeof(float));
+    // Plan of the real-input FFT of size WHISPER_N_FFT (see fft() below)
+    // The real signal is packed into WHISPER_N_FFT/2 complex values, which are transformed by an iterative
+    // mixed-radix FFT: the input is loaded in digit-reversed order and each stage applies radix-p butterflies
+    // with twiddles that are precomputed here, in the order in which they are consumed
+    int   fft_n_stages;
+    int   fft_radix[WHISPER_FFT_MAX_STAGES];
+    int   fft_perm[WHISPER_N_FFT/2];
+    float fft_twiddles[WHISPER_N_FFT]; // (re, im) pairs, WHISPER_N_FFT/2 - 1 in total
 
-    return 0;
-}
+    whisper_global_cache() {
+        fill_sin_cos_table();
+        fill_hann_window(sizeof(hann_window)/sizeof(hann_window[0]), true, hann_window);
+        fill_fft_plan();
+    }
 
-int whisper_set_mel(
-        struct whisper_context * ctx,
-        const float * data,
-        int n_len,
-        int n_mel) {
-    return whisper_set_mel_with_state(ctx, ctx->state, data, n_len, n_mel);
-}
+    void fill_sin_cos_table() {
+        for (int i = 0; i < SIN_COS_N_COUNT; i++) {
+            double theta = (2 * M_PI * i) / SIN_COS_N_COUNT;
+            sin_vals[i] = sinf(theta);
+            cos_vals[i] = cosf(theta);
+        }
+    }
 
-int whisper_encode_with_state(struct whisper_context * ctx, struct whisper_state * state, int offset, int n_threads) {
-    if (!whisper_encode_internal(*ctx, *state, offset, n_threads, nullptr, nullptr)) {
-        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
-        return -1;
+    void fill_hann_window(int length, bool periodic, float * output) {
+        int offset = -1;
+        if (periodic) {
+            offset = 0;
+        }
+        for (int i = 0; i < length; i++) {
+            output[i] = 0.5 * (1.0 - cosf((2.0 * M_PI * i) / (length + offset)));
+        }
     }
 
-    return 0;
-}
+    void fill_fft_plan() {
+        const int n = WHISPER_N_FFT/2;
 
-int whisper_encode(struct whisper_context * ctx, int offset, int n_threads) {
-    if (!whisper_encode_internal(*ctx, *ctx->state, offset, n_threads, nullptr, nullptr)) {
-        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
-        return -1;
-    }
+        // factorize n - prefer radix 4 over radix 2
+        {
+            const int radices[] = { 4, 2, 5 };
 
-    return 0;
-}
+            int m = n;
 
-int whisper_decode_with_state(struct whisper_context * ctx, struct whisper_state * state, const whisper_token * tokens, int n_tokens, int n_past, int n_threads) {
-    whisper_batch_prep_legacy(state->batch, tokens, n_tokens, n_past, 0);
+            fft_n_stages = 0;
+            for (int p : radices) {
+                while (m % p == 0) {
+                    WHISPER_ASSERT(fft_n_stages < WHISPER_FFT_MAX_STAGES);
+                    fft_radix[fft_n_stages++] = p;
+                    m /= p;
+                }
+            }
 
-    whisper_kv_cache_seq_rm(state->kv_self, 0, n_past, -1);
+            WHISPER_ASSERT(m == 1 && "Unsupported WHISPER_N_FFT");
+        }
 
-    if (!whisper_decode_internal(*ctx, *state, state->batch, n_threads, false, nullptr, nullptr)) {
-        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
-        return 1;
-    }
+        // digit reversal: position i of the work buffer holds input element fft_perm[i]
+        for (int i = 0; i < n; i++) {
+            int rem  = i;
+            int size = n;
+            int idx  = 0;
+            int mult = 1;
 
-    return 0;
-}
+            for (int s = fft_n_stages - 1; s >= 0; s--) {
+                size /= fft_radix[s];
+                idx  += (rem / size)*mult;
+                rem  %= size;
+                mult *= fft_radix[s];
+            }
 
-int whisper_decode(struct whisper_context * ctx, const whisper_token * tokens, int n_tokens, int n_past, int n_threads) {
-    if (ctx->state == nullptr) {
-        WHISPER_LOG_ERROR("%s: ERROR state was not loaded.\n", __func__);
-        return -1;
-    }
+            fft_perm[i] = idx;
+        }
 
-    return whisper_decode_with_state(ctx, ctx->state, tokens, n_tokens, n_past, n_threads);
-}
+        // stage twiddles: W_L^(j*q) for j in [0, l), q in [1, p) where L = l*p
+        float * tw = fft_twiddles;
+        for (int s = 0, l = 1; s < fft_n_stages; s++) {
+            const int p = fft_radix[s];
+            const int L = l*p;
 
-int whisper_tokenize(struct whisper_context * ctx, const char * text, whisper_token * tokens, int n_max_tokens) {
-    const auto res = tokenize(ctx->vocab, text);
+            for (int j = 0; j < l; j++) {
+                for (int q = 1; q < p; q++) {
+                    const double theta = (2 * M_PI * j * q) / L;
+                    *tw++ =  cos(theta);
+                    *tw++ = -sin(theta);
+                }
+            }
 
-    if (n_max_tokens < (int) res.size()) {
-        WHISPER_LOG_ERROR("%s: too many resulting tokens: %d (max %d)\n", __func__, (int) res.size(), n_max_tokens);
-        return -(int) res.size();
+            l = L;
+        }
     }
+} global_cache;
+}
 
-    for (int i = 0; i < (int) res.size(); i++) {
-        tokens[i] = res[i];
+// radix-p butterflies of the FFT stages
+// x points to the first of p complex values that are l complex values apart
+// w holds the p - 1 twiddles of the non-zero inputs
+static inline void fft_radix_2(float * x, int l, const float * w) {
+    float * x0 = x;
+    float * x1 = x + 2*l;
+
+    const float a1r = x1[0]*w[0] - x1[1]*w[1];
+    const float a1i = x1[0]*w[1] + x1[1]*w[0];
+
+    x1[0] = x0[0] - a1r;
+    x1[1] = x0[1] - a1i;
+    x0[0] = x0[0] + a1r;
+    x0[1] = x0[1] + a1i;
+}
+
+static inline void fft_radix_4(float * x, int l, const float * w) {
+    float * x0 = x;
+    float * x1 = x + 2*l;
+    float * x2 = x + 4*l;
+    float * x3 = x + 6*l;
+
+    const float a0r = x0[0];
+    const float a0i = x0[1];
+    const float a1r = x1[0]*w[0] - x1[1]*w[1];
+    const float a1i = x1[0]*w[1] + x1[1]*w[0];
+    const float a2r = x2[0]*w[2] - x2[1]*w[3];
+    const float a2i = x2[0]*w[3] + x2[1]*w[2];
+    const float a3r = x3[0]*w[4] - x3[1]*w[5];
+    const float a3i = x3[0]*w[5] + x3[1]*w[4];
+
+    const float t0r = a0r + a2r, t0i = a0i + a2i;
+    const float t1r = a0r - a2r, t1i = a0i - a2i;
+    const float t2r = a1r + a3r, t2i = a1i + a3i;
+    const float t3r = a1r - a3r, t3i = a1i - a3i;
+
+    x0[0] = t0r + t2r; x0[1] = t0i + t2i;
+    x2[0] = t0r - t2r; x2[1] = t0i - t2i;
+    x1[0] = t1r + t3i; x1[1] = t1i - t3r; // t1 - i*t3
+    x3[0] = t1r - t3i; x3[1] = t1i + t3r; // t1 + i*t3
+}
+
+static inline void fft_radix_5(float * x, int l, const float * w) {
+    const float c1 =  0.309016994374947424f; // cos(2*pi/5)
+    const float c2 = -0.809016994374947424f; // cos(4*pi/5)
+    const float s1 =  0.951056516295153572f; // sin(2*pi/5)
+    const float s2 =  0.587785252292473129f; // sin(4*pi/5)
+
+    float * x0 = x;
+    float * x1 = x + 2*l;
+    float * x2 = x + 4*l;
+    float * x3 = x + 6*l;
+    float * x4 = x + 8*l;
+
+    const float a0r = x0[0];
+    const float a0i = x0[1];
+    const float a1r = x1[0]*w[0] - x1[1]*w[1];
+    const float a1i = x1[0]*w[1] + x1[1]*w[0];
+    const float a2r = x2[0]*w[2] - x2[1]*w[3];
+    const float a2i = x2[0]*w[3] + x2[1]*w[2];
+    const float a3r = x3[0]*w[4] - x3[1]*w[5];
+    const float a3i = x3[0]*w[5] + x3[1]*w[4];
+    const float a4r = x4[0]*w[6] - x4[1]*w[7];
+    const float a4i = x4[0]*w[7] + x4[1]*w[6];
+
+    const float b1r = a1r + a4r, b1i = a1i + a4i;
+    const float b2r = a2r + a3r, b2i = a2i + a3i;
+    const float d1r = a1r - a4r, d1i = a1i - a4i;
+    const float d2r = a2r - a3r, d2i = a2i - a3i;
+
+    const float e1r = a0r + c1*b1r + c2*b2r, e1i = a0i + c1*b1i + c2*b2i;
+    const float e2r = a0r + c2*b1r + c1*b2r, e2i = a0i + c2*b1i + c1*b2i;
+    const float u1r = s1*d1r + s2*d2r,       u1i = s1*d1i + s2*d2i;
+    const float u2r = s2*d1r - s1*d2r,       u2i = s2*d1i - s1*d2i;
+
+    x0[0] = a0r + b1r + b2r; x0[1] = a0i + b1i + b2i;
+    x1[0] = e1r + u1i;       x1[1] = e1i - u1r; // e1 - i*u1
+    x4[0] = e1r - u1i;       x4[1] = e1i + u1r; // e1 + i*u1
+    x2[0] = e2r + u2i;       x2[1] = e2i - u2r; // e2 - i*u2
+    x3[0] = e2r - u2i;       x3[1] = e2i + u2r; // e2 + i*u2
+}
+
+// real-input FFT of size WHISPER_N_FFT, planned in whisper_global_cache
+// input is real-valued (WHISPER_N_FFT values)
+// output is complex-valued, only the bins [0, WHISPER_N_FFT/2] are computed
+// scratch must hold WHISPER_N_FFT floats
+static void fft(const float * in, float * out, float * scratch) {
+    const int n = WHISPER_N_FFT/2;
+
+    const auto & plan = global_cache;
+
+    // pack the even/odd samples as complex values, in digit-reversed order
+    float * z = scratch;
+    for (int i = 0; i < n; i++) {
+        const int m = plan.fft_perm[i];
+
+        z[2*i + 0] = in[2*m + 0];
+        z[2*i + 1] = in[2*m + 1];
+    }
+
+    // complex FFT of size n
+    const float * tw = plan.fft_twiddles;
+    for (int s = 0, l = 1; s < plan.fft_n_stages; s++) {
+        const int p = plan.fft_radix[s];
+        const int L = l*p;
+
+        for (int b = 0; b < n; b += L) {
+            for (int j = 0; j < l; j++) {
+                float       * x = z  + 2*(b + j);
+                const float * w = tw + 2*(p - 1)*j;
+
+                switch (p) {
+                    case 2: fft_radix_2(x, l, w); break;
+                    case 4: fft_radix_4(x, l, w); break;
+                    case 5: fft_radix_5(x, l, w); break;
+                    default: GGML_ABORT("unsupported FFT radix");
+                }
+            }
+        }
+
+        tw += 2*(p - 1)*l;
+        l = L;
     }
 
-    return res.size();
-}
+    // split into the spectrum of the real input
+    // X[k] = E[k] + W_N^k*O[k], E[k] = (Z[k] + conj(Z[n - k]))/2, O[k] = -i*(Z[k] - conj(Z[n - k]))/2
+    for (int k = 0; k <= n; k++) {
+        const int k0 = k % n;
+        const int k1 = (n - k) % n;
 
-int whisper_token_count(struct whisper_context * ctx, const char * text) {
-    return -whisper_tokenize(ctx, text, NULL, 0);
-}
+        const float zr = z[2*k0 + 0];
+        const float zi = z[2*k0 + 1];
+        const float yr = z[2*k1 + 0];
+        const float yi = z[2*k1 + 1];
 
-int whisper_lang_max_id(void) {
-    auto max_id = 0;
-    for (const auto & kv : g_lang) {
-        max_id = std::max(max_id, kv.second.first);
+        const float er = 0.5f*(zr + yr);
+        const float ei = 0.5f*(zi - yi);
+        const float or_ = 0.5f*(zi + yi);
+        const float oi  = 0.5f*(yr - zr);
+
+        const float wr =  plan.cos_vals[k]; // W_N^k = cos(t) - i*sin(t), t = 2*M_PI*k/N
+        const float wi = -plan.sin_vals[k];
+
+        out[2*k + 0] = er + wr*or_ - wi*oi;
+        out[2*k + 1] = ei + wr*oi  + wi*or_;
     }
+}
 
-    return max_id;
+// natural logarithm of a positive, normal x
+// branch-free so that the loops of the callers can be vectorized
+// ref: https://github.com/jeremybarnes/cephes/blob/master/single/logf.c
+static inline float whisper_logf(float x) {
+    uint32_t bits;
+    memcpy(&bits, &x, sizeof(bits));
+
+    // x = m*2^e, m in [0.5, 1)
+    int e = (int) ((bits >> 23) & 0xff) - 126;
+    bits = (bits & 0x007fffff) | 0x3f000000;
+
+    float m;
+    memcpy(&m, &bits, sizeof(m));
+
+    // move m to [sqrt(0.5), sqrt(2)) and compute log(1 + m)
+    const bool lo = m < 0.707106781186547524f;
+    e -= lo;
+    m  = lo ? m + m - 1.0f : m - 1.0f;
+
+    const float z = m*m;
+
+    float y = 7.0376836292e-2f;
+    y = y*m - 1.1514610310e-1f;
+    y = y*m + 1.1676998740e-1f;
+    y = y*m - 1.2420140846e-1f;
+    y = y*m + 1.4249322787e-1f;
+    y = y*m - 1.6668057665e-1f;
+    y = y*m + 2.0000714765e-1f;
+    y = y*m - 2.4999993993e-1f;
+    y = y*m + 3.3333331174e-1f;
+    y = y*m*z;
+
+    y += -2.12194440e-4f*e;
+    y += -0.5f*z;
+
+    return m + y + 0.693359375f*e;
 }
 
-int whisper_lang_id(const char * lang) {
-    if (!g_lang.count(lang)) {
-        for (const auto & kv : g_lang) {
-            if (kv.second.second == lang) {
-                return kv.second.first;
+// number of frames that are projected onto the mel filterbank at once
+#define WHISPER_MEL_BLOCK 16
+
+// computes the log10 mel values of the frames [i_beg, i_end)
+// samples[0] is the first sample of frame i_beg, the signal is zero from samples[n_samples] on
+// mel band j of frame i is stored in dst[j*n_stride + i]
+static void log_mel_spectrogram_worker_thread(int ith, const float * hann, const float * samples,
+                                              int n_samples, int frame_size, int frame_step, int i_beg, int i_end, int n_threads,
+                                              const whisper_filters & filters, whisper_mel_scratch & scratch,
+                                              float * dst_data, int n_stride, float & mel_max) {
+    const int n_fft = filters.n_fft;
+
+    // no-op after the first call on this state
+    scratch.fft_in.resize(frame_size, 0.0f);
+    scratch.fft_out.resize(frame_size + 2);
+    scratch.fft_scratch.resize(frame_size);
+    scratch.power.resize(n_fft*WHISPER_MEL_BLOCK, 0.0f);
+
+    std::vector<float> & fft_in      = scratch.fft_in;
+    std::vector<float> & fft_out     = scratch.fft_out;
+    std::vector<float> & fft_scratch = scratch.fft_scratch;
+
+    // power spectra of a block of frames, bin-major: power[k*WHISPER_MEL_BLOCK + f]
+    std::vector<float> & power = scratch.power;
+
+    // make sure n_fft == 1 + (WHISPER_N_FFT / 2), bin_0 to bin_nyquist
+    assert(n_fft == 1 + (frame_size / 2));
+
+    float vmax = -INFINITY;
+
+    for (int i0 = i_beg + ith*WHISPER_MEL_BLOCK; i0 < i_end; i0 += n_threads*WHISPER_MEL_BLOCK) {
+        const int n_cur = std::min(WHISPER_MEL_BLOCK, i_end - i0);
+
+        for (int f = 0; f < n_cur; f++) {
+            const int offset = (i0 + f - i_beg) * frame_step;
+
+            // apply Hann window (~10% faster)
+            for (int j = 0; j < std::min(frame_size, n_samples - offset); j++) {
+                fft_in[j] = hann[j] * samples[offset + j];
             }
-        }
 
-        WHISPER_LOG_ERROR("%s: unknown language '%s'\n", __func__, lang);
-        return -1;
-    }
-    return g_lang.at(lang).first;
-}
+            // fill the rest with zeros
+            if (n_samples - offset < frame_size) {
+                std::fill(fft_in.begin() + (n_samples - offset), fft_in.end(), 0.0);
+            }
 
-const char * whisper_lang_str(int id) {
-    for (const auto & kv : g_lang) {
-        if (kv.second.first == id) {
-            return kv.first.c_str();
+            // FFT
+            fft(fft_in.data(), fft_out.data(), fft_scratch.data());
+
+            // Calculate modulus^2 of complex numbers
+            // Use pow(fft_out[2 * j + 0], 2) + pow(fft_out[2 * j + 1], 2) causes inference quality problem? Interesting.
+            for (int k = 0; k < n_fft; k++) {
+                power[k*WHISPER_MEL_BLOCK + f] = (fft_out[2 * k + 0] * fft_out[2 * k + 0] + fft_out[2 * k + 1] * fft_out[2 * k + 1]);
+            }
         }
-    }
 
-    WHISPER_LOG_ERROR("%s: unknown language id %d\n", __func__, id);
-    return nullptr;
-}
+        // mel spectrogram - the block of power spectra times the non-zero taps of each filter
+        // the columns past n_cur hold stale (finite) values from the previous block and are not stored
+        for (int j = 0; j < filters.n_mel; j++) {
+            const float * filter = filters.data.data() + j*n_fft;
 
-const char * whisper_lang_str_full(int id) {
-   for (const auto & kv : g_lang) {
-        if (kv.second.first == id) {
-            return kv.second.second.c_str();
+            float sum[WHISPER_MEL_BLOCK] = { 0.0f };
+
+            for (int k = filters.k_beg[j]; k < filters.k_end[j]; k++) {
+                const float   w = filter[k];
+                const float * p = power.data() + k*WHISPER_MEL_BLOCK;
+
+                for (int f = 0; f < WHISPER_MEL_BLOCK; f++) {
+                    sum[f] += w*p[f];
+                }
+            }
+
+            // log10 and the running max for the normalization
+            float * dst = dst_data + j*n_stride + i0;
+            for (int f = 0; f < n_cur; f++) {
+                dst[f] = 0.434294481903251828f*whisper_logf(std::max(sum[f], 1e-10f));
+                vmax   = std::max(vmax, dst[f]);
+            }
         }
     }
 
-    WHISPER_LOG_ERROR("%s: unknown language id %d\n", __func__, id);
-    return nullptr;
+    mel_max = vmax;
 }
 
-int whisper_lang_auto_detect_with_state(
-        struct whisper_context * ctx,
-          struct whisper_state * state,
-                           int   offset_ms,
-                           int   n_threads,
-                         float * lang_probs) {
-    const int seek = offset_ms/10;
+// ref: https://github.com/openai/whisper/blob/main/whisper/audio.py#L110-L157
+static bool log_mel_spectrogram(
+              whisper_state & wstate,
+              whisper_thread_pool & pool,
+              const float * samples,
+              const int   n_samples,
+              const int   /*sample_rate*/,
+              const int   frame_size,
+              const int   frame_step,
+              const int   n_mel,
+              const int   n_threads,
+              const whisper_filters & filters,
+              const bool   debug,
+              whisper_mel & mel) {
+    const int64_t t_start_us = ggml_time_us();
 
-    if (seek < 0) {
-        WHISPER_LOG_ERROR("%s: offset %dms is before the start of the audio\n", __func__, offset_ms);
-        return -1;
-    }
+    // Hann window
+    WHISPER_ASSERT(frame_size == WHISPER_N_FFT && "Unsupported frame_size");
+    const float * hann = global_cache.hann_window;
 
-    if (seek >= state->mel.n_len_org) {
-        WHISPER_LOG_ERROR("%s: offset %dms is past the end of the audio (%dms)\n", __func__, offset_ms, state->mel.n_len_org*10);
-        return -2;
-    }
+    // Calculate the length of padding
+    int64_t stage_1_pad = WHISPER_SAMPLE_RATE * 30;
+    int64_t stage_2_pad = frame_size / 2;
 
-    // run the encoder
-    if (whisper_encode_with_state(ctx, state, seek, n_threads) != 0) {
-        WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
-        return -6;
-    }
+    // Initialize a vector and copy data from C array to it.
+    // the 30 seconds of zeros at the end of audio (480,000 samples) + 200 samples of zeros are not stored,
+    // the worker threads treat everything past the audio as zero
+    std::vector<float> samples_padded;
+    samples_padded.resize(n_samples + stage_2_pad);
+    std::copy(samples, samples + n_samples, samples_padded.begin() + stage_2_pad);
 
-    const std::vector<whisper_token> prompt = { whisper_token_sot(ctx) };
+    // reflective pad 200 samples at the beginning of audio
+    std::reverse_copy(samples + 1, samples + 1 + stage_2_pad, samples_padded.begin());
 
-    if (whisper_decode_with_state(ctx, state, prompt.data(), prompt.size(), 0, n_threads) != 0) {
-        WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
-        return -7;
-    }
+    mel.n_mel     = n_mel;
+    // https://github.com/pytorch/pytorch/blob/main/aten/src/ATen/native/SpectralOps.cpp#L936
+    // Calculate number of frames + remove the last frame
+    mel.n_len     = (n_samples + stage_1_pad + stage_2_pad * 2 - frame_size) / frame_step;
+    // Calculate semi-padded sample length to ensure compatibility
+    mel.n_len_org = 1 + (n_samples + stage_2_pad - frame_size) / frame_step;
 
-    auto & logits_id = state->decoders[0].logits_id;
-    logits_id.clear();
+    // calculate FFT only when fft_in are not all zero
+    // Otherwise fft_out are all zero and the frame is the constant tail column
+    const int n_frames = std::min((int) (n_samples + stage_2_pad) / frame_step + 1, mel.n_len);
 
-    for (const auto & kv : g_lang) {
-        const auto token_lang = whisper_token_lang(ctx, kv.second.first);
-        logits_id.emplace_back(state->logits[token_lang], kv.second.first);
-    }
+    mel.n_stride   = n_frames;
+    mel.n_len_data = n_frames;
+    mel.data.resize(mel.n_mel * mel.n_stride);
 
-    // sort descending
-    {
-        using pair_type = std::remove_reference<decltype(logits_id)>::type::value_type;
-        std::sort(logits_id.begin(), logits_id.end(), [](const pair_type & a, const pair_type & b) {
-            return a.first > b.first;
-        });
+    // per-thread max of the log mel values
+    std::vector<float> mel_max(n_threads, -INFINITY);
+
+    if ((int) wstate.mel_scratch.size() < n_threads) {
+        wstate.mel_scratch.resize(n_threads);
     }
 
-    // softmax
+    pool.parallel_for(n_threads, [&](int ith) {
+        log_mel_spectrogram_worker_thread(ith, hann, samples_padded.data(), n_samples + stage_2_pad, frame_size, frame_step, 0, n_frames, n_threads,
+                                          filters, wstate.mel_scratch[ith], mel.data.data(), mel.n_stride, mel_max[ith]);
+    });
+
+    // clamping and normalization
     {
-        const auto max = logits_id[0].first;
+        const float tail = log10(1e-10);
 
-        double sum = 0.0f;
-        for (auto & kv : logits_id) {
-            kv.first = exp(kv.first - max);
-            sum += kv.first;
+        float mmax = *std::max_element(mel_max.begin(), mel_max.end());
+        if (n_frames < mel.n_len) {
+            mmax = std::max(mmax, tail);
         }
+        mmax -= 8.0f;
 
-        for (auto & kv : logits_id) {
-            kv.first /= sum;
+        float * data = mel.data.data();
+        for (int i = 0; i < mel.n_mel*mel.n_stride; i++) {
+            data[i] = (std::max(data[i], mmax) + 4.0f)/4.0f;
         }
+
+        mel.v_tail = (std::max(tail, mmax) + 4.0f)/4.0f;
     }
 
-    {
-        for (const auto & prob : logits_id) {
-            if (lang_probs) {
-                lang_probs[prob.second] = prob.first;
-            }
+    wstate.t_mel_us += ggml_time_us() - t_start_us;
 
-            //printf("%s: lang %2d (%3s): %f\n", __func__, prob.second, whisper_lang_str(prob.second), prob.first);
+    // Dump log_mel_spectrogram
+    if (debug) {
+        std::ofstream outFile("log_mel_spectrogram.json");
+        outFile << "[";
+        for (int j = 0; j < mel.n_mel; j++) {
+            for (int i = 0; i < mel.n_len; i++) {
+                outFile << (i < mel.n_len_data ? mel.data[j*mel.n_stride + i] : mel.v_tail);
+                outFile << (j == mel.n_mel - 1 && i == mel.n_len - 1 ? "]" : ", ");
+            }
         }
+        outFile.close();
     }
 
-    return logits_id[0].second;
+    return true;
 }
 
-int whisper_lang_auto_detect(
-        struct whisper_context * ctx,
-                           int   offset_ms,
-                           int   n_threads,
-                         float * lang_probs) {
-    return whisper_lang_auto_detect_with_state(ctx, ctx->state, offset_ms, n_threads, lang_probs);
-}
+// decodes the UTF-8 sequence at text[0, n), returns its length
+// invalid bytes are returned as code points of length 1
+static int whisper_utf8_decode(const char * text, size_t n, uint32_t & cp) {
+    const uint8_t c = text[0];
 
-int whisper_model_n_vocab(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_vocab;
-}
+    int len = 1;
+    if      ((c & 0xE0) == 0xC0) { len = 2; cp = c & 0x1F; }
+    else if ((c & 0xF0) == 0xE0) { len = 3; cp = c & 0x0F; }
+    else if ((c & 0xF8) == 0xF0) { len = 4; cp = c & 0x07; }
 
-int whisper_model_n_audio_ctx(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_audio_ctx;
-}
+    if (len == 1 || (size_t) len > n) {
+        cp = c;
+        return 1;
+    }
 
-int whisper_model_n_audio_state(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_audio_state;
-}
+    for (int i = 1; i < len; ++i) {
+        const uint8_t ci = text[i];
+        if ((ci & 0xC0) != 0x80) {
+            cp = c;
+            return 1;
+        }
+        cp = (cp << 6) | (ci & 0x3F);
+    }
 
-int whisper_model_n_audio_head(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_audio_head;
+    return len;
 }
 
-int whisper_model_n_audio_layer(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_audio_layer;
-}
+// split text into pre-tokens, the byte offsets of their ends are appended to ends
+//
+// ref: https://github.com/openai/gpt-2/blob/a74da5d99abaaba920de8131d64da2862a8f213b/src/encoder.py#L53
+//
+// Regex (Python):
+// r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+//
+// the alternatives are matched by hand, in the same order
+static void whisper_pretokenize(const std::string & text, std::vector<size_t> & ends) {
+    // code points and their classes
+    std::vector<uint32_t> cps;
+    std::vector<uint8_t>  cls;
+    std::vector<size_t>   offs; // byte offset of each code point
 
-int whisper_model_n_text_ctx(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_text_ctx;
-}
+    for (size_t i = 0; i < text.size(); ) {
+        uint32_t cp;
+        const int len = whisper_utf8_decode(text.data() + i, text.size() - i, cp);
 
-int whisper_model_n_text_state(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_text_state;
-}
+        cps.push_back(cp);
+        cls.push_back(whisper_unicode_class_of(cp));
+        offs.push_back(i);
 
-int whisper_model_n_text_head(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_text_head;
-}
+        i += len;
+    }
+    offs.push_back(text.size());
 
-int whisper_model_n_text_layer(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_text_layer;
-}
+    const size_t n = cps.size();
 
-int whisper_model_n_mels(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_mels;
-}
+    // end of the run of code points of class c starting at j
+    const auto run = [&](size_t j, uint8_t c) {
+        while (j < n && cls[j] == c) {
+            ++j;
+        }
+        return j;
+    };
 
-int whisper_model_ftype(struct whisper_context * ctx) {
-    return ctx->model.hparams.ftype;
-}
+    size_t i = 0;
+    while (i < n) {
+        size_t e = i;
 
-int whisper_model_type(struct whisper_context * ctx) {
-    return ctx->model.type;
-}
+        // 's|'t|'re|'ve|'m|'ll|'d
+        if (cps[i] == '\'' && i + 1 < n) {
+            const uint32_t c1 = cps[i + 1];
+            const uint32_t c2 = i + 2 < n ? cps[i + 2] : 0;
 
-const char *whisper_model_type_readable(struct whisper_context * ctx) {
-    switch (ctx->model.type) {
-    case e_model::MODEL_TINY:
-        return "tiny";
-    case e_model::MODEL_BASE:
-        return "base";
-    case e_model::MODEL_SMALL:
-        return "small";
-    case e_model::MODEL_MEDIUM:
-        return "medium";
-    case e_model::MODEL_LARGE:
-        return "large";
-    default:
-        return "unknown";
-    }
-}
+            if (c1 == 's' || c1 == 't' || c1 == 'm' || c1 == 'd') {
+                e = i + 2;
+            } else if ((c1 == 'r' && c2 == 'e') || (c1 == 'v' && c2 == 'e') || (c1 == 'l' && c2 == 'l')) {
+                e = i + 3;
+            }
+        }
 
-int whisper_n_len_from_state(struct whisper_state * state) {
-    return state->mel.n_len_org;
-}
+        if (e == i) {
+            // ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+
+            const size_t j = (cps[i] == ' ' && i + 1 < n && cls[i + 1] != WHISPER_UNICODE_SPACE) ? i + 1 : i;
 
-int whisper_n_len(struct whisper_context * ctx) {
-    return ctx->state->mel.n_len_org;
-}
+            if (cls[j] != WHISPER_UNICODE_SPACE) {
+                e = run(j, cls[j]);
+            } else {
+                // \s+(?!\S)|\s+ - a whitespace run followed by a word leaves its last character to the word
+                e = run(i, WHISPER_UNICODE_SPACE);
+                if (e < n && e - i > 1) {
+                    --e;
+                }
+            }
+        }
 
-int whisper_n_vocab(struct whisper_context * ctx) {
-    return ctx->vocab.n_vocab;
+        ends.push_back(offs[e]);
+        i = e;
+    }
 }
 
-int whisper_n_text_ctx(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_text_ctx;
-}
+// byte-level BPE of the pre-token text[0, n)
+//
+// the tokens are sorted by merge rank (tiktoken), so the merges are recovered from the vocabulary: the adjacent
+// pair whose concatenation is the token with the lowest id is merged first
+// ref: https://github.com/openai/tiktoken/blob/main/src/lib.rs (byte_pair_merge)
+//
+// the merges start from the bytes of the text, as in the reference. with the files that store the tokens that are not
+// valid UTF-8 as U+FFFD (see whisper_vocab_init_index()) these tokens are lost, so the merges start from the
+// characters that are tokens instead. this is exact as long as the reference does not merge through a lost token
+static void whisper_bpe(const whisper_vocab & vocab, const char * text, size_t n, std::vector<whisper_vocab::id> & tokens) {
+    // only the byte sequences are mergeable, not the special tokens
+    const auto rank = [&](size_t i0, size_t i1) {
+        const whisper_vocab::id id = whisper_token_find(vocab, text + i0, i1 - i0);
+        return id >= 0 && id < vocab.token_eot ? id : INT_MAX;
+    };
 
-int whisper_n_audio_ctx(struct whisper_context * ctx) {
-    return ctx->model.hparams.n_audio_ctx;
-}
+    {
+        const int id = rank(0, n);
+        if (id != INT_MAX) {
+            tokens.push_back(id);
+            return;
+        }
+    }
 
-int whisper_is_multilingual(struct whisper_context * ctx) {
-    return ctx->vocab.is_multilingual() ? 1 : 0;
-}
+    // start of each part and rank of merging it with the next one
+    std::vector<std::pair<size_t, int>> parts;
+    parts.reserve(n + 1);
+    for (size_t i = 0; i < n; ) {
+        uint32_t cp;
+        const size_t len = whisper_utf8_decode(text + i, n - i, cp);
 
-float * whisper_get_logits(struct whisper_context * ctx) {
-    return ctx->state->logits.data();
-}
+        if (len > 1 && !vocab.token_raw && rank(i, i + len) != INT_MAX) {
+            parts.emplace_back(i, INT_MAX);
+        } else {
+            for (size_t j = i; j < i + len; ++j) {
+                parts.emplace_back(j, INT_MAX);
+            }
+        }
 
-float * whisper_get_logits_from_state(struct whisper_state * state) {
-    return state->logits.data();
-}
+        i += len;
+    }
+    parts.emplace_back(n, INT_MAX);
 
-const char * whisper_token_to_str(struct whisper_context * ctx, whisper_token token) {
-    return ctx->vocab.id_to_token.at(token).c_str();
-}
+    for (size_t i = 0; i + 2 < parts.size(); ++i) {
+        parts[i].second = rank(parts[i].first, parts[i + 2].first);
+    }
 
-whisper_token whisper_token_eot(struct whisper_context * ctx) {
-    return ctx->vocab.token_eot;
-}
+    while (parts.size() > 2) {
+        size_t imin = 0;
+        for (size_t i = 1; i + 1 < parts.size(); ++i) {
+            if (parts[i].second < parts[imin].second) {
+                imin = i;
+            }
+        }
 
-whisper_token whisper_token_sot(struct whisper_context * ctx) {
-    return ctx->vocab.token_sot;
-}
+        if (parts[imin].second == INT_MAX) {
+            break;
+        }
 
-whisper_token whisper_token_solm(struct whisper_context * ctx) {
-    return ctx->vocab.token_solm;
-}
+        parts.erase(parts.begin() + imin + 1);
 
-whisper_token whisper_token_prev(struct whisper_context * ctx) {
-    return ctx->vocab.token_prev;
-}
+        // the merged part and the one before it have new right neighbours
+        parts[imin].second = imin + 2 < parts.size() ? rank(parts[imin].first, parts[imin + 2].first) : INT_MAX;
+        if (imin > 0) {
+            parts[imin - 1].second = rank(parts[imin - 1].first, parts[imin + 1].first);
+        }
+    }
 
-whisper_token whisper_token_nosp(struct whisper_context * ctx) {
-    return ctx->vocab.token_nosp;
-}
+    for (size_t i = 0; i + 1 < parts.size(); ++i) {
+        const size_t i0 = parts[i].first;
+        const size_t i1 = parts[i + 1].first;
 
-whisper_token whisper_token_not(struct whisper_context * ctx) {
-    return ctx->vocab.token_not;
+        tokens.push_back(i1 - i0 == 1 ? vocab.token_byte[(uint8_t) text[i0]] : rank(i0, i1));
+    }
 }
 
-whisper_token whisper_token_beg(struct whisper_context * ctx) {
-    return ctx->vocab.token_beg;
-}
+// split text into tokens
+static std::vector<whisper_vocab::id> tokenize(const whisper_vocab & vocab, const std::string & text) {
+    std::vector<size_t> ends;
+    whisper_pretokenize(text, ends);
 
-whisper_token whisper_token_lang(struct whisper_context * ctx, int lang_id) {
-    return whisper_token_sot(ctx) + 1 + lang_id;
-}
+    std::vector<whisper_vocab::id> tokens;
+    tokens.reserve(text.size()/2);
 
-whisper_token whisper_token_translate(struct whisper_context * ctx) {
-    return ctx->vocab.token_translate;
-}
+    size_t i0 = 0;
+    for (size_t i1 : ends) {
+        whisper_bpe(vocab, text.data() + i0, i1 - i0, tokens);
+        i0 = i1;
+    }
 
-whisper_token whisper_token_transcribe(struct whisper_context * ctx) {
-    return ctx->vocab.token_transcribe;
+    return tokens;
 }
 
-struct whisper_timings * whisper_get_timings(struct whisper_context * ctx) {
-    if (ctx->state == nullptr) {
-        return nullptr;
+//
+// interface implementation
+//
+
+#ifdef WHISPER_USE_COREML
+// replace .bin with -encoder.mlmodelc
+static std::string whisper_get_coreml_path_encoder(std::string path_bin) {
+    auto pos = path_bin.rfind('.');
+    if (pos != std::string::npos) {
+        path_bin = path_bin.substr(0, pos);
     }
-    whisper_timings * timings = new whisper_timings;
-    timings->sample_ms = 1e-3f * ctx->state->t_sample_us / std::max(1, ctx->state->n_sample);
-    timings->encode_ms = 1e-3f * ctx->state->t_encode_us / std::max(1, ctx->state->n_encode);
-    timings->decode_ms = 1e-3f * ctx->state->t_decode_us / std::max(1, ctx->state->n_decode);
-    timings->batchd_ms = 1e-3f * ctx->state->t_batchd_us / std::max(1, ctx->state->n_batchd);
-    timings->prompt_ms = 1e-3f * ctx->state->t_prompt_us / std::max(1, ctx->state->n_prompt);
-    return timings;
-}
 
-void whisper_print_timings(struct whisper_context * ctx) {
-    const int64_t t_end_us = ggml_time_us();
+    // match "-qx_x"
+    pos = path_bin.rfind('-');
+    if (pos != std::string::npos) {
+        auto sub = path_bin.substr(pos);
+        if (sub.size() == 5 && sub[1] == 'q' && sub[3] == '_') {
+            path_bin = path_bin.substr(0, pos);
+        }
+    }
 
-    WHISPER_LOG_INFO("\n");
-    WHISPER_LOG_INFO("%s:     load time = %8.2f ms\n", __func__, ctx->t_load_us / 1000.0f);
-    if (ctx->state != nullptr) {
+    path_bin += "-encoder.mlmodelc";
 
-        const int32_t n_sample = std::max(1, ctx->state->n_sample);
-        const int32_t n_encode = std::max(1, ctx->state->n_encode);
-        const int32_t n_decode = std::max(1, ctx->state->n_decode);
-        const int32_t n_batchd = std::max(1, ctx->state->n_batchd);
-        const int32_t n_prompt = std::max(1, ctx->state->n_prompt);
+    return path_bin;
+}
+#endif
 
-        WHISPER_LOG_INFO("%s:     fallbacks = %3d p / %3d h\n", __func__, ctx->state->n_fail_p, ctx->state->n_fail_h);
-        WHISPER_LOG_INFO("%s:      mel time = %8.2f ms\n", __func__, ctx->state->t_mel_us / 1000.0f);
-        WHISPER_LOG_INFO("%s:   sample time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_sample_us, n_sample, 1e-3f * ctx->state->t_sample_us / n_sample);
-        WHISPER_LOG_INFO("%s:   encode time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_encode_us, n_encode, 1e-3f * ctx->state->t_encode_us / n_encode);
-        WHISPER_LOG_INFO("%s:   decode time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_decode_us, n_decode, 1e-3f * ctx->state->t_decode_us / n_decode);
-        WHISPER_LOG_INFO("%s:   batchd time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_batchd_us, n_batchd, 1e-3f * ctx->state->t_batchd_us / n_batchd);
-        WHISPER_LOG_INFO("%s:   prompt time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_prompt_us, n_prompt, 1e-3f * ctx->state->t_prompt_us / n_prompt);
+#ifdef WHISPER_USE_OPENVINO
+// replace .bin with-encoder-openvino.xml
+static std::string whisper_openvino_get_path_encoder(std::string path_bin) {
+    auto pos = path_bin.rfind('.');
+    if (pos != std::string::npos) {
+        path_bin = path_bin.substr(0, pos);
     }
-    WHISPER_LOG_INFO("%s:    total time = %8.2f ms\n", __func__, (t_end_us - ctx->t_start_us)/1000.0f);
+
+    path_bin += "-encoder-openvino.xml";
+
+    return path_bin;
 }
 
-void whisper_reset_timings(struct whisper_context * ctx) {
-    ctx->t_start_us = ggml_time_us();
-    if (ctx->state != nullptr) {
-        ctx->state->t_mel_us = 0;
-        ctx->state->t_sample_us = 0;
-        ctx->state->t_encode_us = 0;
-        ctx->state->t_decode_us = 0;
-        ctx->state->t_batchd_us = 0;
-        ctx->state->t_prompt_us = 0;
-        ctx->state->n_sample = 0;
-        ctx->state->n_encode = 0;
-        ctx->state->n_decode = 0;
-        ctx->state->n_batchd = 0;
-        ctx->state->n_prompt = 0;
+static std::string whisper_openvino_get_path_cache(std::string path_bin) {
+    auto pos = path_bin.rfind('.');
+    if (pos != std::string::npos) {
+        path_bin = path_bin.substr(0, pos);
     }
-}
 
-static int whisper_has_coreml(void) {
-#ifdef WHISPER_USE_COREML
-    return 1;
-#else
-    return 0;
-#endif
-}
+    path_bin += "-encoder-openvino-cache";
 
-static int whisper_has_openvino(void) {
-#ifdef WHISPER_USE_OPENVINO
-    return 1;
-#else
-    return 0;
-#endif
+    return path_bin;
 }
+#endif
 
-const char * whisper_print_system_info(void) {
-    static std::string s;
+struct whisper_state * whisper_init_state(whisper_context * ctx) {
+    whisper_state * state = new whisper_state;
 
-    s  = "";
-    s += "WHISPER : ";
-    s += "COREML = "    + std::to_string(whisper_has_coreml())     + " | ";
-    s += "OPENVINO = "  + std::to_string(whisper_has_openvino())   + " | ";
+    state->backends = whisper_backend_init(ctx->params);
+    if (state->backends.empty()) {
+        WHISPER_LOG_ERROR("%s: whisper_backend_init() failed\n", __func__);
+        whisper_free_state(state);
+        return nullptr;
+    }
 
-    for (size_t i = 0; i < ggml_backend_reg_count(); i++) {
-        auto * reg = ggml_backend_reg_get(i);
-        auto * get_features_fn = (ggml_backend_get_features_t) ggml_backend_reg_get_proc_address(reg, "ggml_backend_get_features");
-        if (get_features_fn) {
-            ggml_backend_feature * features = get_features_fn(reg);
-            s += ggml_backend_reg_name(reg);
-            s += " : ";
-            for (; features->name; features++) {
-                s += features->name;
-                s += " = ";
-                s += features->value;
-                s += " | ";
-            }
-        }
+    // unless the context reserves for more, we don't know yet how many decoders will be used
+    // later during decoding, if more decoders are used, we will recreate the KV cache respectively
+    // the decoder compute buffer below is sized for this cache, so a reserved state never reallocates either
+    const int n_max_decoders = std::min(std::max(ctx->params.n_max_decoders, 1), WHISPER_MAX_DECODERS);
+    if (!whisper_kv_self_init(*ctx, *state, n_max_decoders)) {
+        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
+        whisper_free_state(state);
+        return nullptr;
     }
-    return s.c_str();
-}
 
-//////////////////////////////////
-// Voice Activity Detection (VAD)
-//////////////////////////////////
+    {
+        const size_t memory_size = ggml_nbytes(state->kv_self.k) + ggml_nbytes(state->kv_self.v);
+        WHISPER_LOG_INFO("%s: kv self size  = %7.2f MB (%d cells, k %s, v %s)\n", __func__, memory_size / 1e6,
+                (int) state->kv_self.size, ggml_type_name(state->kv_self.k->type), ggml_type_name(state->kv_self.v->type));
+    }
 
-struct whisper_vad_hparams {
-    int32_t   n_encoder_layers;
-    int32_t * encoder_in_channels;
-    int32_t * encoder_out_channels;
-    int32_t * kernel_sizes;
-    int32_t   lstm_input_size;
-    int32_t   lstm_hidden_size;
-    int32_t   final_conv_in;
-    int32_t   final_conv_out;
-};
+    if (!whisper_kv_cache_init(state->kv_cross, state->backends[0], ctx->kv_cross_type_k, ctx->kv_cross_type_v,
+                ctx->model.hparams.n_text_state,
+                ctx->model.hparams.n_text_layer,
+                GGML_PAD(ctx->model.hparams.n_audio_ctx, ctx->audio_ctx_pad))) {
+        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for cross-attention cache\n", __func__);
+        whisper_free_state(state);
+        return nullptr;
+    }
 
-struct whisper_vad_model {
-    std::string type;
-    std::string version;
-    whisper_vad_hparams hparams;
+    {
+        const size_t memory_size = ggml_nbytes(state->kv_cross.k) + ggml_nbytes(state->kv_cross.v);
+        WHISPER_LOG_INFO("%s: kv cross size = %7.2f MB (%d cells, k %s, v %s)\n", __func__, memory_size / 1e6,
+                (int) state->kv_cross.size, ggml_type_name(state->kv_cross.k->type), ggml_type_name(state->kv_cross.v->type));
+    }
 
-    struct ggml_tensor * stft_forward_basis; // [256, 1, 258]
+    if (!whisper_kv_cache_init(state->kv_pad, state->backends[0], ctx->itype, ctx->itype,
+                ctx->model.hparams.n_audio_state,
+                1,
+                GGML_PAD(ctx->model.hparams.n_audio_ctx, ctx->audio_ctx_pad))) {
+        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
+        whisper_free_state(state);
+        return nullptr;
+    }
 
-    // Encoder tensors - 4 convolutional layers
-    struct ggml_tensor * encoder_0_weight;  // [3, 129, 128]
-    struct ggml_tensor * encoder_0_bias;    // [128]
+    {
+        const size_t memory_size = ggml_nbytes(state->kv_pad.k) + ggml_nbytes(state->kv_pad.v);
+        WHISPER_LOG_INFO("%s: kv pad  size  = %7.2f MB\n", __func__, memory_size / 1e6);
+    }
 
-    // Second encoder layer
-    struct ggml_tensor * encoder_1_weight;  // [3, 128, 64]
-    struct ggml_tensor * encoder_1_bias;    // [64]
+    // [EXPERIMENTAL] Token-level timestamps with DTW
+    if (ctx->params.dtw_token_timestamps) {
+        if (!aheads_masks_init(ctx->params, ctx->model.hparams, state->aheads_masks, state->backends[0])) {
+            WHISPER_LOG_ERROR("%s: aheads_masks_init() failed for alignment heads masks\n", __func__);
+            whisper_free_state(state);
+            return nullptr;
+        }
+        const size_t memory_size = aheads_masks_nbytes(state->aheads_masks);
+        WHISPER_LOG_INFO("%s: alignment heads masks size = %ld B\n", __func__, memory_size);
+    }
 
-    // Third encoder layer
-    struct ggml_tensor * encoder_2_weight;  // [3, 64, 64]
-    struct ggml_tensor * encoder_2_bias;    // [64]
+#ifdef WHISPER_USE_COREML
+    const auto path_coreml = whisper_get_coreml_path_encoder(ctx->path_model);
 
-    // Fourth encoder layer
-    struct ggml_tensor * encoder_3_weight;  // [3, 64, 128]
-    struct ggml_tensor * encoder_3_bias;    // [128]
+    WHISPER_LOG_INFO("%s: loading Core ML model from '%s'\n", __func__, path_coreml.c_str());
+    WHISPER_LOG_INFO("%s: first run on a device may take a while ...\n", __func__);
 
-    // LSTM decoder tensors
-    struct ggml_tensor * lstm_ih_weight;    // [128, 512] input-to-hidden
-    struct ggml_tensor * lstm_ih_bias;      // [512]
-    struct ggml_tensor * lstm_hh_weight;    // [128, 512] hidden-to-hidden
-    struct ggml_tensor * lstm_hh_bias;      // [512]
+    state->ctx_coreml = whisper_coreml_init(path_coreml.c_str());
+    if (!state->ctx_coreml) {
+        WHISPER_LOG_ERROR("%s: failed to load Core ML model from '%s'\n", __func__, path_coreml.c_str());
+#ifndef WHISPER_COREML_ALLOW_FALLBACK
+        whisper_free_state(state);
+        return nullptr;
+#endif
+    } else {
+        WHISPER_LOG_INFO("%s: Core ML model loaded\n", __func__);
+    }
+#endif
 
-    // Final conv layer
-    struct ggml_tensor * final_conv_weight; // [128]
-    struct ggml_tensor * final_conv_bias;   // [1]
+    state->logits.reserve(ctx->vocab.n_vocab * ctx->model.hparams.n_text_ctx);
 
-    // ggml contexts
-    std::vector<ggml_context *> ctxs;
+    state->batch = whisper_batch_init(ctx->model.hparams.n_text_ctx, WHISPER_MAX_DECODERS);
 
-    // buffer for the model tensors
-    std::vector<ggml_backend_buffer_t> buffers;
+    // TAGS: WHISPER_DECODER_INIT
+    state->decoders[0].sequence.tokens.reserve(ctx->model.hparams.n_text_ctx);
 
-    // tensors
-    int n_loaded;
-    std::map<std::string, struct ggml_tensor *> tensors;
-};
+    state->decoders[0].probs.reserve    (ctx->vocab.n_vocab);
+    state->decoders[0].logits.reserve   (ctx->vocab.n_vocab);
+    state->decoders[0].logprobs.reserve (ctx->vocab.n_vocab);
+    state->decoders[0].logits_id.reserve(ctx->model.hparams.n_vocab);
 
-struct whisper_vad_segment {
-    int64_t start;
-    int64_t end;
-};
+    state->decoders[0].rng = std::mt19937(0);
 
-struct whisper_vad_segments {
-    std::vector<whisper_vad_segment> data;
-};
+    // conv allocator
+    {
+        bool ok = whisper_sched_graph_init(state->sched_conv, state->backends,
+                [&]() {
+                    return whisper_build_graph_conv(*ctx, *state);
+                });
 
-struct whisper_vad_context {
-    int64_t t_vad_us = 0;
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to init conv allocator\n", __func__);
+            whisper_free_state(state);
+            return nullptr;
+        }
 
-    int     n_window;
-    int     n_context;
-    int     n_threads;
+        WHISPER_LOG_INFO("%s: compute buffer (conv)   = %7.2f MB\n", __func__, whisper_sched_size(state->sched_conv) / 1e6);
+    }
 
-    std::vector<ggml_backend_t> backends;
-    ggml_backend_buffer_t       buffer = nullptr;
-    whisper_context_params      params;
-    std::vector<uint8_t>        ctx_buf;
-    whisper_sched               sched;
+    // encoder allocator
+    if (!whisper_encode_external(*state)) {
+        bool ok = whisper_sched_graph_init(state->sched_encode, state->backends,
+                [&]() {
+                    return whisper_build_graph_encoder(*ctx, *state);
+                });
 
-    whisper_vad_model    model;
-    std::string          path_model;
-    struct ggml_tensor * h_state;
-    struct ggml_tensor * c_state;
-    std::vector<float>   probs;
-};
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to init encoder allocator\n", __func__);
+            whisper_free_state(state);
+            return nullptr;
+        }
 
-struct whisper_vad_context_params whisper_vad_default_context_params(void) {
-    whisper_vad_context_params result = {
-        /*.n_thread                = */ 4,
-        /*.use_gpu                 = */ false,
-        /*.gpu_device              = */ 0,
-    };
-    return result;
-}
+        WHISPER_LOG_INFO("%s: compute buffer (encode) = %7.2f MB\n", __func__, whisper_sched_size(state->sched_encode) / 1e6);
+    }
 
-struct whisper_vad_params whisper_vad_default_params(void) {
-    whisper_vad_params result = {
-        /* threshold               = */ 0.5f,
-        /* min_speech_duration_ms  = */ 250,
-        /* min_silence_duration_ms = */ 100,
-        /* max_speech_duration_s   = */ FLT_MAX,
-        /* speech_pad_ms           = */ 30,
-        /* samples_overlap         = */ 0.1,
-    };
-    return result;
-}
+    // cross allocator
+    {
+        bool ok = whisper_sched_graph_init(state->sched_cross, state->backends,
+                [&]() {
+                    return whisper_build_graph_cross(*ctx, *state);
+                });
 
-// Time conversion utility functions for whisper VAD
-static int cs_to_samples(int64_t cs) {
-    return (int)((cs / 100.0) * WHISPER_SAMPLE_RATE + 0.5);
-}
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to init cross allocator\n", __func__);
+            whisper_free_state(state);
+            return nullptr;
+        }
 
-static int64_t samples_to_cs(int samples) {
-    return (int64_t)((samples / (double)WHISPER_SAMPLE_RATE) * 100.0 + 0.5);
-}
+        WHISPER_LOG_INFO("%s: compute buffer (cross)  = %7.2f MB\n", __func__, whisper_sched_size(state->sched_cross) / 1e6);
+    }
 
-static bool weight_buft_supported(const whisper_vad_hparams & hparams, ggml_tensor * w, ggml_op op, ggml_backend_buffer_type_t buft, ggml_backend_dev_t dev) {
-    bool op_supported = true;
+    // decoder allocator
+    {
+        bool ok = whisper_sched_graph_init(state->sched_decode, state->backends,
+                [&]() {
+                    const auto & hparams = ctx->model.hparams;
 
-    if (ggml_backend_dev_type(dev) == GGML_BACKEND_DEVICE_TYPE_GPU ||
-        ggml_backend_dev_type(dev) == GGML_BACKEND_DEVICE_TYPE_IGPU ||
-        (ggml_backend_dev_type(dev) == GGML_BACKEND_DEVICE_TYPE_CPU && buft == ggml_backend_cpu_buffer_type())) {
-        // GPU and default CPU backend support all operators
-        op_supported = true;
-    } else {
-        switch (op) {
-            // The current extra_buffer_type implementations only support GGML_OP_MUL_MAT
-            case GGML_OP_MUL_MAT: {
-                ggml_init_params params = {
-                    /*.mem_size   =*/ 2 * ggml_tensor_overhead(),
-                    /*.mem_buffer =*/ nullptr,
-                    /*.no_alloc   =*/ true,
-                };
+                    // TODO: make sure this is the worst-case scenario
+                    const int n_tokens = hparams.n_text_ctx;
+                    const int n_past   = 0;
 
-                ggml_context_ptr ctx_ptr { ggml_init(params) };
-                if (!ctx_ptr) {
-                    throw std::runtime_error("failed to create ggml context");
-                }
-                ggml_context * ctx = ctx_ptr.get();
+                    whisper_batch_prep_legacy(state->batch, nullptr, n_tokens, n_past, 0);
 
-                ggml_tensor * op_tensor = nullptr;
+                    return whisper_build_graph_decoder(*ctx, *state, state->batch, ctx->params.dtw_token_timestamps, true);
+                });
 
-                int64_t n_ctx = hparams.lstm_hidden_size;
-                ggml_tensor * b = ggml_new_tensor_4d(ctx, GGML_TYPE_F32, w->ne[0], n_ctx, w->ne[2], w->ne[3]);
-                op_tensor = ggml_mul_mat(ctx, w, b);
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to init decoder allocator\n", __func__);
+            whisper_free_state(state);
+            return nullptr;
+        }
 
-                // create a temporary dummy buffer for the weight so that supports_op can check the buffer type
-                GGML_ASSERT(w->buffer == nullptr);
-                w->buffer = ggml_backend_buft_alloc_buffer(buft, 0);
-                op_supported = ggml_backend_dev_supports_op(dev, op_tensor);
-                ggml_backend_buffer_free(w->buffer);
-                w->buffer = nullptr;
-                break;
+        WHISPER_LOG_INFO("%s: compute buffer (decode) = %7.2f MB\n", __func__, whisper_sched_size(state->sched_decode) / 1e6);
+    }
+
+    return state;
+}
+
+int whisper_ctx_init_openvino_encoder_with_state(
+        struct whisper_context * ctx,
+          struct whisper_state * state,
+                    const char * model_path,
+                    const char * device,
+                    const char * cache_dir) {
+#ifndef WHISPER_USE_OPENVINO
+    (void)(ctx);
+    (void)(state);
+    (void)(model_path);
+    (void)(device);
+    (void)(cache_dir);
+
+    return 1;
+#else
+    if (!model_path && ctx->path_model.empty()) {
+        WHISPER_LOG_ERROR("%s: model_path is nullptr, and ctx has no model_path set.\n", __func__);
+        return 1;
+    }
+
+    std::string path_encoder;
+    if (!model_path) {
+        //if model_path is not set, attempt to find it in the same directory as ggml-<model>.bin model
+        path_encoder = whisper_openvino_get_path_encoder(ctx->path_model);
+    } else {
+        path_encoder = model_path;
+    }
+
+    std::string path_cache;
+    if (!cache_dir) {
+        //if cache_dir is not set, set it as a dir residing next to ggml-<model>.bin
+        path_cache = whisper_openvino_get_path_cache(ctx->path_model);
+    } else {
+        path_cache = cache_dir;
+    }
+
+    WHISPER_LOG_INFO("%s: loading OpenVINO model from '%s'\n", __func__, path_encoder.c_str());
+    WHISPER_LOG_INFO("%s: first run on a device may take a while ...\n", __func__);
+
+    state->ctx_openvino = whisper_openvino_init(path_encoder.c_str(), device, path_cache.c_str());
+    if (!state->ctx_openvino) {
+        WHISPER_LOG_ERROR("%s: failed to init OpenVINO encoder from '%s'\n", __func__, path_encoder.c_str());
+        return 1;
+    } else {
+        WHISPER_LOG_INFO("%s: OpenVINO model loaded\n", __func__);
+    }
+
+    return 0;
+#endif
+}
+
+int whisper_ctx_init_openvino_encoder(
+        struct whisper_context * ctx,
+                    const char * model_path,
+                    const char * device,
+                    const char * cache_dir) {
+    return whisper_ctx_init_openvino_encoder_with_state(ctx, ctx->state, model_path, device, cache_dir);
+}
+
+struct whisper_context_params whisper_context_default_params() {
+    struct whisper_context_params result = {
+        /*.use_gpu              =*/ true,
+        /*.flash_attn           =*/ WHISPER_FLASH_ATTN_DEFAULT != 0,
+        /*.gpu_device           =*/ 0,
+
+        /*.dtw_token_timestamps =*/ false,
+        /*.dtw_aheads_preset    =*/ WHISPER_AHEADS_NONE,
+        /*.dtw_n_top            =*/ -1,
+        /*.dtw_aheads           =*/ {
+            /*.n_heads          =*/ 0,
+            /*.heads            =*/ NULL,
+        },
+        /*.dtw_mem_size         =*/ 1024*1024*128,
+
+        /*.use_mmap             =*/ true,
+        /*.n_max_decoders       =*/ 1,
+        /*.enc_cache_size       =*/ 0,
+        /*.kv_self_type         =*/ GGML_TYPE_F16,
+        /*.kv_cross_type        =*/ GGML_TYPE_F16,
+    };
+    return result;
+}
+
+static struct whisper_context * whisper_init_with_params_no_state_impl(struct whisper_model_loader * loader, struct whisper_context_params params, whisper_mmap * mapping);
+
+struct whisper_context * whisper_init_from_file_with_params_no_state(const char * path_model, struct whisper_context_params params) {
+    WHISPER_LOG_INFO("%s: loading model from '%s'\n", __func__, path_model);
+
+    if (params.use_mmap) {
+        whisper_mmap * mapping = whisper_mmap::open(path_model);
+
+        if (mapping) {
+            whisper_model_loader loader = {};
+
+            loader.context = mapping;
+
+            loader.read = [](void * ctx, void * output, size_t read_size) {
+                whisper_mmap * mapping = reinterpret_cast<whisper_mmap *>(ctx);
+
+                size_t size_to_copy = mapping->pos + read_size < mapping->size ? read_size : mapping->size - mapping->pos;
+
+                memcpy(output, (const char *) mapping->addr + mapping->pos, size_to_copy);
+                mapping->pos += size_to_copy;
+
+                return size_to_copy;
+            };
+
+            loader.eof = [](void * ctx) {
+                whisper_mmap * mapping = reinterpret_cast<whisper_mmap *>(ctx);
+
+                return mapping->pos >= mapping->size;
+            };
+
+            loader.close = [](void * /*ctx*/) { };
+
+            auto ctx = whisper_init_with_params_no_state_impl(&loader, params, mapping);
+
+            if (ctx) {
+                ctx->path_model = path_model;
+            }
+
+            return ctx;
+        }
+
+        WHISPER_LOG_WARN("%s: failed to mmap '%s' - reading the file instead\n", __func__, path_model);
+    }
+
+#ifdef _MSC_VER
+    // Convert UTF-8 path to wide string (UTF-16) for Windows, resolving character encoding issues.
+    std::wstring_convert<std::codecvt_utf8<wchar_t>> converter;
+    std::wstring path_model_wide = converter.from_bytes(path_model);
+    auto fin = std::ifstream(path_model_wide, std::ios::binary);
+#else
+    auto fin = std::ifstream(path_model, std::ios::binary);
+#endif
+    if (!fin) {
+        WHISPER_LOG_ERROR("%s: failed to open '%s'\n", __func__, path_model);
+        return nullptr;
+    }
+
+    whisper_model_loader loader = {};
+
+    loader.context = &fin;
+
+    loader.read = [](void * ctx, void * output, size_t read_size) {
+        std::ifstream * fin = (std::ifstream*)ctx;
+        fin->read((char *)output, read_size);
+        return read_size;
+    };
+
+    loader.eof = [](void * ctx) {
+        std::ifstream * fin = (std::ifstream*)ctx;
+        return fin->eof();
+    };
+
+    loader.close = [](void * ctx) {
+        std::ifstream * fin = (std::ifstream*)ctx;
+        fin->close();
+    };
+
+    auto ctx = whisper_init_with_params_no_state(&loader, params);
+
+    if (ctx) {
+        ctx->path_model = path_model;
+    }
+
+    return ctx;
+}
+
+struct whisper_context * whisper_init_from_buffer_with_params_no_state(void * buffer, size_t buffer_size, struct whisper_context_params params) {
+    struct buf_context {
+        uint8_t* buffer;
+        size_t size;
+        size_t current_offset;
+    };
+
+    buf_context ctx = { reinterpret_cast<uint8_t*>(buffer), buffer_size, 0 };
+
+    WHISPER_LOG_INFO("%s: loading model from buffer\n", __func__);
+
+    whisper_model_loader loader = {};
+
+    loader.context = &ctx;
+
+    loader.read = [](void * ctx, void * output, size_t read_size) {
+        buf_context * buf = reinterpret_cast<buf_context *>(ctx);
+
+        size_t size_to_copy = buf->current_offset + read_size < buf->size ? read_size : buf->size - buf->current_offset;
+
+        memcpy(output, buf->buffer + buf->current_offset, size_to_copy);
+        buf->current_offset += size_to_copy;
+
+        return size_to_copy;
+    };
+
+    loader.eof = [](void * ctx) {
+        buf_context * buf = reinterpret_cast<buf_context *>(ctx);
+
+        return buf->current_offset >= buf->size;
+    };
+
+    loader.close = [](void * /*ctx*/) { };
+
+    return whisper_init_with_params_no_state(&loader, params);
+}
+
+static struct whisper_context * whisper_init_with_params_no_state_impl(struct whisper_model_loader * loader, struct whisper_context_params params, whisper_mmap * mapping) {
+    ggml_time_init();
+
+    if (params.flash_attn && params.dtw_token_timestamps) {
+        WHISPER_LOG_WARN("%s: dtw_token_timestamps is not supported with flash_attn - disabling\n", __func__);
+        params.dtw_token_timestamps = false;
+    }
+
+    if (!whisper_kv_type_supported(params.kv_self_type)) {
+        WHISPER_LOG_WARN("%s: kv_self_type %d is not supported (f16, q8_0 or q4_0) - using f16\n", __func__, params.kv_self_type);
+        params.kv_self_type = GGML_TYPE_F16;
+    }
+
+    if (!whisper_kv_type_supported(params.kv_cross_type)) {
+        WHISPER_LOG_WARN("%s: kv_cross_type %d is not supported (f16, q8_0 or q4_0) - using f16\n", __func__, params.kv_cross_type);
+        params.kv_cross_type = GGML_TYPE_F16;
+    }
+
+    if (!params.flash_attn && (ggml_is_quantized(params.kv_self_type) || ggml_is_quantized(params.kv_cross_type))) {
+        WHISPER_LOG_WARN("%s: quantized V caches need flash_attn - only the K caches are quantized\n", __func__);
+    }
+
+    WHISPER_LOG_INFO("%s: use gpu    = %d\n", __func__, params.use_gpu);
+    WHISPER_LOG_INFO("%s: flash attn = %d\n", __func__, params.flash_attn);
+    WHISPER_LOG_INFO("%s: gpu_device = %d\n", __func__, params.gpu_device);
+    WHISPER_LOG_INFO("%s: use mmap   = %d\n", __func__, mapping != nullptr);
+    WHISPER_LOG_INFO("%s: dtw        = %d\n", __func__, params.dtw_token_timestamps);
+    WHISPER_LOG_INFO("%s: kv self    = %s\n", __func__, ggml_type_name(params.kv_self_type));
+    WHISPER_LOG_INFO("%s: kv cross   = %s\n", __func__, ggml_type_name(params.kv_cross_type));
+    WHISPER_LOG_INFO("%s: devices    = %zu\n", __func__, ggml_backend_dev_count());
+    WHISPER_LOG_INFO("%s: backends   = %zu\n", __func__, ggml_backend_reg_count());
+
+    whisper_context * ctx = new whisper_context;
+    ctx->params = params;
+    ctx->mapping.reset(mapping);
+
+    // without flash attention, V is stored transposed with one value per row, which a block type cannot hold
+    ctx->kv_self_type_k  = params.kv_self_type;
+    ctx->kv_self_type_v  = params.flash_attn ? params.kv_self_type  : GGML_TYPE_F16;
+    ctx->kv_cross_type_k = params.kv_cross_type;
+    ctx->kv_cross_type_v = params.flash_attn ? params.kv_cross_type : GGML_TYPE_F16;
+
+    ctx->audio_ctx_pad = whisper_audio_ctx_get_padding(params);
+
+    if (!whisper_model_load(loader, *ctx)) {
+        loader->close(loader->context);
+        WHISPER_LOG_ERROR("%s: failed to load model\n", __func__);
+        delete ctx;
+        return nullptr;
+    }
+
+    loader->close(loader->context);
+
+    return ctx;
+}
+
+struct whisper_context * whisper_init_with_params_no_state(struct whisper_model_loader * loader, struct whisper_context_params params) {
+    return whisper_init_with_params_no_state_impl(loader, params, nullptr);
+}
+
+struct whisper_context * whisper_init_from_file_with_params(const char * path_model, struct whisper_context_params params) {
+    whisper_context * ctx = whisper_init_from_file_with_params_no_state(path_model, params);
+    if (!ctx) {
+        return nullptr;
+    }
+
+    ctx->state = whisper_init_state(ctx);
+    if (!ctx->state) {
+        whisper_free(ctx);
+        return nullptr;
+    }
+
+    return ctx;
+}
+
+struct whisper_context * whisper_init_from_buffer_with_params(void * buffer, size_t buffer_size, struct whisper_context_params params) {
+    whisper_context * ctx = whisper_init_from_buffer_with_params_no_state(buffer, buffer_size, params);
+    if (!ctx) {
+        return nullptr;
+    }
+
+    ctx->state = whisper_init_state(ctx);
+    if (!ctx->state) {
+        whisper_free(ctx);
+        return nullptr;
+    }
+
+    return ctx;
+}
+
+struct whisper_context * whisper_init_with_params(struct whisper_model_loader * loader, struct whisper_context_params params) {
+    whisper_context * ctx = whisper_init_with_params_no_state(loader, params);
+    if (!ctx) {
+        return nullptr;
+    }
+
+    ctx->state = whisper_init_state(ctx);
+    if (!ctx->state) {
+        whisper_free(ctx);
+        return nullptr;
+    }
+
+    return ctx;
+}
+
+struct whisper_context * whisper_init_from_file(const char * path_model) {
+    return whisper_init_from_file_with_params(path_model, whisper_context_default_params());
+}
+
+struct whisper_context * whisper_init_from_buffer(void * buffer, size_t buffer_size) {
+    return whisper_init_from_buffer_with_params(buffer, buffer_size, whisper_context_default_params());
+}
+
+struct whisper_context * whisper_init(struct whisper_model_loader * loader) {
+    return whisper_init_with_params(loader, whisper_context_default_params());
+}
+
+struct whisper_context * whisper_init_from_file_no_state(const char * path_model) {
+    return whisper_init_from_file_with_params_no_state(path_model, whisper_context_default_params());
+}
+
+struct whisper_context * whisper_init_from_buffer_no_state(void * buffer, size_t buffer_size) {
+    return whisper_init_from_buffer_with_params_no_state(buffer, buffer_size, whisper_context_default_params());
+}
+
+struct whisper_context * whisper_init_no_state(struct whisper_model_loader * loader) {
+    return whisper_init_with_params_no_state(loader, whisper_context_default_params());
+}
+
+void whisper_free_state(struct whisper_state * state) {
+    if (state) {
+        whisper_kv_cache_free(state->kv_self);
+        whisper_kv_cache_free(state->kv_cross);
+        whisper_kv_cache_free(state->kv_pad);
+
+#ifdef WHISPER_USE_COREML
+        if (state->ctx_coreml != nullptr) {
+            whisper_coreml_free(state->ctx_coreml);
+            state->ctx_coreml = nullptr;
+        }
+#endif
+
+#ifdef WHISPER_USE_OPENVINO
+        if (state->ctx_openvino != nullptr) {
+            whisper_openvino_free(state->ctx_openvino);
+            state->ctx_openvino = nullptr;
+        }
+#endif
+
+        whisper_batch_free(state->batch);
+
+        ggml_backend_sched_free(state->sched_conv.sched);
+        ggml_backend_sched_free(state->sched_encode.sched);
+        ggml_backend_sched_free(state->sched_cross.sched);
+        ggml_backend_sched_free(state->sched_decode.sched);
+
+        for (auto & backend : state->backends) {
+            ggml_backend_free(backend);
+        }
+
+        // [EXPERIMENTAL] Token-level timestamps with DTW
+        aheads_masks_free(state->aheads_masks);
+
+        if (state->vad_context != nullptr) {
+            whisper_vad_free(state->vad_context);
+            state->vad_context = nullptr;
+        }
+
+        delete state;
+    }
+}
+
+void whisper_state_reset(struct whisper_state * state) {
+    whisper_state & wstate = *state;
+
+    // the self-attention cells only - the KV data is overwritten before it is read again
+    for (auto & cell : wstate.kv_self.cells) {
+        cell.pos = -1;
+        cell.seq_id.clear();
+    }
+    wstate.kv_self.head = 0;
+    wstate.kv_self.n    = 0;
+
+    wstate.t_sample_us = 0;
+    wstate.t_encode_us = 0;
+    wstate.t_decode_us = 0;
+    wstate.t_batchd_us = 0;
+    wstate.t_prompt_us = 0;
+    wstate.t_mel_us    = 0;
+
+    wstate.n_sample = 0;
+    wstate.n_encode = 0;
+    wstate.n_decode = 0;
+    wstate.n_batchd = 0;
+    wstate.n_prompt = 0;
+    wstate.n_fail_p = 0;
+    wstate.n_fail_h = 0;
+
+    // the kept decoder graph stays valid for the next request
+    wstate.sched_decode.n_graph_reuse    = 0;
+    wstate.sched_decode.n_graph_build    = 0;
+    wstate.sched_decode.t_graph_build_us = 0;
+
+    wstate.result_all.clear();
+    wstate.prompt_past0.clear();
+    wstate.prompt_past1.clear();
+
+    wstate.lang_id        = 0;
+    wstate.no_speech_prob = 0.0f;
+    wstate.energy.clear();
+
+    // same sampling at t > 0.0 as a fresh state
+    for (int j = 0; j < WHISPER_MAX_DECODERS; ++j) {
+        wstate.decoders[j].rng = std::mt19937(j);
+    }
+
+    whisper_pcm_to_mel_reset_with_state(state);
+
+    wstate.exp_n_audio_ctx = 0;
+
+    wstate.vad_segments.clear();
+    wstate.has_vad_segments = false;
+    wstate.vad_mapping_table.clear();
+}
+
+struct whisper_state_pool {
+    whisper_context * ctx = nullptr;
+
+    std::vector<whisper_state *> states; // all states of the pool
+    std::vector<whisper_state *> idle;   // states that are not checked out
+    std::set<whisper_state *>    busy;   // states that are checked out and not yet being released
+
+    std::mutex              mutex;
+    std::condition_variable cv;
+};
+
+struct whisper_state_pool * whisper_state_pool_init(struct whisper_context * ctx, int n_states, int n_threads) {
+    if (n_states <= 0) {
+        // one state per n_threads cores - more concurrent requests would only oversubscribe the CPU
+        const int n_cores = std::max(1, (int) std::thread::hardware_concurrency());
+        n_states = std::max(1, n_cores/std::max(1, n_threads));
+    }
+
+    whisper_state_pool * pool = new whisper_state_pool;
+    pool->ctx = ctx;
+
+    for (int i = 0; i < n_states; ++i) {
+        whisper_state * state = whisper_init_state(ctx);
+        if (state == nullptr) {
+            WHISPER_LOG_ERROR("%s: failed to initialize state %d of %d\n", __func__, i, n_states);
+            whisper_state_pool_free(pool);
+            return nullptr;
+        }
+
+        pool->states.push_back(state);
+    }
+
+    // checked out from the back - the most recently used state is handed out first while its memory is still warm
+    pool->idle = pool->states;
+
+    WHISPER_LOG_INFO("%s: %d states\n", __func__, n_states);
+
+    return pool;
+}
+
+void whisper_state_pool_free(struct whisper_state_pool * pool) {
+    if (pool) {
+        if (pool->idle.size() != pool->states.size()) {
+            WHISPER_LOG_ERROR("%s: %zu states are still checked out\n", __func__, pool->states.size() - pool->idle.size());
+        }
+
+        for (whisper_state * state : pool->states) {
+            whisper_free_state(state);
+        }
+
+        delete pool;
+    }
+}
+
+struct whisper_state * whisper_state_pool_acquire(struct whisper_state_pool * pool, int timeout_ms) {
+    std::unique_lock<std::mutex> lock(pool->mutex);
+
+    const auto available = [pool] { return !pool->idle.empty(); };
+
+    if (timeout_ms < 0) {
+        pool->cv.wait(lock, available);
+    } else if (!pool->cv.wait_for(lock, std::chrono::milliseconds(timeout_ms), available)) {
+        return nullptr;
+    }
+
+    whisper_state * state = pool->idle.back();
+    pool->idle.pop_back();
+    pool->busy.insert(state);
+
+    return state;
+}
+
+void whisper_state_pool_release(struct whisper_state_pool * pool, struct whisper_state * state) {
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+
+        if (pool->busy.erase(state) == 0) {
+            if (std::find(pool->states.begin(), pool->states.end(), state) == pool->states.end()) {
+                WHISPER_LOG_ERROR("%s: state %p does not belong to the pool\n", __func__, (void *) state);
+            } else {
+                WHISPER_LOG_ERROR("%s: state %p was released twice\n", __func__, (void *) state);
+            }
+            return;
+        }
+    }
+
+    // the state is neither checked out nor idle, so no other thread can use it until it is reset
+    whisper_state_reset(state);
+
+    {
+        std::lock_guard<std::mutex> lock(pool->mutex);
+        pool->idle.push_back(state);
+    }
+
+    pool->cv.notify_one();
+}
+
+int whisper_state_pool_n_states(struct whisper_state_pool * pool) {
+    return pool->states.size();
+}
+
+int whisper_state_pool_n_idle(struct whisper_state_pool * pool) {
+    std::lock_guard<std::mutex> lock(pool->mutex);
+    return pool->idle.size();
+}
+
+void whisper_free(struct whisper_context * ctx) {
+    if (ctx) {
+        for (ggml_context * context : ctx->model.ctxs) {
+            ggml_free(context);
+        }
+
+        for (ggml_backend_buffer_t buf : ctx->model.buffers) {
+            ggml_backend_buffer_free(buf);
+        }
+
+        whisper_free_state(ctx->state);
+
+        delete ctx;
+    }
+}
+
+void whisper_free_context_params(struct whisper_context_params * params) {
+    if (params) {
+        delete params;
+    }
+}
+
+void whisper_free_params(struct whisper_full_params * params) {
+    if (params) {
+        delete params;
+    }
+}
+
+void whisper_pcm_to_mel_reset_with_state(struct whisper_state * state) {
+    auto & stream = state->mel_stream;
+
+    stream.n_samples = 0;
+    stream.n_final   = 0;
+    stream.max_final = -INFINITY;
+    stream.mmax      = NAN;
+
+    stream.pcm.clear();
+    stream.raw.clear();
+
+    state->enc_mel_offset = -1;
+}
+
+void whisper_pcm_to_mel_reset(struct whisper_context * ctx) {
+    whisper_pcm_to_mel_reset_with_state(ctx->state);
+}
+
+int whisper_pcm_to_mel_with_state(struct whisper_context * ctx, struct whisper_state * state, const float * samples, int n_samples, int n_threads) {
+    whisper_pcm_to_mel_reset_with_state(state);
+
+    if (!log_mel_spectrogram(*state, ctx->pool, samples, n_samples, WHISPER_SAMPLE_RATE, WHISPER_N_FFT, WHISPER_HOP_LENGTH, ctx->model.filters.n_mel, n_threads, ctx->model.filters, false, state->mel)) {
+        WHISPER_LOG_ERROR("%s: failed to compute mel spectrogram\n", __func__);
+        return -1;
+    }
+
+    return 0;
+}
+
+int whisper_pcm_to_mel(struct whisper_context * ctx, const float * samples, int n_samples, int n_threads) {
+    return whisper_pcm_to_mel_with_state(ctx, ctx->state, samples, n_samples, n_threads);
+}
+
+// the padded signal of a stream is
+//
+//   [ reflection of samples 1 .. 200 | samples | zeros ... ]
+//
+// exactly as in log_mel_spectrogram(). frame i covers the padded samples [i*hop, i*hop + n_fft) - it is final once
+// these are all known, i.e. it lies left of the zeros and the reflection is complete. frames that reach into the
+// zeros are recomputed by every append until they are final, frames that only see zeros are the constant tail
+int whisper_pcm_to_mel_append_with_state(struct whisper_context * ctx, struct whisper_state * state, const float * samples, int n_samples, int n_threads) {
+    if (n_samples < 0 || (n_samples > 0 && samples == nullptr)) {
+        WHISPER_LOG_ERROR("%s: invalid samples\n", __func__);
+        return -1;
+    }
+
+    const int64_t t_start_us = ggml_time_us();
+
+    state->enc_mel_offset = -1;
+
+    const int frame_size  = WHISPER_N_FFT;
+    const int frame_step  = WHISPER_HOP_LENGTH;
+    const int stage_1_pad = WHISPER_SAMPLE_RATE * 30;
+    const int stage_2_pad = frame_size / 2;
+
+    const whisper_filters & filters = ctx->model.filters;
+
+    auto & stream = state->mel_stream;
+    auto & mel    = state->mel;
+
+    if (stream.n_samples == 0 && stream.pcm.empty()) {
+        // placeholder for the reflection, filled in as soon as sample 200 arrives
+        stream.pcm.assign(stage_2_pad, 0.0f);
+    }
+
+    const int64_t n_prev = stream.n_samples;
+    const int64_t n_cur  = n_prev + n_samples;
+
+    if (n_cur > INT_MAX - stage_1_pad - 2*stage_2_pad) {
+        WHISPER_LOG_ERROR("%s: too many samples in the stream\n", __func__);
+        return -1;
+    }
+
+    stream.pcm.insert(stream.pcm.end(), samples, samples + n_samples);
+    stream.n_samples = n_cur;
+
+    // reflective pad 200 samples at the beginning of audio (nothing is final yet, so pcm starts at padded sample 0)
+    if (n_prev <= stage_2_pad && n_cur > stage_2_pad) {
+        std::reverse_copy(stream.pcm.begin() + stage_2_pad + 1, stream.pcm.begin() + 2*stage_2_pad + 1, stream.pcm.begin());
+    }
+
+    const int n_final_prev = stream.n_final;
+    const int n_final      = n_cur > stage_2_pad ? (int) ((n_cur + stage_2_pad - frame_size)/frame_step + 1) : 0;
+    const int n_len        = (int) ((n_cur + stage_1_pad + stage_2_pad*2 - frame_size)/frame_step);
+    const int n_frames     = std::min((int) ((n_cur + stage_2_pad)/frame_step + 1), n_len);
+
+    // grow the rows of raw and mel.data geometrically, so that appends are amortized O(new frames)
+    if (mel.n_mel != filters.n_mel || mel.n_stride < n_frames || n_prev == 0) {
+        const int n_stride = std::max(n_frames, n_prev == 0 ? 0 : 2*mel.n_stride);
+
+        std::vector<float> raw(filters.n_mel*n_stride, 0.0f);
+        std::vector<float> data(filters.n_mel*n_stride, 0.0f);
+        if (n_prev > 0) {
+            for (int j = 0; j < filters.n_mel; j++) {
+                std::copy(stream.raw.begin() + j*mel.n_stride, stream.raw.begin() + j*mel.n_stride + mel.n_len_data, raw.begin()  + j*n_stride);
+                std::copy(mel.data.begin()   + j*mel.n_stride, mel.data.begin()   + j*mel.n_stride + mel.n_len_data, data.begin() + j*n_stride);
+            }
+        } else {
+            mel.n_len_data = 0;
+        }
+
+        stream.raw.swap(raw);
+        mel.data.swap(data);
+        mel.n_stride = n_stride;
+    }
+
+    mel.n_mel     = filters.n_mel;
+    mel.n_len     = n_len;
+    mel.n_len_org = 1 + (int) ((n_cur + stage_2_pad - frame_size)/frame_step);
+
+    // FFT of the frames that are new or not final yet
+    if (n_final_prev < n_frames) {
+        const float * hann = global_cache.hann_window;
+
+        // pcm[0] is the first sample of frame n_final_prev
+        const int n_valid = (int) (n_cur + stage_2_pad) - n_final_prev*frame_step;
+
+        // the blocks of WHISPER_MEL_BLOCK frames set the useful number of workers
+        const int n_blocks = (n_frames - n_final_prev + WHISPER_MEL_BLOCK - 1)/WHISPER_MEL_BLOCK;
+        const int n_workers = std::max(1, std::min(n_threads, n_blocks));
+
+        if ((int) state->mel_scratch.size() < n_workers) {
+            state->mel_scratch.resize(n_workers);
+        }
+
+        std::vector<float> mel_max(n_workers, -INFINITY);
+
+        ctx->pool.parallel_for(n_workers, [&](int ith) {
+            log_mel_spectrogram_worker_thread(ith, hann, stream.pcm.data(), n_valid, frame_size, frame_step, n_final_prev, n_frames, n_workers,
+                                              filters, state->mel_scratch[ith], stream.raw.data(), mel.n_stride, mel_max[ith]);
+        });
+    }
+
+    // max over all frames, as seen by log_mel_spectrogram()
+    float vmax = log10(1e-10); // the tail is never empty
+    for (int j = 0; j < filters.n_mel; j++) {
+        const float * raw = stream.raw.data() + j*mel.n_stride;
+        for (int i = n_final_prev; i < n_final; i++) {
+            stream.max_final = std::max(stream.max_final, raw[i]);
+        }
+        for (int i = n_final; i < n_frames; i++) {
+            vmax = std::max(vmax, raw[i]);
+        }
+    }
+    vmax = std::max(vmax, stream.max_final);
+
+    const float mmax = vmax - 8.0f;
+
+    // clamping and normalization - only the recomputed frames, unless the clamp value has changed
+    {
+        const int i_beg = mmax == stream.mmax ? n_final_prev : 0;
+
+        for (int j = 0; j < filters.n_mel; j++) {
+            const float * raw  = stream.raw.data() + j*mel.n_stride;
+                  float * data = mel.data.data()   + j*mel.n_stride;
+            for (int i = i_beg; i < n_frames; i++) {
+                data[i] = (std::max(raw[i], mmax) + 4.0f)/4.0f;
+            }
+        }
+
+        stream.mmax = mmax;
+
+        mel.n_len_data = n_frames;
+        mel.v_tail     = (std::max((float) log10(1e-10), mmax) + 4.0f)/4.0f;
+    }
+
+    // drop the samples that only final frames depend on
+    if (n_final > n_final_prev) {
+        stream.pcm.erase(stream.pcm.begin(), stream.pcm.begin() + (int64_t) (n_final - n_final_prev)*frame_step);
+        stream.n_final = n_final;
+    }
+
+    state->t_mel_us += ggml_time_us() - t_start_us;
+
+    return 0;
+}
+
+int whisper_pcm_to_mel_append(struct whisper_context * ctx, const float * samples, int n_samples, int n_threads) {
+    return whisper_pcm_to_mel_append_with_state(ctx, ctx->state, samples, n_samples, n_threads);
+}
+
+int whisper_set_mel_with_state(
+        struct whisper_context * ctx,
+          struct whisper_state * state,
+                   const float * data,
+                           int   n_len,
+                           int   n_mel) {
+    if (n_mel != ctx->model.filters.n_mel) {
+        WHISPER_LOG_ERROR("%s: invalid number of mel bands: %d (expected %d)\n", __func__, n_mel, ctx->model.filters.n_mel);
+        return -1;
+    }
+
+    state->mel.n_len     = n_len;
+    state->mel.n_len_org = n_len;
+    state->mel.n_mel     = n_mel;
+
+    state->mel.n_stride   = n_len;
+    state->mel.n_len_data = n_len;
+
+    state->mel.data.resize(n_len*n_mel);
+    memcpy(state->mel.data.data(), data, n_len*n_mel*sizeof(float));
+
+    whisper_pcm_to_mel_reset_with_state(state);
+
+    return 0;
+}
+
+int whisper_set_mel(
+        struct whisper_context * ctx,
+        const float * data,
+        int n_len,
+        int n_mel) {
+    return whisper_set_mel_with_state(ctx, ctx->state, data, n_len, n_mel);
+}
+
+int whisper_encode_with_state(struct whisper_context * ctx, struct whisper_state * state, int offset, int n_threads) {
+    if (!whisper_encode_internal(*ctx, *state, offset, n_threads, nullptr, nullptr)) {
+        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
+        return -1;
+    }
+
+    return 0;
+}
+
+int whisper_encode(struct whisper_context * ctx, int offset, int n_threads) {
+    if (!whisper_encode_internal(*ctx, *ctx->state, offset, n_threads, nullptr, nullptr)) {
+        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
+        return -1;
+    }
+
+    return 0;
+}
+
+struct whisper_encoder_batch * whisper_encoder_batch_init(struct whisper_context * ctx, int n_max) {
+    if (n_max < 1) {
+        WHISPER_LOG_ERROR("%s: invalid batch size %d\n", __func__, n_max);
+        return nullptr;
+    }
+
+    // every window adds its copies to the cross-attention caches to the graph
+    const int n_max_nodes = (WHISPER_MAX_NODES - 64*ctx->model.hparams.n_audio_layer)/(8*ctx->model.hparams.n_text_layer);
+    if (n_max > n_max_nodes) {
+        WHISPER_LOG_WARN("%s: batch size %d exceeds the graph size, using %d\n", __func__, n_max, n_max_nodes);
+        n_max = n_max_nodes;
+    }
+
+    whisper_encoder_batch * batch = new whisper_encoder_batch;
+
+    batch->ctx   = ctx;
+    batch->n_max = n_max;
+
+    batch->backends = whisper_backend_init(ctx->params);
+    if (batch->backends.empty()) {
+        WHISPER_LOG_ERROR("%s: whisper_backend_init() failed\n", __func__);
+        whisper_encoder_batch_free(batch);
+        return nullptr;
+    }
+
+    bool ok = whisper_sched_graph_init(batch->sched, batch->backends,
+            [&]() {
+                return whisper_build_graph_encoder_batch(*ctx, *batch, nullptr, n_max, ctx->model.hparams.n_audio_ctx);
+            });
+
+    if (!ok) {
+        WHISPER_LOG_ERROR("%s: failed to init batched encoder allocator\n", __func__);
+        whisper_encoder_batch_free(batch);
+        return nullptr;
+    }
+
+    WHISPER_LOG_INFO("%s: compute buffer (encode x%d) = %7.2f MB\n", __func__, n_max, whisper_sched_size(batch->sched) / 1e6);
+
+    return batch;
+}
+
+void whisper_encoder_batch_free(struct whisper_encoder_batch * batch) {
+    if (batch) {
+        ggml_backend_sched_free(batch->sched.sched);
+
+        for (auto & backend : batch->backends) {
+            ggml_backend_free(backend);
+        }
+
+        delete batch;
+    }
+}
+
+int whisper_encode_batch(struct whisper_encoder_batch * batch, struct whisper_state ** states, const int * offsets, int n_states, int n_threads) {
+    whisper_context & wctx = *batch->ctx;
+
+    // larger requests are split into batches of n_max windows
+    for (int i0 = 0; i0 + batch->n_max < n_states; i0 += batch->n_max) {
+        const int ret = whisper_encode_batch(batch, states + i0, offsets ? offsets + i0 : nullptr, batch->n_max, n_threads);
+        if (ret != 0) {
+            return ret;
+        }
+    }
+
+    const int i0 = n_states > 0 ? ((n_states - 1)/batch->n_max)*batch->n_max : 0;
+
+    states   += i0;
+    offsets   = offsets ? offsets + i0 : nullptr;
+    n_states -= i0;
+
+    if (n_states <= 0) {
+        return 0;
+    }
+
+    const int n_ctx = states[0]->exp_n_audio_ctx > 0 ? states[0]->exp_n_audio_ctx : wctx.model.hparams.n_audio_ctx;
+
+    for (int i = 0; i < n_states; ++i) {
+        const int n_ctx_i = states[i]->exp_n_audio_ctx > 0 ? states[i]->exp_n_audio_ctx : wctx.model.hparams.n_audio_ctx;
+        if (n_ctx_i != n_ctx) {
+            WHISPER_LOG_ERROR("%s: the states of a batch must use the same audio context (%d != %d)\n", __func__, n_ctx_i, n_ctx);
+            return -1;
+        }
+    }
+
+    // Core ML / OpenVINO encoders run per state
+    if (whisper_encode_external(*states[0])) {
+        for (int i = 0; i < n_states; ++i) {
+            if (whisper_encode_with_state(&wctx, states[i], offsets ? offsets[i] : 0, n_threads) != 0) {
+                return -1;
+            }
+        }
+        return 0;
+    }
+
+    const int64_t t_start_us = ggml_time_us();
+
+    for (int i = 0; i < n_states; ++i) {
+        states[i]->enc_mel_offset = -1;
+    }
+
+    auto & sched = batch->sched.sched;
+
+    ggml_cgraph * gf = whisper_build_graph_encoder_batch(wctx, *batch, states, n_states, n_ctx);
+
+    if (!ggml_backend_sched_alloc_graph(sched, gf)) {
+        WHISPER_LOG_ERROR("%s: failed to allocate the compute buffer\n", __func__);
+        return -1;
+    }
+
+    // set the input
+    {
+        struct ggml_tensor * mel = ggml_graph_get_tensor(gf, "mel");
+
+        const int n_window = 2*n_ctx*wctx.model.hparams.n_mels;
+
+        batch->inp_mel.resize(ggml_nelements(mel));
+
+        for (int i = 0; i < n_states; ++i) {
+            whisper_mel_window(states[i]->mel, offsets ? offsets[i] : 0, n_ctx, batch->inp_mel.data() + i*n_window);
+        }
+
+        ggml_backend_tensor_set(mel, batch->inp_mel.data(), 0, ggml_nbytes(mel));
+    }
+
+    if (!ggml_graph_compute_helper(sched, gf, n_threads)) {
+        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
+        return -1;
+    }
+
+    // the batch time is shared evenly between the requests
+    const int64_t t_encode_us = (ggml_time_us() - t_start_us)/n_states;
+
+    for (int i = 0; i < n_states; ++i) {
+        states[i]->t_encode_us += t_encode_us;
+        states[i]->n_encode++;
+
+        states[i]->enc_mel_offset = offsets ? offsets[i] : 0;
+        states[i]->enc_n_ctx      = n_ctx;
+    }
+
+    return 0;
+}
+
+int whisper_decode_with_state(struct whisper_context * ctx, struct whisper_state * state, const whisper_token * tokens, int n_tokens, int n_past, int n_threads) {
+    whisper_batch_prep_legacy(state->batch, tokens, n_tokens, n_past, 0);
+
+    whisper_kv_cache_seq_rm(state->kv_self, 0, n_past, -1);
+
+    if (!whisper_decode_internal(*ctx, *state, state->batch, n_threads, false, nullptr, nullptr)) {
+        WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
+        return 1;
+    }
+
+    return 0;
+}
+
+int whisper_decode(struct whisper_context * ctx, const whisper_token * tokens, int n_tokens, int n_past, int n_threads) {
+    if (ctx->state == nullptr) {
+        WHISPER_LOG_ERROR("%s: ERROR state was not loaded.\n", __func__);
+        return -1;
+    }
+
+    return whisper_decode_with_state(ctx, ctx->state, tokens, n_tokens, n_past, n_threads);
+}
+
+int whisper_tokenize(struct whisper_context * ctx, const char * text, whisper_token * tokens, int n_max_tokens) {
+    const auto res = tokenize(ctx->vocab, text);
+
+    if (n_max_tokens < (int) res.size()) {
+        WHISPER_LOG_ERROR("%s: too many resulting tokens: %d (max %d)\n", __func__, (int) res.size(), n_max_tokens);
+        return -(int) res.size();
+    }
+
+    for (int i = 0; i < (int) res.size(); i++) {
+        tokens[i] = res[i];
+    }
+
+    return res.size();
+}
+
+int whisper_token_count(struct whisper_context * ctx, const char * text) {
+    return -whisper_tokenize(ctx, text, NULL, 0);
+}
+
+int whisper_lang_max_id(void) {
+    auto max_id = 0;
+    for (const auto & kv : g_lang) {
+        max_id = std::max(max_id, kv.second.first);
+    }
+
+    return max_id;
+}
+
+int whisper_lang_id(const char * lang) {
+    if (!g_lang.count(lang)) {
+        for (const auto & kv : g_lang) {
+            if (kv.second.second == lang) {
+                return kv.second.first;
+            }
+        }
+
+        WHISPER_LOG_ERROR("%s: unknown language '%s'\n", __func__, lang);
+        return -1;
+    }
+    return g_lang.at(lang).first;
+}
+
+const char * whisper_lang_str(int id) {
+    for (const auto & kv : g_lang) {
+        if (kv.second.first == id) {
+            return kv.first.c_str();
+        }
+    }
+
+    WHISPER_LOG_ERROR("%s: unknown language id %d\n", __func__, id);
+    return nullptr;
+}
+
+const char * whisper_lang_str_full(int id) {
+   for (const auto & kv : g_lang) {
+        if (kv.second.first == id) {
+            return kv.second.second.c_str();
+        }
+    }
+
+    WHISPER_LOG_ERROR("%s: unknown language id %d\n", __func__, id);
+    return nullptr;
+}
+
+// the probabilities of the languages, most probable first, from the logits of the language tokens
+// (logits_lang[i] - the logit of the token of language id i)
+static void whisper_lang_probs(
+      const whisper_vocab & vocab,
+              const float * logits_lang,
+    std::vector<whisper_pair<double, whisper_vocab::id>> & logits_id) {
+    logits_id.clear();
+
+    for (const auto & kv : g_lang) {
+        // models with 99 languages have no token for the last one
+        if (kv.second.first < vocab.num_languages()) {
+            logits_id.emplace_back(logits_lang[kv.second.first], kv.second.first);
+        }
+    }
+
+    // sort descending
+    {
+        using pair_type = std::remove_reference<decltype(logits_id)>::type::value_type;
+        std::sort(logits_id.begin(), logits_id.end(), [](const pair_type & a, const pair_type & b) {
+            return a.first > b.first;
+        });
+    }
+
+    // softmax
+    {
+        const auto max = logits_id[0].first;
+
+        double sum = 0.0f;
+        for (auto & kv : logits_id) {
+            kv.first = exp(kv.first - max);
+            sum += kv.first;
+        }
+
+        for (auto & kv : logits_id) {
+            kv.first /= sum;
+        }
+    }
+}
+
+// scores the languages of the window at mel offset seek into state.decoders[0].logits_id
+// the window is encoded unless it already is in the cross-attention cache, e.g. when whisper_full_with_state()
+// detects the language of the first window it then decodes
+// lang_only - the decoder computes the logits of the language tokens instead of the whole vocabulary
+static int whisper_lang_detect_internal(
+        whisper_context & ctx,
+          whisper_state & state,
+                    int   seek,
+                    int   n_threads,
+                   bool   lang_only) {
+    const int n_ctx = state.exp_n_audio_ctx > 0 ? state.exp_n_audio_ctx : ctx.model.hparams.n_audio_ctx;
+
+    if (state.enc_mel_offset != seek || state.enc_n_ctx != n_ctx) {
+        if (!whisper_encode_internal(ctx, state, seek, n_threads, nullptr, nullptr)) {
+            WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
+            return -6;
+        }
+    }
+
+    const whisper_token token_sot = whisper_token_sot(&ctx);
+
+    whisper_batch_prep_legacy(state.batch, &token_sot, 1, 0, 0);
+
+    whisper_kv_cache_seq_rm(state.kv_self, 0, 0, -1);
+
+    state.logits_lang = lang_only;
+
+    const bool ok = whisper_decode_internal(ctx, state, state.batch, n_threads, false, nullptr, nullptr);
+
+    state.logits_lang = false;
+
+    if (!ok) {
+        WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
+        return -7;
+    }
+
+    whisper_lang_probs(ctx.vocab, lang_only ? state.logits.data() : state.logits.data() + whisper_token_lang(&ctx, 0), state.decoders[0].logits_id);
+
+    return 0;
+}
+
+static int whisper_lang_detect_check_offset(const whisper_state & state, int offset_ms, const char * func) {
+    const int seek = offset_ms/10;
+
+    if (seek < 0) {
+        WHISPER_LOG_ERROR("%s: offset %dms is before the start of the audio\n", func, offset_ms);
+        return -1;
+    }
+
+    if (seek >= state.mel.n_len_org) {
+        WHISPER_LOG_ERROR("%s: offset %dms is past the end of the audio (%dms)\n", func, offset_ms, state.mel.n_len_org*10);
+        return -2;
+    }
+
+    return 0;
+}
+
+int whisper_lang_auto_detect_with_state(
+        struct whisper_context * ctx,
+          struct whisper_state * state,
+                           int   offset_ms,
+                           int   n_threads,
+                         float * lang_probs) {
+    int ret = whisper_lang_detect_check_offset(*state, offset_ms, __func__);
+    if (ret != 0) {
+        return ret;
+    }
+
+    ret = whisper_lang_detect_internal(*ctx, *state, offset_ms/10, n_threads, false);
+    if (ret != 0) {
+        return ret;
+    }
+
+    const auto & logits_id = state->decoders[0].logits_id;
+
+    if (lang_probs) {
+        for (const auto & prob : logits_id) {
+            lang_probs[prob.second] = prob.first;
+        }
+    }
+
+    return logits_id[0].second;
+}
+
+int whisper_lang_detect_top_k(
+        struct whisper_context * ctx,
+          struct whisper_state * state,
+                           int   offset_ms,
+                           int   n_threads,
+                           int   k,
+                           int * lang_ids,
+                         float * lang_probs) {
+    int ret = whisper_lang_detect_check_offset(*state, offset_ms, __func__);
+    if (ret != 0) {
+        return ret;
+    }
+
+    ret = whisper_lang_detect_internal(*ctx, *state, offset_ms/10, n_threads, true);
+    if (ret != 0) {
+        return ret;
+    }
+
+    const auto & logits_id = state->decoders[0].logits_id;
+
+    k = std::max(0, std::min(k, (int) logits_id.size()));
+
+    for (int i = 0; i < k; ++i) {
+        if (lang_ids) {
+            lang_ids[i] = logits_id[i].second;
+        }
+        if (lang_probs) {
+            lang_probs[i] = logits_id[i].first;
+        }
+    }
+
+    return k;
+}
+
+int whisper_lang_detect_batch(
+    struct whisper_encoder_batch * batch,
+          struct whisper_state ** states,
+                     const int * offsets,
+                           int   n_states,
+                           int   n_threads,
+                           int * lang_ids,
+                         float * lang_probs) {
+    if (n_states <= 0) {
+        return 0;
+    }
+
+    whisper_context & ctx = *batch->ctx;
+
+    const auto & hparams = ctx.model.hparams;
+
+    // encode the windows that are not in the cross-attention caches yet
+    {
+        std::vector<whisper_state *> enc_states;
+        std::vector<int>             enc_offsets;
+
+        for (int i = 0; i < n_states; ++i) {
+            const int seek  = offsets ? offsets[i] : 0;
+            const int n_ctx = states[i]->exp_n_audio_ctx > 0 ? states[i]->exp_n_audio_ctx : hparams.n_audio_ctx;
+
+            if (seek < 0 || seek >= states[i]->mel.n_len_org) {
+                WHISPER_LOG_ERROR("%s: offset %d of state %d is outside of the audio (%d)\n", __func__, seek, i, states[i]->mel.n_len_org);
+                return -1;
+            }
+
+            if (states[i]->enc_mel_offset != seek || states[i]->enc_n_ctx != n_ctx) {
+                enc_states.push_back(states[i]);
+                enc_offsets.push_back(seek);
+            }
+        }
+
+        if (!enc_states.empty() && whisper_encode_batch(batch, enc_states.data(), enc_offsets.data(), enc_states.size(), n_threads) != 0) {
+            WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
+            return -6;
+        }
+    }
+
+    // a decoder call scores the SOT token of every state against its own cross-attention cache
+    // the first state hosts the calls - its self-attention cache, batch and compute buffer are used
+    whisper_state & host = *states[0];
+
+    const int n_lang   = ctx.vocab.num_languages();
+    const int n_max_id = whisper_lang_max_id();
+
+    // every state adds its cross-attention to the graph
+    const int n_max = std::max(1, std::min((WHISPER_MAX_NODES - 64*hparams.n_text_layer)/(12*hparams.n_text_layer), hparams.n_text_ctx));
+
+    std::vector<whisper_cross_span> spans;
+
+    for (int i0 = 0; i0 < n_states; i0 += n_max) {
+        const int n = std::min(n_max, n_states - i0);
+
+        whisper_kv_cache_clear(host.kv_self);
+
+        auto & hbatch = host.batch;
+
+        hbatch.n_tokens = n;
+
+        spans.clear();
+
+        for (int i = 0; i < n; ++i) {
+            hbatch.token   [i]    = whisper_token_sot(&ctx);
+            hbatch.pos     [i]    = 0;
+            hbatch.n_seq_id[i]    = 1;
+            hbatch.seq_id  [i][0] = i;
+            hbatch.logits  [i]    = 1;
+
+            spans.push_back({ &states[i0 + i]->kv_cross, states[i0 + i]->enc_n_ctx, i, 1 });
+        }
+
+        host.logits_lang = true;
+
+        const bool ok = whisper_decode_internal(ctx, host, hbatch, n_threads, false, nullptr, nullptr, &spans);
+
+        host.logits_lang = false;
+
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
+            whisper_kv_cache_clear(host.kv_self);
+            return -7;
+        }
+
+        for (int i = 0; i < n; ++i) {
+            auto & logits_id = states[i0 + i]->decoders[0].logits_id;
+
+            whisper_lang_probs(ctx.vocab, host.logits.data() + i*n_lang, logits_id);
+
+            if (lang_ids) {
+                lang_ids[i0 + i] = logits_id[0].second;
+            }
+
+            if (lang_probs) {
+                for (const auto & prob : logits_id) {
+                    lang_probs[(i0 + i)*(n_max_id + 1) + prob.second] = prob.first;
+                }
+            }
+        }
+    }
+
+    whisper_kv_cache_clear(host.kv_self);
+
+    return 0;
+}
+
+int whisper_lang_auto_detect(
+        struct whisper_context * ctx,
+                           int   offset_ms,
+                           int   n_threads,
+                         float * lang_probs) {
+    return whisper_lang_auto_detect_with_state(ctx, ctx->state, offset_ms, n_threads, lang_probs);
+}
+
+int whisper_model_n_vocab(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_vocab;
+}
+
+int whisper_model_n_audio_ctx(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_audio_ctx;
+}
+
+int whisper_model_n_audio_state(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_audio_state;
+}
+
+int whisper_model_n_audio_head(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_audio_head;
+}
+
+int whisper_model_n_audio_layer(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_audio_layer;
+}
+
+int whisper_model_n_text_ctx(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_text_ctx;
+}
+
+int whisper_model_n_text_state(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_text_state;
+}
+
+int whisper_model_n_text_head(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_text_head;
+}
+
+int whisper_model_n_text_layer(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_text_layer;
+}
+
+int whisper_model_n_mels(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_mels;
+}
+
+int whisper_model_ftype(struct whisper_context * ctx) {
+    return ctx->model.hparams.ftype;
+}
+
+int whisper_model_type(struct whisper_context * ctx) {
+    return ctx->model.type;
+}
+
+const char *whisper_model_type_readable(struct whisper_context * ctx) {
+    switch (ctx->model.type) {
+    case e_model::MODEL_TINY:
+        return "tiny";
+    case e_model::MODEL_BASE:
+        return "base";
+    case e_model::MODEL_SMALL:
+        return "small";
+    case e_model::MODEL_MEDIUM:
+        return "medium";
+    case e_model::MODEL_LARGE:
+        return "large";
+    default:
+        return "unknown";
+    }
+}
+
+int whisper_n_len_from_state(struct whisper_state * state) {
+    return state->mel.n_len_org;
+}
+
+int whisper_audio_ctx_auto(struct whisper_context * ctx, const struct whisper_full_params * params, int n_frames) {
+    int n_margin = WHISPER_AUDIO_CTX_AUTO_MARGIN;
+    int n_min    = WHISPER_AUDIO_CTX_AUTO_MIN;
+    int n_bucket = WHISPER_AUDIO_CTX_AUTO_BUCKET;
+
+    if (params) {
+        n_margin = params->audio_ctx_auto_margin > 0 ? params->audio_ctx_auto_margin : n_margin;
+        n_min    = params->audio_ctx_auto_min    > 0 ? params->audio_ctx_auto_min    : n_min;
+        n_bucket = params->audio_ctx_auto_bucket > 0 ? params->audio_ctx_auto_bucket : n_bucket;
+    }
+
+    // the audio positions are padded with flash attention on GPUs, see whisper_audio_ctx_get_padding()
+    n_bucket = GGML_PAD(n_bucket, ctx->audio_ctx_pad);
+
+    const int n_ctx = std::max(n_min, (std::max(0, n_frames) + 1)/2 + n_margin);
+
+    return std::min(GGML_PAD(n_ctx, n_bucket), ctx->model.hparams.n_audio_ctx);
+}
+
+int whisper_n_len(struct whisper_context * ctx) {
+    return ctx->state->mel.n_len_org;
+}
+
+int whisper_n_vocab(struct whisper_context * ctx) {
+    return ctx->vocab.n_vocab;
+}
+
+int whisper_n_text_ctx(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_text_ctx;
+}
+
+int whisper_n_audio_ctx(struct whisper_context * ctx) {
+    return ctx->model.hparams.n_audio_ctx;
+}
+
+int whisper_is_multilingual(struct whisper_context * ctx) {
+    return ctx->vocab.is_multilingual() ? 1 : 0;
+}
+
+float * whisper_get_logits(struct whisper_context * ctx) {
+    return ctx->state->logits.data();
+}
+
+float * whisper_get_logits_from_state(struct whisper_state * state) {
+    return state->logits.data();
+}
+
+const char * whisper_token_to_str(struct whisper_context * ctx, whisper_token token) {
+    if (token < 0 || token >= ctx->vocab.n_tokens()) {
+        WHISPER_LOG_ERROR("%s: invalid token id %d\n", __func__, token);
+        return "";
+    }
+
+    return ctx->vocab.token_text(token);
+}
+
+whisper_token whisper_token_eot(struct whisper_context * ctx) {
+    return ctx->vocab.token_eot;
+}
+
+whisper_token whisper_token_sot(struct whisper_context * ctx) {
+    return ctx->vocab.token_sot;
+}
+
+whisper_token whisper_token_solm(struct whisper_context * ctx) {
+    return ctx->vocab.token_solm;
+}
+
+whisper_token whisper_token_prev(struct whisper_context * ctx) {
+    return ctx->vocab.token_prev;
+}
+
+whisper_token whisper_token_nosp(struct whisper_context * ctx) {
+    return ctx->vocab.token_nosp;
+}
+
+whisper_token whisper_token_not(struct whisper_context * ctx) {
+    return ctx->vocab.token_not;
+}
+
+whisper_token whisper_token_beg(struct whisper_context * ctx) {
+    return ctx->vocab.token_beg;
+}
+
+whisper_token whisper_token_lang(struct whisper_context * ctx, int lang_id) {
+    return whisper_token_sot(ctx) + 1 + lang_id;
+}
+
+whisper_token whisper_token_translate(struct whisper_context * ctx) {
+    return ctx->vocab.token_translate;
+}
+
+whisper_token whisper_token_transcribe(struct whisper_context * ctx) {
+    return ctx->vocab.token_transcribe;
+}
+
+struct whisper_timings * whisper_get_timings(struct whisper_context * ctx) {
+    if (ctx->state == nullptr) {
+        return nullptr;
+    }
+    whisper_timings * timings = new whisper_timings;
+    timings->sample_ms = 1e-3f * ctx->state->t_sample_us / std::max(1, ctx->state->n_sample);
+    timings->encode_ms = 1e-3f * ctx->state->t_encode_us / std::max(1, ctx->state->n_encode);
+    timings->decode_ms = 1e-3f * ctx->state->t_decode_us / std::max(1, ctx->state->n_decode);
+    timings->batchd_ms = 1e-3f * ctx->state->t_batchd_us / std::max(1, ctx->state->n_batchd);
+    timings->prompt_ms = 1e-3f * ctx->state->t_prompt_us / std::max(1, ctx->state->n_prompt);
+    return timings;
+}
+
+void whisper_print_timings(struct whisper_context * ctx) {
+    const int64_t t_end_us = ggml_time_us();
+
+    WHISPER_LOG_INFO("\n");
+    WHISPER_LOG_INFO("%s:     load time = %8.2f ms\n", __func__, ctx->t_load_us / 1000.0f);
+    if (ctx->state != nullptr) {
+
+        const int32_t n_sample = std::max(1, ctx->state->n_sample);
+        const int32_t n_encode = std::max(1, ctx->state->n_encode);
+        const int32_t n_decode = std::max(1, ctx->state->n_decode);
+        const int32_t n_batchd = std::max(1, ctx->state->n_batchd);
+        const int32_t n_prompt = std::max(1, ctx->state->n_prompt);
+
+        WHISPER_LOG_INFO("%s:     fallbacks = %3d p / %3d h\n", __func__, ctx->state->n_fail_p, ctx->state->n_fail_h);
+        WHISPER_LOG_INFO("%s:      mel time = %8.2f ms\n", __func__, ctx->state->t_mel_us / 1000.0f);
+        WHISPER_LOG_INFO("%s:   sample time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_sample_us, n_sample, 1e-3f * ctx->state->t_sample_us / n_sample);
+        WHISPER_LOG_INFO("%s:   encode time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_encode_us, n_encode, 1e-3f * ctx->state->t_encode_us / n_encode);
+        WHISPER_LOG_INFO("%s:   decode time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_decode_us, n_decode, 1e-3f * ctx->state->t_decode_us / n_decode);
+        WHISPER_LOG_INFO("%s:   batchd time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_batchd_us, n_batchd, 1e-3f * ctx->state->t_batchd_us / n_batchd);
+        WHISPER_LOG_INFO("%s:   prompt time = %8.2f ms / %5d runs ( %8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_prompt_us, n_prompt, 1e-3f * ctx->state->t_prompt_us / n_prompt);
+
+        const auto & sched_decode = ctx->state->sched_decode;
+
+        WHISPER_LOG_INFO("%s:  decode graph = %5d reused / %5d built ( %8.2f ms per build)\n", __func__, (int) sched_decode.n_graph_reuse, (int) sched_decode.n_graph_build,
+                1e-3f * sched_decode.t_graph_build_us / std::max<int64_t>(1, sched_decode.n_graph_build));
+    }
+    if (ctx->params.enc_cache_size > 0) {
+        int64_t n_hit;
+        int64_t n_miss;
+        size_t  size;
+        whisper_enc_cache_stats(ctx, &n_hit, &n_miss, &size);
+
+        WHISPER_LOG_INFO("%s:  encode cache = %5d hits / %5d misses ( %8.2f MB)\n", __func__, (int) n_hit, (int) n_miss, size/1e6);
+    }
+    WHISPER_LOG_INFO("%s:    total time = %8.2f ms\n", __func__, (t_end_us - ctx->t_start_us)/1000.0f);
+}
+
+void whisper_reset_timings(struct whisper_context * ctx) {
+    ctx->t_start_us = ggml_time_us();
+    if (ctx->state != nullptr) {
+        ctx->state->t_mel_us = 0;
+        ctx->state->t_sample_us = 0;
+        ctx->state->t_encode_us = 0;
+        ctx->state->t_decode_us = 0;
+        ctx->state->t_batchd_us = 0;
+        ctx->state->t_prompt_us = 0;
+        ctx->state->n_sample = 0;
+        ctx->state->n_encode = 0;
+        ctx->state->n_decode = 0;
+        ctx->state->n_batchd = 0;
+        ctx->state->n_prompt = 0;
+        ctx->state->sched_decode.n_graph_reuse    = 0;
+        ctx->state->sched_decode.n_graph_build    = 0;
+        ctx->state->sched_decode.t_graph_build_us = 0;
+    }
+}
+
+void whisper_enc_cache_stats(struct whisper_context * ctx, int64_t * n_hit, int64_t * n_miss, size_t * size) {
+    auto & cache = ctx->enc_cache;
+
+    std::lock_guard<std::mutex> lock(cache.mutex);
+
+    if (n_hit) {
+        *n_hit = cache.n_hit;
+    }
+    if (n_miss) {
+        *n_miss = cache.n_miss;
+    }
+    if (size) {
+        *size = cache.size;
+    }
+}
+
+static int whisper_has_coreml(void) {
+#ifdef WHISPER_USE_COREML
+    return 1;
+#else
+    return 0;
+#endif
+}
+
+static int whisper_has_openvino(void) {
+#ifdef WHISPER_USE_OPENVINO
+    return 1;
+#else
+    return 0;
+#endif
+}
+
+const char * whisper_print_system_info(void) {
+    static std::string s;
+
+    s  = "";
+    s += "WHISPER : ";
+    s += "COREML = "    + std::to_string(whisper_has_coreml())     + " | ";
+    s += "OPENVINO = "  + std::to_string(whisper_has_openvino())   + " | ";
+
+    for (size_t i = 0; i < ggml_backend_reg_count(); i++) {
+        auto * reg = ggml_backend_reg_get(i);
+        auto * get_features_fn = (ggml_backend_get_features_t) ggml_backend_reg_get_proc_address(reg, "ggml_backend_get_features");
+        if (get_features_fn) {
+            ggml_backend_feature * features = get_features_fn(reg);
+            s += ggml_backend_reg_name(reg);
+            s += " : ";
+            for (; features->name; features++) {
+                s += features->name;
+                s += " = ";
+                s += features->value;
+                s += " | ";
+            }
+        }
+    }
+    return s.c_str();
+}
+
+//////////////////////////////////
+// Voice Activity Detection (VAD)
+//////////////////////////////////
+
+struct whisper_vad_hparams {
+    int32_t   n_encoder_layers;
+    int32_t * encoder_in_channels;
+    int32_t * encoder_out_channels;
+    int32_t * kernel_sizes;
+    int32_t   lstm_input_size;
+    int32_t   lstm_hidden_size;
+    int32_t   final_conv_in;
+    int32_t   final_conv_out;
+};
+
+struct whisper_vad_model {
+    std::string type;
+    std::string version;
+    whisper_vad_hparams hparams;
+
+    struct ggml_tensor * stft_forward_basis; // [256, 1, 258]
+
+    // Encoder tensors - 4 convolutional layers
+    struct ggml_tensor * encoder_0_weight;  // [3, 129, 128]
+    struct ggml_tensor * encoder_0_bias;    // [128]
+
+    // Second encoder layer
+    struct ggml_tensor * encoder_1_weight;  // [3, 128, 64]
+    struct ggml_tensor * encoder_1_bias;    // [64]
+
+    // Third encoder layer
+    struct ggml_tensor * encoder_2_weight;  // [3, 64, 64]
+    struct ggml_tensor * encoder_2_bias;    // [64]
+
+    // Fourth encoder layer
+    struct ggml_tensor * encoder_3_weight;  // [3, 64, 128]
+    struct ggml_tensor * encoder_3_bias;    // [128]
+
+    // LSTM decoder tensors
+    struct ggml_tensor * lstm_ih_weight;    // [128, 512] input-to-hidden
+    struct ggml_tensor * lstm_ih_bias;      // [512]
+    struct ggml_tensor * lstm_hh_weight;    // [128, 512] hidden-to-hidden
+    struct ggml_tensor * lstm_hh_bias;      // [512]
+
+    // Final conv layer
+    struct ggml_tensor * final_conv_weight; // [128]
+    struct ggml_tensor * final_conv_bias;   // [1]
+
+    // ggml contexts
+    std::vector<ggml_context *> ctxs;
+
+    // buffer for the model tensors
+    std::vector<ggml_backend_buffer_t> buffers;
+
+    // tensors
+    int n_loaded;
+    std::map<std::string, struct ggml_tensor *> tensors;
+};
+
+struct whisper_vad_segment {
+    int64_t start;
+    int64_t end;
+};
+
+struct whisper_vad_segments {
+    std::vector<whisper_vad_segment> data;
+};
+
+struct whisper_vad_context {
+    int64_t t_vad_us = 0;
+
+    int     n_window;
+    int     n_context;
+    int     n_threads;
+
+    std::vector<ggml_backend_t> backends;
+    ggml_backend_buffer_t       buffer = nullptr;
+    whisper_context_params      params;
+    std::vector<uint8_t>        ctx_buf;
+    whisper_sched               sched;
+
+    whisper_vad_model    model;
+    std::string          path_model;
+    struct ggml_tensor * h_state;
+    struct ggml_tensor * c_state;
+    std::vector<float>   probs;
+};
+
+struct whisper_vad_context_params whisper_vad_default_context_params(void) {
+    whisper_vad_context_params result = {
+        /*.n_thread                = */ 4,
+        /*.use_gpu                 = */ false,
+        /*.gpu_device              = */ 0,
+    };
+    return result;
+}
+
+struct whisper_vad_params whisper_vad_default_params(void) {
+    whisper_vad_params result = {
+        /* threshold               = */ 0.5f,
+        /* min_speech_duration_ms  = */ 250,
+        /* min_silence_duration_ms = */ 100,
+        /* max_speech_duration_s   = */ FLT_MAX,
+        /* speech_pad_ms           = */ 30,
+        /* samples_overlap         = */ 0.1,
+    };
+    return result;
+}
+
+// Time conversion utility functions for whisper VAD
+static int cs_to_samples(int64_t cs) {
+    return (int)((cs / 100.0) * WHISPER_SAMPLE_RATE + 0.5);
+}
+
+static int64_t samples_to_cs(int samples) {
+    return (int64_t)((samples / (double)WHISPER_SAMPLE_RATE) * 100.0 + 0.5);
+}
+
+static bool weight_buft_supported(const whisper_vad_hparams & hparams, ggml_tensor * w, ggml_op op, ggml_backend_buffer_type_t buft, ggml_backend_dev_t dev) {
+    bool op_supported = true;
+
+    if (ggml_backend_dev_type(dev) == GGML_BACKEND_DEVICE_TYPE_GPU ||
+        ggml_backend_dev_type(dev) == GGML_BACKEND_DEVICE_TYPE_IGPU ||
+        (ggml_backend_dev_type(dev) == GGML_BACKEND_DEVICE_TYPE_CPU && buft == ggml_backend_cpu_buffer_type())) {
+        // GPU and default CPU backend support all operators
+        op_supported = true;
+    } else {
+        switch (op) {
+            // The current extra_buffer_type implementations only support GGML_OP_MUL_MAT
+            case GGML_OP_MUL_MAT: {
+                ggml_init_params params = {
+                    /*.mem_size   =*/ 2 * ggml_tensor_overhead(),
+                    /*.mem_buffer =*/ nullptr,
+                    /*.no_alloc   =*/ true,
+                };
+
+                ggml_context_ptr ctx_ptr { ggml_init(params) };
+                if (!ctx_ptr) {
+                    throw std::runtime_error("failed to create ggml context");
+                }
+                ggml_context * ctx = ctx_ptr.get();
+
+                ggml_tensor * op_tensor = nullptr;
+
+                int64_t n_ctx = hparams.lstm_hidden_size;
+                ggml_tensor * b = ggml_new_tensor_4d(ctx, GGML_TYPE_F32, w->ne[0], n_ctx, w->ne[2], w->ne[3]);
+                op_tensor = ggml_mul_mat(ctx, w, b);
+
+                // create a temporary dummy buffer for the weight so that supports_op can check the buffer type
+                GGML_ASSERT(w->buffer == nullptr);
+                w->buffer = ggml_backend_buft_alloc_buffer(buft, 0);
+                op_supported = ggml_backend_dev_supports_op(dev, op_tensor);
+                ggml_backend_buffer_free(w->buffer);
+                w->buffer = nullptr;
+                break;
+            }
+            default: {
+                op_supported = false;
+                break;
+            }
+        };
+    }
+    return op_supported;
+}
+
+static ggml_backend_buffer_type_t select_weight_buft(const whisper_vad_hparams & hparams, ggml_tensor * w, ggml_op op, buft_list_t buft_list) {
+    GGML_ASSERT(!buft_list.empty());
+    for (const auto & p : buft_list) {
+        ggml_backend_dev_t dev = p.first;
+        ggml_backend_buffer_type_t buft = p.second;
+        if (weight_buft_supported(hparams, w, op, buft, dev)) {
+            return buft;
+        }
+    }
+
+    return nullptr;
+}
+
+static ggml_tensor * whisper_vad_build_stft_layer(ggml_context * ctx0,
+        const whisper_vad_model & model, ggml_tensor * cur) {
+    // Apply reflective padding to the input tensor
+    ggml_tensor * padded = ggml_pad_reflect_1d(ctx0, cur, 64, 64);
+
+    struct ggml_tensor * stft = ggml_conv_1d(ctx0, model.stft_forward_basis, padded, model.hparams.lstm_input_size, 0, 1);
+
+    // Calculate cutoff for real/imaginary parts
+    int cutoff = model.stft_forward_basis->ne[2] / 2;
+
+    // Extract real part (first half of the STFT output).
+    struct ggml_tensor * real_part = ggml_view_2d(ctx0, stft, 4, cutoff, stft->nb[1], 0);
+    // Extract imaginary part (second half of the STFT output).
+    struct ggml_tensor * img_part = ggml_view_2d(ctx0, stft, 4, cutoff, stft->nb[1], cutoff * stft->nb[1]);
+
+    // Calculate magnitude: sqrt(real^2 + imag^2)
+    struct ggml_tensor * real_squared = ggml_mul(ctx0, real_part, real_part);
+    struct ggml_tensor * img_squared  = ggml_mul(ctx0, img_part, img_part);
+    struct ggml_tensor * sum_squares  = ggml_add(ctx0, real_squared, img_squared);
+    struct ggml_tensor * magnitude    = ggml_sqrt(ctx0, sum_squares);
+    return magnitude;
+}
+
+static ggml_tensor * whisper_vad_build_encoder_layer(ggml_context * ctx0,
+        const whisper_vad_model & model, ggml_tensor * cur) {
+    // First Conv1D: expands to 128 channels.
+    cur = ggml_conv_1d(ctx0, model.encoder_0_weight, cur, 1, 1, 1);
+    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_0_bias, 1, 128, 1));
+    cur = ggml_relu(ctx0, cur);
+
+    // Second Conv1D: reduces to 64 channels.
+    cur = ggml_conv_1d(ctx0, model.encoder_1_weight, cur, 2, 1, 1);
+    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_1_bias, 1, 64, 1));
+    cur = ggml_relu(ctx0, cur);
+
+    // Third Conv1D: maintains 64 channels
+    cur = ggml_conv_1d(ctx0, model.encoder_2_weight, cur, 2, 1, 1);
+    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_2_bias, 1, 64, 1));
+    cur = ggml_relu(ctx0, cur);
+
+    // Fourth Conv1D: expands to 128 channels
+    cur = ggml_conv_1d(ctx0, model.encoder_3_weight, cur, 1, 1, 1);
+    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_3_bias, 1, 128, 1));
+    cur = ggml_relu(ctx0, cur);
+
+    return cur;
+}
+
+static ggml_tensor * whisper_vad_build_lstm_layer(ggml_context * ctx0,
+        const whisper_vad_context & vctx, ggml_tensor * cur, ggml_cgraph * gf) {
+    const whisper_vad_model & model = vctx.model;
+    const int hdim = model.hparams.lstm_hidden_size;
+
+    struct ggml_tensor * x_t = ggml_transpose(ctx0, cur);
+
+    // Create operations using the input-to-hidden weights.
+    struct ggml_tensor * inp_gate = ggml_mul_mat(ctx0, model.lstm_ih_weight, x_t);
+    inp_gate = ggml_add(ctx0, inp_gate, model.lstm_ih_bias);
+
+    // Create operations using the hidden-to-hidden weights.
+    struct ggml_tensor * hid_gate = ggml_mul_mat(ctx0, model.lstm_hh_weight, vctx.h_state);
+    hid_gate = ggml_add(ctx0, hid_gate, model.lstm_hh_bias);
+
+    // Create add operation to get preactivations for all gates.
+    struct ggml_tensor * out_gate = ggml_add(ctx0, inp_gate, hid_gate);
+
+    const size_t hdim_size = ggml_row_size(out_gate->type, hdim);
+
+    // Create sigmoid for input gate (using the first 128 bytes from the preactivations).
+    struct ggml_tensor * i_t = ggml_sigmoid(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 0 * hdim_size));
+
+    // Create sigmoid for the forget gate (using the second 128 bytes from the preactivations).
+    struct ggml_tensor * f_t = ggml_sigmoid(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 1 * hdim_size));
+
+    // Create sigmoid for the cell gate (using the third 128 bytes from the preactivations).
+    struct ggml_tensor * g_t = ggml_tanh(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 2 * hdim_size));
+
+    // Create sigmoid for the output gate (using the fourth 128 bytes from the preactivations).
+    struct ggml_tensor * o_t = ggml_sigmoid(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 3 * hdim_size));
+
+    // Update cell state
+    struct ggml_tensor * c_out = ggml_add(ctx0,
+        ggml_mul(ctx0, f_t, vctx.c_state),
+        ggml_mul(ctx0, i_t, g_t));
+    ggml_build_forward_expand(gf, ggml_cpy(ctx0, c_out, vctx.c_state));
+
+    // Update hidden state
+    struct ggml_tensor * out = ggml_mul(ctx0, o_t, ggml_tanh(ctx0, c_out));
+    ggml_build_forward_expand(gf, ggml_cpy(ctx0, out,   vctx.h_state));
+
+    return out;
+}
+
+static struct ggml_cgraph * whisper_vad_build_graph(whisper_vad_context & vctx) {
+    const auto & model = vctx.model;
+
+    struct ggml_init_params params = {
+        /*.mem_size   =*/ vctx.sched.meta.size(),
+        /*.mem_buffer =*/ vctx.sched.meta.data(),
+        /*.no_alloc   =*/ true,
+    };
+
+    struct ggml_context * ctx0 = ggml_init(params);
+
+    ggml_cgraph * gf = ggml_new_graph(ctx0);
+
+    struct ggml_tensor * frame = ggml_new_tensor_2d(ctx0, GGML_TYPE_F32, vctx.n_window, 1);
+    ggml_set_name(frame, "frame");
+    ggml_set_input(frame);
+
+    struct ggml_tensor * cur = nullptr;
+    {
+        cur = whisper_vad_build_stft_layer(ctx0, model, frame);
+
+        cur = whisper_vad_build_encoder_layer(ctx0, model, cur);
+
+        // Extract the first element of the first dimension
+        // (equivalent to pytorch's [:, :, 0])
+        cur = ggml_view_2d(ctx0, cur, 1, 128, cur->nb[1], 0);
+
+        cur = whisper_vad_build_lstm_layer(ctx0, vctx, cur, gf);
+        cur = ggml_relu(ctx0, cur);
+        cur = ggml_conv_1d(ctx0, model.final_conv_weight, cur, 1, 0, 1);
+        cur = ggml_add(ctx0, cur, model.final_conv_bias);
+        cur = ggml_sigmoid(ctx0, cur);
+        ggml_set_name(cur, "prob");
+        ggml_set_output(cur);
+    }
+
+    ggml_build_forward_expand(gf, cur);
+
+    ggml_free(ctx0);
+
+    return gf;
+}
+
+static bool whisper_vad_init_context(whisper_vad_context * vctx) {
+
+    auto whisper_context_params = whisper_context_default_params();
+    // TODO: GPU VAD is forced disabled until the performance is improved
+    //whisper_context_params.use_gpu    = vctx->params.use_gpu;
+    whisper_context_params.use_gpu    = false;
+    whisper_context_params.gpu_device = vctx->params.gpu_device;
+
+    vctx->backends = whisper_backend_init(whisper_context_params);
+    if (vctx->backends.empty()) {
+        WHISPER_LOG_ERROR("%s: whisper_backend_init() failed\n", __func__);
+        return false;
+    }
+
+    const int32_t lstm_hidden_size = vctx->model.hparams.lstm_hidden_size;
+
+    vctx->ctx_buf.resize(2u*ggml_tensor_overhead());
+
+    struct ggml_init_params params = {
+        /*.mem_size   =*/ vctx->ctx_buf.size(),
+        /*.mem_buffer =*/ vctx->ctx_buf.data(),
+        /*.no_alloc   =*/ true,
+    };
+
+    ggml_context * ctx = ggml_init(params);
+    if (!ctx) {
+        WHISPER_LOG_ERROR("%s: failed to init LSTM state ggml context\n", __func__);
+        return false;
+    }
+
+    // LSTM Hidden state
+    vctx->h_state = ggml_new_tensor_1d(ctx, GGML_TYPE_F32, lstm_hidden_size);
+    ggml_set_name(vctx->h_state, "h_state");
+
+    // LSTM Cell state
+    vctx->c_state = ggml_new_tensor_1d(ctx, GGML_TYPE_F32, lstm_hidden_size);
+    ggml_set_name(vctx->c_state, "c_state");
+
+    vctx->buffer = ggml_backend_alloc_ctx_tensors(ctx, vctx->backends[0]);
+    ggml_free(ctx);
+    if (!vctx->buffer) {
+        WHISPER_LOG_ERROR("%s: failed to allocate memory for the VAD state\n", __func__);
+        return false;
+    }
+
+    {
+        bool ok = whisper_sched_graph_init(vctx->sched, vctx->backends,
+                [&]() {
+                    return whisper_vad_build_graph(*vctx);
+                });
+
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to init VAD allocator\n", __func__);
+            return false;
+        }
+
+        WHISPER_LOG_INFO("%s: compute buffer (VAD)   = %7.2f MB\n", __func__, whisper_sched_size(vctx->sched) / 1e6);
+    }
+
+    return true;
+}
+
+struct whisper_vad_context * whisper_vad_init_from_file_with_params(
+        const char * path_model,
+        struct whisper_vad_context_params params) {
+    WHISPER_LOG_INFO("%s: loading VAD model from '%s'\n", __func__, path_model);
+#ifdef _MSC_VER
+    std::wstring_convert<std::codecvt_utf8<wchar_t>> converter;
+    std::wstring path_model_wide = converter.from_bytes(path_model);
+    auto fin = std::ifstream(path_model_wide, std::ios::binary);
+#else
+    auto fin = std::ifstream(path_model, std::ios::binary);
+#endif
+    if (!fin) {
+        WHISPER_LOG_ERROR("%s: failed to open VAD model '%s'\n", __func__, path_model);
+        return nullptr;
+    }
+
+    whisper_model_loader loader = {};
+    loader.context = &fin;
+
+    loader.read = [](void * ctx, void * output, size_t read_size) {
+        std::ifstream * fin = (std::ifstream*)ctx;
+        fin->read((char *)output, read_size);
+        return read_size;
+    };
+
+    loader.eof = [](void * ctx) {
+        std::ifstream * fin = (std::ifstream*)ctx;
+        return fin->eof();
+    };
+
+    loader.close = [](void * ctx) {
+        std::ifstream * fin = (std::ifstream*)ctx;
+        fin->close();
+    };
+
+    auto ctx = whisper_vad_init_with_params(&loader, params);
+    if (!ctx) {
+        whisper_vad_free(ctx);
+        return nullptr;
+    }
+    ctx->path_model = path_model;
+    return ctx;
+}
+
+struct whisper_vad_context * whisper_vad_init_with_params(
+            struct whisper_model_loader * loader,
+            struct whisper_vad_context_params params) {
+    // Read the VAD model
+    {
+        uint32_t magic;
+        read_safe(loader, magic);
+        if (magic != GGML_FILE_MAGIC) {
+            WHISPER_LOG_ERROR("%s: invalid model data (bad magic)\n", __func__);
+            return nullptr;
+        }
+    }
+
+    whisper_vad_context * vctx = new whisper_vad_context;
+    vctx->n_threads = params.n_threads;
+    vctx->params.use_gpu = params.use_gpu;
+    vctx->params.gpu_device = params.gpu_device;
+
+    auto & model = vctx->model;
+    auto & hparams = model.hparams;
+
+    // load model context params.
+    {
+        int32_t str_len;
+        read_safe(loader, str_len);
+        std::vector<char> buffer(str_len + 1, 0);
+        loader->read(loader->context, buffer.data(), str_len);
+        std::string model_type(buffer.data(), str_len);
+        model.type = model_type;
+        WHISPER_LOG_INFO("%s: model type: %s\n", __func__, model.type.c_str());
+
+        int32_t major, minor, patch;
+        read_safe(loader, major);
+        read_safe(loader, minor);
+        read_safe(loader, patch);
+        std::string version_str = std::to_string(major) + "." +
+                                  std::to_string(minor) + "." +
+                                  std::to_string(patch);
+        model.version = version_str;
+        WHISPER_LOG_INFO("%s: model version: %s\n", __func__, model.version.c_str());
+
+        read_safe(loader, vctx->n_window);
+        read_safe(loader, vctx->n_context);
+    }
+
+    // load model hyper params (hparams).
+    {
+        read_safe(loader, hparams.n_encoder_layers);
+
+        hparams.encoder_in_channels = new int32_t[hparams.n_encoder_layers];
+        hparams.encoder_out_channels = new int32_t[hparams.n_encoder_layers];
+        hparams.kernel_sizes = new int32_t[hparams.n_encoder_layers];
+
+        for (int32_t i = 0; i < hparams.n_encoder_layers; i++) {
+            read_safe(loader, hparams.encoder_in_channels[i]);
+            read_safe(loader, hparams.encoder_out_channels[i]);
+            read_safe(loader, hparams.kernel_sizes[i]);
+        }
+
+        read_safe(loader, hparams.lstm_input_size);
+        read_safe(loader, hparams.lstm_hidden_size);
+        read_safe(loader, hparams.final_conv_in);
+        read_safe(loader, hparams.final_conv_out);
+
+        WHISPER_LOG_INFO("%s: n_encoder_layers = %d\n", __func__, hparams.n_encoder_layers);
+        for (int32_t i = 0; i < hparams.n_encoder_layers; i++) {
+            WHISPER_LOG_INFO("%s: encoder_in_channels[%d] = %d\n", __func__, i, hparams.encoder_in_channels[i]);
+        }
+        for (int32_t i = 0; i < hparams.n_encoder_layers; i++) {
+            WHISPER_LOG_INFO("%s: encoder_out_channels[%d] = %d\n", __func__, i, hparams.encoder_out_channels[i]);
+        }
+        WHISPER_LOG_INFO("%s: lstm_input_size = %d\n", __func__, hparams.lstm_input_size);
+        WHISPER_LOG_INFO("%s: lstm_hidden_size = %d\n", __func__, hparams.lstm_hidden_size);
+        WHISPER_LOG_INFO("%s: final_conv_in = %d\n", __func__, hparams.final_conv_in);
+        WHISPER_LOG_INFO("%s: final_conv_out = %d\n", __func__, hparams.final_conv_out);
+    }
+
+    // 1 STFT tensor, 4*2 encoder tensors, 4 LSTM tensors, 2 final output tensors
+    const size_t n_tensors = hparams.n_encoder_layers * 2 + 4 + 2 + 1;
+
+    std::map<ggml_backend_buffer_type_t, ggml_context *> ctx_map;
+    auto get_ctx = [&](ggml_backend_buffer_type_t buft) -> ggml_context * {
+        auto it = ctx_map.find(buft);
+        if (it == ctx_map.end()) {
+            ggml_init_params params = {
+                /*.mem_size   =*/ n_tensors * ggml_tensor_overhead(),
+                /*.mem_buffer =*/ nullptr,
+                /*.no_alloc   =*/ true,
+            };
+
+            ggml_context * ctx = ggml_init(params);
+            if (!ctx) {
+                throw std::runtime_error("failed to create ggml context");
+            }
+
+            ctx_map[buft] = ctx;
+            model.ctxs.emplace_back(ctx);
+
+            return ctx;
+        }
+
+        return it->second;
+    };
+
+    whisper_context_params wparams = whisper_context_default_params();
+    wparams.use_gpu = params.use_gpu;
+    wparams.gpu_device = params.gpu_device;
+    buft_list_t buft_list = make_buft_list(wparams);
+
+    auto create_tensor = [&](vad_tensor type, ggml_tensor * meta) -> ggml_tensor * {
+        ggml_op op = VAD_TENSOR_OPS.at(type);
+        ggml_backend_buffer_type_t buft = select_weight_buft(hparams, meta, op, buft_list);
+        if (!buft) {
+            throw std::runtime_error(format("failed to find a compatible buffer type for tensor %s", VAD_TENSOR_NAMES.at(type)));
+        }
+        ggml_context * ctx = get_ctx(buft);
+        ggml_tensor * tensor = ggml_dup_tensor(ctx, meta);
+        model.tensors[VAD_TENSOR_NAMES.at(type)] = tensor;
+
+        return tensor;
+    };
+
+    // create tensors
+    {
+        ggml_init_params params = {
+            /*.mem_size   =*/ n_tensors * ggml_tensor_overhead(),
+            /*.mem_buffer =*/ nullptr,
+            /*.no_alloc   =*/ true,
+        };
+
+        ggml_context * ctx = ggml_init(params);
+        const auto & hparams = model.hparams;
+
+        // SFTF precomputed basis matrix
+        model.stft_forward_basis = create_tensor(VAD_TENSOR_STFT_BASIS,
+            ggml_new_tensor_3d(ctx, GGML_TYPE_F16, 256, 1, 258));
+
+        model.encoder_0_weight = create_tensor(VAD_TENSOR_ENC_0_WEIGHT,
+            ggml_new_tensor_3d(
+                ctx,
+                GGML_TYPE_F16,
+                hparams.kernel_sizes[0],
+                hparams.encoder_in_channels[0],
+                hparams.encoder_out_channels[0]
+        ));
+        model.encoder_0_bias = create_tensor(VAD_TENSOR_ENC_0_BIAS,
+            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[0]));
+
+        model.encoder_1_weight = create_tensor(VAD_TENSOR_ENC_1_WEIGHT,
+            ggml_new_tensor_3d(
+                ctx,
+                GGML_TYPE_F16,
+                hparams.kernel_sizes[1],
+                hparams.encoder_in_channels[1],
+                hparams.encoder_out_channels[1]
+        ));
+        model.encoder_1_bias = create_tensor(VAD_TENSOR_ENC_1_BIAS,
+            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[1]));
+
+        model.encoder_2_weight = create_tensor(VAD_TENSOR_ENC_2_WEIGHT,
+            ggml_new_tensor_3d(
+                ctx,
+                GGML_TYPE_F16,
+                hparams.kernel_sizes[2],
+                hparams.encoder_in_channels[2],
+                hparams.encoder_out_channels[2]
+        ));
+        model.encoder_2_bias = create_tensor(VAD_TENSOR_ENC_2_BIAS,
+            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[2]));
+
+        model.encoder_3_weight = create_tensor(VAD_TENSOR_ENC_3_WEIGHT,
+            ggml_new_tensor_3d(
+                ctx,
+                GGML_TYPE_F16,
+                hparams.kernel_sizes[3],
+                hparams.encoder_in_channels[3],
+                hparams.encoder_out_channels[3]
+        ));
+        model.encoder_3_bias = create_tensor(VAD_TENSOR_ENC_3_BIAS,
+                ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[3]));
+
+        // Hidden State dimension (input gate, forget gate, cell gate, output gate)
+        const int hstate_dim = hparams.lstm_hidden_size * 4;
+
+        // LSTM weights - input to hidden
+        model.lstm_ih_weight = create_tensor(
+            VAD_TENSOR_LSTM_WEIGHT_IH,
+            ggml_new_tensor_2d(ctx, GGML_TYPE_F32, hparams.lstm_hidden_size, hstate_dim)
+        );
+        model.lstm_ih_bias = create_tensor(
+            VAD_TENSOR_LSTM_BIAS_IH,
+            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hstate_dim)
+        );
+
+        // LSTM weights - hidden to hidden
+        model.lstm_hh_weight = create_tensor(
+            VAD_TENSOR_LSTM_WEIGHT_HH,
+            ggml_new_tensor_2d(ctx, GGML_TYPE_F32, hparams.lstm_hidden_size, hstate_dim)
+        );
+        model.lstm_hh_bias = create_tensor(
+            VAD_TENSOR_LSTM_BIAS_HH,
+            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hstate_dim)
+        );
+
+        // Final conv layer weight
+        model.final_conv_weight = create_tensor(
+            VAD_TENSOR_FINAL_CONV_WEIGHT,
+            ggml_new_tensor_2d(ctx, GGML_TYPE_F16, hparams.final_conv_in, 1)
+        );
+        model.final_conv_bias = create_tensor(
+            VAD_TENSOR_FINAL_CONV_BIAS,
+            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, 1)
+        );
+
+        ggml_free(ctx);
+    }
+
+    // allocate tensors in the backend buffers
+    for (auto & p : ctx_map) {
+        ggml_backend_buffer_type_t buft = p.first;
+        ggml_context * ctx = p.second;
+        ggml_backend_buffer_t buf = ggml_backend_alloc_ctx_tensors_from_buft(ctx, buft);
+        if (buf) {
+            model.buffers.emplace_back(buf);
+
+            size_t size_main = ggml_backend_buffer_get_size(buf);
+            WHISPER_LOG_INFO("%s: %12s total size = %8.2f MB\n", __func__, ggml_backend_buffer_name(buf), size_main / 1e6);
+        }
+    }
+
+    // load weights
+    {
+        size_t total_size = 0;
+        model.n_loaded = 0;
+        std::vector<char> read_buf;
+
+        while (true) {
+            int32_t n_dims;
+            int32_t length;
+            int32_t ttype;
+
+            read_safe(loader, n_dims);
+            read_safe(loader, length);
+            read_safe(loader, ttype);
+
+            if (loader->eof(loader->context)) {
+                break;
+            }
+
+            int32_t nelements = 1;
+            int32_t ne[4] = { 1, 1, 1, 1 };
+            for (int i = 0; i < n_dims; ++i) {
+                read_safe(loader, ne[i]);
+                nelements *= ne[i];
+            }
+
+            std::string name;
+            std::vector<char> tmp(length);
+            loader->read(loader->context, &tmp[0], tmp.size());
+            name.assign(&tmp[0], tmp.size());
+
+            if (model.tensors.find(name) == model.tensors.end()) {
+                WHISPER_LOG_ERROR("%s: unknown tensor '%s' in model file\n", __func__, name.data());
+                return nullptr;
+            }
+
+            auto tensor = model.tensors[name.data()];
+
+            if (ggml_nelements(tensor) != nelements) {
+                WHISPER_LOG_ERROR("%s: tensor '%s' has wrong size in model file\n", __func__, name.data());
+                WHISPER_LOG_ERROR("%s: shape: [%d, %d, %d], expected: [%d, %d, %d]\n",
+                        __func__, ne[0], ne[1], ne[2], (int) tensor->ne[0], (int) tensor->ne[1], (int) tensor->ne[2]);
+                return nullptr;
+            }
+
+            if (tensor->ne[0] != ne[0] || tensor->ne[1] != ne[1] || tensor->ne[2] != ne[2]) {
+                WHISPER_LOG_ERROR("%s: tensor '%s' has wrong shape in model file: got [%d, %d, %d], expected [%d, %d, %d]\n",
+                        __func__, name.data(), (int) tensor->ne[0], (int) tensor->ne[1], (int) tensor->ne[2], ne[0], ne[1], ne[2]);
+                return nullptr;
+            }
+
+            const size_t bpe = ggml_type_size(ggml_type(ttype));
+
+            if ((nelements*bpe)/ggml_blck_size(tensor->type) != ggml_nbytes(tensor)) {
+                WHISPER_LOG_ERROR("%s: tensor '%s' has wrong size in model file: got %zu, expected %zu\n",
+                        __func__, name.data(), ggml_nbytes(tensor), nelements*bpe);
+                return nullptr;
+            }
+
+            if (ggml_backend_buffer_is_host(tensor->buffer)) {
+                // for the CPU and Metal backend, we can read directly into the tensor
+                loader->read(loader->context, tensor->data, ggml_nbytes(tensor));
+                BYTESWAP_TENSOR(tensor);
+            } else {
+                // read into a temporary buffer first, then copy to device memory
+                read_buf.resize(ggml_nbytes(tensor));
+
+                loader->read(loader->context, read_buf.data(), read_buf.size());
+
+                ggml_backend_tensor_set(tensor, read_buf.data(), 0, ggml_nbytes(tensor));
+            }
+
+            total_size += ggml_nbytes(tensor);
+            model.n_loaded++;
+        }
+
+        WHISPER_LOG_INFO("%s: model size    = %7.2f MB\n", __func__, total_size/1e6);
+
+        if (model.n_loaded == 0) {
+            WHISPER_LOG_WARN("%s: WARN no tensors loaded from model file - assuming empty model for testing\n", __func__);
+        } else if (model.n_loaded != (int) model.tensors.size()) {
+            WHISPER_LOG_ERROR("%s: ERROR not all tensors loaded from model file - expected %zu, got %d\n", __func__, model.tensors.size(), model.n_loaded);
+            return nullptr;
+        }
+
+    }
+
+    if (!whisper_vad_init_context(vctx)) {
+        whisper_vad_free(vctx);
+        return nullptr;
+    }
+
+    return vctx;
+}
+
+bool whisper_vad_detect_speech(
+        struct whisper_vad_context * vctx,
+        const float * samples,
+        int n_samples) {
+    int n_chunks = n_samples / vctx->n_window;
+    if (n_samples % vctx->n_window != 0) {
+        n_chunks += 1;  // Add one more chunk for remaining samples.
+    }
+
+    WHISPER_LOG_INFO("%s: detecting speech in %d samples\n", __func__, n_samples);
+    WHISPER_LOG_INFO("%s: n_chunks: %d\n", __func__, n_chunks);
+
+    // Reset LSTM hidden/cell states
+    ggml_backend_buffer_clear(vctx->buffer, 0);
+
+    vctx->probs.resize(n_chunks);
+    WHISPER_LOG_INFO("%s: props size: %u\n", __func__, n_chunks);
+
+    std::vector<float> window(vctx->n_window, 0.0f);
+
+    auto & sched = vctx->sched.sched;
+
+    ggml_cgraph * gf = whisper_vad_build_graph(*vctx);
+
+    if (!ggml_backend_sched_alloc_graph(sched, gf)) {
+        WHISPER_LOG_ERROR("%s: failed to allocate the compute buffer\n", __func__);
+        return false;
+    }
+
+    struct ggml_tensor * frame = ggml_graph_get_tensor(gf, "frame");
+    struct ggml_tensor * prob  = ggml_graph_get_tensor(gf, "prob");
+
+    // we are going to reuse the graph multiple times for each chunk
+    const int64_t t_start_vad_us = ggml_time_us();
+
+    for (int i = 0; i < n_chunks; i++) {
+        const int idx_start = i * vctx->n_window;
+        const int idx_end = std::min(idx_start + vctx->n_window, n_samples);
+
+        const int chunk_len = idx_end - idx_start;
+
+        if (chunk_len < vctx->n_window) {
+            WHISPER_LOG_INFO("%s: chunk_len: %d < n_window: %d\n", __func__, chunk_len, vctx->n_window);
+            std::vector<float> partial_chunk(vctx->n_window, 0.0f);
+            std::copy(samples + idx_start, samples + idx_end, partial_chunk.begin());
+
+            // Copy the zero-padded chunk to the window.
+            const int samples_to_copy_max = vctx->n_window;
+            const int samples_to_copy_cur = std::min(samples_to_copy_max, (int)partial_chunk.size());
+            std::copy(partial_chunk.begin(), partial_chunk.begin() + samples_to_copy_cur, window.begin());
+            if (samples_to_copy_cur < samples_to_copy_max) {
+                std::fill(window.begin() + samples_to_copy_cur, window.end(), 0.0f);
+            }
+        } else {
+            // Copy current frame samples to the window.
+            const int samples_to_copy = std::min(idx_end - idx_start, vctx->n_window);
+            std::copy(samples + idx_start, samples + idx_start + samples_to_copy, window.begin());
+        }
+
+        // Set the frame tensor data with the samples.
+        ggml_backend_tensor_set(frame, window.data(), 0, ggml_nelements(frame) * sizeof(float));
+
+        // do not reset the scheduler - we will reuse the graph in the next chunk
+        if (!ggml_graph_compute_helper(sched, gf, vctx->n_threads, false)) {
+            WHISPER_LOG_ERROR("%s: failed to compute VAD graph\n", __func__);
+            break;
+        }
+
+        // Get the probability for this chunk.
+        ggml_backend_tensor_get(prob, &vctx->probs[i], 0, sizeof(float));
+
+        //WHISPER_LOG_DEBUG("chunk %d: p = %7.3f\n", i, probs[i]);
+    }
+
+    vctx->t_vad_us += ggml_time_us() - t_start_vad_us;
+    WHISPER_LOG_INFO("%s: vad time = %.2f ms processing %d samples\n", __func__, 1e-3f * vctx->t_vad_us, n_samples);
+
+    ggml_backend_sched_reset(sched);
+
+    return true;
+}
+
+int whisper_vad_segments_n_segments(struct whisper_vad_segments * segments) {
+    return segments->data.size();
+}
+
+float whisper_vad_segments_get_segment_t0(struct whisper_vad_segments * segments, int i_segment) {
+    return segments->data[i_segment].start;
+}
+
+float whisper_vad_segments_get_segment_t1(struct whisper_vad_segments * segments, int i_segment) {
+    return segments->data[i_segment].end;
+}
+
+int whisper_vad_n_probs(struct whisper_vad_context * vctx) {
+    return vctx->probs.size();
+}
+
+float * whisper_vad_probs(struct whisper_vad_context * vctx) {
+    return vctx->probs.data();
+}
+
+struct whisper_vad_segments * whisper_vad_segments_from_probs(
+        struct whisper_vad_context *  vctx,
+                whisper_vad_params    params) {
+    WHISPER_LOG_INFO("%s: detecting speech timestamps using %d probabilities\n", __func__, whisper_vad_n_probs(vctx));
+
+    int     n_probs                 = whisper_vad_n_probs(vctx);
+    float * probs                   = whisper_vad_probs(vctx);
+    float   threshold               = params.threshold;
+    int     min_speech_duration_ms  = params.min_speech_duration_ms;
+    int     min_silence_duration_ms = params.min_silence_duration_ms;
+    float   max_speech_duration_s   = params.max_speech_duration_s;
+    int     speech_pad_ms           = params.speech_pad_ms;
+    int     n_window                = vctx->n_window;
+    int     sample_rate             = WHISPER_SAMPLE_RATE;
+    int     min_silence_samples     = sample_rate * min_silence_duration_ms / 1000;
+    int     audio_length_samples    = n_probs * n_window;
+
+    // Min number of samples to be considered valid speech.
+    int     min_speech_samples      = sample_rate * min_speech_duration_ms / 1000;
+    int     speech_pad_samples      = sample_rate * speech_pad_ms / 1000;
+
+    // Max number of samples that a speech segment can contain before it is
+    // split into multiple segments.
+    int max_speech_samples;
+    if (max_speech_duration_s > 100000.0f) {
+        max_speech_samples = INT_MAX / 2;
+    } else {
+        int64_t temp = (int64_t)sample_rate * (int64_t)(max_speech_duration_s) - n_window - 2 * speech_pad_samples;
+        max_speech_samples = (temp > INT_MAX) ? INT_MAX / 2 : (int)temp;
+        if (max_speech_samples < 0) {
+            max_speech_samples = INT_MAX / 2;
+        }
+    }
+    // Detect silence period that exceeds this value, then that location (sample)
+    // is marked as a potential place where the segment could be split if
+    // max_speech_samples is reached. The value 98 was taken from the original
+    // silaro-vad python implementation:
+    //https://github.com/snakers4/silero-vad/blob/0dd45f0bcd7271463c234f3bae5ad25181f9df8b/src/silero_vad/utils_vad.py#L291
+    int min_silence_samples_at_max_speech = sample_rate * 98 / 1000;
+
+    // Calculate lower threshold for detecting end of speech segments.
+    float neg_threshold = threshold - 0.15f;
+    if (neg_threshold < 0.01f) {
+        neg_threshold = 0.01f;
+    }
+
+    struct speech_segment_t {
+        int start;
+        int end;
+    };
+
+    std::vector<speech_segment_t> speeches;
+    speeches.reserve(256);
+
+    bool is_speech_segment = false;
+    int  temp_end          = 0;
+    int  prev_end          = 0;
+    int  next_start        = 0;
+    int  curr_speech_start = 0;
+    bool has_curr_speech   = false;
+
+    for (int i = 0; i < n_probs; i++) {
+        float curr_prob   = probs[i];
+        int   curr_sample = n_window * i;
+
+        // Reset temp_end when we get back to speech
+        if ((curr_prob >= threshold) && temp_end) {
+            temp_end = 0;
+            if (next_start < prev_end) {
+                next_start = curr_sample;
             }
-            default: {
-                op_supported = false;
-                break;
+        }
+
+        // Start a new speech segment when probability exceeds threshold and not already in speech
+        if ((curr_prob >= threshold) && !is_speech_segment) {
+            is_speech_segment = true;
+            curr_speech_start = curr_sample;
+            has_curr_speech = true;
+            continue;
+        }
+
+        // Handle maximum speech duration
+        if (is_speech_segment && (curr_sample - curr_speech_start) > max_speech_samples) {
+            if (prev_end) {
+                speeches.push_back({ curr_speech_start, prev_end });
+                has_curr_speech = true;
+
+                if (next_start < prev_end) {  // Previously reached silence and is still not speech
+                    is_speech_segment = false;
+                    has_curr_speech = false;
+                } else {
+                    curr_speech_start = next_start;
+                }
+                prev_end = next_start = temp_end = 0;
+            } else {
+                speeches.push_back({ curr_speech_start, curr_sample });
+
+                prev_end = next_start = temp_end = 0;
+                is_speech_segment = false;
+                has_curr_speech = false;
+                continue;
             }
-        };
+        }
+
+        // Handle silence after speech
+        if ((curr_prob < neg_threshold) && is_speech_segment) {
+            if (!temp_end) {
+                temp_end = curr_sample;
+            }
+
+            // Track potential segment ends for max_speech handling
+            if ((curr_sample - temp_end) > min_silence_samples_at_max_speech) {
+                prev_end = temp_end;
+            }
+
+            // Check if silence is long enough to end the segment
+            if ((curr_sample - temp_end) < min_silence_samples) {
+                continue;
+            } else {
+                // End the segment if it's long enough
+                if ((temp_end - curr_speech_start) > min_speech_samples) {
+                    speeches.push_back({ curr_speech_start, temp_end });
+                }
+
+                prev_end = next_start = temp_end = 0;
+                is_speech_segment = false;
+                has_curr_speech = false;
+                continue;
+            }
+        }
+    }
+
+    // Handle the case if we're still in a speech segment at the end
+    if (has_curr_speech && (audio_length_samples - curr_speech_start) > min_speech_samples) {
+        speeches.push_back({ curr_speech_start, audio_length_samples });
+    }
+
+    // Merge adjacent segments with small gaps in between (post-processing)
+    if (speeches.size() > 1) {
+        int merged_count = 0;
+        for (int i = 0; i < (int) speeches.size() - 1; i++) {
+            // Define maximum gap allowed for merging (e.g., 200ms converted to samples)
+            int max_merge_gap_samples = sample_rate * 200 / 1000;
+
+            // If the gap between this segment and the next is small enough
+            if (speeches[i+1].start - speeches[i].end < max_merge_gap_samples) {
+                // Merge by extending current segment to the end of next segment
+                speeches[i].end = speeches[i+1].end;
+                speeches.erase(speeches.begin() + i + 1);
+
+                i--;
+                merged_count++;
+            }
+        }
+        WHISPER_LOG_INFO("%s: Merged %d adjacent segments, now have %d segments\n",
+                         __func__, merged_count, (int) speeches.size());
+    }
+
+    // Double-check for minimum speech duration
+    for (int i = 0; i < (int) speeches.size(); i++) {
+        if (speeches[i].end - speeches[i].start < min_speech_samples) {
+            WHISPER_LOG_INFO("%s: Removing segment %d (too short: %d samples)\n",
+                            __func__, i, speeches[i].end - speeches[i].start);
+
+            speeches.erase(speeches.begin() + i);
+            i--;
+        }
+    }
+
+    WHISPER_LOG_INFO("%s: Final speech segments after filtering: %d\n", __func__, (int) speeches.size());
+
+    // Allocate final segments
+    std::vector<whisper_vad_segment> segments;
+    if (speeches.size() > 0) {
+        try {
+            segments.resize(speeches.size());
+        } catch (const std::bad_alloc &) {
+            WHISPER_LOG_ERROR("%s: failed to allocate memory for final segments\n", __func__);
+            return nullptr;
+        }
+    }
+
+    // Apply padding to segments and copy to final segments
+    for (int i = 0; i < (int) speeches.size(); i++) {
+        // Apply padding to the start of the first segment
+        if (i == 0) {
+            speeches[i].start =
+                (speeches[i].start > speech_pad_samples) ?
+                (speeches[i].start - speech_pad_samples) : 0;
+        }
+
+        // Handle spacing between segments
+        if (i < (int) speeches.size() - 1) {
+            int silence_duration = speeches[i+1].start - speeches[i].end;
+
+            if (silence_duration < 2 * speech_pad_samples) {
+                // If segments are close, split the difference
+                speeches[i].end += silence_duration / 2;
+                speeches[i+1].start =
+                    (speeches[i+1].start > silence_duration / 2) ?
+                    (speeches[i+1].start - silence_duration / 2) : 0;
+            } else {
+                // Otherwise, apply full padding to both
+                speeches[i].end =
+                    (speeches[i].end + speech_pad_samples < audio_length_samples) ?
+                    (speeches[i].end + speech_pad_samples) : audio_length_samples;
+                speeches[i+1].start =
+                    (speeches[i+1].start > speech_pad_samples) ?
+                    (speeches[i+1].start - speech_pad_samples) : 0;
+            }
+        } else {
+            // Apply padding to the end of the last segment
+            speeches[i].end =
+                (speeches[i].end + speech_pad_samples < audio_length_samples) ?
+                (speeches[i].end + speech_pad_samples) : audio_length_samples;
+        }
+
+        // Convert from samples to centiseconds
+        segments[i].start = samples_to_cs(speeches[i].start);
+        segments[i].end   = samples_to_cs(speeches[i].end);
+
+        WHISPER_LOG_INFO("%s: VAD segment %d: start = %.2f, end = %.2f (duration: %.2f)\n",
+                        __func__, i, segments[i].start/100.0, segments[i].end/100.0, (segments[i].end - segments[i].start)/100.0);
+    }
+
+    whisper_vad_segments * vad_segments = new whisper_vad_segments;
+    if (vad_segments == NULL) {
+        WHISPER_LOG_ERROR("%s: failed to allocate memory for whisper_vad_segments\n", __func__);
+        return nullptr;
+    }
+
+    vad_segments->data = std::move(segments);
+
+    return vad_segments;
+}
+
+struct whisper_vad_segments * whisper_vad_segments_from_samples(
+        whisper_vad_context * vctx,
+        whisper_vad_params params,
+        const float * samples,
+        int n_samples) {
+    WHISPER_LOG_INFO("%s: detecting speech timestamps in %d samples\n", __func__, n_samples);
+    if (!whisper_vad_detect_speech(vctx, samples, n_samples)) {
+        WHISPER_LOG_ERROR("%s: failed to detect speech\n", __func__);
+        return nullptr;
+    }
+    return whisper_vad_segments_from_probs(vctx, params);
+}
+
+void whisper_vad_free(whisper_vad_context * ctx) {
+    if (ctx) {
+        if (ctx->buffer) {
+            ggml_backend_buffer_free(ctx->buffer);
+        }
+        for (ggml_context * context : ctx->model.ctxs) {
+            ggml_free(context);
+        }
+
+        for (ggml_backend_buffer_t buf : ctx->model.buffers) {
+            ggml_backend_buffer_free(buf);
+        }
+
+        ggml_backend_sched_free(ctx->sched.sched);
+
+        for (auto & backend : ctx->backends) {
+            ggml_backend_free(backend);
+        }
+
+        delete[] ctx->model.hparams.encoder_in_channels;
+        delete[] ctx->model.hparams.encoder_out_channels;
+        delete[] ctx->model.hparams.kernel_sizes;
+
+        delete ctx;
     }
-    return op_supported;
 }
 
-static ggml_backend_buffer_type_t select_weight_buft(const whisper_vad_hparams & hparams, ggml_tensor * w, ggml_op op, buft_list_t buft_list) {
-    GGML_ASSERT(!buft_list.empty());
-    for (const auto & p : buft_list) {
-        ggml_backend_dev_t dev = p.first;
-        ggml_backend_buffer_type_t buft = p.second;
-        if (weight_buft_supported(hparams, w, op, buft, dev)) {
-            return buft;
+void whisper_vad_free_segments(whisper_vad_segments * segments) {
+    if (segments) {
+        delete segments;
+    }
+}
+
+//////////////////////////////////
+// Grammar - ported from llama.cpp
+//////////////////////////////////
+
+// Decodes a UTF-8 string which may end in an incomplete sequence. Adds a terminating 0 for use as
+// pointer. If an invalid sequence is encountered, returns `whisper_partial_utf8.n_remain == -1`.
+static std::pair<std::vector<uint32_t>, whisper_partial_utf8> decode_utf8(
+        const char         * src,
+        whisper_partial_utf8   partial_start) {
+    static const int      lookup[] = { 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 2, 2, 3, 4 };
+    const char          * pos      = src;
+    std::vector<uint32_t> code_points;
+    uint32_t              value    = partial_start.value;
+    int                   n_remain = partial_start.n_remain;
+
+    // continue previous decode, if applicable
+    while (*pos != 0 && n_remain > 0) {
+        uint8_t next_byte = static_cast<uint8_t>(*pos);
+        if ((next_byte >> 6) != 2) {
+            // invalid sequence, abort
+            code_points.push_back(0);
+            return std::make_pair(std::move(code_points), whisper_partial_utf8{ 0, -1 });
         }
+        value = (value << 6) + (next_byte & 0x3F);
+        ++pos;
+        --n_remain;
     }
 
-    return nullptr;
-}
+    if (partial_start.n_remain > 0 && n_remain == 0) {
+        code_points.push_back(value);
+    }
 
-static ggml_tensor * whisper_vad_build_stft_layer(ggml_context * ctx0,
-        const whisper_vad_model & model, ggml_tensor * cur) {
-    // Apply reflective padding to the input tensor
-    ggml_tensor * padded = ggml_pad_reflect_1d(ctx0, cur, 64, 64);
+    // decode any subsequent utf-8 sequences, which may end in an incomplete one
+    while (*pos != 0) {
+        uint8_t  first_byte = static_cast<uint8_t>(*pos);
+        uint8_t  highbits   = first_byte >> 4;
+                 n_remain   = lookup[highbits] - 1;
 
-    struct ggml_tensor * stft = ggml_conv_1d(ctx0, model.stft_forward_basis, padded, model.hparams.lstm_input_size, 0, 1);
+        if (n_remain < 0) {
+            // invalid sequence, abort
+            code_points.clear();
+            code_points.push_back(0);
+            return std::make_pair(std::move(code_points), whisper_partial_utf8{ 0, n_remain });
+        }
 
-    // Calculate cutoff for real/imaginary parts
-    int cutoff = model.stft_forward_basis->ne[2] / 2;
+        uint8_t  mask       = (1 << (7 - n_remain)) - 1;
+                 value      = first_byte & mask;
+        ++pos;
+        while (*pos != 0 && n_remain > 0) {
+            value = (value << 6) + (static_cast<uint8_t>(*pos) & 0x3F);
+            ++pos;
+            --n_remain;
+        }
+        if (n_remain == 0) {
+            code_points.push_back(value);
+        }
+    }
+    code_points.push_back(0);
 
-    // Extract real part (first half of the STFT output).
-    struct ggml_tensor * real_part = ggml_view_2d(ctx0, stft, 4, cutoff, stft->nb[1], 0);
-    // Extract imaginary part (second half of the STFT output).
-    struct ggml_tensor * img_part = ggml_view_2d(ctx0, stft, 4, cutoff, stft->nb[1], cutoff * stft->nb[1]);
+    return std::make_pair(std::move(code_points), whisper_partial_utf8{ value, n_remain });
+}
 
-    // Calculate magnitude: sqrt(real^2 + imag^2)
-    struct ggml_tensor * real_squared = ggml_mul(ctx0, real_part, real_part);
-    struct ggml_tensor * img_squared  = ggml_mul(ctx0, img_part, img_part);
-    struct ggml_tensor * sum_squares  = ggml_add(ctx0, real_squared, img_squared);
-    struct ggml_tensor * magnitude    = ggml_sqrt(ctx0, sum_squares);
-    return magnitude;
+// returns true iff pos points to the end of one of the definitions of a rule
+static bool whisper_grammar_is_end_of_sequence(const whisper_grammar_element * pos) {
+    switch (pos->type) {
+        case WHISPER_GRETYPE_END: return true;  // NOLINT
+        case WHISPER_GRETYPE_ALT: return true;  // NOLINT
+        default:                return false;
+    }
 }
 
-static ggml_tensor * whisper_vad_build_encoder_layer(ggml_context * ctx0,
-        const whisper_vad_model & model, ggml_tensor * cur) {
-    // First Conv1D: expands to 128 channels.
-    cur = ggml_conv_1d(ctx0, model.encoder_0_weight, cur, 1, 1, 1);
-    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_0_bias, 1, 128, 1));
-    cur = ggml_relu(ctx0, cur);
+// returns true iff chr satisfies the char range at pos (regular or inverse range)
+// asserts that pos is pointing to a char range element
+static std::pair<bool, const whisper_grammar_element *> whisper_grammar_match_char(
+        const whisper_grammar_element * pos,
+        const uint32_t                chr) {
 
-    // Second Conv1D: reduces to 64 channels.
-    cur = ggml_conv_1d(ctx0, model.encoder_1_weight, cur, 2, 1, 1);
-    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_1_bias, 1, 64, 1));
-    cur = ggml_relu(ctx0, cur);
+    bool found            = false;
+    bool is_positive_char = pos->type == WHISPER_GRETYPE_CHAR;
 
-    // Third Conv1D: maintains 64 channels
-    cur = ggml_conv_1d(ctx0, model.encoder_2_weight, cur, 2, 1, 1);
-    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_2_bias, 1, 64, 1));
-    cur = ggml_relu(ctx0, cur);
+    WHISPER_ASSERT(is_positive_char || pos->type == WHISPER_GRETYPE_CHAR_NOT); // NOLINT
 
-    // Fourth Conv1D: expands to 128 channels
-    cur = ggml_conv_1d(ctx0, model.encoder_3_weight, cur, 1, 1, 1);
-    cur = ggml_add(ctx0, cur, ggml_reshape_3d(ctx0, model.encoder_3_bias, 1, 128, 1));
-    cur = ggml_relu(ctx0, cur);
+    do {
+        if (pos[1].type == WHISPER_GRETYPE_CHAR_RNG_UPPER) {
+            // inclusive range, e.g. [a-z]
+            found = found || (pos->value <= chr && chr <= pos[1].value);
+            pos += 2;
+        } else {
+            // exact char match, e.g. [a] or "a"
+            found = found || pos->value == chr;
+            pos += 1;
+        }
+    } while (pos->type == WHISPER_GRETYPE_CHAR_ALT);
 
-    return cur;
+    return std::make_pair(found == is_positive_char, pos);
 }
 
-static ggml_tensor * whisper_vad_build_lstm_layer(ggml_context * ctx0,
-        const whisper_vad_context & vctx, ggml_tensor * cur, ggml_cgraph * gf) {
-    const whisper_vad_model & model = vctx.model;
-    const int hdim = model.hparams.lstm_hidden_size;
+// returns true iff some continuation of the given partial UTF-8 sequence could satisfy the char
+// range at pos (regular or inverse range)
+// asserts that pos is pointing to a char range element
+static bool whisper_grammar_match_partial_char(
+        const whisper_grammar_element * pos,
+        const whisper_partial_utf8      partial_utf8) {
 
-    struct ggml_tensor * x_t = ggml_transpose(ctx0, cur);
+    bool is_positive_char = pos->type == WHISPER_GRETYPE_CHAR;
+    WHISPER_ASSERT(is_positive_char || pos->type == WHISPER_GRETYPE_CHAR_NOT);
 
-    // Create operations using the input-to-hidden weights.
-    struct ggml_tensor * inp_gate = ggml_mul_mat(ctx0, model.lstm_ih_weight, x_t);
-    inp_gate = ggml_add(ctx0, inp_gate, model.lstm_ih_bias);
+    uint32_t partial_value = partial_utf8.value;
+    int      n_remain      = partial_utf8.n_remain;
 
-    // Create operations using the hidden-to-hidden weights.
-    struct ggml_tensor * hid_gate = ggml_mul_mat(ctx0, model.lstm_hh_weight, vctx.h_state);
-    hid_gate = ggml_add(ctx0, hid_gate, model.lstm_hh_bias);
+    // invalid sequence or 7-bit char split across 2 bytes (overlong)
+    if (n_remain < 0 || (n_remain == 1 && partial_value < 2)) {
+        return false;
+    }
 
-    // Create add operation to get preactivations for all gates.
-    struct ggml_tensor * out_gate = ggml_add(ctx0, inp_gate, hid_gate);
+    // range of possible code points this partial UTF-8 sequence could complete to
+    uint32_t low  = partial_value << (n_remain * 6);
+    uint32_t high = low | ((1 << (n_remain * 6)) - 1);
 
-    const size_t hdim_size = ggml_row_size(out_gate->type, hdim);
+    if (low == 0) {
+        if (n_remain == 2) {
+            low = 1 << 11;
+        } else if (n_remain == 3) {
+            low = 1 << 16;
+        }
+    }
 
-    // Create sigmoid for input gate (using the first 128 bytes from the preactivations).
-    struct ggml_tensor * i_t = ggml_sigmoid(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 0 * hdim_size));
+    do {
+        if (pos[1].type == WHISPER_GRETYPE_CHAR_RNG_UPPER) {
+            // inclusive range, e.g. [a-z]
+            if (pos->value <= high && low <= pos[1].value) {
+                return is_positive_char;
+            }
+            pos += 2;
+        } else {
+            // exact char match, e.g. [a] or "a"
+            if (low <= pos->value && pos->value <= high) {
+                return is_positive_char;
+            }
+            pos += 1;
+        }
+    } while (pos->type == WHISPER_GRETYPE_CHAR_ALT);
+
+    return !is_positive_char;
+}
+
+
+// transforms a grammar pushdown stack into N possible stacks, all ending
+// at a character range (terminal element)
+static void whisper_grammar_advance_stack(
+        const std::vector<std::vector<whisper_grammar_element>>   & rules,
+        const std::vector<const whisper_grammar_element *>        & stack,
+        std::vector<std::vector<const whisper_grammar_element *>> & new_stacks) {
+
+    if (stack.empty()) {
+        new_stacks.emplace_back();
+        return;
+    }
+
+    const whisper_grammar_element * pos = stack.back();
+
+    switch (pos->type) {
+        case WHISPER_GRETYPE_RULE_REF: {
+            const size_t                  rule_id = static_cast<size_t>(pos->value);
+            const whisper_grammar_element * subpos  = rules[rule_id].data();
+            do {
+                // init new stack without the top (pos)
+                std::vector<const whisper_grammar_element *> new_stack(stack.begin(), stack.end() - 1);
+                if (!whisper_grammar_is_end_of_sequence(pos + 1)) {
+                    // if this rule ref is followed by another element, add that to stack
+                    new_stack.push_back(pos + 1);
+                }
+                if (!whisper_grammar_is_end_of_sequence(subpos)) {
+                    // if alternate is nonempty, add to stack
+                    new_stack.push_back(subpos);
+                }
+                whisper_grammar_advance_stack(rules, new_stack, new_stacks);
+                while (!whisper_grammar_is_end_of_sequence(subpos)) {
+                    // scan to end of alternate def
+                    subpos++;
+                }
+                if (subpos->type == WHISPER_GRETYPE_ALT) {
+                    // there's another alternate def of this rule to process
+                    subpos++;
+                } else {
+                    break;
+                }
+            } while (true);
+            break;
+        }
+        case WHISPER_GRETYPE_CHAR:
+        case WHISPER_GRETYPE_CHAR_NOT:
+            new_stacks.push_back(stack);
+            break;
+        default:
+            // end of alternate (WHISPER_GRETYPE_END, WHISPER_GRETYPE_ALT) or middle of char range
+            // (WHISPER_GRETYPE_CHAR_ALT, WHISPER_GRETYPE_CHAR_RNG_UPPER); stack should never be left on
+            // those
+            WHISPER_ASSERT(false);
+    }
+}
 
-    // Create sigmoid for the forget gate (using the second 128 bytes from the preactivations).
-    struct ggml_tensor * f_t = ggml_sigmoid(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 1 * hdim_size));
+// takes a set of possible pushdown stacks on a grammar, which are required to
+// be positioned at a character range (see `whisper_grammar_advance_stack`), and
+// produces the N possible stacks if the given char is accepted at those
+// positions
+static std::vector<std::vector<const whisper_grammar_element *>> whisper_grammar_accept(
+        const std::vector<std::vector<whisper_grammar_element>>         & rules,
+        const std::vector<std::vector<const whisper_grammar_element *>> & stacks,
+        const uint32_t                                                  chr) {
 
-    // Create sigmoid for the cell gate (using the third 128 bytes from the preactivations).
-    struct ggml_tensor * g_t = ggml_tanh(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 2 * hdim_size));
+    std::vector<std::vector<const whisper_grammar_element *>> new_stacks;
 
-    // Create sigmoid for the output gate (using the fourth 128 bytes from the preactivations).
-    struct ggml_tensor * o_t = ggml_sigmoid(ctx0, ggml_view_1d(ctx0, out_gate, hdim, 3 * hdim_size));
+    for (const auto & stack : stacks) {
+        if (stack.empty()) {
+            continue;
+        }
 
-    // Update cell state
-    struct ggml_tensor * c_out = ggml_add(ctx0,
-        ggml_mul(ctx0, f_t, vctx.c_state),
-        ggml_mul(ctx0, i_t, g_t));
-    ggml_build_forward_expand(gf, ggml_cpy(ctx0, c_out, vctx.c_state));
+        auto match = whisper_grammar_match_char(stack.back(), chr);
+        if (match.first) {
+            const whisper_grammar_element * pos = match.second;
 
-    // Update hidden state
-    struct ggml_tensor * out = ggml_mul(ctx0, o_t, ggml_tanh(ctx0, c_out));
-    ggml_build_forward_expand(gf, ggml_cpy(ctx0, out,   vctx.h_state));
+            // update top of stack to next element, if any
+            std::vector<const whisper_grammar_element *> new_stack(stack.begin(), stack.end() - 1);
+            if (!whisper_grammar_is_end_of_sequence(pos)) {
+                new_stack.push_back(pos);
+            }
+            whisper_grammar_advance_stack(rules, new_stack, new_stacks);
+        }
+    }
 
-    return out;
+    return new_stacks;
 }
 
-static struct ggml_cgraph * whisper_vad_build_graph(whisper_vad_context & vctx) {
-    const auto & model = vctx.model;
+static std::vector<whisper_grammar_candidate> whisper_grammar_reject_candidates(
+        const std::vector<std::vector<whisper_grammar_element>>         & rules,
+        const std::vector<std::vector<const whisper_grammar_element *>> & stacks,
+        const std::vector<whisper_grammar_candidate>                    & candidates);
 
-    struct ggml_init_params params = {
-        /*.mem_size   =*/ vctx.sched.meta.size(),
-        /*.mem_buffer =*/ vctx.sched.meta.data(),
-        /*.no_alloc   =*/ true,
-    };
+static std::vector<whisper_grammar_candidate> whisper_grammar_reject_candidates_for_stack(
+        const std::vector<std::vector<whisper_grammar_element>> & rules,
+        const std::vector<const whisper_grammar_element *>      & stack,
+        const std::vector<whisper_grammar_candidate>            & candidates) {
 
-    struct ggml_context * ctx0 = ggml_init(params);
+    std::vector<whisper_grammar_candidate> rejects;
 
-    ggml_cgraph * gf = ggml_new_graph(ctx0);
+    if (stack.empty()) {
+        for (auto tok : candidates) {
+            if (*tok.code_points != 0 || tok.partial_utf8.n_remain != 0) {
+                rejects.push_back(tok);
+            }
+        }
+        return rejects;
+    }
 
-    struct ggml_tensor * frame = ggml_new_tensor_2d(ctx0, GGML_TYPE_F32, vctx.n_window, 1);
-    ggml_set_name(frame, "frame");
-    ggml_set_input(frame);
+    const whisper_grammar_element * stack_pos = stack.back();
 
-    struct ggml_tensor * cur = nullptr;
-    {
-        cur = whisper_vad_build_stft_layer(ctx0, model, frame);
+    std::vector<whisper_grammar_candidate> next_candidates;
+    for (auto tok : candidates) {
+        if (*tok.code_points == 0) {
+            // reached end of full codepoints in token, reject iff it ended in a partial sequence
+            // that cannot satisfy this position in grammar
+            if (tok.partial_utf8.n_remain != 0 && !whisper_grammar_match_partial_char(stack_pos, tok.partial_utf8)) {
+                rejects.push_back(tok);
+            }
+        } else if (whisper_grammar_match_char(stack_pos, *tok.code_points).first) {
+            next_candidates.push_back({ tok.id, tok.code_points + 1, tok.partial_utf8 });
+        } else {
+            rejects.push_back(tok);
+        }
+    }
 
-        cur = whisper_vad_build_encoder_layer(ctx0, model, cur);
+    const auto * stack_pos_after = whisper_grammar_match_char(stack_pos, 0).second;
 
-        // Extract the first element of the first dimension
-        // (equivalent to pytorch's [:, :, 0])
-        cur = ggml_view_2d(ctx0, cur, 1, 128, cur->nb[1], 0);
+    // update top of stack to next element, if any
+    std::vector<const whisper_grammar_element *> stack_after(stack.begin(), stack.end() - 1);
+    if (!whisper_grammar_is_end_of_sequence(stack_pos_after)) {
+        stack_after.push_back(stack_pos_after);
+    }
+    std::vector<std::vector<const whisper_grammar_element *>> next_stacks;
+    whisper_grammar_advance_stack(rules, stack_after, next_stacks);
 
-        cur = whisper_vad_build_lstm_layer(ctx0, vctx, cur, gf);
-        cur = ggml_relu(ctx0, cur);
-        cur = ggml_conv_1d(ctx0, model.final_conv_weight, cur, 1, 0, 1);
-        cur = ggml_add(ctx0, cur, model.final_conv_bias);
-        cur = ggml_sigmoid(ctx0, cur);
-        ggml_set_name(cur, "prob");
-        ggml_set_output(cur);
+    auto next_rejects = whisper_grammar_reject_candidates(rules, next_stacks, next_candidates);
+    for (auto tok : next_rejects) {
+        rejects.push_back({ tok.id, tok.code_points - 1, tok.partial_utf8 });
     }
 
-    ggml_build_forward_expand(gf, cur);
+    return rejects;
+}
 
-    ggml_free(ctx0);
+static std::vector<whisper_grammar_candidate> whisper_grammar_reject_candidates(
+        const std::vector<std::vector<whisper_grammar_element>>         & rules,
+        const std::vector<std::vector<const whisper_grammar_element *>> & stacks,
+        const std::vector<whisper_grammar_candidate>                    & candidates) {
+    if (candidates.empty() || stacks.empty()) {
+        return std::vector<whisper_grammar_candidate>();
+    }
 
-    return gf;
-}
+    auto rejects = whisper_grammar_reject_candidates_for_stack(rules, stacks.front(), candidates);
 
-static bool whisper_vad_init_context(whisper_vad_context * vctx) {
+    for (size_t i = 1, size = stacks.size(); i < size; ++i) {
+        rejects = whisper_grammar_reject_candidates_for_stack(rules, stacks[i], rejects);
+    }
+    return rejects;
+}
 
-    auto whisper_context_params = whisper_context_default_params();
-    // TODO: GPU VAD is forced disabled until the performance is improved
-    //whisper_context_params.use_gpu    = vctx->params.use_gpu;
-    whisper_context_params.use_gpu    = false;
-    whisper_context_params.gpu_device = vctx->params.gpu_device;
+static struct whisper_grammar whisper_grammar_init(
+            const whisper_grammar_element ** rules,
+                                 size_t      n_rules,
+                                 size_t      i_start_rule) {
+    const whisper_grammar_element * pos;
 
-    vctx->backends = whisper_backend_init(whisper_context_params);
-    if (vctx->backends.empty()) {
-        WHISPER_LOG_ERROR("%s: whisper_backend_init() failed\n", __func__);
-        return false;
+    // copy rule definitions into vectors
+    std::vector<std::vector<whisper_grammar_element>> vec_rules(n_rules);
+    for (size_t i = 0; i < n_rules; i++) {
+        for (pos = rules[i]; pos->type != WHISPER_GRETYPE_END; pos++) {
+            vec_rules[i].push_back(*pos);
+        }
+        vec_rules[i].push_back({WHISPER_GRETYPE_END, 0});
     }
 
-    const int32_t lstm_hidden_size = vctx->model.hparams.lstm_hidden_size;
+    // loop over alternates of start rule to build initial stacks
+    std::vector<std::vector<const whisper_grammar_element *>> stacks;
+    pos = rules[i_start_rule];
+    do {
+        std::vector<const whisper_grammar_element *> stack;
+        if (!whisper_grammar_is_end_of_sequence(pos)) {
+            // if alternate is nonempty, add to stack
+            stack.push_back(pos);
+        }
+        whisper_grammar_advance_stack(vec_rules, stack, stacks);
+        while (!whisper_grammar_is_end_of_sequence(pos)) {
+            // scan to end of alternate def
+            pos++;
+        }
+        if (pos->type == WHISPER_GRETYPE_ALT) {
+            // there's another alternate def of this rule to process
+            pos++;
+        } else {
+            break;
+        }
+    } while (true);
 
-    vctx->ctx_buf.resize(2u*ggml_tensor_overhead());
+    return { std::move(vec_rules), std::move(stacks), {} };
+}
 
-    struct ggml_init_params params = {
-        /*.mem_size   =*/ vctx->ctx_buf.size(),
-        /*.mem_buffer =*/ vctx->ctx_buf.data(),
-        /*.no_alloc   =*/ true,
-    };
+static void whisper_suppress_invalid_grammar(
+             whisper_context  & ctx,
+    const whisper_full_params & params,
+           std::vector<float> & logits,
+    const     whisper_grammar & grammar) {
 
-    ggml_context * ctx = ggml_init(params);
-    if (!ctx) {
-        WHISPER_LOG_ERROR("%s: failed to init LSTM state ggml context\n", __func__);
-        return false;
+    if (grammar.rules.empty() || grammar.stacks.empty()) {
+        return;
     }
 
-    // LSTM Hidden state
-    vctx->h_state = ggml_new_tensor_1d(ctx, GGML_TYPE_F32, lstm_hidden_size);
-    ggml_set_name(vctx->h_state, "h_state");
-
-    // LSTM Cell state
-    vctx->c_state = ggml_new_tensor_1d(ctx, GGML_TYPE_F32, lstm_hidden_size);
-    ggml_set_name(vctx->c_state, "c_state");
+    //bool allow_eot = false;
+    //for (const auto & stack : grammar.stacks) {
+    //    if (stack.empty()) {
+    //        allow_eot = true;
+    //        break;
+    //    }
+    //}
 
-    vctx->buffer = ggml_backend_alloc_ctx_tensors(ctx, vctx->backends[0]);
-    ggml_free(ctx);
-    if (!vctx->buffer) {
-        WHISPER_LOG_ERROR("%s: failed to allocate memory for the VAD state\n", __func__);
-        return false;
-    }
+    const whisper_token eot = whisper_token_eot(&ctx);
 
-    {
-        bool ok = whisper_sched_graph_init(vctx->sched, vctx->backends,
-                [&]() {
-                    return whisper_vad_build_graph(*vctx);
-                });
+    std::vector<std::pair<std::vector<uint32_t>, whisper_partial_utf8>> candidates_decoded;
+    std::vector<whisper_grammar_candidate>                              candidates_grammar;
 
-        if (!ok) {
-            WHISPER_LOG_ERROR("%s: failed to init VAD allocator\n", __func__);
-            return false;
+    for (whisper_token id = 0; id < eot; ++id) {
+        if (ctx.vocab.token_size(id) > 0) {
+            candidates_decoded.push_back(decode_utf8(ctx.vocab.token_text(id), grammar.partial_utf8));
+            candidates_grammar.push_back({ id, candidates_decoded.back().first.data(), candidates_decoded.back().second });
         }
-
-        WHISPER_LOG_INFO("%s: compute buffer (VAD)   = %7.2f MB\n", __func__, whisper_sched_size(vctx->sched) / 1e6);
     }
 
-    return true;
-}
+    const auto rejects = whisper_grammar_reject_candidates(grammar.rules, grammar.stacks, candidates_grammar);
 
-struct whisper_vad_context * whisper_vad_init_from_file_with_params(
-        const char * path_model,
-        struct whisper_vad_context_params params) {
-    WHISPER_LOG_INFO("%s: loading VAD model from '%s'\n", __func__, path_model);
-#ifdef _MSC_VER
-    std::wstring_convert<std::codecvt_utf8<wchar_t>> converter;
-    std::wstring path_model_wide = converter.from_bytes(path_model);
-    auto fin = std::ifstream(path_model_wide, std::ios::binary);
-#else
-    auto fin = std::ifstream(path_model, std::ios::binary);
-#endif
-    if (!fin) {
-        WHISPER_LOG_ERROR("%s: failed to open VAD model '%s'\n", __func__, path_model);
-        return nullptr;
+    for (const auto & reject : rejects) {
+        logits[reject.id] -= params.grammar_penalty;
     }
 
-    whisper_model_loader loader = {};
-    loader.context = &fin;
+    // when the grammar allows a continuation, we penalize the end-of-text token
+    //if (!allow_eot) {
+    //    logits[eot] -= params.grammar_penalty;
+    //}
+    //fprintf(stderr, "Allowed: (%zu tokens)\n", size - rejects.size());
+}
+
+static void whisper_grammar_accept_token(whisper_context & ctx, whisper_grammar & grammar, whisper_token token) {
+    if (grammar.rules.empty() || grammar.stacks.empty()) {
+        return;
+    }
 
-    loader.read = [](void * ctx, void * output, size_t read_size) {
-        std::ifstream * fin = (std::ifstream*)ctx;
-        fin->read((char *)output, read_size);
-        return read_size;
-    };
+    //fprintf(stderr, "Accept: '%s'\n", ctx.vocab.token_text(token));
 
-    loader.eof = [](void * ctx) {
-        std::ifstream * fin = (std::ifstream*)ctx;
-        return fin->eof();
-    };
+    const char * text = ctx.vocab.token_text(token);
 
-    loader.close = [](void * ctx) {
-        std::ifstream * fin = (std::ifstream*)ctx;
-        fin->close();
-    };
+    if (strncmp(text, "[_", 2) == 0) {
+        // fprintf(stderr, " (skipped)\n");
+        return;
+    }
+    // fprintf(stderr, "\n");
 
-    auto ctx = whisper_vad_init_with_params(&loader, params);
-    if (!ctx) {
-        whisper_vad_free(ctx);
-        return nullptr;
+    // Note terminating 0 in decoded string
+    const auto   decoded     = decode_utf8(text, grammar.partial_utf8);
+    const auto & code_points = decoded.first;
+    for (auto it = code_points.begin(), end = code_points.end() - 1; it != end; ++it) {
+        grammar.stacks = whisper_grammar_accept(grammar.rules, grammar.stacks, *it);
     }
-    ctx->path_model = path_model;
-    return ctx;
+    grammar.partial_utf8 = decoded.second;
 }
 
-struct whisper_vad_context * whisper_vad_init_with_params(
-            struct whisper_model_loader * loader,
-            struct whisper_vad_context_params params) {
-    // Read the VAD model
-    {
-        uint32_t magic;
-        read_safe(loader, magic);
-        if (magic != GGML_FILE_MAGIC) {
-            WHISPER_LOG_ERROR("%s: invalid model data (bad magic)\n", __func__);
-            return nullptr;
-        }
-    }
+//////////////
+// END grammar
+//////////////
 
-    whisper_vad_context * vctx = new whisper_vad_context;
-    vctx->n_threads = params.n_threads;
-    vctx->params.use_gpu = params.use_gpu;
-    vctx->params.gpu_device = params.gpu_device;
+////////////////////////////////////////////////////////////////////////////
 
-    auto & model = vctx->model;
-    auto & hparams = model.hparams;
+struct whisper_context_params * whisper_context_default_params_by_ref(void) {
+    struct whisper_context_params params = whisper_context_default_params();
 
-    // load model context params.
-    {
-        int32_t str_len;
-        read_safe(loader, str_len);
-        std::vector<char> buffer(str_len + 1, 0);
-        loader->read(loader->context, buffer.data(), str_len);
-        std::string model_type(buffer.data(), str_len);
-        model.type = model_type;
-        WHISPER_LOG_INFO("%s: model type: %s\n", __func__, model.type.c_str());
+    struct whisper_context_params* result = new whisper_context_params();
+    *result = params;
+    return result;
+}
 
-        int32_t major, minor, patch;
-        read_safe(loader, major);
-        read_safe(loader, minor);
-        read_safe(loader, patch);
-        std::string version_str = std::to_string(major) + "." +
-                                  std::to_string(minor) + "." +
-                                  std::to_string(patch);
-        model.version = version_str;
-        WHISPER_LOG_INFO("%s: model version: %s\n", __func__, model.version.c_str());
+struct whisper_full_params * whisper_full_default_params_by_ref(enum whisper_sampling_strategy strategy) {
+    struct whisper_full_params params = whisper_full_default_params(strategy);
 
-        read_safe(loader, vctx->n_window);
-        read_safe(loader, vctx->n_context);
-    }
+    struct whisper_full_params* result = new whisper_full_params();
+    *result = params;
+    return result;
+}
 
-    // load model hyper params (hparams).
-    {
-        read_safe(loader, hparams.n_encoder_layers);
+struct whisper_full_params whisper_full_default_params(enum whisper_sampling_strategy strategy) {
+    struct whisper_full_params result = {
+        /*.strategy          =*/ strategy,
 
-        hparams.encoder_in_channels = new int32_t[hparams.n_encoder_layers];
-        hparams.encoder_out_channels = new int32_t[hparams.n_encoder_layers];
-        hparams.kernel_sizes = new int32_t[hparams.n_encoder_layers];
+        /*.n_threads         =*/ std::min(4, (int32_t) std::thread::hardware_concurrency()),
+        /*.n_max_text_ctx    =*/ 16384,
+        /*.offset_ms         =*/ 0,
+        /*.duration_ms       =*/ 0,
 
-        for (int32_t i = 0; i < hparams.n_encoder_layers; i++) {
-            read_safe(loader, hparams.encoder_in_channels[i]);
-            read_safe(loader, hparams.encoder_out_channels[i]);
-            read_safe(loader, hparams.kernel_sizes[i]);
-        }
+        /*.translate         =*/ false,
+        /*.no_context        =*/ true,
+        /*.no_timestamps     =*/ false,
+        /*.single_segment    =*/ false,
+        /*.print_special     =*/ false,
+        /*.print_progress    =*/ true,
+        /*.print_realtime    =*/ false,
+        /*.print_timestamps  =*/ true,
 
-        read_safe(loader, hparams.lstm_input_size);
-        read_safe(loader, hparams.lstm_hidden_size);
-        read_safe(loader, hparams.final_conv_in);
-        read_safe(loader, hparams.final_conv_out);
+        /*.token_timestamps  =*/ false,
+        /*.thold_pt          =*/ 0.01f,
+        /*.thold_ptsum       =*/ 0.01f,
+        /*.max_len           =*/ 0,
+        /*.split_on_word     =*/ false,
+        /*.max_tokens        =*/ 0,
 
-        WHISPER_LOG_INFO("%s: n_encoder_layers = %d\n", __func__, hparams.n_encoder_layers);
-        for (int32_t i = 0; i < hparams.n_encoder_layers; i++) {
-            WHISPER_LOG_INFO("%s: encoder_in_channels[%d] = %d\n", __func__, i, hparams.encoder_in_channels[i]);
-        }
-        for (int32_t i = 0; i < hparams.n_encoder_layers; i++) {
-            WHISPER_LOG_INFO("%s: encoder_out_channels[%d] = %d\n", __func__, i, hparams.encoder_out_channels[i]);
-        }
-        WHISPER_LOG_INFO("%s: lstm_input_size = %d\n", __func__, hparams.lstm_input_size);
-        WHISPER_LOG_INFO("%s: lstm_hidden_size = %d\n", __func__, hparams.lstm_hidden_size);
-        WHISPER_LOG_INFO("%s: final_conv_in = %d\n", __func__, hparams.final_conv_in);
-        WHISPER_LOG_INFO("%s: final_conv_out = %d\n", __func__, hparams.final_conv_out);
-    }
+        /*.debug_mode        =*/ false,
+        /*.audio_ctx         =*/ 0,
 
-    // 1 STFT tensor, 4*2 encoder tensors, 4 LSTM tensors, 2 final output tensors
-    const size_t n_tensors = hparams.n_encoder_layers * 2 + 4 + 2 + 1;
+        /*.tdrz_enable       =*/ false,
 
-    std::map<ggml_backend_buffer_type_t, ggml_context *> ctx_map;
-    auto get_ctx = [&](ggml_backend_buffer_type_t buft) -> ggml_context * {
-        auto it = ctx_map.find(buft);
-        if (it == ctx_map.end()) {
-            ggml_init_params params = {
-                /*.mem_size   =*/ n_tensors * ggml_tensor_overhead(),
-                /*.mem_buffer =*/ nullptr,
-                /*.no_alloc   =*/ true,
-            };
+        /* suppress_regex    =*/ nullptr,
 
-            ggml_context * ctx = ggml_init(params);
-            if (!ctx) {
-                throw std::runtime_error("failed to create ggml context");
-            }
+        /*.initial_prompt       =*/ nullptr,
+        /*.carry_initial_prompt =*/ false,
+        /*.prompt_tokens        =*/ nullptr,
+        /*.prompt_n_tokens      =*/ 0,
 
-            ctx_map[buft] = ctx;
-            model.ctxs.emplace_back(ctx);
+        /*.language          =*/ "en",
+        /*.detect_language   =*/ false,
 
-            return ctx;
-        }
+        /*.suppress_blank    =*/ true,
+        /*.suppress_nst      =*/ false,
 
-        return it->second;
-    };
+        /*.temperature       =*/  0.0f,
+        /*.max_initial_ts    =*/  1.0f,
+        /*.length_penalty    =*/ -1.0f,
 
-    whisper_context_params wparams = whisper_context_default_params();
-    wparams.use_gpu = params.use_gpu;
-    wparams.gpu_device = params.gpu_device;
-    buft_list_t buft_list = make_buft_list(wparams);
+        /*.temperature_inc   =*/  0.2f,
+        /*.entropy_thold     =*/  2.4f,
+        /*.logprob_thold     =*/ -1.0f,
+        /*.no_speech_thold   =*/  0.6f,
 
-    auto create_tensor = [&](vad_tensor type, ggml_tensor * meta) -> ggml_tensor * {
-        ggml_op op = VAD_TENSOR_OPS.at(type);
-        ggml_backend_buffer_type_t buft = select_weight_buft(hparams, meta, op, buft_list);
-        if (!buft) {
-            throw std::runtime_error(format("failed to find a compatible buffer type for tensor %s", VAD_TENSOR_NAMES.at(type)));
-        }
-        ggml_context * ctx = get_ctx(buft);
-        ggml_tensor * tensor = ggml_dup_tensor(ctx, meta);
-        model.tensors[VAD_TENSOR_NAMES.at(type)] = tensor;
+        /*.greedy            =*/ {
+            /*.best_of   =*/ -1,
+        },
 
-        return tensor;
-    };
+        /*.beam_search      =*/ {
+            /*.beam_size =*/ -1,
 
-    // create tensors
-    {
-        ggml_init_params params = {
-            /*.mem_size   =*/ n_tensors * ggml_tensor_overhead(),
-            /*.mem_buffer =*/ nullptr,
-            /*.no_alloc   =*/ true,
-        };
+            /*.patience  =*/ -1.0f,
+        },
 
-        ggml_context * ctx = ggml_init(params);
-        const auto & hparams = model.hparams;
+        /*.new_segment_callback           =*/ nullptr,
+        /*.new_segment_callback_user_data =*/ nullptr,
 
-        // SFTF precomputed basis matrix
-        model.stft_forward_basis = create_tensor(VAD_TENSOR_STFT_BASIS,
-            ggml_new_tensor_3d(ctx, GGML_TYPE_F16, 256, 1, 258));
+        /*.progress_callback           =*/ nullptr,
+        /*.progress_callback_user_data =*/ nullptr,
 
-        model.encoder_0_weight = create_tensor(VAD_TENSOR_ENC_0_WEIGHT,
-            ggml_new_tensor_3d(
-                ctx,
-                GGML_TYPE_F16,
-                hparams.kernel_sizes[0],
-                hparams.encoder_in_channels[0],
-                hparams.encoder_out_channels[0]
-        ));
-        model.encoder_0_bias = create_tensor(VAD_TENSOR_ENC_0_BIAS,
-            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[0]));
+        /*.encoder_begin_callback           =*/ nullptr,
+        /*.encoder_begin_callback_user_data =*/ nullptr,
 
-        model.encoder_1_weight = create_tensor(VAD_TENSOR_ENC_1_WEIGHT,
-            ggml_new_tensor_3d(
-                ctx,
-                GGML_TYPE_F16,
-                hparams.kernel_sizes[1],
-                hparams.encoder_in_channels[1],
-                hparams.encoder_out_channels[1]
-        ));
-        model.encoder_1_bias = create_tensor(VAD_TENSOR_ENC_1_BIAS,
-            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[1]));
+        /*.abort_callback                   =*/ nullptr,
+        /*.abort_callback_user_data         =*/ nullptr,
 
-        model.encoder_2_weight = create_tensor(VAD_TENSOR_ENC_2_WEIGHT,
-            ggml_new_tensor_3d(
-                ctx,
-                GGML_TYPE_F16,
-                hparams.kernel_sizes[2],
-                hparams.encoder_in_channels[2],
-                hparams.encoder_out_channels[2]
-        ));
-        model.encoder_2_bias = create_tensor(VAD_TENSOR_ENC_2_BIAS,
-            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[2]));
+        /*.logits_filter_callback           =*/ nullptr,
+        /*.logits_filter_callback_user_data =*/ nullptr,
+
+        /*.grammar_rules   =*/ nullptr,
+        /*.n_grammar_rules =*/ 0,
+        /*.i_start_rule    =*/ 0,
+        /*.grammar_penalty =*/ 100.0f,
 
-        model.encoder_3_weight = create_tensor(VAD_TENSOR_ENC_3_WEIGHT,
-            ggml_new_tensor_3d(
-                ctx,
-                GGML_TYPE_F16,
-                hparams.kernel_sizes[3],
-                hparams.encoder_in_channels[3],
-                hparams.encoder_out_channels[3]
-        ));
-        model.encoder_3_bias = create_tensor(VAD_TENSOR_ENC_3_BIAS,
-                ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hparams.encoder_out_channels[3]));
+        /*.vad                         =*/ false,
+        /*.vad_model_path              =*/ nullptr,
 
-        // Hidden State dimension (input gate, forget gate, cell gate, output gate)
-        const int hstate_dim = hparams.lstm_hidden_size * 4;
+        /* vad_params =*/ whisper_vad_default_params(),
 
-        // LSTM weights - input to hidden
-        model.lstm_ih_weight = create_tensor(
-            VAD_TENSOR_LSTM_WEIGHT_IH,
-            ggml_new_tensor_2d(ctx, GGML_TYPE_F32, hparams.lstm_hidden_size, hstate_dim)
-        );
-        model.lstm_ih_bias = create_tensor(
-            VAD_TENSOR_LSTM_BIAS_IH,
-            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hstate_dim)
-        );
+        /*.audio_ctx_auto        =*/ false,
+        /*.audio_ctx_auto_margin =*/ 0,
+        /*.audio_ctx_auto_min    =*/ 0,
+        /*.audio_ctx_auto_bucket =*/ 0,
 
-        // LSTM weights - hidden to hidden
-        model.lstm_hh_weight = create_tensor(
-            VAD_TENSOR_LSTM_WEIGHT_HH,
-            ggml_new_tensor_2d(ctx, GGML_TYPE_F32, hparams.lstm_hidden_size, hstate_dim)
-        );
-        model.lstm_hh_bias = create_tensor(
-            VAD_TENSOR_LSTM_BIAS_HH,
-            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, hstate_dim)
-        );
+        /*.parallel         =*/ {
+            /*.overlap_ms =*/ 2000,
+            /*.search_ms  =*/ 5000,
+        },
+    };
 
-        // Final conv layer weight
-        model.final_conv_weight = create_tensor(
-            VAD_TENSOR_FINAL_CONV_WEIGHT,
-            ggml_new_tensor_2d(ctx, GGML_TYPE_F16, hparams.final_conv_in, 1)
-        );
-        model.final_conv_bias = create_tensor(
-            VAD_TENSOR_FINAL_CONV_BIAS,
-            ggml_new_tensor_1d(ctx, GGML_TYPE_F32, 1)
-        );
+    switch (strategy) {
+        case WHISPER_SAMPLING_GREEDY:
+            {
+                result.greedy = {
+                    /*.best_of   =*/ 5,
+                };
+            } break;
+        case WHISPER_SAMPLING_BEAM_SEARCH:
+            {
+                result.beam_search = {
+                    /*.beam_size =*/ 5,
 
-        ggml_free(ctx);
+                    /*.patience  =*/ -1.0f,
+                };
+            } break;
     }
 
-    // allocate tensors in the backend buffers
-    for (auto & p : ctx_map) {
-        ggml_backend_buffer_type_t buft = p.first;
-        ggml_context * ctx = p.second;
-        ggml_backend_buffer_t buf = ggml_backend_alloc_ctx_tensors_from_buft(ctx, buft);
-        if (buf) {
-            model.buffers.emplace_back(buf);
+    return result;
+}
 
-            size_t size_main = ggml_backend_buffer_get_size(buf);
-            WHISPER_LOG_INFO("%s: %12s total size = %8.2f MB\n", __func__, ggml_backend_buffer_name(buf), size_main / 1e6);
-        }
-    }
+#define WHISPER_FIELD(T, member, type) { #member, type, offsetof(T, member), sizeof(((T *) nullptr)->member) }
+
+static const whisper_field_info g_context_params_fields[] = {
+    WHISPER_FIELD(whisper_context_params, use_gpu,              WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_context_params, flash_attn,           WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_context_params, gpu_device,           WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_context_params, dtw_token_timestamps, WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_context_params, dtw_aheads_preset,    WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_context_params, dtw_n_top,            WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_context_params, dtw_aheads.n_heads,   WHISPER_FIELD_TYPE_SIZE_T),
+    WHISPER_FIELD(whisper_context_params, dtw_aheads.heads,     WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_context_params, dtw_mem_size,         WHISPER_FIELD_TYPE_SIZE_T),
+    WHISPER_FIELD(whisper_context_params, use_mmap,             WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_context_params, n_max_decoders,       WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_context_params, enc_cache_size,       WHISPER_FIELD_TYPE_SIZE_T),
+    WHISPER_FIELD(whisper_context_params, kv_self_type,         WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_context_params, kv_cross_type,        WHISPER_FIELD_TYPE_INT32),
+};
 
-    // load weights
-    {
-        size_t total_size = 0;
-        model.n_loaded = 0;
-        std::vector<char> read_buf;
+static const whisper_field_info g_full_params_fields[] = {
+    WHISPER_FIELD(whisper_full_params, strategy,                           WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, n_threads,                          WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, n_max_text_ctx,                     WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, offset_ms,                          WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, duration_ms,                        WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, translate,                          WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, no_context,                         WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, no_timestamps,                      WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, single_segment,                     WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, print_special,                      WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, print_progress,                     WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, print_realtime,                     WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, print_timestamps,                   WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, token_timestamps,                   WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, thold_pt,                           WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, thold_ptsum,                        WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, max_len,                            WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, split_on_word,                      WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, max_tokens,                         WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, debug_mode,                         WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, audio_ctx,                          WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, tdrz_enable,                        WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, suppress_regex,                     WHISPER_FIELD_TYPE_STRING),
+    WHISPER_FIELD(whisper_full_params, initial_prompt,                     WHISPER_FIELD_TYPE_STRING),
+    WHISPER_FIELD(whisper_full_params, carry_initial_prompt,               WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, prompt_tokens,                      WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, prompt_n_tokens,                    WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, language,                           WHISPER_FIELD_TYPE_STRING),
+    WHISPER_FIELD(whisper_full_params, detect_language,                    WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, suppress_blank,                     WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, suppress_nst,                       WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, temperature,                        WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, max_initial_ts,                     WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, length_penalty,                     WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, temperature_inc,                    WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, entropy_thold,                      WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, logprob_thold,                      WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, no_speech_thold,                    WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, greedy.best_of,                     WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, beam_search.beam_size,              WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, beam_search.patience,               WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, new_segment_callback,               WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, new_segment_callback_user_data,     WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, progress_callback,                  WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, progress_callback_user_data,        WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, encoder_begin_callback,             WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, encoder_begin_callback_user_data,   WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, abort_callback,                     WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, abort_callback_user_data,           WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, logits_filter_callback,             WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, logits_filter_callback_user_data,   WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, grammar_rules,                      WHISPER_FIELD_TYPE_PTR),
+    WHISPER_FIELD(whisper_full_params, n_grammar_rules,                    WHISPER_FIELD_TYPE_SIZE_T),
+    WHISPER_FIELD(whisper_full_params, i_start_rule,                       WHISPER_FIELD_TYPE_SIZE_T),
+    WHISPER_FIELD(whisper_full_params, grammar_penalty,                    WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, vad,                                WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, vad_model_path,                     WHISPER_FIELD_TYPE_STRING),
+    WHISPER_FIELD(whisper_full_params, vad_params.threshold,               WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, vad_params.min_speech_duration_ms,  WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, vad_params.min_silence_duration_ms, WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, vad_params.max_speech_duration_s,   WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, vad_params.speech_pad_ms,           WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, vad_params.samples_overlap,         WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_full_params, audio_ctx_auto,                     WHISPER_FIELD_TYPE_BOOL),
+    WHISPER_FIELD(whisper_full_params, audio_ctx_auto_margin,              WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, audio_ctx_auto_min,                 WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, audio_ctx_auto_bucket,              WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, parallel.overlap_ms,                WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_full_params, parallel.search_ms,                 WHISPER_FIELD_TYPE_INT32),
+};
 
-        while (true) {
-            int32_t n_dims;
-            int32_t length;
-            int32_t ttype;
+static const whisper_field_info g_token_data_fields[] = {
+    WHISPER_FIELD(whisper_token_data, id,    WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_token_data, tid,   WHISPER_FIELD_TYPE_INT32),
+    WHISPER_FIELD(whisper_token_data, p,     WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_token_data, plog,  WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_token_data, pt,    WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_token_data, ptsum, WHISPER_FIELD_TYPE_FLOAT),
+    WHISPER_FIELD(whisper_token_data, t0,    WHISPER_FIELD_TYPE_INT64),
+    WHISPER_FIELD(whisper_token_data, t1,    WHISPER_FIELD_TYPE_INT64),
+    WHISPER_FIELD(whisper_token_data, t_dtw, WHISPER_FIELD_TYPE_INT64),
+    WHISPER_FIELD(whisper_token_data, vlen,  WHISPER_FIELD_TYPE_FLOAT),
+};
 
-            read_safe(loader, n_dims);
-            read_safe(loader, length);
-            read_safe(loader, ttype);
+#undef WHISPER_FIELD
 
-            if (loader->eof(loader->context)) {
-                break;
-            }
+const struct whisper_field_info * whisper_context_params_fields(int * n_fields, size_t * size) {
+    *n_fields = sizeof(g_context_params_fields)/sizeof(g_context_params_fields[0]);
+    *size     = sizeof(whisper_context_params);
+    return g_context_params_fields;
+}
 
-            int32_t nelements = 1;
-            int32_t ne[4] = { 1, 1, 1, 1 };
-            for (int i = 0; i < n_dims; ++i) {
-                read_safe(loader, ne[i]);
-                nelements *= ne[i];
-            }
+const struct whisper_field_info * whisper_full_params_fields(int * n_fields, size_t * size) {
+    *n_fields = sizeof(g_full_params_fields)/sizeof(g_full_params_fields[0]);
+    *size     = sizeof(whisper_full_params);
+    return g_full_params_fields;
+}
 
-            std::string name;
-            std::vector<char> tmp(length);
-            loader->read(loader->context, &tmp[0], tmp.size());
-            name.assign(&tmp[0], tmp.size());
+const struct whisper_field_info * whisper_token_data_fields(int * n_fields, size_t * size) {
+    *n_fields = sizeof(g_token_data_fields)/sizeof(g_token_data_fields[0]);
+    *size     = sizeof(whisper_token_data);
+    return g_token_data_fields;
+}
 
-            if (model.tensors.find(name) == model.tensors.end()) {
-                WHISPER_LOG_ERROR("%s: unknown tensor '%s' in model file\n", __func__, name.data());
-                return nullptr;
-            }
+// forward declarations
+static std::vector<float> get_signal_energy(const float * signal, int n_samples, int n_samples_per_half_window);
+static void whisper_exp_compute_token_level_timestamps(
+        struct whisper_context & ctx,
+          struct whisper_state & state,
+                           int   i_segment,
+                         float   thold_pt,
+                         float   thold_ptsum);
 
-            auto tensor = model.tensors[name.data()];
+static inline bool should_split_on_word(const char * txt, bool split_on_word) {
+    if (!split_on_word) return true;
 
-            if (ggml_nelements(tensor) != nelements) {
-                WHISPER_LOG_ERROR("%s: tensor '%s' has wrong size in model file\n", __func__, name.data());
-                WHISPER_LOG_ERROR("%s: shape: [%d, %d, %d], expected: [%d, %d, %d]\n",
-                        __func__, ne[0], ne[1], ne[2], (int) tensor->ne[0], (int) tensor->ne[1], (int) tensor->ne[2]);
-                return nullptr;
-            }
+    return txt[0] == ' ';
+}
 
-            if (tensor->ne[0] != ne[0] || tensor->ne[1] != ne[1] || tensor->ne[2] != ne[2]) {
-                WHISPER_LOG_ERROR("%s: tensor '%s' has wrong shape in model file: got [%d, %d, %d], expected [%d, %d, %d]\n",
-                        __func__, name.data(), (int) tensor->ne[0], (int) tensor->ne[1], (int) tensor->ne[2], ne[0], ne[1], ne[2]);
-                return nullptr;
-            }
+static void whisper_exp_compute_token_level_timestamps_dtw(
+            struct whisper_context * ctx,
+              struct whisper_state * state,
+        struct whisper_full_params   params,
+                               int   i_segment,
+                            size_t   n_segments,
+                               int   seek,
+                               int   n_frames,
+                               int   medfilt_width,
+                               int   n_threads);
 
-            const size_t bpe = ggml_type_size(ggml_type(ttype));
+// wrap the last segment to max_len characters
+// returns the number of new segments
+static int whisper_wrap_segment(struct whisper_context & ctx, struct whisper_state & state, int max_len, bool split_on_word) {
+    auto segment = state.result_all.back();
 
-            if ((nelements*bpe)/ggml_blck_size(tensor->type) != ggml_nbytes(tensor)) {
-                WHISPER_LOG_ERROR("%s: tensor '%s' has wrong size in model file: got %zu, expected %zu\n",
-                        __func__, name.data(), ggml_nbytes(tensor), nelements*bpe);
-                return nullptr;
-            }
+    int res = 1;
+    int acc = 0;
 
-            if (ggml_backend_buffer_is_host(tensor->buffer)) {
-                // for the CPU and Metal backend, we can read directly into the tensor
-                loader->read(loader->context, tensor->data, ggml_nbytes(tensor));
-                BYTESWAP_TENSOR(tensor);
-            } else {
-                // read into a temporary buffer first, then copy to device memory
-                read_buf.resize(ggml_nbytes(tensor));
+    std::string text;
 
-                loader->read(loader->context, read_buf.data(), read_buf.size());
+    for (int i = 0; i < (int) segment.tokens.size(); i++) {
+        const auto & token = segment.tokens[i];
+        if (token.id >= whisper_token_eot(&ctx)) {
+            continue;
+        }
 
-                ggml_backend_tensor_set(tensor, read_buf.data(), 0, ggml_nbytes(tensor));
-            }
+        const auto txt = whisper_token_to_str(&ctx, token.id);
+        const int cur = strlen(txt);
 
-            total_size += ggml_nbytes(tensor);
-            model.n_loaded++;
+        if (acc + cur > max_len && i > 0 && should_split_on_word(txt, split_on_word)) {
+            state.result_all.back().text = std::move(text);
+            state.result_all.back().t1 = token.t0;
+            state.result_all.back().tokens.resize(i);
+            state.result_all.back().speaker_turn_next = false;
+
+            state.result_all.push_back({});
+            state.result_all.back().t0 = token.t0;
+            state.result_all.back().t1 = segment.t1;
+
+            // add tokens [i, end] to the new segment
+            state.result_all.back().tokens.insert(
+                state.result_all.back().tokens.end(),
+                    segment.tokens.begin() + i,
+                    segment.tokens.end());
+
+            state.result_all.back().speaker_turn_next = segment.speaker_turn_next;
+
+            acc = 0;
+            text = "";
+
+            segment = state.result_all.back();
+            i = -1;
+
+            res++;
+        } else {
+            acc += cur;
+            text += txt;
         }
+    }
 
-        WHISPER_LOG_INFO("%s: model size    = %7.2f MB\n", __func__, total_size/1e6);
+    state.result_all.back().text = std::move(text);
 
-        if (model.n_loaded == 0) {
-            WHISPER_LOG_WARN("%s: WARN no tensors loaded from model file - assuming empty model for testing\n", __func__);
-        } else if (model.n_loaded != (int) model.tensors.size()) {
-            WHISPER_LOG_ERROR("%s: ERROR not all tensors loaded from model file - expected %zu, got %d\n", __func__, model.tensors.size(), model.n_loaded);
-            return nullptr;
+    return res;
+}
+
+static const std::vector<std::string> non_speech_tokens = {
+    "\"", "#", "(", ")", "*", "+", "/", ":", ";", "<", "=", ">", "@", "[", "\\", "]", "^",
+    "_", "`", "{", "|", "}", "~", "「", "」", "『", "』", "<<", ">>", "<<<", ">>>", "--",
+    "---", "-(", "-[", "('", "(\"", "((", "))", "(((", ")))", "[[", "]]", "{{", "}}", "♪♪",
+    "♪♪♪","♩", "♪", "♫", "♬", "♭", "♮", "♯"
+};
+
+// max of x[0] .. x[n - 1], in independent lanes so that the loop vectorizes
+static float whisper_vec_max(const float * x, int n) {
+    float m[8] = { -INFINITY, -INFINITY, -INFINITY, -INFINITY, -INFINITY, -INFINITY, -INFINITY, -INFINITY, };
+
+    int i = 0;
+    for (; i + 8 <= n; i += 8) {
+        for (int j = 0; j < 8; ++j) {
+            m[j] = std::max(m[j], x[i + j]);
         }
+    }
 
+    float res = -INFINITY;
+    for (int j = 0; j < 8; ++j) {
+        res = std::max(res, m[j]);
+    }
+    for (; i < n; ++i) {
+        res = std::max(res, x[i]);
     }
 
-    if (!whisper_vad_init_context(vctx)) {
-        whisper_vad_free(vctx);
-        return nullptr;
+    return res;
+}
+
+static void whisper_compute_logprobs(
+                const std::vector<float> & logits,
+                              const int    n_logits,
+                      std::vector<float> & logprobs) {
+    const float logit_max = whisper_vec_max(logits.data(), n_logits);
+
+    // expf(-INFINITY) == 0.0f, the suppressed tokens do not need a branch
+    float logsumexp = 0.0f;
+    for (int i = 0; i < n_logits; ++i) {
+        logsumexp += expf(logits[i] - logit_max);
     }
+    logsumexp = logf(logsumexp) + logit_max;
 
-    return vctx;
+    for (int i = 0; i < n_logits; ++i) {
+        logprobs[i] = logits[i] - logsumexp;
+    }
 }
 
-bool whisper_vad_detect_speech(
-        struct whisper_vad_context * vctx,
-        const float * samples,
-        int n_samples) {
-    int n_chunks = n_samples / vctx->n_window;
-    if (n_samples % vctx->n_window != 0) {
-        n_chunks += 1;  // Add one more chunk for remaining samples.
+static void whisper_compute_probs(
+    const std::vector<float> & logits,
+                  const int    n_logits,
+    const std::vector<float> & logprobs,
+          std::vector<float> & probs)     {
+    for (int i = 0; i < n_logits; ++i) {
+        if (logits[i] == -INFINITY) {
+            probs[i] = 0.0f;
+        } else {
+            probs[i] = expf(logprobs[i]);
+        }
     }
+}
 
-    WHISPER_LOG_INFO("%s: detecting speech in %d samples\n", __func__, n_samples);
-    WHISPER_LOG_INFO("%s: n_chunks: %d\n", __func__, n_chunks);
+static void whisper_mask_set(std::vector<uint64_t> & mask, int i0, int i1) {
+    for (int i = i0; i < i1; ++i) {
+        mask[i >> 6] |= uint64_t(1) << (i & 63);
+    }
+}
 
-    // Reset LSTM hidden/cell states
-    ggml_backend_buffer_clear(vctx->buffer, 0);
+static void whisper_logits_mask_init(
+              struct whisper_context & ctx,
+    const struct whisper_full_params & params,
+         struct whisper_logits_mask & mask) {
+    const auto & vocab = ctx.vocab;
 
-    vctx->probs.resize(n_chunks);
-    WHISPER_LOG_INFO("%s: props size: %u\n", __func__, n_chunks);
+    const int n_logits = vocab.n_vocab;
+    const int n_words  = (n_logits + 63)/64;
 
-    std::vector<float> window(vctx->n_window, 0.0f);
+    auto & base = mask.base;
+    auto & post = mask.post;
 
-    auto & sched = vctx->sched.sched;
+    base.assign(n_words, 0);
+    post.assign(n_words, 0);
 
-    ggml_cgraph * gf = whisper_vad_build_graph(*vctx);
+    // suppress <|notimestamps|> token
+    // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L410-L412
+    whisper_mask_set(base, vocab.token_not, vocab.token_not + 1);
+    if (params.no_timestamps) {
+        whisper_mask_set(base, vocab.token_beg, n_logits);
+    }
 
-    if (!ggml_backend_sched_alloc_graph(sched, gf)) {
-        WHISPER_LOG_ERROR("%s: failed to allocate the compute buffer\n", __func__);
-        return false;
+    // suppress sot and nosp tokens
+    whisper_mask_set(base, vocab.token_sot,  vocab.token_sot  + 1);
+    whisper_mask_set(base, vocab.token_nosp, vocab.token_nosp + 1);
+
+    // [TDRZ] when tinydiarize is disabled, suppress solm token
+    if (params.tdrz_enable == false) {
+        whisper_mask_set(base, vocab.token_solm, vocab.token_solm + 1);
     }
 
-    struct ggml_tensor * frame = ggml_graph_get_tensor(gf, "frame");
-    struct ggml_tensor * prob  = ggml_graph_get_tensor(gf, "prob");
+    // suppress task tokens
+    whisper_mask_set(base, vocab.token_translate,  vocab.token_translate  + 1);
+    whisper_mask_set(base, vocab.token_transcribe, vocab.token_transcribe + 1);
+    whisper_mask_set(base, vocab.token_prev,       vocab.token_prev       + 1);
 
-    // we are going to reuse the graph multiple times for each chunk
-    const int64_t t_start_vad_us = ggml_time_us();
+    // suppress lang tokens
+    whisper_mask_set(base, whisper_token_lang(&ctx, 0), whisper_token_lang(&ctx, 0) + g_lang.size());
 
-    for (int i = 0; i < n_chunks; i++) {
-        const int idx_start = i * vctx->n_window;
-        const int idx_end = std::min(idx_start + vctx->n_window, n_samples);
+    if (params.suppress_regex == nullptr && !params.suppress_nst) {
+        return;
+    }
 
-        const int chunk_len = idx_end - idx_start;
+    // the cache is cleared when full, in case the regex varies per call
+    const int n_max_cached = 64;
 
-        if (chunk_len < vctx->n_window) {
-            WHISPER_LOG_INFO("%s: chunk_len: %d < n_window: %d\n", __func__, chunk_len, vctx->n_window);
-            std::vector<float> partial_chunk(vctx->n_window, 0.0f);
-            std::copy(samples + idx_start, samples + idx_end, partial_chunk.begin());
+    auto & cache = ctx.logits_mask_cache;
 
-            // Copy the zero-padded chunk to the window.
-            const int samples_to_copy_max = vctx->n_window;
-            const int samples_to_copy_cur = std::min(samples_to_copy_max, (int)partial_chunk.size());
-            std::copy(partial_chunk.begin(), partial_chunk.begin() + samples_to_copy_cur, window.begin());
-            if (samples_to_copy_cur < samples_to_copy_max) {
-                std::fill(window.begin() + samples_to_copy_cur, window.end(), 0.0f);
-            }
-        } else {
-            // Copy current frame samples to the window.
-            const int samples_to_copy = std::min(idx_end - idx_start, vctx->n_window);
-            std::copy(samples + idx_start, samples + idx_start + samples_to_copy, window.begin());
+    const auto key = std::make_tuple(std::string(params.suppress_regex ? params.suppress_regex : ""), params.suppress_regex != nullptr, params.suppress_nst);
+
+    {
+        std::lock_guard<std::mutex> lock(cache.mutex);
+
+        const auto it = cache.post.find(key);
+        if (it != cache.post.end()) {
+            post = it->second;
+            return;
         }
+    }
 
-        // Set the frame tensor data with the samples.
-        ggml_backend_tensor_set(frame, window.data(), 0, ggml_nelements(frame) * sizeof(float));
+    // built without the lock, the states setting up with cached params do not wait for the scan of the vocabulary
+    // two states with the same new params may both build the mask, the second one replaces the first in the cache
 
-        // do not reset the scheduler - we will reuse the graph in the next chunk
-        if (!ggml_graph_compute_helper(sched, gf, vctx->n_threads, false)) {
-            WHISPER_LOG_ERROR("%s: failed to compute VAD graph\n", __func__);
-            break;
+    // suppress any tokens matching a regular expression
+    // ref: https://github.com/openai/whisper/discussions/1041
+    if (params.suppress_regex != nullptr) {
+        try {
+            std::regex re(params.suppress_regex);
+            for (int id = 0; id < vocab.n_tokens(); ++id) {
+                const char * text = vocab.token_text(id);
+                if (std::regex_match(text, text + vocab.token_size(id), re)) {
+                    whisper_mask_set(post, id, id + 1);
+                }
+            }
+        } catch (const std::regex_error & e) {
+            WHISPER_LOG_ERROR("%s: invalid suppress_regex '%s': %s\n", __func__, params.suppress_regex, e.what());
         }
+    }
 
-        // Get the probability for this chunk.
-        ggml_backend_tensor_get(prob, &vctx->probs[i], 0, sizeof(float));
+    // suppress non-speech tokens
+    // ref: https://github.com/openai/whisper/blob/7858aa9c08d98f75575035ecd6481f462d66ca27/whisper/tokenizer.py#L224-L253
+    if (params.suppress_nst) {
+        for (const std::string & token : non_speech_tokens) {
+            const std::string suppress_tokens[] = {token, " " + token};
+            for (const std::string & suppress_token : suppress_tokens) {
+                const whisper_vocab::id id = whisper_token_find(vocab, suppress_token);
+                if (id >= 0) {
+                    whisper_mask_set(post, id, id + 1);
+                }
+            }
+        }
 
-        //WHISPER_LOG_DEBUG("chunk %d: p = %7.3f\n", i, probs[i]);
+        // allow hyphens "-" and single quotes "'" between words, but not at the beginning of a word
+        for (const char * token : { " -", " '" }) {
+            const whisper_vocab::id id = whisper_token_find(vocab, token);
+            if (id >= 0) {
+                whisper_mask_set(post, id, id + 1);
+            }
+        }
     }
 
-    vctx->t_vad_us += ggml_time_us() - t_start_vad_us;
-    WHISPER_LOG_INFO("%s: vad time = %.2f ms processing %d samples\n", __func__, 1e-3f * vctx->t_vad_us, n_samples);
+    std::lock_guard<std::mutex> lock(cache.mutex);
 
-    ggml_backend_sched_reset(sched);
+    if ((int) cache.post.size() >= n_max_cached) {
+        cache.post.clear();
+    }
 
-    return true;
+    cache.post[key] = post;
 }
 
-int whisper_vad_segments_n_segments(struct whisper_vad_segments * segments) {
-    return segments->data.size();
-}
+// dst[i] = src[i]/temperature, or -INFINITY for the tokens in mask
+// the mask is processed in words of 64 tokens, so that the common words (none or all suppressed) are plain
+// vectorizable loops
+static void whisper_logits_masked_copy(
+                  float * dst,
+            const float * src,
+    const std::vector<uint64_t> & mask,
+                    int   n_logits,
+                  float   temperature) {
+    const float t = temperature > 0.0f ? temperature : 1.0f;
 
-float whisper_vad_segments_get_segment_t0(struct whisper_vad_segments * segments, int i_segment) {
-    return segments->data[i_segment].start;
-}
+    for (int i0 = 0; i0 < n_logits; i0 += 64) {
+        const int      i1 = std::min(i0 + 64, n_logits);
+        const uint64_t m  = mask[i0 >> 6];
 
-float whisper_vad_segments_get_segment_t1(struct whisper_vad_segments * segments, int i_segment) {
-    return segments->data[i_segment].end;
+        if (m == 0) {
+            for (int i = i0; i < i1; ++i) {
+                dst[i] = src[i]/t;
+            }
+        } else if (m == ~uint64_t(0)) {
+            for (int i = i0; i < i1; ++i) {
+                dst[i] = -INFINITY;
+            }
+        } else {
+            for (int i = i0; i < i1; ++i) {
+                dst[i] = (m >> (i - i0)) & 1 ? -INFINITY : src[i]/t;
+            }
+        }
+    }
 }
 
-int whisper_vad_n_probs(struct whisper_vad_context * vctx) {
-    return vctx->probs.size();
-}
+static void whisper_logits_mask_apply(float * logits, const std::vector<uint64_t> & mask, int n_logits) {
+    for (int i0 = 0; i0 < n_logits; i0 += 64) {
+        const uint64_t m = mask[i0 >> 6];
+        if (m == 0) {
+            continue;
+        }
 
-float * whisper_vad_probs(struct whisper_vad_context * vctx) {
-    return vctx->probs.data();
+        for (int i = i0; i < std::min(i0 + 64, n_logits); ++i) {
+            if ((m >> (i - i0)) & 1) {
+                logits[i] = -INFINITY;
+            }
+        }
+    }
 }
 
-struct whisper_vad_segments * whisper_vad_segments_from_probs(
-        struct whisper_vad_context *  vctx,
-                whisper_vad_params    params) {
-    WHISPER_LOG_INFO("%s: detecting speech timestamps using %d probabilities\n", __func__, whisper_vad_n_probs(vctx));
+// process the logits for the selected decoder
+// - applies logit filters
+// - computes logprobs and probs
+// mask holds the tokens suppressed at every step (whisper_logits_mask_init() with the same params)
+static void whisper_process_logits(
+              struct whisper_context & ctx,
+               struct whisper_state  & state,
+              struct whisper_decoder & decoder,
+    const struct whisper_full_params   params,
+    const struct whisper_logits_mask & mask,
+                               float   temperature) {
+    const auto & vocab      = ctx.vocab;
+    const auto & tokens_cur = decoder.sequence.tokens;
 
-    int     n_probs                 = whisper_vad_n_probs(vctx);
-    float * probs                   = whisper_vad_probs(vctx);
-    float   threshold               = params.threshold;
-    int     min_speech_duration_ms  = params.min_speech_duration_ms;
-    int     min_silence_duration_ms = params.min_silence_duration_ms;
-    float   max_speech_duration_s   = params.max_speech_duration_s;
-    int     speech_pad_ms           = params.speech_pad_ms;
-    int     n_window                = vctx->n_window;
-    int     sample_rate             = WHISPER_SAMPLE_RATE;
-    int     min_silence_samples     = sample_rate * min_silence_duration_ms / 1000;
-    int     audio_length_samples    = n_probs * n_window;
+    const bool is_initial = tokens_cur.size() == 0;
+    const int  n_logits   = vocab.n_tokens();
 
-    // Min number of samples to be considered valid speech.
-    int     min_speech_samples      = sample_rate * min_speech_duration_ms / 1000;
-    int     speech_pad_samples      = sample_rate * speech_pad_ms / 1000;
+    WHISPER_ASSERT(n_logits == ctx.vocab.n_vocab);
+    WHISPER_ASSERT((int) mask.base.size()*64 >= n_logits);
 
-    // Max number of samples that a speech segment can contain before it is
-    // split into multiple segments.
-    int max_speech_samples;
-    if (max_speech_duration_s > 100000.0f) {
-        max_speech_samples = INT_MAX / 2;
-    } else {
-        int64_t temp = (int64_t)sample_rate * (int64_t)(max_speech_duration_s) - n_window - 2 * speech_pad_samples;
-        max_speech_samples = (temp > INT_MAX) ? INT_MAX / 2 : (int)temp;
-        if (max_speech_samples < 0) {
-            max_speech_samples = INT_MAX / 2;
-        }
-    }
-    // Detect silence period that exceeds this value, then that location (sample)
-    // is marked as a potential place where the segment could be split if
-    // max_speech_samples is reached. The value 98 was taken from the original
-    // silaro-vad python implementation:
-    //https://github.com/snakers4/silero-vad/blob/0dd45f0bcd7271463c234f3bae5ad25181f9df8b/src/silero_vad/utils_vad.py#L291
-    int min_silence_samples_at_max_speech = sample_rate * 98 / 1000;
+    // extract the logits for the last token
+    // we will be mutating, and therefore we don't want to use the ctx.logits buffer directly
+    auto & probs    = decoder.probs;
+    auto & logits   = decoder.logits;
+    auto & logprobs = decoder.logprobs;
+    {
+        logits.resize(n_logits);
+        probs.resize(n_logits);
+        logprobs.resize(n_logits);
 
-    // Calculate lower threshold for detecting end of speech segments.
-    float neg_threshold = threshold - 0.15f;
-    if (neg_threshold < 0.01f) {
-        neg_threshold = 0.01f;
+        // temperature and the static filters (no timestamps, special, task and lang tokens) in the same pass
+        whisper_logits_masked_copy(logits.data(), state.logits.data() + decoder.i_batch*n_logits, mask.base, n_logits, temperature);
     }
 
-    struct speech_segment_t {
-        int start;
-        int end;
+    const auto suppress = [&](int i0, int i1) {
+        std::fill(logits.begin() + i0, logits.begin() + std::max(i0, i1), -INFINITY);
     };
 
-    std::vector<speech_segment_t> speeches;
-    speeches.reserve(256);
-
-    bool is_speech_segment = false;
-    int  temp_end          = 0;
-    int  prev_end          = 0;
-    int  next_start        = 0;
-    int  curr_speech_start = 0;
-    bool has_curr_speech   = false;
+    // sum of the exponentials left in probs, 0 if they have to be recomputed from the logprobs
+    float expsum = 0.0f;
 
-    for (int i = 0; i < n_probs; i++) {
-        float curr_prob   = probs[i];
-        int   curr_sample = n_window * i;
+    // apply logit filters here
+    // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L480-L493
+    {
+        // suppress blank
+        // https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L388-L390
+        if (params.suppress_blank) {
+            if (is_initial) {
+                logits[vocab.token_eot] = -INFINITY;
 
-        // Reset temp_end when we get back to speech
-        if ((curr_prob >= threshold) && temp_end) {
-            temp_end = 0;
-            if (next_start < prev_end) {
-                next_start = curr_sample;
+                const whisper_token id_space = whisper_token_find(vocab, " ");
+                if (id_space >= 0) {
+                    logits[id_space] = -INFINITY;
+                }
             }
         }
 
-        // Start a new speech segment when probability exceeds threshold and not already in speech
-        if ((curr_prob >= threshold) && !is_speech_segment) {
-            is_speech_segment = true;
-            curr_speech_start = curr_sample;
-            has_curr_speech = true;
-            continue;
+        if (params.logits_filter_callback) {
+            params.logits_filter_callback(&ctx, &state, tokens_cur.data(), tokens_cur.size(), logits.data(), params.logits_filter_callback_user_data);
         }
 
-        // Handle maximum speech duration
-        if (is_speech_segment && (curr_sample - curr_speech_start) > max_speech_samples) {
-            if (prev_end) {
-                speeches.push_back({ curr_speech_start, prev_end });
-                has_curr_speech = true;
+        // suppress_regex and suppress_nst
+        whisper_logits_mask_apply(logits.data(), mask.post, n_logits);
 
-                if (next_start < prev_end) {  // Previously reached silence and is still not speech
-                    is_speech_segment = false;
-                    has_curr_speech = false;
+        // timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
+        // https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L414-L424
+        {
+            const bool last_was_timestamp        = tokens_cur.size() > 0 && tokens_cur.back().id >= vocab.token_beg;
+            const bool penultimate_was_timestamp = tokens_cur.size() < 2 || tokens_cur[tokens_cur.size() - 2].id >= vocab.token_beg;
+
+            //WHISPER_LOG_INFO("last_was_timestamp=%d penultimate_was_timestamp=%d\n", last_was_timestamp, penultimate_was_timestamp);
+
+            if (last_was_timestamp) {
+                if (penultimate_was_timestamp) {
+                    suppress(vocab.token_beg, n_logits);
                 } else {
-                    curr_speech_start = next_start;
+                    suppress(0, vocab.token_eot);
                 }
-                prev_end = next_start = temp_end = 0;
-            } else {
-                speeches.push_back({ curr_speech_start, curr_sample });
+            }
+        }
 
-                prev_end = next_start = temp_end = 0;
-                is_speech_segment = false;
-                has_curr_speech = false;
-                continue;
+        // the initial timestamp cannot be larger than max_initial_ts
+        // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L426-L429
+        if (is_initial && params.max_initial_ts > 0.0f) {
+            const float precision = float(WHISPER_CHUNK_SIZE)/ctx.model.hparams.n_audio_ctx;
+            const int   tid0      = std::round(params.max_initial_ts/precision);
+
+            suppress(std::min(vocab.token_beg + tid0 + 1, n_logits), n_logits);
+        }
+
+        // condition timestamp tokens to be increasing
+        // ref: https://github.com/openai/whisper/pull/831#issuecomment-1385910556
+        if (decoder.has_ts) {
+            const int tid0 = decoder.seek_delta/2;
+
+            suppress(vocab.token_beg, std::min(vocab.token_beg + tid0, n_logits));
+        }
+
+        // populate the logprobs array (log_softmax)
+        // the maxima of the text and the timestamp logprobs follow from the logits, as all logprobs are shifted
+        // by the same constant. probs holds the exponentials until they are normalized below
+        float text_max = whisper_vec_max(logits.data(),                   vocab.token_beg);
+        float ts_max   = whisper_vec_max(logits.data() + vocab.token_beg, n_logits - vocab.token_beg);
+        {
+            const float logit_max = std::max(text_max, ts_max);
+
+            for (int i = 0; i < n_logits; ++i) {
+                probs[i] = expf(logits[i] - logit_max);
+                expsum += probs[i];
             }
+
+            const float logsumexp = logf(expsum) + logit_max;
+
+            for (int i = 0; i < n_logits; ++i) {
+                logprobs[i] = logits[i] - logsumexp;
+            }
+
+            text_max -= logsumexp;
+            ts_max   -= logsumexp;
         }
 
-        // Handle silence after speech
-        if ((curr_prob < neg_threshold) && is_speech_segment) {
-            if (!temp_end) {
-                temp_end = curr_sample;
+        // if sum of probability over timestamps is above any other token, sample timestamp
+        // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L431-L437
+        {
+            // logsumexp over timestamps
+            float timestamp_logprob = -INFINITY;
+            if (ts_max > -INFINITY) {
+                float logsumexp = 0.0f;
+                for (int i = vocab.token_beg; i < n_logits; ++i) {
+                    logsumexp += expf(logprobs[i] - ts_max);
+                }
+                timestamp_logprob = logf(logsumexp) + ts_max;
             }
 
-            // Track potential segment ends for max_speech handling
-            if ((curr_sample - temp_end) > min_silence_samples_at_max_speech) {
-                prev_end = temp_end;
-            }
+            const float max_text_token_logprob = text_max;
 
-            // Check if silence is long enough to end the segment
-            if ((curr_sample - temp_end) < min_silence_samples) {
-                continue;
+            //WHISPER_LOG_INFO("timestamp_logprob=%f max_text_token_logprob=%f\n", timestamp_logprob, max_text_token_logprob);
+
+            if (timestamp_logprob > max_text_token_logprob) {
+                suppress(0, vocab.token_beg);
+                std::fill(logprobs.begin(), logprobs.begin() + vocab.token_beg, -INFINITY);
+                std::fill(probs.begin(),    probs.begin()    + vocab.token_beg, 0.0f);
             } else {
-                // End the segment if it's long enough
-                if ((temp_end - curr_speech_start) > min_speech_samples) {
-                    speeches.push_back({ curr_speech_start, temp_end });
-                }
+                if (params.n_grammar_rules > 0) {
+                    whisper_suppress_invalid_grammar(ctx, params, logits, decoder.grammar);
 
-                prev_end = next_start = temp_end = 0;
-                is_speech_segment = false;
-                has_curr_speech = false;
-                continue;
+                    // populate the logprobs array (log_softmax)
+                    whisper_compute_logprobs(logits, n_logits, logprobs);
+
+                    expsum = 0.0f;
+                }
             }
         }
     }
 
-    // Handle the case if we're still in a speech segment at the end
-    if (has_curr_speech && (audio_length_samples - curr_speech_start) > min_speech_samples) {
-        speeches.push_back({ curr_speech_start, audio_length_samples });
+    // compute probs
+    if (expsum > 0.0f) {
+        const float scale = 1.0f/expsum;
+        for (int i = 0; i < n_logits; ++i) {
+            probs[i] *= scale;
+        }
+    } else {
+        whisper_compute_probs(logits, n_logits, logprobs, probs);
     }
 
-    // Merge adjacent segments with small gaps in between (post-processing)
-    if (speeches.size() > 1) {
-        int merged_count = 0;
-        for (int i = 0; i < (int) speeches.size() - 1; i++) {
-            // Define maximum gap allowed for merging (e.g., 200ms converted to samples)
-            int max_merge_gap_samples = sample_rate * 200 / 1000;
+    // the most probable token (the first one, as in whisper_sample_token())
+    {
+        const float p_best = whisper_vec_max(probs.data(), n_logits);
 
-            // If the gap between this segment and the next is small enough
-            if (speeches[i+1].start - speeches[i].end < max_merge_gap_samples) {
-                // Merge by extending current segment to the end of next segment
-                speeches[i].end = speeches[i+1].end;
-                speeches.erase(speeches.begin() + i + 1);
+        decoder.id_best = p_best > 0.0f ? std::find(probs.begin(), probs.end(), p_best) - probs.begin() : -1;
+    }
 
-                i--;
-                merged_count++;
-            }
+#if 0
+    // print first 100 logits - token string : logit
+    //for (int i = 0; i < 10; i++) {
+    //    const auto token   = vocab.token_text(i);
+    //    const auto prob    = probs[i];
+    //    const auto logit   = logits[i];
+    //    const auto logprob = logprobs[i];
+    //    printf("%16s : prob=%9.5f logit=%9.5f logprob=%9.5f\n", token, prob, logit, logprob);
+    //}
+
+    // print sorted
+    {
+        std::vector<std::pair<float, int>> pairs;
+
+        for (int i = 0; i < n_logits; ++i) {
+            pairs.push_back(std::make_pair(probs[i], i));
         }
-        WHISPER_LOG_INFO("%s: Merged %d adjacent segments, now have %d segments\n",
-                         __func__, merged_count, (int) speeches.size());
-    }
 
-    // Double-check for minimum speech duration
-    for (int i = 0; i < (int) speeches.size(); i++) {
-        if (speeches[i].end - speeches[i].start < min_speech_samples) {
-            WHISPER_LOG_INFO("%s: Removing segment %d (too short: %d samples)\n",
-                            __func__, i, speeches[i].end - speeches[i].start);
+        std::sort(pairs.begin(), pairs.end(), [](const std::pair<float, int>& a, const std::pair<float, int>& b) {
+            return a.first > b.first;
+        });
 
-            speeches.erase(speeches.begin() + i);
-            i--;
+        for (int i = 0; i < 10; i++) {
+            const auto token   = vocab.token_text(pairs[i].second);
+            const auto prob    = pairs[i].first;
+            const auto logit   = logits[pairs[i].second];
+            const auto logprob = logprobs[pairs[i].second];
+            printf("%16s : id=%6d prob=%9.5f logit=%9.5f logprob=%9.5f '%s'\n", token, pairs[i].second, prob, logit, logprob, token);
         }
+
+        printf("----------------\n");
     }
 
-    WHISPER_LOG_INFO("%s: Final speech segments after filtering: %d\n", __func__, (int) speeches.size());
+    // "And", "and", " And", " and"
+    //printf("logits[\"and\"]  = %f\n", logits[whisper_token_find(vocab, "and")]);
+    //printf("logits[\"And\"]  = %f\n", logits[whisper_token_find(vocab, "And")]);
+    //printf("logits[\" and\"] = %f\n", logits[whisper_token_find(vocab, " and")]);
+    //printf("logits[\" And\"] = %f\n", logits[whisper_token_find(vocab, " And")]);
+    //printf("logits[\" so\"]  = %f\n", logits[whisper_token_find(vocab, " so")]);
+
+    //printf("logprobs[\"and\"]  = %f\n", logprobs[whisper_token_find(vocab, "and")]);
+    //printf("logprobs[\"And\"]  = %f\n", logprobs[whisper_token_find(vocab, "And")]);
+    //printf("logprobs[\" and\"] = %f\n", logprobs[whisper_token_find(vocab, " and")]);
+    //printf("logprobs[\" And\"] = %f\n", logprobs[whisper_token_find(vocab, " And")]);
+    //printf("logprobs[\" so\"]  = %f\n", logprobs[whisper_token_find(vocab, " so")]);
+
+    //printf("probs[\"and\"]  = %f\n", probs[whisper_token_find(vocab, "and")]);
+    //printf("probs[\"And\"]  = %f\n", probs[whisper_token_find(vocab, "And")]);
+    //printf("probs[\" and\"] = %f\n", probs[whisper_token_find(vocab, " and")]);
+    //printf("probs[\" And\"] = %f\n", probs[whisper_token_find(vocab, " And")]);
+    //printf("probs[\" so\"]  = %f\n", probs[whisper_token_find(vocab, " so")]);
+#endif
+}
 
-    // Allocate final segments
-    std::vector<whisper_vad_segment> segments;
-    if (speeches.size() > 0) {
-        try {
-            segments.resize(speeches.size());
-        } catch (const std::bad_alloc &) {
-            WHISPER_LOG_ERROR("%s: failed to allocate memory for final segments\n", __func__);
-            return nullptr;
+static bool whisper_sequence_tokens_equal(const whisper_sequence & a, const whisper_sequence & b) {
+    if (a.tokens.size() != b.tokens.size()) {
+        return false;
+    }
+    // sequences are more likely to diverge at the end
+    for (int i = a.tokens.size() - 1; i >= 0; i--) {
+        if (a.tokens[i].id != b.tokens[i].id) {
+            return false;
         }
     }
+    return true;
+}
 
-    // Apply padding to segments and copy to final segments
-    for (int i = 0; i < (int) speeches.size(); i++) {
-        // Apply padding to the start of the first segment
-        if (i == 0) {
-            speeches[i].start =
-                (speeches[i].start > speech_pad_samples) ?
-                (speeches[i].start - speech_pad_samples) : 0;
-        }
+// prepare decoder.cdf for sampling from decoder.probs
+// the same draws as std::discrete_distribution (libstdc++) for the same rng state, without its allocations
+static void whisper_sample_init(whisper_decoder & decoder, int n_logits) {
+    const auto & probs = decoder.probs;
 
-        // Handle spacing between segments
-        if (i < (int) speeches.size() - 1) {
-            int silence_duration = speeches[i+1].start - speeches[i].end;
+    auto & cdf = decoder.cdf;
 
-            if (silence_duration < 2 * speech_pad_samples) {
-                // If segments are close, split the difference
-                speeches[i].end += silence_duration / 2;
-                speeches[i+1].start =
-                    (speeches[i+1].start > silence_duration / 2) ?
-                    (speeches[i+1].start - silence_duration / 2) : 0;
-            } else {
-                // Otherwise, apply full padding to both
-                speeches[i].end =
-                    (speeches[i].end + speech_pad_samples < audio_length_samples) ?
-                    (speeches[i].end + speech_pad_samples) : audio_length_samples;
-                speeches[i+1].start =
-                    (speeches[i+1].start > speech_pad_samples) ?
-                    (speeches[i+1].start - speech_pad_samples) : 0;
-            }
-        } else {
-            // Apply padding to the end of the last segment
-            speeches[i].end =
-                (speeches[i].end + speech_pad_samples < audio_length_samples) ?
-                (speeches[i].end + speech_pad_samples) : audio_length_samples;
-        }
+    double sum = 0.0;
+    for (int i = 0; i < n_logits; ++i) {
+        sum += probs[i];
+    }
 
-        // Convert from samples to centiseconds
-        segments[i].start = samples_to_cs(speeches[i].start);
-        segments[i].end   = samples_to_cs(speeches[i].end);
+    cdf.resize(n_logits);
 
-        WHISPER_LOG_INFO("%s: VAD segment %d: start = %.2f, end = %.2f (duration: %.2f)\n",
-                        __func__, i, segments[i].start/100.0, segments[i].end/100.0, (segments[i].end - segments[i].start)/100.0);
+    double acc = 0.0;
+    for (int i = 0; i < n_logits; ++i) {
+        acc += probs[i]/sum;
+        cdf[i] = acc;
     }
+    cdf[n_logits - 1] = 1.0;
+}
 
-    whisper_vad_segments * vad_segments = new whisper_vad_segments;
-    if (vad_segments == NULL) {
-        WHISPER_LOG_ERROR("%s: failed to allocate memory for whisper_vad_segments\n", __func__);
-        return nullptr;
+static whisper_token whisper_sample(const whisper_decoder & decoder) {
+    const double p = std::generate_canonical<double, std::numeric_limits<double>::digits>(decoder.rng);
+
+    return std::lower_bound(decoder.cdf.begin(), decoder.cdf.end(), p) - decoder.cdf.begin();
+}
+
+static whisper_token_data whisper_sample_token(
+            whisper_context & ctx,
+            whisper_decoder & decoder,
+                       bool   best) {
+    whisper_token_data result = {
+        0, 0, 0.0f, 0.0f, 0.0f, 0.0f, -1, -1, -1, 0.0f,
+    };
+
+    const auto & vocab = ctx.vocab;
+
+    const auto & probs    = decoder.probs;
+    const auto & logprobs = decoder.logprobs;
+
+    const int n_logits = vocab.n_vocab;
+
+    {
+        double sum_ts = 0.0;
+        double max_ts = 0.0;
+
+        for (int i = vocab.token_beg; i < n_logits; i++) {
+            if (probs[i] == -INFINITY) {
+                continue;
+            }
+
+            sum_ts += probs[i];
+            if (max_ts < probs[i]) {
+                max_ts = probs[i];
+                result.tid = i;
+            }
+        }
+
+        result.pt    = max_ts/(sum_ts + 1e-10);
+        result.ptsum = sum_ts;
     }
 
-    vad_segments->data = std::move(segments);
+    if (best) {
+        // found by whisper_process_logits()
+        if (decoder.id_best >= 0) {
+            result.id   = decoder.id_best;
+            result.p    = probs[result.id];
+            result.plog = logprobs[result.id];
+        }
+    } else {
+        whisper_sample_init(decoder, n_logits);
 
-    return vad_segments;
-}
+        result.id   = whisper_sample(decoder);
+        result.p    = probs[result.id];
+        result.plog = logprobs[result.id];
+    }
 
-struct whisper_vad_segments * whisper_vad_segments_from_samples(
-        whisper_vad_context * vctx,
-        whisper_vad_params params,
-        const float * samples,
-        int n_samples) {
-    WHISPER_LOG_INFO("%s: detecting speech timestamps in %d samples\n", __func__, n_samples);
-    if (!whisper_vad_detect_speech(vctx, samples, n_samples)) {
-        WHISPER_LOG_ERROR("%s: failed to detect speech\n", __func__);
-        return nullptr;
+    if (result.id >= vocab.token_beg) {
+        result.tid = result.id;
+        result.pt  = result.p;
     }
-    return whisper_vad_segments_from_probs(vctx, params);
+
+    return result;
 }
 
-void whisper_vad_free(whisper_vad_context * ctx) {
-    if (ctx) {
-        if (ctx->buffer) {
-            ggml_backend_buffer_free(ctx->buffer);
-        }
-        for (ggml_context * context : ctx->model.ctxs) {
-            ggml_free(context);
-        }
+static std::vector<whisper_token_data> whisper_sample_token_topk(
+            whisper_context & ctx,
+            whisper_decoder & decoder,
+                        int   k) {
+    const auto & vocab = ctx.vocab;
 
-        for (ggml_backend_buffer_t buf : ctx->model.buffers) {
-            ggml_backend_buffer_free(buf);
-        }
+    const auto & probs    = decoder.probs;
+    const auto & logprobs = decoder.logprobs;
 
-        ggml_backend_sched_free(ctx->sched.sched);
+    const int n_logits = vocab.n_vocab;
 
-        for (auto & backend : ctx->backends) {
-            ggml_backend_free(backend);
-        }
+    std::vector<whisper_token_data> result;
+    result.reserve(k);
 
-        delete[] ctx->model.hparams.encoder_in_channels;
-        delete[] ctx->model.hparams.encoder_out_channels;
-        delete[] ctx->model.hparams.kernel_sizes;
+    whisper_token tid = vocab.token_beg;
+
+    float pt    = 0.0;
+    float ptsum = 0.0;
+
+    {
+        double sum_ts = 0.0;
+        double max_ts = 0.0;
+
+        for (int i = vocab.token_beg; i < n_logits; i++) {
+            if (probs[i] == -INFINITY) {
+                continue;
+            }
+
+            sum_ts += probs[i];
+            if (max_ts < probs[i]) {
+                max_ts = probs[i];
+                tid = i;
+            }
+        }
 
-        delete ctx;
+        pt    = max_ts/(sum_ts + 1e-10);
+        ptsum = sum_ts;
     }
-}
 
-void whisper_vad_free_segments(whisper_vad_segments * segments) {
-    if (segments) {
-        delete segments;
-    }
-}
+    // the candidates are drawn from the distribution
+    whisper_sample_init(decoder, n_logits);
 
-//////////////////////////////////
-// Grammar - ported from llama.cpp
-//////////////////////////////////
+    for (int i = 0; i < k; ++i) {
+        const auto id = whisper_sample(decoder);
+        //printf("XXX %d %d %f %f %f %f\n", id, tid, probs[id], logprobs[id], pt, ptsum);
 
-// Decodes a UTF-8 string which may end in an incomplete sequence. Adds a terminating 0 for use as
-// pointer. If an invalid sequence is encountered, returns `whisper_partial_utf8.n_remain == -1`.
-static std::pair<std::vector<uint32_t>, whisper_partial_utf8> decode_utf8(
-        const char         * src,
-        whisper_partial_utf8   partial_start) {
-    static const int      lookup[] = { 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 2, 2, 3, 4 };
-    const char          * pos      = src;
-    std::vector<uint32_t> code_points;
-    uint32_t              value    = partial_start.value;
-    int                   n_remain = partial_start.n_remain;
+        result.push_back({ id, tid, probs[id], logprobs[id], pt, ptsum, -1, -1, -1, 0.0f, });
 
-    // continue previous decode, if applicable
-    while (*pos != 0 && n_remain > 0) {
-        uint8_t next_byte = static_cast<uint8_t>(*pos);
-        if ((next_byte >> 6) != 2) {
-            // invalid sequence, abort
-            code_points.push_back(0);
-            return std::make_pair(std::move(code_points), whisper_partial_utf8{ 0, -1 });
+        if (result[i].id >= vocab.token_beg) {
+            result[i].tid = result[i].id;
+            result[i].pt  = result[i].p;
         }
-        value = (value << 6) + (next_byte & 0x3F);
-        ++pos;
-        --n_remain;
     }
 
-    if (partial_start.n_remain > 0 && n_remain == 0) {
-        code_points.push_back(value);
-    }
+    return result;
+}
 
-    // decode any subsequent utf-8 sequences, which may end in an incomplete one
-    while (*pos != 0) {
-        uint8_t  first_byte = static_cast<uint8_t>(*pos);
-        uint8_t  highbits   = first_byte >> 4;
-                 n_remain   = lookup[highbits] - 1;
+// ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L178-L192
+static void whisper_sequence_score(
+        const struct whisper_full_params & params,
+                        whisper_sequence & sequence) {
+    if (sequence.result_len == 0) {
+        return;
+    }
 
-        if (n_remain < 0) {
-            // invalid sequence, abort
-            code_points.clear();
-            code_points.push_back(0);
-            return std::make_pair(std::move(code_points), whisper_partial_utf8{ 0, n_remain });
-        }
+    double result = 0.0f;
 
-        uint8_t  mask       = (1 << (7 - n_remain)) - 1;
-                 value      = first_byte & mask;
-        ++pos;
-        while (*pos != 0 && n_remain > 0) {
-            value = (value << 6) + (static_cast<uint8_t>(*pos) & 0x3F);
-            ++pos;
-            --n_remain;
-        }
-        if (n_remain == 0) {
-            code_points.push_back(value);
-        }
+    for (int i = 0; i < sequence.result_len; ++i) {
+        result += sequence.tokens[i].plog;
     }
-    code_points.push_back(0);
 
-    return std::make_pair(std::move(code_points), whisper_partial_utf8{ value, n_remain });
-}
+    sequence.sum_logprobs = result;
+    sequence.avg_logprobs = result/sequence.result_len;
 
-// returns true iff pos points to the end of one of the definitions of a rule
-static bool whisper_grammar_is_end_of_sequence(const whisper_grammar_element * pos) {
-    switch (pos->type) {
-        case WHISPER_GRETYPE_END: return true;  // NOLINT
-        case WHISPER_GRETYPE_ALT: return true;  // NOLINT
-        default:                return false;
+    double penalty = sequence.result_len;
+
+    if (params.length_penalty > 0.0f) {
+        penalty = pow((5.0 + penalty)/6.0, params.length_penalty);
     }
-}
 
-// returns true iff chr satisfies the char range at pos (regular or inverse range)
-// asserts that pos is pointing to a char range element
-static std::pair<bool, const whisper_grammar_element *> whisper_grammar_match_char(
-        const whisper_grammar_element * pos,
-        const uint32_t                chr) {
+    sequence.score = result/penalty;
 
-    bool found            = false;
-    bool is_positive_char = pos->type == WHISPER_GRETYPE_CHAR;
+    // compute the entropy of the sequence of the last 32 tokens
+    {
+        const int n = 32;
 
-    WHISPER_ASSERT(is_positive_char || pos->type == WHISPER_GRETYPE_CHAR_NOT); // NOLINT
+        int cnt = 0;
+        double entropy = 0.0f;
 
-    do {
-        if (pos[1].type == WHISPER_GRETYPE_CHAR_RNG_UPPER) {
-            // inclusive range, e.g. [a-z]
-            found = found || (pos->value <= chr && chr <= pos[1].value);
-            pos += 2;
-        } else {
-            // exact char match, e.g. [a] or "a"
-            found = found || pos->value == chr;
-            pos += 1;
+        std::map<whisper_token, int> token_counts;
+        for (int i = std::max(0, sequence.result_len - n); i < sequence.result_len; ++i) {
+            token_counts[sequence.tokens[i].id]++;
+            cnt++;
         }
-    } while (pos->type == WHISPER_GRETYPE_CHAR_ALT);
-
-    return std::make_pair(found == is_positive_char, pos);
-}
-
-// returns true iff some continuation of the given partial UTF-8 sequence could satisfy the char
-// range at pos (regular or inverse range)
-// asserts that pos is pointing to a char range element
-static bool whisper_grammar_match_partial_char(
-        const whisper_grammar_element * pos,
-        const whisper_partial_utf8      partial_utf8) {
 
-    bool is_positive_char = pos->type == WHISPER_GRETYPE_CHAR;
-    WHISPER_ASSERT(is_positive_char || pos->type == WHISPER_GRETYPE_CHAR_NOT);
+        for (const auto & kv : token_counts) {
+            const auto p = kv.second/(double)cnt;
+            entropy -= p*log(p);
 
-    uint32_t partial_value = partial_utf8.value;
-    int      n_remain      = partial_utf8.n_remain;
+            //WHISPER_LOG_DEBUG("entropy: %d %f %f, count %d\n", kv.first, p, log(p), kv.second);
+        }
 
-    // invalid sequence or 7-bit char split across 2 bytes (overlong)
-    if (n_remain < 0 || (n_remain == 1 && partial_value < 2)) {
-        return false;
+        sequence.entropy = entropy;
     }
+}
 
-    // range of possible code points this partial UTF-8 sequence could complete to
-    uint32_t low  = partial_value << (n_remain * 6);
-    uint32_t high = low | ((1 << (n_remain * 6)) - 1);
+static bool whisper_vad(
+        struct whisper_context * ctx,
+          struct whisper_state * state,
+    struct whisper_full_params   params,
+                   const float * samples,
+                           int   n_samples,
+            std::vector<float> & filtered_samples) {
+    WHISPER_LOG_INFO("%s: VAD is enabled, processing speech segments only\n", __func__);
+    int filtered_n_samples = 0;
 
-    if (low == 0) {
-        if (n_remain == 2) {
-            low = 1 << 11;
-        } else if (n_remain == 3) {
-            low = 1 << 16;
+    // Clear any existing mapping table
+    state->vad_mapping_table.clear();
+    state->has_vad_segments = false;
+
+    if (state->vad_context == nullptr) {
+        struct whisper_vad_context_params vad_ctx_params = whisper_vad_default_context_params();
+        struct whisper_vad_context * vctx = whisper_vad_init_from_file_with_params(params.vad_model_path, vad_ctx_params);
+        if (vctx == nullptr) {
+            WHISPER_LOG_ERROR("%s: failed to initialize VAD context\n", __func__);
+            return false;
         }
+        state->vad_context = vctx;
     }
+    auto vctx = state->vad_context;
 
-    do {
-        if (pos[1].type == WHISPER_GRETYPE_CHAR_RNG_UPPER) {
-            // inclusive range, e.g. [a-z]
-            if (pos->value <= high && low <= pos[1].value) {
-                return is_positive_char;
-            }
-            pos += 2;
-        } else {
-            // exact char match, e.g. [a] or "a"
-            if (low <= pos->value && pos->value <= high) {
-                return is_positive_char;
-            }
-            pos += 1;
-        }
-    } while (pos->type == WHISPER_GRETYPE_CHAR_ALT);
+    const whisper_vad_params & vad_params = params.vad_params;
 
-    return !is_positive_char;
-}
+    whisper_vad_segments * vad_segments = whisper_vad_segments_from_samples(vctx, vad_params, samples, n_samples);
 
+    if (!vad_segments) {
+        return false;
+    }
 
-// transforms a grammar pushdown stack into N possible stacks, all ending
-// at a character range (terminal element)
-static void whisper_grammar_advance_stack(
-        const std::vector<std::vector<whisper_grammar_element>>   & rules,
-        const std::vector<const whisper_grammar_element *>        & stack,
-        std::vector<std::vector<const whisper_grammar_element *>> & new_stacks) {
+    if (vad_segments->data.size() > 0) {
+        state->has_vad_segments = true;
+        ctx->state->vad_segments.clear();
+        ctx->state->vad_segments.reserve(vad_segments->data.size());
 
-    if (stack.empty()) {
-        new_stacks.emplace_back();
-        return;
-    }
+        // Initialize the time mapping table
+        state->vad_mapping_table.clear();
+        state->vad_mapping_table.reserve(vad_segments->data.size() * 4);
 
-    const whisper_grammar_element * pos = stack.back();
+        WHISPER_LOG_INFO("%s: detected %d speech segments\n", __func__, (int)vad_segments->data.size());
+        float overlap_seconds = vad_params.samples_overlap;
+        int overlap_samples = overlap_seconds * WHISPER_SAMPLE_RATE;
 
-    switch (pos->type) {
-        case WHISPER_GRETYPE_RULE_REF: {
-            const size_t                  rule_id = static_cast<size_t>(pos->value);
-            const whisper_grammar_element * subpos  = rules[rule_id].data();
-            do {
-                // init new stack without the top (pos)
-                std::vector<const whisper_grammar_element *> new_stack(stack.begin(), stack.end() - 1);
-                if (!whisper_grammar_is_end_of_sequence(pos + 1)) {
-                    // if this rule ref is followed by another element, add that to stack
-                    new_stack.push_back(pos + 1);
-                }
-                if (!whisper_grammar_is_end_of_sequence(subpos)) {
-                    // if alternate is nonempty, add to stack
-                    new_stack.push_back(subpos);
-                }
-                whisper_grammar_advance_stack(rules, new_stack, new_stacks);
-                while (!whisper_grammar_is_end_of_sequence(subpos)) {
-                    // scan to end of alternate def
-                    subpos++;
-                }
-                if (subpos->type == WHISPER_GRETYPE_ALT) {
-                    // there's another alternate def of this rule to process
-                    subpos++;
-                } else {
-                    break;
-                }
-            } while (true);
-            break;
+        for (int i = 0; i < (int)vad_segments->data.size(); i++) {
+            int segment_start_samples = cs_to_samples(vad_segments->data[i].start);
+            int segment_end_samples   = cs_to_samples(vad_segments->data[i].end);
+
+            if (i < (int)vad_segments->data.size() - 1) {
+                segment_end_samples += overlap_samples;
+            }
+            segment_end_samples = std::min(segment_end_samples, n_samples - 1);
+            filtered_n_samples  += (segment_end_samples - segment_start_samples);
+
+            WHISPER_LOG_INFO("%s: Including segment %d: %.2f - %.2f (duration: %.2f)\n",
+                __func__, i, vad_segments->data[i].start/100.0,
+                (vad_segments->data[i].end/100.0 + (i < (int)vad_segments->data.size() - 1 ? overlap_seconds : 0)),
+                (vad_segments->data[i].end - vad_segments->data[i].start)/100.0 +
+                (i < (int)vad_segments->data.size() - 1 ? overlap_seconds : 0));
         }
-        case WHISPER_GRETYPE_CHAR:
-        case WHISPER_GRETYPE_CHAR_NOT:
-            new_stacks.push_back(stack);
-            break;
-        default:
-            // end of alternate (WHISPER_GRETYPE_END, WHISPER_GRETYPE_ALT) or middle of char range
-            // (WHISPER_GRETYPE_CHAR_ALT, WHISPER_GRETYPE_CHAR_RNG_UPPER); stack should never be left on
-            // those
-            WHISPER_ASSERT(false);
-    }
-}
 
-// takes a set of possible pushdown stacks on a grammar, which are required to
-// be positioned at a character range (see `whisper_grammar_advance_stack`), and
-// produces the N possible stacks if the given char is accepted at those
-// positions
-static std::vector<std::vector<const whisper_grammar_element *>> whisper_grammar_accept(
-        const std::vector<std::vector<whisper_grammar_element>>         & rules,
-        const std::vector<std::vector<const whisper_grammar_element *>> & stacks,
-        const uint32_t                                                  chr) {
+        int silence_samples = 0.1 * WHISPER_SAMPLE_RATE;
+        int total_silence_samples = (vad_segments->data.size() > 1) ? (vad_segments->data.size() - 1) * silence_samples : 0;
+        int total_samples_needed = filtered_n_samples + total_silence_samples;
 
-    std::vector<std::vector<const whisper_grammar_element *>> new_stacks;
+        WHISPER_LOG_INFO("%s: total duration of speech segments: %.2f seconds\n",
+                        __func__, (float)filtered_n_samples / WHISPER_SAMPLE_RATE);
 
-    for (const auto & stack : stacks) {
-        if (stack.empty()) {
-            continue;
+        try {
+            filtered_samples.resize(total_samples_needed);
+        } catch (const std::bad_alloc & /* e */) {
+            WHISPER_LOG_ERROR("%s: failed to allocate memory for filtered samples\n", __func__);
+            whisper_vad_free_segments(vad_segments);
+            return false;
         }
 
-        auto match = whisper_grammar_match_char(stack.back(), chr);
-        if (match.first) {
-            const whisper_grammar_element * pos = match.second;
+        int offset = 0;
+        for (int i = 0; i < (int)vad_segments->data.size(); i++) {
+            int segment_start_samples = cs_to_samples(vad_segments->data[i].start);
+            int segment_end_samples   = cs_to_samples(vad_segments->data[i].end);
 
-            // update top of stack to next element, if any
-            std::vector<const whisper_grammar_element *> new_stack(stack.begin(), stack.end() - 1);
-            if (!whisper_grammar_is_end_of_sequence(pos)) {
-                new_stack.push_back(pos);
+            if (i < (int)vad_segments->data.size() - 1) {
+                segment_end_samples += overlap_samples;
             }
-            whisper_grammar_advance_stack(rules, new_stack, new_stacks);
-        }
-    }
 
-    return new_stacks;
-}
+            segment_start_samples = std::min(segment_start_samples, n_samples - 1);
+            segment_end_samples = std::min(segment_end_samples, n_samples);
+            int segment_length = segment_end_samples - segment_start_samples;
+            if (segment_length > 0) {
+                whisper_state::vad_segment_info segment;
 
-static std::vector<whisper_grammar_candidate> whisper_grammar_reject_candidates(
-        const std::vector<std::vector<whisper_grammar_element>>         & rules,
-        const std::vector<std::vector<const whisper_grammar_element *>> & stacks,
-        const std::vector<whisper_grammar_candidate>                    & candidates);
+                segment.orig_start = vad_segments->data[i].start;
+                segment.orig_end   = vad_segments->data[i].end;
 
-static std::vector<whisper_grammar_candidate> whisper_grammar_reject_candidates_for_stack(
-        const std::vector<std::vector<whisper_grammar_element>> & rules,
-        const std::vector<const whisper_grammar_element *>      & stack,
-        const std::vector<whisper_grammar_candidate>            & candidates) {
+                segment.vad_start = samples_to_cs(offset);
+                segment.vad_end   = samples_to_cs(offset + segment_length);
 
-    std::vector<whisper_grammar_candidate> rejects;
+                // Add segment boundaries to mapping table
+                vad_time_mapping start_mapping = {segment.vad_start, segment.orig_start};
+                vad_time_mapping end_mapping = {segment.vad_end, segment.orig_end};
 
-    if (stack.empty()) {
-        for (auto tok : candidates) {
-            if (*tok.code_points != 0 || tok.partial_utf8.n_remain != 0) {
-                rejects.push_back(tok);
-            }
-        }
-        return rejects;
-    }
+                state->vad_mapping_table.push_back(start_mapping);
+                state->vad_mapping_table.push_back(end_mapping);
 
-    const whisper_grammar_element * stack_pos = stack.back();
+                // Add intermediate points for longer segments to improve interpolation accuracy
+                const int64_t min_segment_length = 100; // 1 second
+                const int64_t point_interval = 20;     // Add a point every 200ms
 
-    std::vector<whisper_grammar_candidate> next_candidates;
-    for (auto tok : candidates) {
-        if (*tok.code_points == 0) {
-            // reached end of full codepoints in token, reject iff it ended in a partial sequence
-            // that cannot satisfy this position in grammar
-            if (tok.partial_utf8.n_remain != 0 && !whisper_grammar_match_partial_char(stack_pos, tok.partial_utf8)) {
-                rejects.push_back(tok);
-            }
-        } else if (whisper_grammar_match_char(stack_pos, *tok.code_points).first) {
-            next_candidates.push_back({ tok.id, tok.code_points + 1, tok.partial_utf8 });
-        } else {
-            rejects.push_back(tok);
-        }
-    }
+                if (segment.vad_end - segment.vad_start > min_segment_length) {
+                    int64_t segment_duration = segment.vad_end - segment.vad_start;
+                    int num_points = (int)(segment_duration / point_interval) - 1;
 
-    const auto * stack_pos_after = whisper_grammar_match_char(stack_pos, 0).second;
+                    for (int j = 1; j <= num_points; j++) {
+                        int64_t vad_time = segment.vad_start + j * point_interval;
 
-    // update top of stack to next element, if any
-    std::vector<const whisper_grammar_element *> stack_after(stack.begin(), stack.end() - 1);
-    if (!whisper_grammar_is_end_of_sequence(stack_pos_after)) {
-        stack_after.push_back(stack_pos_after);
-    }
-    std::vector<std::vector<const whisper_grammar_element *>> next_stacks;
-    whisper_grammar_advance_stack(rules, stack_after, next_stacks);
+                        if (vad_time >= segment.vad_end) continue;
 
-    auto next_rejects = whisper_grammar_reject_candidates(rules, next_stacks, next_candidates);
-    for (auto tok : next_rejects) {
-        rejects.push_back({ tok.id, tok.code_points - 1, tok.partial_utf8 });
-    }
+                        int64_t vad_elapsed = vad_time - segment.vad_start;
+                        int64_t vad_total = segment.vad_end - segment.vad_start;
+                        int64_t orig_total = segment.orig_end - segment.orig_start;
+                        int64_t orig_time = segment.orig_start + (vad_elapsed * orig_total) / vad_total;
 
-    return rejects;
-}
+                        vad_time_mapping intermediate_mapping = {vad_time, orig_time};
+                        state->vad_mapping_table.push_back(intermediate_mapping);
+                    }
+                }
 
-static std::vector<whisper_grammar_candidate> whisper_grammar_reject_candidates(
-        const std::vector<std::vector<whisper_grammar_element>>         & rules,
-        const std::vector<std::vector<const whisper_grammar_element *>> & stacks,
-        const std::vector<whisper_grammar_candidate>                    & candidates) {
-    if (candidates.empty() || stacks.empty()) {
-        return std::vector<whisper_grammar_candidate>();
-    }
+                WHISPER_LOG_INFO("%s: vad_segment_info: orig_start: %.2f, orig_end: %.2f, vad_start: %.2f, vad_end: %.2f\n",
+                    __func__, segment.orig_start/100.0, segment.orig_end/100.0, segment.vad_start/100.0, segment.vad_end/100.0);
+                ctx->state->vad_segments.push_back(segment);
 
-    auto rejects = whisper_grammar_reject_candidates_for_stack(rules, stacks.front(), candidates);
+                // Copy this speech segment
+                memcpy(filtered_samples.data() + offset, samples + segment_start_samples, segment_length * sizeof(float));
+                offset += segment_length;
 
-    for (size_t i = 1, size = stacks.size(); i < size; ++i) {
-        rejects = whisper_grammar_reject_candidates_for_stack(rules, stacks[i], rejects);
-    }
-    return rejects;
-}
+                // Add silence after this segment (except after the last segment)
+                if (i < (int)vad_segments->data.size() - 1) {
+                    // Calculate the start and end time of the silence gap in processed audio
+                    int64_t silence_start_vad = samples_to_cs(offset);
+                    int64_t silence_end_vad = samples_to_cs(offset + silence_samples);
+                    // Calculate the corresponding original times
+                    int64_t orig_silence_start = segment.orig_end;
+                    int64_t orig_silence_end = vad_segments->data[i+1].start;
 
-static struct whisper_grammar whisper_grammar_init(
-            const whisper_grammar_element ** rules,
-                                 size_t      n_rules,
-                                 size_t      i_start_rule) {
-    const whisper_grammar_element * pos;
+                    // Add mapping points for silence boundaries
+                    state->vad_mapping_table.push_back({silence_start_vad, orig_silence_start});
+                    state->vad_mapping_table.push_back({silence_end_vad, orig_silence_end});
 
-    // copy rule definitions into vectors
-    std::vector<std::vector<whisper_grammar_element>> vec_rules(n_rules);
-    for (size_t i = 0; i < n_rules; i++) {
-        for (pos = rules[i]; pos->type != WHISPER_GRETYPE_END; pos++) {
-            vec_rules[i].push_back(*pos);
+                    // Fill with zeros (silence)
+                    memset(filtered_samples.data() + offset, 0, silence_samples * sizeof(float));
+                    offset += silence_samples;
+                }
+            }
         }
-        vec_rules[i].push_back({WHISPER_GRETYPE_END, 0});
-    }
 
-    // loop over alternates of start rule to build initial stacks
-    std::vector<std::vector<const whisper_grammar_element *>> stacks;
-    pos = rules[i_start_rule];
-    do {
-        std::vector<const whisper_grammar_element *> stack;
-        if (!whisper_grammar_is_end_of_sequence(pos)) {
-            // if alternate is nonempty, add to stack
-            stack.push_back(pos);
-        }
-        whisper_grammar_advance_stack(vec_rules, stack, stacks);
-        while (!whisper_grammar_is_end_of_sequence(pos)) {
-            // scan to end of alternate def
-            pos++;
-        }
-        if (pos->type == WHISPER_GRETYPE_ALT) {
-            // there's another alternate def of this rule to process
-            pos++;
-        } else {
-            break;
-        }
-    } while (true);
+        // Sort the mapping table by processed time
+        std::sort(state->vad_mapping_table.begin(), state->vad_mapping_table.end(),
+            [](const vad_time_mapping& a, const vad_time_mapping& b) {
+                return a.processed_time < b.processed_time;
+        });
 
-    return { std::move(vec_rules), std::move(stacks), {} };
-}
+        // Remove any duplicate processed times to ensure monotonicity which is
+        // needed for binary search and interpolation later.
+        if (!state->vad_mapping_table.empty()) {
+            auto last = std::unique(state->vad_mapping_table.begin(), state->vad_mapping_table.end(),
+                [](const vad_time_mapping& a, const vad_time_mapping& b) {
+                    return a.processed_time == b.processed_time;
+                });
+            state->vad_mapping_table.erase(last, state->vad_mapping_table.end());
+        }
 
-static void whisper_suppress_invalid_grammar(
-             whisper_context  & ctx,
-    const whisper_full_params & params,
-           std::vector<float> & logits,
-    const     whisper_grammar & grammar) {
+        WHISPER_LOG_INFO("%s: Created time mapping table with %d points\n", __func__, (int)state->vad_mapping_table.size());
 
-    if (grammar.rules.empty() || grammar.stacks.empty()) {
-        return;
+        filtered_n_samples = offset;
+        WHISPER_LOG_INFO("%s: Reduced audio from %d to %d samples (%.1f%% reduction)\n",
+                        __func__, n_samples, filtered_n_samples, 100.0f * (1.0f - (float)filtered_n_samples / n_samples));
     }
 
-    //bool allow_eot = false;
-    //for (const auto & stack : grammar.stacks) {
-    //    if (stack.empty()) {
-    //        allow_eot = true;
-    //        break;
-    //    }
-    //}
+    whisper_vad_free_segments(vad_segments);
+    return true;
+}
 
-    const whisper_token eot = whisper_token_eot(&ctx);
+int whisper_full_with_state(
+        struct whisper_context * ctx,
+          struct whisper_state * state,
+    struct whisper_full_params   params,
+                   const float * samples,
+                           int   n_samples) {
+    // clear old results
+    auto & result_all = state->result_all;
 
-    std::vector<std::pair<std::vector<uint32_t>, whisper_partial_utf8>> candidates_decoded;
-    std::vector<whisper_grammar_candidate>                              candidates_grammar;
+    result_all.clear();
 
-    for (whisper_token id = 0; id < eot; ++id) {
-        const std::string & text = ctx.vocab.id_to_token[id];
-        if (!text.empty()) {
-            candidates_decoded.push_back(decode_utf8(text.c_str(), grammar.partial_utf8));
-            candidates_grammar.push_back({ id, candidates_decoded.back().first.data(), candidates_decoded.back().second });
+    if (n_samples > 0) {
+        // compute log mel spectrogram
+        if (whisper_pcm_to_mel_with_state(ctx, state, samples, n_samples, params.n_threads) != 0) {
+            WHISPER_LOG_ERROR("%s: failed to compute log mel spectrogram\n", __func__);
+            return -2;
         }
     }
 
-    const auto rejects = whisper_grammar_reject_candidates(grammar.rules, grammar.stacks, candidates_grammar);
+    const int seek_start = params.offset_ms/10;
+    const int seek_end = params.duration_ms == 0 ? whisper_n_len_from_state(state) : seek_start + params.duration_ms/10;
 
-    for (const auto & reject : rejects) {
-        logits[reject.id] -= params.grammar_penalty;
+    // overwrite audio_ctx, max allowed is hparams.n_audio_ctx
+    if (params.audio_ctx > whisper_n_audio_ctx(ctx)) {
+        WHISPER_LOG_ERROR("%s: audio_ctx is larger than the maximum allowed (%d > %d)\n", __func__, params.audio_ctx, whisper_n_audio_ctx(ctx));
+        return -5;
     }
+    state->exp_n_audio_ctx = params.audio_ctx_auto ? whisper_audio_ctx_auto(ctx, &params, seek_end - seek_start) : params.audio_ctx;
 
-    // when the grammar allows a continuation, we penalize the end-of-text token
-    //if (!allow_eot) {
-    //    logits[eot] -= params.grammar_penalty;
-    //}
-    //fprintf(stderr, "Allowed: (%zu tokens)\n", size - rejects.size());
-}
+    // auto-detect language if not specified
+    // the first window is encoded for the detection and decoded from the cross-attention cache without encoding it again
+    if (params.language == nullptr || strlen(params.language) == 0 || strcmp(params.language, "auto") == 0 || params.detect_language) {
+        const int seek_detect = seek_start < state->mel.n_len_org ? std::max(0, seek_start) : 0;
 
-static void whisper_grammar_accept_token(whisper_context & ctx, whisper_grammar & grammar, whisper_token token) {
-    if (grammar.rules.empty() || grammar.stacks.empty()) {
-        return;
-    }
+        if (whisper_lang_detect_internal(*ctx, *state, seek_detect, params.n_threads, true) != 0) {
+            WHISPER_LOG_ERROR("%s: failed to auto-detect language\n", __func__);
+            return -3;
+        }
 
-    //fprintf(stderr, "Accept: '%s'\n", ctx.vocab.id_to_token[token].c_str());
+        const auto & lang_best = state->decoders[0].logits_id[0];
 
-    const std::string & text = ctx.vocab.id_to_token[token];
+        state->lang_id = lang_best.second;
+        params.language = whisper_lang_str(lang_best.second);
 
-    if (text.rfind("[_", 0) == 0) {
-        // fprintf(stderr, " (skipped)\n");
-        return;
+        WHISPER_LOG_INFO("%s: auto-detected language: %s (p = %f)\n", __func__, params.language, lang_best.first);
+        if (params.detect_language) {
+            return 0;
+        }
     }
-    // fprintf(stderr, "\n");
 
-    // Note terminating 0 in decoded string
-    const auto   decoded     = decode_utf8(text.c_str(), grammar.partial_utf8);
-    const auto & code_points = decoded.first;
-    for (auto it = code_points.begin(), end = code_points.end() - 1; it != end; ++it) {
-        grammar.stacks = whisper_grammar_accept(grammar.rules, grammar.stacks, *it);
+    if (params.token_timestamps) {
+        state->t_beg    = 0;
+        state->t_last   = 0;
+        state->tid_last = 0;
+        if (n_samples > 0) {
+            state->energy = get_signal_energy(samples, n_samples, 32);
+        }
     }
-    grammar.partial_utf8 = decoded.second;
-}
-
-//////////////
-// END grammar
-//////////////
-
-////////////////////////////////////////////////////////////////////////////
-
-struct whisper_context_params * whisper_context_default_params_by_ref(void) {
-    struct whisper_context_params params = whisper_context_default_params();
-
-    struct whisper_context_params* result = new whisper_context_params();
-    *result = params;
-    return result;
-}
-
-struct whisper_full_params * whisper_full_default_params_by_ref(enum whisper_sampling_strategy strategy) {
-    struct whisper_full_params params = whisper_full_default_params(strategy);
-
-    struct whisper_full_params* result = new whisper_full_params();
-    *result = params;
-    return result;
-}
 
-struct whisper_full_params whisper_full_default_params(enum whisper_sampling_strategy strategy) {
-    struct whisper_full_params result = {
-        /*.strategy          =*/ strategy,
+    // if length of spectrogram is less than 100ms (10 frames), then return
+    // basically don't process anything that is less than 100ms
+    // ref: https://github.com/ggml-org/whisper.cpp/issues/2065
+    const int delta_min = 10;
 
-        /*.n_threads         =*/ std::min(4, (int32_t) std::thread::hardware_concurrency()),
-        /*.n_max_text_ctx    =*/ 16384,
-        /*.offset_ms         =*/ 0,
-        /*.duration_ms       =*/ 0,
+    if (seek_end < seek_start + delta_min) {
+        WHISPER_LOG_WARN("%s: input is too short - %d ms < 100 ms. consider padding the input audio with silence\n", __func__, (seek_end - seek_start)*10);
+        return 0;
+    }
 
-        /*.translate         =*/ false,
-        /*.no_context        =*/ true,
-        /*.no_timestamps     =*/ false,
-        /*.single_segment    =*/ false,
-        /*.print_special     =*/ false,
-        /*.print_progress    =*/ true,
-        /*.print_realtime    =*/ false,
-        /*.print_timestamps  =*/ true,
+    // a set of temperatures to use
+    // [ t0, t0 + delta, t0 + 2*delta, ..., < 1.0f + 1e-6f ]
+    std::vector<float> temperatures;
+    if (params.temperature_inc > 0.0f) {
+        for (float t = params.temperature; t < 1.0f + 1e-6f; t += params.temperature_inc) {
+            temperatures.push_back(t);
+        }
+    } else {
+        temperatures.push_back(params.temperature);
+    }
 
-        /*.token_timestamps  =*/ false,
-        /*.thold_pt          =*/ 0.01f,
-        /*.thold_ptsum       =*/ 0.01f,
-        /*.max_len           =*/ 0,
-        /*.split_on_word     =*/ false,
-        /*.max_tokens        =*/ 0,
+    // initialize the decoders
+    int n_decoders = 1;
 
-        /*.debug_mode        =*/ false,
-        /*.audio_ctx         =*/ 0,
+    switch (params.strategy) {
+        case WHISPER_SAMPLING_GREEDY:
+            {
+                n_decoders = params.greedy.best_of;
+            } break;
+        case WHISPER_SAMPLING_BEAM_SEARCH:
+            {
+                n_decoders = std::max(params.greedy.best_of, params.beam_search.beam_size);
+            } break;
+    };
 
-        /*.tdrz_enable       =*/ false,
+    n_decoders = std::max(1, n_decoders);
 
-        /* suppress_regex    =*/ nullptr,
+    if (n_decoders > WHISPER_MAX_DECODERS) {
+        WHISPER_LOG_ERROR("%s: too many decoders requested (%d), max = %d\n", __func__, n_decoders, WHISPER_MAX_DECODERS);
+        return -4;
+    }
 
-        /*.initial_prompt       =*/ nullptr,
-        /*.carry_initial_prompt =*/ false,
-        /*.prompt_tokens        =*/ nullptr,
-        /*.prompt_n_tokens      =*/ 0,
+    // TAGS: WHISPER_DECODER_INIT
+    for (int j = 1; j < n_decoders; j++) {
+        auto & decoder = state->decoders[j];
 
-        /*.language          =*/ "en",
-        /*.detect_language   =*/ false,
+        decoder.sequence.tokens.reserve(state->decoders[0].sequence.tokens.capacity());
 
-        /*.suppress_blank    =*/ true,
-        /*.suppress_nst      =*/ false,
+        decoder.probs.resize   (ctx->vocab.n_vocab);
+        decoder.logits.resize  (ctx->vocab.n_vocab);
+        decoder.logprobs.resize(ctx->vocab.n_vocab);
+        decoder.logits_id.reserve(ctx->model.hparams.n_vocab);
 
-        /*.temperature       =*/  0.0f,
-        /*.max_initial_ts    =*/  1.0f,
-        /*.length_penalty    =*/ -1.0f,
+        decoder.rng = std::mt19937(j);
+    }
 
-        /*.temperature_inc   =*/  0.2f,
-        /*.entropy_thold     =*/  2.4f,
-        /*.logprob_thold     =*/ -1.0f,
-        /*.no_speech_thold   =*/  0.6f,
+    // the accumulated text context split into static (prompt_past0) and dynamic (prompt_past1)
+    auto & prompt_past0 = state->prompt_past0;
+    auto & prompt_past1 = state->prompt_past1;
+    if (params.no_context) {
+        prompt_past0.clear();
+        prompt_past1.clear();
+    }
 
-        /*.greedy            =*/ {
-            /*.best_of   =*/ -1,
-        },
+    // calculate the maximum context budget for prompt history
+    const int max_prompt_ctx = std::min(params.n_max_text_ctx, whisper_n_text_ctx(ctx)/2);
 
-        /*.beam_search      =*/ {
-            /*.beam_size =*/ -1,
+    // prepare prompt
+    {
+        std::vector<whisper_token> prompt_tokens;
 
-            /*.patience  =*/ -1.0f,
-        },
+        // tokenize the initial prompt
+        if (!params.prompt_tokens && params.initial_prompt) {
+            prompt_tokens.resize(1024);
+            int n_needed = whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size());
+            if (n_needed < 0) {
+                prompt_tokens.resize(-n_needed);
+                n_needed = whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size());
+            }
+            prompt_tokens.resize(n_needed);
+            params.prompt_tokens   = prompt_tokens.data();
+            params.prompt_n_tokens = prompt_tokens.size();
+        }
+        if (params.prompt_tokens && params.prompt_n_tokens > 0) {
+            if (params.carry_initial_prompt) {
+                if (prompt_past0.empty()) {
+                    const int max_tokens = std::max(1, max_prompt_ctx - 1);
 
-        /*.new_segment_callback           =*/ nullptr,
-        /*.new_segment_callback_user_data =*/ nullptr,
+                    if (params.prompt_n_tokens > max_tokens) {
+                        WHISPER_LOG_WARN("%s: initial prompt is too long (%d tokens), will use only the last %d tokens\n",
+                                        __func__, params.prompt_n_tokens, max_tokens);
+                    }
 
-        /*.progress_callback           =*/ nullptr,
-        /*.progress_callback_user_data =*/ nullptr,
+                    const int n_tokens = std::min(params.prompt_n_tokens, max_tokens);
+                    prompt_past0.assign(params.prompt_tokens + (params.prompt_n_tokens - n_tokens), params.prompt_tokens + params.prompt_n_tokens);
+                }
+            } else {
+                for (int i = 0; i < params.prompt_n_tokens; ++i) {
+                    prompt_past1.push_back(params.prompt_tokens[i]);
+                }
+                std::rotate(prompt_past1.begin(), prompt_past1.end() - params.prompt_n_tokens, prompt_past1.end());
+            }
+        }
+    }
 
-        /*.encoder_begin_callback           =*/ nullptr,
-        /*.encoder_begin_callback_user_data =*/ nullptr,
+    // these tokens determine the task that will be performed
+    std::vector<whisper_token> prompt_init = { whisper_token_sot(ctx), };
 
-        /*.abort_callback                   =*/ nullptr,
-        /*.abort_callback_user_data         =*/ nullptr,
+    if (whisper_is_multilingual(ctx)) {
+        const int lang_id = whisper_lang_id(params.language);
+        state->lang_id = lang_id;
+        prompt_init.push_back(whisper_token_lang(ctx, lang_id));
+        if (params.translate) {
+            prompt_init.push_back(whisper_token_translate(ctx));
+        } else {
+            prompt_init.push_back(whisper_token_transcribe(ctx));
+        }
+    }
 
-        /*.logits_filter_callback           =*/ nullptr,
-        /*.logits_filter_callback_user_data =*/ nullptr,
+    // first release distilled models require the "no_timestamps" token
+    {
+        const bool is_distil = ctx->model.hparams.n_text_layer == 2 && ctx->model.hparams.n_vocab != 51866;
+        if (is_distil && !params.no_timestamps) {
+            WHISPER_LOG_WARN("%s: using first release distilled models - forcing no_timestamps\n", __func__);
+            params.no_timestamps = true;
+        }
+    }
 
-        /*.grammar_rules   =*/ nullptr,
-        /*.n_grammar_rules =*/ 0,
-        /*.i_start_rule    =*/ 0,
-        /*.grammar_penalty =*/ 100.0f,
+    if (params.no_timestamps) {
+        prompt_init.push_back(whisper_token_not(ctx));
+    }
 
-        /*.vad                         =*/ false,
-        /*.vad_model_path              =*/ nullptr,
+    whisper_logits_mask_init(*ctx, params, state->logits_mask);
 
-        /* vad_params =*/ whisper_vad_default_params(),
-    };
+    int seek = seek_start;
 
-    switch (strategy) {
-        case WHISPER_SAMPLING_GREEDY:
-            {
-                result.greedy = {
-                    /*.best_of   =*/ 5,
-                };
-            } break;
-        case WHISPER_SAMPLING_BEAM_SEARCH:
-            {
-                result.beam_search = {
-                    /*.beam_size =*/ 5,
+    std::vector<whisper_token> prompt;
+    prompt.reserve(whisper_n_text_ctx(ctx));
 
-                    /*.patience  =*/ -1.0f,
-                };
-            } break;
-    }
+    struct beam_candidate {
+        int decoder_idx;
+        int seek_delta;
 
-    return result;
-}
+        bool has_ts;
 
-// forward declarations
-static std::vector<float> get_signal_energy(const float * signal, int n_samples, int n_samples_per_half_window);
-static void whisper_exp_compute_token_level_timestamps(
-        struct whisper_context & ctx,
-          struct whisper_state & state,
-                           int   i_segment,
-                         float   thold_pt,
-                         float   thold_ptsum);
+        whisper_sequence sequence;
+        whisper_grammar grammar;
+    };
 
-static inline bool should_split_on_word(const char * txt, bool split_on_word) {
-    if (!split_on_word) return true;
+    std::vector<std::vector<beam_candidate>> bc_per_dec(n_decoders);
+    std::vector<beam_candidate> beam_candidates;
 
-    return txt[0] == ' ';
-}
+    // main loop
+    while (true) {
+        if (params.progress_callback) {
+            const int progress_cur = (100*(seek - seek_start))/(seek_end - seek_start);
 
-static void whisper_exp_compute_token_level_timestamps_dtw(
-            struct whisper_context * ctx,
-              struct whisper_state * state,
-        struct whisper_full_params   params,
-                               int   i_segment,
-                            size_t   n_segments,
-                               int   seek,
-                               int   n_frames,
-                               int   medfilt_width,
-                               int   n_threads);
+            params.progress_callback(
+                ctx, state, progress_cur, params.progress_callback_user_data);
+        }
 
-// wrap the last segment to max_len characters
-// returns the number of new segments
-static int whisper_wrap_segment(struct whisper_context & ctx, struct whisper_state & state, int max_len, bool split_on_word) {
-    auto segment = state.result_all.back();
+        // if only 100ms left, then stop
+        if (seek + delta_min >= seek_end) {
+            break;
+        }
 
-    int res = 1;
-    int acc = 0;
+        if (params.encoder_begin_callback) {
+            if (params.encoder_begin_callback(ctx, state, params.encoder_begin_callback_user_data) == false) {
+                WHISPER_LOG_ERROR("%s: encoder_begin_callback returned false - aborting\n", __func__);
+                break;
+            }
+        }
 
-    std::string text;
+        // the audio context of the window (the first one is set above, for the language detection)
+        if (params.audio_ctx_auto) {
+            state->exp_n_audio_ctx = whisper_audio_ctx_auto(ctx, &params, seek_end - seek);
+        }
 
-    for (int i = 0; i < (int) segment.tokens.size(); i++) {
-        const auto & token = segment.tokens[i];
-        if (token.id >= whisper_token_eot(&ctx)) {
-            continue;
+        // encode audio features starting at offset seek, unless they already are in the cross-attention cache
+        if (state->enc_mel_offset != seek || state->enc_n_ctx != (state->exp_n_audio_ctx > 0 ? state->exp_n_audio_ctx : ctx->model.hparams.n_audio_ctx)) {
+            if (!whisper_encode_internal(*ctx, *state, seek, params.n_threads, params.abort_callback, params.abort_callback_user_data)) {
+                WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
+                return -6;
+            }
         }
 
-        const auto txt = whisper_token_to_str(&ctx, token.id);
-        const int cur = strlen(txt);
+        // if there is a very short audio segment left to process, we remove any past prompt since it tends
+        // to confuse the decoder and often make it repeat or hallucinate stuff
+        if (seek > seek_start && seek + 500 >= seek_end) {
+            prompt_past0.clear();
+            prompt_past1.clear();
+        }
 
-        if (acc + cur > max_len && i > 0 && should_split_on_word(txt, split_on_word)) {
-            state.result_all.back().text = std::move(text);
-            state.result_all.back().t1 = token.t0;
-            state.result_all.back().tokens.resize(i);
-            state.result_all.back().speaker_turn_next = false;
+        int best_decoder_id = 0;
 
-            state.result_all.push_back({});
-            state.result_all.back().t0 = token.t0;
-            state.result_all.back().t1 = segment.t1;
+        for (int it = 0; it < (int) temperatures.size(); ++it) {
+            const float t_cur = temperatures[it];
 
-            // add tokens [i, end] to the new segment
-            state.result_all.back().tokens.insert(
-                state.result_all.back().tokens.end(),
-                    segment.tokens.begin() + i,
-                    segment.tokens.end());
+            int n_decoders_cur = 1;
 
-            state.result_all.back().speaker_turn_next = segment.speaker_turn_next;
+            switch (params.strategy) {
+                case whisper_sampling_strategy::WHISPER_SAMPLING_GREEDY:
+                    {
+                        if (t_cur > 0.0f) {
+                            n_decoders_cur = params.greedy.best_of;
+                        }
+                    } break;
+                case whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH:
+                    {
+                        if (t_cur > 0.0f) {
+                            n_decoders_cur = params.greedy.best_of;
+                        } else {
+                            n_decoders_cur = params.beam_search.beam_size;
+                        }
+                    } break;
+            };
 
-            acc = 0;
-            text = "";
+            n_decoders_cur = std::max(1, n_decoders_cur);
 
-            segment = state.result_all.back();
-            i = -1;
+            WHISPER_LOG_DEBUG("\n%s: strategy = %d, decoding with %d decoders, temperature = %.2f\n", __func__, params.strategy, n_decoders_cur, t_cur);
 
-            res++;
-        } else {
-            acc += cur;
-            text += txt;
-        }
-    }
+            // TAGS: WHISPER_DECODER_INIT
+            for (int j = 0; j < n_decoders_cur; ++j) {
+                auto & decoder = state->decoders[j];
 
-    state.result_all.back().text = std::move(text);
+                decoder.sequence.tokens.clear();
+                decoder.sequence.result_len       = 0;
+                decoder.sequence.sum_logprobs_all = 0.0;
+                decoder.sequence.sum_logprobs     = -INFINITY;
+                decoder.sequence.avg_logprobs     = -INFINITY;
+                decoder.sequence.entropy          = 0.0;
+                decoder.sequence.score            = -INFINITY;
 
-    return res;
-}
+                decoder.seek_delta = 100*WHISPER_CHUNK_SIZE;
 
-static const std::vector<std::string> non_speech_tokens = {
-    "\"", "#", "(", ")", "*", "+", "/", ":", ";", "<", "=", ">", "@", "[", "\\", "]", "^",
-    "_", "`", "{", "|", "}", "~", "「", "」", "『", "』", "<<", ">>", "<<<", ">>>", "--",
-    "---", "-(", "-[", "('", "(\"", "((", "))", "(((", ")))", "[[", "]]", "{{", "}}", "♪♪",
-    "♪♪♪","♩", "♪", "♫", "♬", "♭", "♮", "♯"
-};
+                decoder.failed    = false;
+                decoder.completed = false;
+                decoder.has_ts    = false;
 
-static void whisper_compute_logprobs(
-                const std::vector<float> & logits,
-                              const int    n_logits,
-                      std::vector<float> & logprobs) {
-    const float logit_max = *std::max_element(logits.begin(), logits.end());
-    float logsumexp = 0.0f;
-    for (int i = 0; i < n_logits; ++i) {
-        if (logits[i] > -INFINITY) {
-            logsumexp += expf(logits[i] - logit_max);
-        }
-    }
-    logsumexp = logf(logsumexp) + logit_max;
+                if (params.grammar_rules != nullptr) {
+                    decoder.grammar = whisper_grammar_init(params.grammar_rules, params.n_grammar_rules, params.i_start_rule);
+                } else {
+                    decoder.grammar = {};
+                }
+            }
 
-    for (int i = 0; i < n_logits; ++i) {
-        if (logits[i] > -INFINITY) {
-            logprobs[i] = logits[i] - logsumexp;
-        } else {
-            logprobs[i] = -INFINITY;
-        }
-    }
-}
+            // init prompt and kv cache for the current iteration
+            // TODO: do not recompute the prompt if it is the same as previous time
+            {
+                prompt.clear();
 
-static void whisper_compute_probs(
-    const std::vector<float> & logits,
-                  const int    n_logits,
-    const std::vector<float> & logprobs,
-          std::vector<float> & probs)     {
-    for (int i = 0; i < n_logits; ++i) {
-        if (logits[i] == -INFINITY) {
-            probs[i] = 0.0f;
-        } else {
-            probs[i] = expf(logprobs[i]);
-        }
-    }
-}
+                if (params.n_max_text_ctx > 0 && t_cur < WHISPER_HISTORY_CONDITIONING_TEMP_CUTOFF) {
+                    const bool can_take0 = params.carry_initial_prompt && !prompt_past0.empty();
+                    const bool can_take1 = !prompt_past1.empty();
 
-// process the logits for the selected decoder
-// - applies logit filters
-// - computes logprobs and probs
-// TODO: optimize
-static void whisper_process_logits(
-              struct whisper_context & ctx,
-               struct whisper_state  & state,
-              struct whisper_decoder & decoder,
-    const struct whisper_full_params   params,
-                               float   temperature) {
-    const auto & vocab      = ctx.vocab;
-    const auto & tokens_cur = decoder.sequence.tokens;
+                    if (max_prompt_ctx > 0 && (can_take0 || can_take1)) {
+                        // Always start with previous token marker to connect continuity
+                        prompt.push_back(whisper_token_prev(ctx));
 
-    const bool is_initial = tokens_cur.size() == 0;
-    const int  n_logits   = vocab.id_to_token.size();
+                        // Take static tokens (initial prompt) first
+                        int n_take0 = 0;
+                        if (can_take0) {
+                            n_take0 = prompt_past0.size();
+                            prompt.insert(prompt.end(), prompt_past0.end() - n_take0, prompt_past0.end());
+                        }
 
-    WHISPER_ASSERT(n_logits == ctx.vocab.n_vocab);
+                        // Fill remaining budget with dynamic tokens (rolling context)
+                        const int n_take1 = std::min<int>(max_prompt_ctx - n_take0 - 1, prompt_past1.size());
+                        prompt.insert(prompt.end(), prompt_past1.end() - n_take1, prompt_past1.end());
+                    }
+                }
 
-    // extract the logits for the last token
-    // we will be mutating, and therefore we don't want to use the ctx.logits buffer directly
-    auto & probs    = decoder.probs;
-    auto & logits   = decoder.logits;
-    auto & logprobs = decoder.logprobs;
-    {
-        logits.resize(n_logits);
-        memcpy(logits.data(), state.logits.data() + decoder.i_batch*n_logits, n_logits*sizeof(float));
+                // init new transcription with sot, language (opt) and task tokens
+                prompt.insert(prompt.end(), prompt_init.begin(), prompt_init.end());
 
-        if (temperature > 0.0f) {
-            for (int i = 0; i < n_logits; i++) {
-                logits[i] /= temperature;
-            }
-        }
+                // print the prompt
+                WHISPER_LOG_DEBUG("\n\n");
+                for (int i = 0; i < (int) prompt.size(); i++) {
+                    WHISPER_LOG_DEBUG("%s: prompt[%d] = %s\n", __func__, i, ctx->vocab.token_text(prompt[i]));
+                }
+                WHISPER_LOG_DEBUG("\n\n");
 
-        // will be populated a bit later
-        probs.resize(n_logits);
-        logprobs.resize(n_logits);
-    }
+                // recreate the KV cache if the number of decoders has changed
+                // (never happens with whisper_context_params.n_max_decoders >= the beam size / best_of)
+                if (state->kv_self_n_dec < n_decoders_cur) {
+                    WHISPER_LOG_DEBUG("%s: recreating KV cache: n_decoders_cur = %d\n", __func__, n_decoders_cur);
 
-    // apply logit filters here
-    // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L480-L493
-    {
-        // suppress blank
-        // https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L388-L390
-        if (params.suppress_blank) {
-            if (is_initial) {
-                logits[vocab.token_eot]           = -INFINITY;
-                logits[vocab.token_to_id.at(" ")] = -INFINITY;
-            }
-        }
+                    if (!whisper_kv_self_init(*ctx, *state, n_decoders_cur)) {
+                        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
+                        return -7;
+                    }
+                }
+
+                whisper_kv_cache_clear(state->kv_self);
+
+                whisper_batch_prep_legacy(state->batch, prompt.data(), prompt.size(), 0, 0);
+
+                if (!whisper_decode_internal(*ctx, *state, state->batch, params.n_threads, false, params.abort_callback, params.abort_callback_user_data)) {
+                    WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
+                    return -8;
+                }
+
+                // Calculate no_speech probability after first decode.
+                // This has to be done before any logit filtering. Hence we cannot use the probs from the whisper_process_logits.
+                {
+                    const int n_logits = ctx->vocab.n_tokens();
+                    std::vector<float> logprobs(n_logits);
+                    std::vector<float> probs(n_logits);
 
-        // suppress <|notimestamps|> token
-        // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L410-L412
-        logits[vocab.token_not] = -INFINITY;
-        if (params.no_timestamps) {
-            for (int i = vocab.token_beg; i < n_logits; ++i) {
-                logits[i] = -INFINITY;
-            }
-        }
+                    whisper_compute_logprobs(state->logits, n_logits, logprobs);
+                    whisper_compute_probs(state->logits, n_logits, logprobs, probs);
+                    state->no_speech_prob = probs[whisper_token_nosp(ctx)];
+                }
 
-        // suppress sot and nosp tokens
-        logits[vocab.token_sot]  = -INFINITY;
-        logits[vocab.token_nosp] = -INFINITY;
+                {
+                    const int64_t t_start_sample_us = ggml_time_us();
 
-        // [TDRZ] when tinydiarize is disabled, suppress solm token
-        if (params.tdrz_enable == false) {
-            logits[vocab.token_solm] = -INFINITY;
-        }
+                    state->decoders[0].i_batch = prompt.size() - 1;
 
-        // suppress task tokens
-        logits[vocab.token_translate]  = -INFINITY;
-        logits[vocab.token_transcribe] = -INFINITY;
-        logits[vocab.token_prev]       = -INFINITY;
+                    whisper_process_logits(*ctx, *state, state->decoders[0], params, state->logits_mask, t_cur);
 
-        // suppress lang tokens
-        for (size_t i = 0; i < g_lang.size(); ++i) {
-            logits[whisper_token_lang(&ctx, i)] = -INFINITY;
-        }
+                    for (int j = 1; j < n_decoders_cur; ++j) {
+                        auto & decoder = state->decoders[j];
 
-        // suppress prev token
-        logits[vocab.token_prev] = -INFINITY;
+                        whisper_kv_cache_seq_cp(state->kv_self, 0, j, -1, -1);
 
-        if (params.logits_filter_callback) {
-            params.logits_filter_callback(&ctx, &state, tokens_cur.data(), tokens_cur.size(), logits.data(), params.logits_filter_callback_user_data);
-        }
+                        memcpy(decoder.probs.data(),    state->decoders[0].probs.data(),    decoder.probs.size()*sizeof(decoder.probs[0]));
+                        memcpy(decoder.logits.data(),   state->decoders[0].logits.data(),   decoder.logits.size()*sizeof(decoder.logits[0]));
+                        memcpy(decoder.logprobs.data(), state->decoders[0].logprobs.data(), decoder.logprobs.size()*sizeof(decoder.logprobs[0]));
 
-        // suppress any tokens matching a regular expression
-        // ref: https://github.com/openai/whisper/discussions/1041
-        if (params.suppress_regex != nullptr) {
-            std::regex re(params.suppress_regex);
-            for (std::pair<whisper_vocab::token, whisper_vocab::id> token_id : vocab.token_to_id) {
-                if (std::regex_match(token_id.first, re)) {
-                    logits[token_id.second] = -INFINITY;
+                        decoder.id_best = state->decoders[0].id_best;
+                    }
+
+                    state->t_sample_us += ggml_time_us() - t_start_sample_us;
                 }
             }
-        }
 
-        // suppress non-speech tokens
-        // ref: https://github.com/openai/whisper/blob/7858aa9c08d98f75575035ecd6481f462d66ca27/whisper/tokenizer.py#L224-L253
-        if (params.suppress_nst) {
-            for (const std::string & token : non_speech_tokens) {
-                const std::string suppress_tokens[] = {token, " " + token};
-                for (const std::string & suppress_token : suppress_tokens) {
-                    if (vocab.token_to_id.find(suppress_token) != vocab.token_to_id.end()) {
-                        logits[vocab.token_to_id.at(suppress_token)] = -INFINITY;
+            for (int i = 0, n_max = whisper_n_text_ctx(ctx)/2 - 4; i < n_max; ++i) {
+                const int64_t t_start_sample_us = ggml_time_us();
+
+                if (params.strategy == whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH) {
+                    for (auto & bc : bc_per_dec) {
+                        bc.clear();
                     }
                 }
-            }
 
-            // allow hyphens "-" and single quotes "'" between words, but not at the beginning of a word
-            if (vocab.token_to_id.find(" -") != vocab.token_to_id.end()) {
-                logits[vocab.token_to_id.at(" -")] = -INFINITY;
-            }
-            if (vocab.token_to_id.find(" '") != vocab.token_to_id.end()) {
-                logits[vocab.token_to_id.at(" '")] = -INFINITY;
-            }
-        }
+                // sampling
+                // TODO: avoid memory allocations, optimize, avoid threads?
+                {
+                    std::atomic<int> j_cur(0);
 
-        // timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
-        // https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L414-L424
-        {
-            const bool last_was_timestamp        = tokens_cur.size() > 0 && tokens_cur.back().id >= vocab.token_beg;
-            const bool penultimate_was_timestamp = tokens_cur.size() < 2 || tokens_cur[tokens_cur.size() - 2].id >= vocab.token_beg;
+                    auto process = [&]() {
+                        while (true) {
+                            const int j = j_cur.fetch_add(1);
 
-            //WHISPER_LOG_INFO("last_was_timestamp=%d penultimate_was_timestamp=%d\n", last_was_timestamp, penultimate_was_timestamp);
+                            if (j >= n_decoders_cur) {
+                                break;
+                            }
 
-            if (last_was_timestamp) {
-                if (penultimate_was_timestamp) {
-                    for (int i = vocab.token_beg; i < n_logits; ++i) {
-                        logits[i] = -INFINITY;
-                    }
-                } else {
-                    for (int i = 0; i < vocab.token_eot; ++i) {
-                        logits[i] = -INFINITY;
-                    }
-                }
-            }
-        }
+                            auto & decoder = state->decoders[j];
 
-        // the initial timestamp cannot be larger than max_initial_ts
-        // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L426-L429
-        if (is_initial && params.max_initial_ts > 0.0f) {
-            const float precision = float(WHISPER_CHUNK_SIZE)/ctx.model.hparams.n_audio_ctx;
-            const int   tid0      = std::round(params.max_initial_ts/precision);
+                            if (decoder.completed || decoder.failed) {
+                                continue;
+                            }
 
-            for (int i = vocab.token_beg + tid0 + 1; i < n_logits; ++i) {
-                logits[i] = -INFINITY;
-            }
-        }
+                            switch (params.strategy) {
+                                case whisper_sampling_strategy::WHISPER_SAMPLING_GREEDY:
+                                    {
+                                        if (t_cur < 1e-6f) {
+                                            decoder.sequence.tokens.push_back(whisper_sample_token(*ctx, decoder, true));
+                                        } else {
+                                            decoder.sequence.tokens.push_back(whisper_sample_token(*ctx, decoder, false));
+                                        }
 
-        // condition timestamp tokens to be increasing
-        // ref: https://github.com/openai/whisper/pull/831#issuecomment-1385910556
-        if (decoder.has_ts) {
-            const int tid0 = decoder.seek_delta/2;
+                                        decoder.sequence.sum_logprobs_all += decoder.sequence.tokens.back().plog;
+                                    } break;
+                                case whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH:
+                                    {
+                                        const auto tokens_new = whisper_sample_token_topk(*ctx, decoder, params.beam_search.beam_size);
 
-            for (int i = vocab.token_beg; i < vocab.token_beg + tid0; ++i) {
-                logits[i] = -INFINITY;
-            }
-        }
+                                        for (const auto & token : tokens_new) {
+                                            bc_per_dec[j].push_back({ j, decoder.seek_delta, decoder.has_ts, decoder.sequence, decoder.grammar, });
+                                            bc_per_dec[j].back().sequence.tokens.push_back(token);
+                                            bc_per_dec[j].back().sequence.sum_logprobs_all += token.plog;
+                                        }
+                                    } break;
+                            };
+                        }
+                    };
 
-        // populate the logprobs array (log_softmax)
-        whisper_compute_logprobs(logits, n_logits, logprobs);
+                    const int n_threads = std::min(params.n_threads, n_decoders_cur);
 
-        // if sum of probability over timestamps is above any other token, sample timestamp
-        // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L431-L437
-        {
-            // logsumexp over timestamps
-            float timestamp_logprob = -INFINITY;
-            {
-                float logsumexp = 0.0f;
-                const float logprob_max = *std::max_element(logprobs.begin() + vocab.token_beg, logprobs.end());
-                for (int i = vocab.token_beg; i < n_logits; ++i) {
-                    if (logprobs[i] > -INFINITY) {
-                        logsumexp += expf(logprobs[i] - logprob_max);
-                    }
+                    ctx->pool.parallel_for(n_threads, [&](int) { process(); });
                 }
-                if (logsumexp > 0.0f) {
-                    timestamp_logprob = logf(logsumexp) + logprob_max;
+
+                beam_candidates.clear();
+                for (const auto & bc : bc_per_dec) {
+                    beam_candidates.insert(beam_candidates.end(), bc.begin(), bc.end());
+
+                    if (!bc.empty()) {
+                        state->n_sample += 1;
+                    }
                 }
-            }
 
-            const float max_text_token_logprob = *std::max_element(logprobs.begin(), logprobs.begin() + vocab.token_beg);
+                // for beam-search, choose the top candidates and update the KV caches
+                if (params.strategy == whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH) {
+                    std::sort(
+                            beam_candidates.begin(),
+                            beam_candidates.end(),
+                            [](const beam_candidate & a, const beam_candidate & b) {
+                        if (a.sequence.sum_logprobs_all != b.sequence.sum_logprobs_all) {
+                            return a.sequence.sum_logprobs_all > b.sequence.sum_logprobs_all;
+                        }
+                        return a.decoder_idx < b.decoder_idx;
+                    });
 
-            //WHISPER_LOG_INFO("timestamp_logprob=%f max_text_token_logprob=%f\n", timestamp_logprob, max_text_token_logprob);
+                    uint32_t cur_c = 0;
 
-            if (timestamp_logprob > max_text_token_logprob) {
-                for (int i = 0; i < vocab.token_beg; ++i) {
-                    logits[i]   = -INFINITY;
-                    logprobs[i] = -INFINITY;
-                }
-            } else {
-                if (params.n_grammar_rules > 0) {
-                    whisper_suppress_invalid_grammar(ctx, params, logits, decoder.grammar);
+                    for (int j = 0; j < n_decoders_cur; ++j) {
+                        auto & decoder = state->decoders[j];
 
-                    // populate the logprobs array (log_softmax)
-                    {
-                        const float logit_max = *std::max_element(logits.begin(), logits.end());
-                        float logsumexp = 0.0f;
-                        for (int i = 0; i < n_logits; ++i) {
-                            if (logits[i] > -INFINITY) {
-                                logsumexp += expf(logits[i] - logit_max);
-                            }
+                        if (decoder.completed || decoder.failed) {
+                            continue;
                         }
-                        logsumexp = logf(logsumexp) + logit_max;
 
-                        for (int i = 0; i < n_logits; ++i) {
-                            if (logits[i] > -INFINITY) {
-                                logprobs[i] = logits[i] - logsumexp;
-                            } else {
-                                logprobs[i] = -INFINITY;
-                            }
+                        if (cur_c >= beam_candidates.size()) {
+                            cur_c = 0;
                         }
-                    }
-                }
-            }
-        }
-    }
 
-    // compute probs
-    whisper_compute_probs(logits, n_logits, logprobs, probs);
+                        auto & cur = beam_candidates[cur_c++];
 
-#if 0
-    // print first 100 logits - token string : logit
-    //for (int i = 0; i < 10; i++) {
-    //    const auto token   = vocab.id_to_token.at(i);
-    //    const auto prob    = probs[i];
-    //    const auto logit   = logits[i];
-    //    const auto logprob = logprobs[i];
-    //    printf("%16s : prob=%9.5f logit=%9.5f logprob=%9.5f\n", token.c_str(), prob, logit, logprob);
-    //}
+                        while (beam_candidates.size() > cur_c && whisper_sequence_tokens_equal(beam_candidates[cur_c].sequence, cur.sequence) && i > 0) {
+                            ++cur_c;
+                        }
 
-    // print sorted
-    {
-        std::vector<std::pair<float, int>> pairs;
+                        decoder.seek_delta = cur.seek_delta;
+                        decoder.has_ts     = cur.has_ts;
+                        decoder.sequence   = cur.sequence;
+                        decoder.grammar    = cur.grammar;
 
-        for (int i = 0; i < n_logits; ++i) {
-            pairs.push_back(std::make_pair(probs[i], i));
-        }
+                        whisper_kv_cache_seq_cp(state->kv_self, cur.decoder_idx, WHISPER_MAX_DECODERS + j, -1, -1);
 
-        std::sort(pairs.begin(), pairs.end(), [](const std::pair<float, int>& a, const std::pair<float, int>& b) {
-            return a.first > b.first;
-        });
+                        WHISPER_LOG_DEBUG("%s: beam search: decoder %d: from decoder %d: token = %10s, plog = %8.5f, sum_logprobs = %8.5f\n",
+                                __func__, j, cur.decoder_idx, ctx->vocab.token_text(decoder.sequence.tokens.back().id), decoder.sequence.tokens.back().plog, decoder.sequence.sum_logprobs_all);
+                    }
 
-        for (int i = 0; i < 10; i++) {
-            const auto token   = vocab.id_to_token.at(pairs[i].second);
-            const auto prob    = pairs[i].first;
-            const auto logit   = logits[pairs[i].second];
-            const auto logprob = logprobs[pairs[i].second];
-            printf("%16s : id=%6d prob=%9.5f logit=%9.5f logprob=%9.5f '%s'\n", token.c_str(), pairs[i].second, prob, logit, logprob, token.c_str());
-        }
+                    for (int j = 0; j < n_decoders_cur; ++j) {
+                        auto & decoder = state->decoders[j];
 
-        printf("----------------\n");
-    }
+                        if (decoder.completed || decoder.failed) {
+                            continue;
+                        }
 
-    // "And", "and", " And", " and"
-    //printf("logits[\"and\"]  = %f\n", logits[vocab.token_to_id.at("and")]);
-    //printf("logits[\"And\"]  = %f\n", logits[vocab.token_to_id.at("And")]);
-    //printf("logits[\" and\"] = %f\n", logits[vocab.token_to_id.at(" and")]);
-    //printf("logits[\" And\"] = %f\n", logits[vocab.token_to_id.at(" And")]);
-    //printf("logits[\" so\"]  = %f\n", logits[vocab.token_to_id.at(" so")]);
-
-    //printf("logprobs[\"and\"]  = %f\n", logprobs[vocab.token_to_id.at("and")]);
-    //printf("logprobs[\"And\"]  = %f\n", logprobs[vocab.token_to_id.at("And")]);
-    //printf("logprobs[\" and\"] = %f\n", logprobs[vocab.token_to_id.at(" and")]);
-    //printf("logprobs[\" And\"] = %f\n", logprobs[vocab.token_to_id.at(" And")]);
-    //printf("logprobs[\" so\"]  = %f\n", logprobs[vocab.token_to_id.at(" so")]);
-
-    //printf("probs[\"and\"]  = %f\n", probs[vocab.token_to_id.at("and")]);
-    //printf("probs[\"And\"]  = %f\n", probs[vocab.token_to_id.at("And")]);
-    //printf("probs[\" and\"] = %f\n", probs[vocab.token_to_id.at(" and")]);
-    //printf("probs[\" And\"] = %f\n", probs[vocab.token_to_id.at(" And")]);
-    //printf("probs[\" so\"]  = %f\n", probs[vocab.token_to_id.at(" so")]);
-#endif
-}
+                        whisper_kv_cache_seq_rm(state->kv_self, j,                           -1, -1);
+                        whisper_kv_cache_seq_cp(state->kv_self, WHISPER_MAX_DECODERS + j, j, -1, -1);
+                        whisper_kv_cache_seq_rm(state->kv_self, WHISPER_MAX_DECODERS + j,    -1, -1);
+                    }
+                }
 
-static bool whisper_sequence_tokens_equal(const whisper_sequence & a, const whisper_sequence & b) {
-    if (a.tokens.size() != b.tokens.size()) {
-        return false;
-    }
-    // sequences are more likely to diverge at the end
-    for (int i = a.tokens.size() - 1; i >= 0; i--) {
-        if (a.tokens[i].id != b.tokens[i].id) {
-            return false;
-        }
-    }
-    return true;
-}
+                // update the decoder state
+                // - check if the sequence is completed
+                // - check if the sequence is failed
+                // - update sliding window based on timestamp tokens
+                for (int j = 0; j < n_decoders_cur; ++j) {
+                    auto & decoder = state->decoders[j];
 
-static whisper_token_data whisper_sample_token(
-            whisper_context & ctx,
-      const whisper_decoder & decoder,
-                       bool   best) {
-    whisper_token_data result = {
-        0, 0, 0.0f, 0.0f, 0.0f, 0.0f, -1, -1, -1, 0.0f,
-    };
+                    if (decoder.completed || decoder.failed) {
+                        continue;
+                    }
 
-    const auto & vocab = ctx.vocab;
+                    auto & has_ts     = decoder.has_ts;
+                    auto & failed     = decoder.failed;
+                    auto & completed  = decoder.completed;
+                    auto & seek_delta = decoder.seek_delta;
+                    auto & result_len = decoder.sequence.result_len;
 
-    const auto & probs    = decoder.probs;
-    const auto & logprobs = decoder.logprobs;
+                    {
+                        const auto & token = decoder.sequence.tokens.back();
 
-    const int n_logits = vocab.n_vocab;
+                        // timestamp token - update sliding window
+                        if (token.id > whisper_token_beg(ctx)) {
+                            const int seek_delta_new = 2*(token.id - whisper_token_beg(ctx));
 
-    {
-        double sum_ts = 0.0;
-        double max_ts = 0.0;
+                            // do not allow to go back in time
+                            if (has_ts && seek_delta > seek_delta_new && result_len < i) {
+                                WHISPER_LOG_DEBUG("%s: decoder %d: failed due to seek_delta (%d > %d)\n", __func__, j, seek_delta, seek_delta_new);
+                                failed = true; // TODO: maybe this is not a failure ?
+                                continue;
+                            }
 
-        for (int i = vocab.token_beg; i < n_logits; i++) {
-            if (probs[i] == -INFINITY) {
-                continue;
-            }
+                            seek_delta = seek_delta_new;
+                            result_len = i + 1;
+                            has_ts = true;
+                        }
 
-            sum_ts += probs[i];
-            if (max_ts < probs[i]) {
-                max_ts = probs[i];
-                result.tid = i;
-            }
-        }
+                        whisper_grammar_accept_token(*ctx, decoder.grammar, token.id);
 
-        result.pt    = max_ts/(sum_ts + 1e-10);
-        result.ptsum = sum_ts;
-    }
+#ifdef WHISPER_DEBUG
+                        {
+                            const char * tt = token.pt > 0.10 ? ctx->vocab.token_text(token.tid) : "[?]";
+                            WHISPER_LOG_DEBUG("%s: id = %3d, decoder = %d, token = %6d, p = %6.3f, ts = %10s, %6.3f, result_len = %4d '%s'\n",
+                                    __func__, i, j, token.id, token.p, tt, token.pt, result_len, ctx->vocab.token_text(token.id));
+                        }
+#endif
 
-    if (best) {
-        for (int i = 0; i < n_logits; ++i) {
-            if (result.p < probs[i]) {
-                result.id   = i;
-                result.p    = probs[i];
-                result.plog = logprobs[i];
-            }
-        }
-    } else {
-        std::discrete_distribution<> dist(probs.begin(), probs.end());
+                        // end of segment
+                        if (token.id == whisper_token_eot(ctx) ||               // end of text token
+                           (params.max_tokens > 0 && i >= params.max_tokens) || // max tokens per segment reached
+                           (has_ts && seek + seek_delta + delta_min >= seek_end)       // end of audio reached (100ms)
+                           ) {
+                            if (result_len == 0 && !params.no_timestamps) {
+                                if (seek + seek_delta + delta_min >= seek_end) {
+                                    result_len = i + 1;
+                                } else {
+                                    WHISPER_LOG_DEBUG("%s: decoder %d failed (result_len = 0)\n", __func__, j);
+                                    failed = true;
+                                    continue;
+                                }
+                            }
 
-        result.id   = dist(decoder.rng);
-        result.p    = probs[result.id];
-        result.plog = logprobs[result.id];
-    }
+                            if (params.single_segment || params.no_timestamps) {
+                                result_len = i + 1;
+                                seek_delta = 100*WHISPER_CHUNK_SIZE;
+                            }
 
-    if (result.id >= vocab.token_beg) {
-        result.tid = result.id;
-        result.pt  = result.p;
-    }
+                            WHISPER_LOG_DEBUG("%s: decoder %d completed\n", __func__, j);
+                            completed = true;
+                            continue;
+                        }
 
-    return result;
-}
+                        // TESTS: if no tensors are loaded, it means we are running tests
+                        if (ctx->model.n_loaded == 0) {
+                            seek_delta = 100*WHISPER_CHUNK_SIZE;
+                            completed = true;
+                            continue;
+                        }
+                    }
 
-static std::vector<whisper_token_data> whisper_sample_token_topk(
-            whisper_context & ctx,
-            whisper_decoder & decoder,
-                        int   k) {
-    const auto & vocab = ctx.vocab;
+                    // sometimes, the decoding can get stuck in a repetition loop
+                    // this is an attempt to mitigate such cases - we flag the decoding as failed and use a fallback strategy
+                    if (i == n_max - 1 && (result_len == 0 || seek_delta < 100*WHISPER_CHUNK_SIZE/2)) {
+                        WHISPER_LOG_DEBUG("%s: decoder %d: failed due to repetition loop\n", __func__, j);
+                        failed = true;
+                        continue;
+                    }
+                }
 
-    const auto & probs    = decoder.probs;
-    const auto & logits   = decoder.logits;
-    const auto & logprobs = decoder.logprobs;
+                // check if all decoders have finished (i.e. completed or failed)
+                {
+                    bool completed_all = true;
 
-    const int n_logits = vocab.n_vocab;
+                    for (int j = 0; j < n_decoders_cur; ++j) {
+                        auto & decoder = state->decoders[j];
 
-    auto & logits_id = decoder.logits_id;
+                        if (decoder.completed || decoder.failed) {
+                            continue;
+                        }
 
-    logits_id.resize(n_logits);
-    for (int i = 0; i < n_logits; ++i) {
-        logits_id[i].first = logits[i];
-        logits_id[i].second = i;
-    }
+                        completed_all = false;
+                    }
 
-    {
-        using pair_type = std::remove_reference<decltype(logits_id)>::type::value_type;
-        std::partial_sort(
-                logits_id.begin(),
-                logits_id.begin() + k, logits_id.end(),
-                [](const pair_type & a, const pair_type & b) {
-            return a.first > b.first;
-        });
-    }
+                    if (completed_all) {
+                        break;
+                    }
+                }
 
-    std::vector<whisper_token_data> result;
-    result.reserve(k);
+                state->t_sample_us += ggml_time_us() - t_start_sample_us;
 
-    whisper_token tid = vocab.token_beg;
+                // obtain logits for the next token
+                {
+                    auto & batch = state->batch;
 
-    float pt    = 0.0;
-    float ptsum = 0.0;
+                    batch.n_tokens = 0;
 
-    {
-        double sum_ts = 0.0;
-        double max_ts = 0.0;
+                    const int n_past = prompt.size() + i;
 
-        for (int i = vocab.token_beg; i < n_logits; i++) {
-            if (probs[i] == -INFINITY) {
-                continue;
-            }
+                    for (int j = 0; j < n_decoders_cur; ++j) {
+                        auto & decoder = state->decoders[j];
 
-            sum_ts += probs[i];
-            if (max_ts < probs[i]) {
-                max_ts = probs[i];
-                tid = i;
-            }
-        }
+                        if (decoder.failed || decoder.completed) {
+                            continue;
+                        }
 
-        pt    = max_ts/(sum_ts + 1e-10);
-        ptsum = sum_ts;
-    }
+                        //WHISPER_LOG_DEBUG("%s: decoder %d: token %d, seek_delta %d\n", __func__, j, decoder.sequence.tokens.back().id, decoder.seek_delta);
 
-    std::discrete_distribution<> dist(probs.begin(), probs.end());
+                        decoder.i_batch = batch.n_tokens;
 
-    for (int i = 0; i < k; ++i) {
-        const auto id = dist(decoder.rng);
-        //printf("XXX %d %d %f %f %f %f\n", id, tid, probs[id], logprobs[id], pt, ptsum);
+                        batch.token   [batch.n_tokens]    = decoder.sequence.tokens.back().id;
+                        batch.pos     [batch.n_tokens]    = n_past;
+                        batch.n_seq_id[batch.n_tokens]    = 1;
+                        batch.seq_id  [batch.n_tokens][0] = j;
+                        batch.logits  [batch.n_tokens]    = 1;
+                        batch.n_tokens++;
+                    }
 
-        result.push_back({ id, tid, probs[id], logprobs[id], pt, ptsum, -1, -1, -1, 0.0f, });
+                    assert(batch.n_tokens > 0);
 
-        if (result[i].id >= vocab.token_beg) {
-            result[i].tid = result[i].id;
-            result[i].pt  = result[i].p;
-        }
-    }
+                    if (!whisper_decode_internal(*ctx, *state, state->batch, params.n_threads, false, params.abort_callback, params.abort_callback_user_data)) {
+                        WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
+                        return -9;
+                    }
 
-    return result;
-}
+                    const int64_t t_start_sample_us = ggml_time_us();
 
-// ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L178-L192
-static void whisper_sequence_score(
-        const struct whisper_full_params & params,
-                        whisper_sequence & sequence) {
-    if (sequence.result_len == 0) {
-        return;
-    }
+                    // TODO: avoid memory allocations, optimize, avoid threads?
+                    {
+                        std::atomic<int> j_cur(0);
 
-    double result = 0.0f;
+                        auto process = [&]() {
+                            while (true) {
+                                const int j = j_cur.fetch_add(1);
 
-    for (int i = 0; i < sequence.result_len; ++i) {
-        result += sequence.tokens[i].plog;
-    }
+                                if (j >= n_decoders_cur) {
+                                    break;
+                                }
 
-    sequence.sum_logprobs = result;
-    sequence.avg_logprobs = result/sequence.result_len;
+                                auto & decoder = state->decoders[j];
 
-    double penalty = sequence.result_len;
+                                if (decoder.failed || decoder.completed) {
+                                    continue;
+                                }
 
-    if (params.length_penalty > 0.0f) {
-        penalty = pow((5.0 + penalty)/6.0, params.length_penalty);
-    }
+                                whisper_process_logits(*ctx, *state, decoder, params, state->logits_mask, t_cur);
+                            }
+                        };
 
-    sequence.score = result/penalty;
+                        const int n_threads = std::min(params.n_threads, n_decoders_cur);
 
-    // compute the entropy of the sequence of the last 32 tokens
-    {
-        const int n = 32;
+                        ctx->pool.parallel_for(n_threads, [&](int) { process(); });
+                    }
 
-        int cnt = 0;
-        double entropy = 0.0f;
+                    state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                }
+            }
 
-        std::map<whisper_token, int> token_counts;
-        for (int i = std::max(0, sequence.result_len - n); i < sequence.result_len; ++i) {
-            token_counts[sequence.tokens[i].id]++;
-            cnt++;
-        }
+            // rank the resulting sequences and select the best one
+            {
+                double best_score = -INFINITY;
 
-        for (const auto & kv : token_counts) {
-            const auto p = kv.second/(double)cnt;
-            entropy -= p*log(p);
+                for (int j = 0; j < n_decoders_cur; ++j) {
+                    auto & decoder = state->decoders[j];
 
-            //WHISPER_LOG_DEBUG("entropy: %d %f %f, count %d\n", kv.first, p, log(p), kv.second);
-        }
+                    if (decoder.failed) {
+                        continue;
+                    }
 
-        sequence.entropy = entropy;
-    }
-}
+                    decoder.sequence.tokens.resize(decoder.sequence.result_len);
+                    whisper_sequence_score(params, decoder.sequence);
 
-static bool whisper_vad(
-        struct whisper_context * ctx,
-          struct whisper_state * state,
-    struct whisper_full_params   params,
-                   const float * samples,
-                           int   n_samples,
-            std::vector<float> & filtered_samples) {
-    WHISPER_LOG_INFO("%s: VAD is enabled, processing speech segments only\n", __func__);
-    int filtered_n_samples = 0;
+                    WHISPER_LOG_DEBUG("%s: decoder %2d: score = %8.5f, result_len = %3d, avg_logprobs = %8.5f, entropy = %8.5f\n",
+                            __func__, j, decoder.sequence.score, decoder.sequence.result_len, decoder.sequence.avg_logprobs, decoder.sequence.entropy);
 
-    // Clear any existing mapping table
-    state->vad_mapping_table.clear();
-    state->has_vad_segments = false;
+                    if (decoder.sequence.result_len > 32 && decoder.sequence.entropy < params.entropy_thold) {
+                        WHISPER_LOG_DEBUG("%s: decoder %2d: failed due to entropy %8.5f < %8.5f\n",
+                                __func__, j, decoder.sequence.entropy, params.entropy_thold);
 
-    if (state->vad_context == nullptr) {
-        struct whisper_vad_context_params vad_ctx_params = whisper_vad_default_context_params();
-        struct whisper_vad_context * vctx = whisper_vad_init_from_file_with_params(params.vad_model_path, vad_ctx_params);
-        if (vctx == nullptr) {
-            WHISPER_LOG_ERROR("%s: failed to initialize VAD context\n", __func__);
-            return false;
-        }
-        state->vad_context = vctx;
-    }
-    auto vctx = state->vad_context;
+                        decoder.failed = true;
+                        state->n_fail_h++;
 
-    const whisper_vad_params & vad_params = params.vad_params;
+                        continue;
+                    }
 
-    whisper_vad_segments * vad_segments = whisper_vad_segments_from_samples(vctx, vad_params, samples, n_samples);
+                    if (best_score < decoder.sequence.score) {
+                        best_score = decoder.sequence.score;
+                        best_decoder_id = j;
+                    }
+                }
 
-    if (!vad_segments) {
-        return false;
-    }
+                WHISPER_LOG_DEBUG("%s: best decoder = %d\n", __func__, best_decoder_id);
+            }
 
-    if (vad_segments->data.size() > 0) {
-        state->has_vad_segments = true;
-        ctx->state->vad_segments.clear();
-        ctx->state->vad_segments.reserve(vad_segments->data.size());
+            bool success = true;
 
-        // Initialize the time mapping table
-        state->vad_mapping_table.clear();
-        state->vad_mapping_table.reserve(vad_segments->data.size() * 4);
+            // was the decoding successful for the current temperature?
+            // do fallback only if:
+            // - we are not at the last temperature
+            if (it != (int) temperatures.size() - 1) {
+                const auto & decoder = state->decoders[best_decoder_id];
 
-        WHISPER_LOG_INFO("%s: detected %d speech segments\n", __func__, (int)vad_segments->data.size());
-        float overlap_seconds = vad_params.samples_overlap;
-        int overlap_samples = overlap_seconds * WHISPER_SAMPLE_RATE;
+                if (decoder.failed ||
+                    (decoder.sequence.avg_logprobs < params.logprob_thold && state->no_speech_prob < params.no_speech_thold)) {
+                    WHISPER_LOG_DEBUG("%s: failed due to avg_logprobs %8.5f < %8.5f and no_speech_prob %8.5f < %8.5f\n", __func__, decoder.sequence.avg_logprobs, params.logprob_thold, state->no_speech_prob, params.no_speech_thold);
+                    success = false;
+                    state->n_fail_p++;
+                }
+            }
 
-        for (int i = 0; i < (int)vad_segments->data.size(); i++) {
-            int segment_start_samples = cs_to_samples(vad_segments->data[i].start);
-            int segment_end_samples   = cs_to_samples(vad_segments->data[i].end);
+            if (success) {
+                //for (auto & token : ctx->decoders[best_decoder_id].sequence.tokens) {
+                //    WHISPER_LOG_DEBUG("%s: token = %d, p = %6.3f, pt = %6.3f, ts = %s, str = %s\n", __func__, token.id, token.p, token.pt, ctx->vocab.token_text(token.tid), ctx->vocab.token_text(token.id));
+                //}
 
-            if (i < (int)vad_segments->data.size() - 1) {
-                segment_end_samples += overlap_samples;
+                break;
             }
-            segment_end_samples = std::min(segment_end_samples, n_samples - 1);
-            filtered_n_samples  += (segment_end_samples - segment_start_samples);
 
-            WHISPER_LOG_INFO("%s: Including segment %d: %.2f - %.2f (duration: %.2f)\n",
-                __func__, i, vad_segments->data[i].start/100.0,
-                (vad_segments->data[i].end/100.0 + (i < (int)vad_segments->data.size() - 1 ? overlap_seconds : 0)),
-                (vad_segments->data[i].end - vad_segments->data[i].start)/100.0 +
-                (i < (int)vad_segments->data.size() - 1 ? overlap_seconds : 0));
+            WHISPER_LOG_DEBUG("\n%s: failed to decode with temperature = %.2f\n", __func__, t_cur);
         }
 
-        int silence_samples = 0.1 * WHISPER_SAMPLE_RATE;
-        int total_silence_samples = (vad_segments->data.size() > 1) ? (vad_segments->data.size() - 1) * silence_samples : 0;
-        int total_samples_needed = filtered_n_samples + total_silence_samples;
+        // output results through a user-provided callback
+        {
+            const auto & best_decoder = state->decoders[best_decoder_id];
 
-        WHISPER_LOG_INFO("%s: total duration of speech segments: %.2f seconds\n",
-                        __func__, (float)filtered_n_samples / WHISPER_SAMPLE_RATE);
+            auto seek_delta = best_decoder.seek_delta;
+            const auto result_len = best_decoder.sequence.result_len;
 
-        try {
-            filtered_samples.resize(total_samples_needed);
-        } catch (const std::bad_alloc & /* e */) {
-            WHISPER_LOG_ERROR("%s: failed to allocate memory for filtered samples\n", __func__);
-            whisper_vad_free_segments(vad_segments);
-            return false;
-        }
+            const auto & tokens_cur = best_decoder.sequence.tokens;
 
-        int offset = 0;
-        for (int i = 0; i < (int)vad_segments->data.size(); i++) {
-            int segment_start_samples = cs_to_samples(vad_segments->data[i].start);
-            int segment_end_samples   = cs_to_samples(vad_segments->data[i].end);
+            // [EXPERIMENTAL] Token-level timestamps with DTW
+            const auto n_segments_before = state->result_all.size();
 
-            if (i < (int)vad_segments->data.size() - 1) {
-                segment_end_samples += overlap_samples;
+            const bool is_no_speech = (state->no_speech_prob > params.no_speech_thold &&
+                best_decoder.sequence.avg_logprobs < params.logprob_thold);
+
+            //WHISPER_LOG_DEBUG("prompt_init.size() = %d, prompt.size() = %d, result_len = %d, seek_delta = %d\n", prompt_init.size(), prompt.size(), result_len, seek_delta);
+
+            // update prompt_past1
+            prompt_past1.clear();
+            if (!params.carry_initial_prompt && !prompt.empty() && prompt.front() == whisper_token_prev(ctx)) {
+                prompt_past1.insert(prompt_past1.end(), prompt.begin() + 1, prompt.end() - prompt_init.size());
             }
 
-            segment_start_samples = std::min(segment_start_samples, n_samples - 1);
-            segment_end_samples = std::min(segment_end_samples, n_samples);
-            int segment_length = segment_end_samples - segment_start_samples;
-            if (segment_length > 0) {
-                whisper_state::vad_segment_info segment;
+            // Add newly decoded tokens to the rolling context
+            if (!is_no_speech) {
+                for (int i = 0; i < result_len; ++i) {
+                    prompt_past1.push_back(tokens_cur[i].id);
+                }
+            }
 
-                segment.orig_start = vad_segments->data[i].start;
-                segment.orig_end   = vad_segments->data[i].end;
+            if (!tokens_cur.empty() && ctx->model.n_loaded > 0 && !is_no_speech) {
+                int  i0 = 0;
+                auto t0 = seek + 2*(tokens_cur.front().tid - whisper_token_beg(ctx));
 
-                segment.vad_start = samples_to_cs(offset);
-                segment.vad_end   = samples_to_cs(offset + segment_length);
+                std::string text;
+                bool speaker_turn_next = false;
 
-                // Add segment boundaries to mapping table
-                vad_time_mapping start_mapping = {segment.vad_start, segment.orig_start};
-                vad_time_mapping end_mapping = {segment.vad_end, segment.orig_end};
+                for (int i = 0; i < (int) tokens_cur.size(); i++) {
+                    //printf("%s: %18s %6.3f %18s %6.3f\n", __func__,
+                    //        ctx->vocab.token_text(tokens_cur[i].id), tokens_cur[i].p,
+                    //        ctx->vocab.token_text(tokens_cur[i].tid), tokens_cur[i].pt);
 
-                state->vad_mapping_table.push_back(start_mapping);
-                state->vad_mapping_table.push_back(end_mapping);
+                    if (params.print_special || tokens_cur[i].id < whisper_token_eot(ctx)) {
+                        text += whisper_token_to_str(ctx, tokens_cur[i].id);
+                    }
 
-                // Add intermediate points for longer segments to improve interpolation accuracy
-                const int64_t min_segment_length = 100; // 1 second
-                const int64_t point_interval = 20;     // Add a point every 200ms
+                    // [TDRZ] record if speaker turn was predicted after current segment
+                    if (params.tdrz_enable && tokens_cur[i].id == whisper_token_solm(ctx)) {
+                        speaker_turn_next = true;
+                    }
 
-                if (segment.vad_end - segment.vad_start > min_segment_length) {
-                    int64_t segment_duration = segment.vad_end - segment.vad_start;
-                    int num_points = (int)(segment_duration / point_interval) - 1;
+                    if (tokens_cur[i].id > whisper_token_beg(ctx) && !params.single_segment) {
+                        const auto t1 = seek + 2*(tokens_cur[i].tid - whisper_token_beg(ctx));
 
-                    for (int j = 1; j <= num_points; j++) {
-                        int64_t vad_time = segment.vad_start + j * point_interval;
+                        if (!text.empty()) {
+                            const auto tt0 = t0;
+                            const auto tt1 = t1;
 
-                        if (vad_time >= segment.vad_end) continue;
+                            if (params.print_realtime) {
+                                if (params.print_timestamps) {
+                                    printf("[%s --> %s]  %s\n", to_timestamp(tt0).c_str(), to_timestamp(tt1).c_str(), text.c_str());
+                                } else {
+                                    printf("%s", text.c_str());
+                                    fflush(stdout);
+                                }
+                            }
 
-                        int64_t vad_elapsed = vad_time - segment.vad_start;
-                        int64_t vad_total = segment.vad_end - segment.vad_start;
-                        int64_t orig_total = segment.orig_end - segment.orig_start;
-                        int64_t orig_time = segment.orig_start + (vad_elapsed * orig_total) / vad_total;
+                            //printf("tt0 = %d, tt1 = %d, text = %s, token = %s, token_id = %d, tid = %d\n", tt0, tt1, text.c_str(), ctx->vocab.token_text(tokens_cur[i].id), tokens_cur[i].id, tokens_cur[i].tid);
 
-                        vad_time_mapping intermediate_mapping = {vad_time, orig_time};
-                        state->vad_mapping_table.push_back(intermediate_mapping);
+                            result_all.push_back({ tt0, tt1, text, state->no_speech_prob, {}, speaker_turn_next });
+                            for (int j = i0; j <= i; j++) {
+                                result_all.back().tokens.push_back(tokens_cur[j]);
+                            }
+
+                            int n_new = 1;
+
+                            if (params.token_timestamps) {
+                                whisper_exp_compute_token_level_timestamps(
+                                        *ctx, *state, result_all.size() - 1, params.thold_pt, params.thold_ptsum);
+
+                                if (params.max_len > 0) {
+                                    n_new = whisper_wrap_segment(*ctx, *state, params.max_len, params.split_on_word);
+                                }
+                            }
+                            if (params.new_segment_callback && !ctx->params.dtw_token_timestamps) {
+                                params.new_segment_callback(ctx, state, n_new, params.new_segment_callback_user_data);
+                            }
+                        }
+                        text = "";
+                        while (i < (int) tokens_cur.size() && tokens_cur[i].id > whisper_token_beg(ctx)) {
+                            i++;
+                        }
+                        i--;
+                        t0 = t1;
+                        i0 = i + 1;
+                        speaker_turn_next = false;
                     }
                 }
 
-                WHISPER_LOG_INFO("%s: vad_segment_info: orig_start: %.2f, orig_end: %.2f, vad_start: %.2f, vad_end: %.2f\n",
-                    __func__, segment.orig_start/100.0, segment.orig_end/100.0, segment.vad_start/100.0, segment.vad_end/100.0);
-                ctx->state->vad_segments.push_back(segment);
+                if (!text.empty()) {
+                    const auto t1 = seek + seek_delta;
 
-                // Copy this speech segment
-                memcpy(filtered_samples.data() + offset, samples + segment_start_samples, segment_length * sizeof(float));
-                offset += segment_length;
+                    const auto tt0 = t0;
+                    const auto tt1 = t1;
 
-                // Add silence after this segment (except after the last segment)
-                if (i < (int)vad_segments->data.size() - 1) {
-                    // Calculate the start and end time of the silence gap in processed audio
-                    int64_t silence_start_vad = samples_to_cs(offset);
-                    int64_t silence_end_vad = samples_to_cs(offset + silence_samples);
-                    // Calculate the corresponding original times
-                    int64_t orig_silence_start = segment.orig_end;
-                    int64_t orig_silence_end = vad_segments->data[i+1].start;
+                    if (params.print_realtime) {
+                        if (params.print_timestamps) {
+                            printf("[%s --> %s]  %s\n", to_timestamp(tt0).c_str(), to_timestamp(tt1).c_str(), text.c_str());
+                        } else {
+                            printf("%s", text.c_str());
+                            fflush(stdout);
+                        }
+                    }
 
-                    // Add mapping points for silence boundaries
-                    state->vad_mapping_table.push_back({silence_start_vad, orig_silence_start});
-                    state->vad_mapping_table.push_back({silence_end_vad, orig_silence_end});
+                    result_all.push_back({ tt0, tt1, text, state->no_speech_prob, {}, speaker_turn_next });
+                    for (int j = i0; j < (int) tokens_cur.size(); j++) {
+                        result_all.back().tokens.push_back(tokens_cur[j]);
+                    }
 
-                    // Fill with zeros (silence)
-                    memset(filtered_samples.data() + offset, 0, silence_samples * sizeof(float));
-                    offset += silence_samples;
+                    int n_new = 1;
+
+                    if (params.token_timestamps) {
+                        whisper_exp_compute_token_level_timestamps(
+                                *ctx, *state, result_all.size() - 1, params.thold_pt, params.thold_ptsum);
+
+                        if (params.max_len > 0) {
+                            n_new = whisper_wrap_segment(*ctx, *state, params.max_len, params.split_on_word);
+                        }
+                    }
+                    if (params.new_segment_callback && !ctx->params.dtw_token_timestamps) {
+                        params.new_segment_callback(ctx, state, n_new, params.new_segment_callback_user_data);
+                    }
                 }
             }
-        }
-
-        // Sort the mapping table by processed time
-        std::sort(state->vad_mapping_table.begin(), state->vad_mapping_table.end(),
-            [](const vad_time_mapping& a, const vad_time_mapping& b) {
-                return a.processed_time < b.processed_time;
-        });
 
-        // Remove any duplicate processed times to ensure monotonicity which is
-        // needed for binary search and interpolation later.
-        if (!state->vad_mapping_table.empty()) {
-            auto last = std::unique(state->vad_mapping_table.begin(), state->vad_mapping_table.end(),
-                [](const vad_time_mapping& a, const vad_time_mapping& b) {
-                    return a.processed_time == b.processed_time;
-                });
-            state->vad_mapping_table.erase(last, state->vad_mapping_table.end());
-        }
+            // FIXME: will timestamp offsets be correct?
+            // [EXPERIMENTAL] Token-level timestamps with DTW
+            {
+                const int n_segments = state->result_all.size() - n_segments_before;
+                if (ctx->params.dtw_token_timestamps && n_segments) {
+                    const int n_frames = std::min(std::min(WHISPER_CHUNK_SIZE * 100, seek_delta), seek_end - seek);
+                    whisper_exp_compute_token_level_timestamps_dtw(
+                            ctx, state, params, result_all.size() - n_segments, n_segments, seek, n_frames, 7, params.n_threads);
+                    if (params.new_segment_callback) {
+                        for (int seg = (int) result_all.size() - n_segments; seg < n_segments; seg++) {
+                            params.new_segment_callback(ctx, state, seg, params.new_segment_callback_user_data);
+                        }
+                    }
+                }
+            }
 
-        WHISPER_LOG_INFO("%s: Created time mapping table with %d points\n", __func__, (int)state->vad_mapping_table.size());
+            // ref: https://github.com/ggml-org/whisper.cpp/pull/2629
+            const bool single_timestamp_ending = tokens_cur.size() > 1 &&
+                tokens_cur[tokens_cur.size() - 2].id < whisper_token_beg(ctx) &&
+                tokens_cur[tokens_cur.size() - 1].id > whisper_token_beg(ctx);
+            if (single_timestamp_ending) {
+                WHISPER_LOG_DEBUG("single timestamp ending - skip entire chunk\n");
+                seek_delta = std::min(seek_end - seek, WHISPER_CHUNK_SIZE * 100);
+            }
 
-        filtered_n_samples = offset;
-        WHISPER_LOG_INFO("%s: Reduced audio from %d to %d samples (%.1f%% reduction)\n",
-                        __func__, n_samples, filtered_n_samples, 100.0f * (1.0f - (float)filtered_n_samples / n_samples));
+            // update audio window
+            seek += seek_delta;
+
+            WHISPER_LOG_DEBUG("seek = %d, seek_delta = %d\n", seek, seek_delta);
+        }
     }
 
-    whisper_vad_free_segments(vad_segments);
-    return true;
+    return 0;
 }
 
-int whisper_full_with_state(
+int whisper_full(
         struct whisper_context * ctx,
-          struct whisper_state * state,
     struct whisper_full_params   params,
                    const float * samples,
                            int   n_samples) {
-    // clear old results
-    auto & result_all = state->result_all;
-
-    result_all.clear();
-
-    if (n_samples > 0) {
-        // compute log mel spectrogram
-        if (whisper_pcm_to_mel_with_state(ctx, state, samples, n_samples, params.n_threads) != 0) {
-            WHISPER_LOG_ERROR("%s: failed to compute log mel spectrogram\n", __func__);
-            return -2;
-        }
-    }
-
-    // auto-detect language if not specified
-    if (params.language == nullptr || strlen(params.language) == 0 || strcmp(params.language, "auto") == 0 || params.detect_language) {
-        std::vector<float> probs(whisper_lang_max_id() + 1, 0.0f);
 
-        const auto lang_id = whisper_lang_auto_detect_with_state(ctx, state, 0, params.n_threads, probs.data());
-        if (lang_id < 0) {
-            WHISPER_LOG_ERROR("%s: failed to auto-detect language\n", __func__);
-            return -3;
+    std::vector<float> vad_samples;
+    if (params.vad) {
+        WHISPER_LOG_INFO("%s: VAD is enabled, processing speech segments only\n", __func__);
+        if (!whisper_vad(ctx, ctx->state, params, samples, n_samples, vad_samples)) {
+            WHISPER_LOG_ERROR("%s: failed to compute VAD\n", __func__);
+            return -1;
         }
-        state->lang_id = lang_id;
-        params.language = whisper_lang_str(lang_id);
-
-        WHISPER_LOG_INFO("%s: auto-detected language: %s (p = %f)\n", __func__, params.language, probs[whisper_lang_id(params.language)]);
-        if (params.detect_language) {
+        if (vad_samples.empty()) {
+            ctx->state->result_all.clear();
             return 0;
         }
+        samples = vad_samples.data();
+        n_samples = vad_samples.size();
     }
+    return whisper_full_with_state(ctx, ctx->state, params, samples, n_samples);
+}
 
-    if (params.token_timestamps) {
-        state->t_beg    = 0;
-        state->t_last   = 0;
-        state->tid_last = 0;
-        if (n_samples > 0) {
-            state->energy = get_signal_energy(samples, n_samples, 32);
-        }
-    }
+// quietest point of samples[i_beg, i_end): the signal energy is averaged over ~100 ms and the split goes
+// to the middle of the longest stretch within 10% of the minimum, i.e. the middle of a pause
+static int whisper_find_quiet_point(const float * samples, int i_beg, int i_end) {
+    const int n = i_end - i_beg;
 
-    const int seek_start = params.offset_ms/10;
-    const int seek_end = params.duration_ms == 0 ? whisper_n_len_from_state(state) : seek_start + params.duration_ms/10;
+    const std::vector<float> energy = get_signal_energy(samples + i_beg, n, 32);
 
-    // if length of spectrogram is less than 100ms (10 frames), then return
-    // basically don't process anything that is less than 100ms
-    // ref: https://github.com/ggml-org/whisper.cpp/issues/2065
-    const int delta_min = 10;
+    const int hw = std::max(1, std::min(n/4, WHISPER_SAMPLE_RATE/20));
 
-    if (seek_end < seek_start + delta_min) {
-        WHISPER_LOG_WARN("%s: input is too short - %d ms < 100 ms. consider padding the input audio with silence\n", __func__, (seek_end - seek_start)*10);
-        return 0;
+    std::vector<double> sum(n + 1, 0.0);
+    for (int i = 0; i < n; ++i) {
+        sum[i + 1] = sum[i] + energy[i];
     }
 
-    // a set of temperatures to use
-    // [ t0, t0 + delta, t0 + 2*delta, ..., < 1.0f + 1e-6f ]
-    std::vector<float> temperatures;
-    if (params.temperature_inc > 0.0f) {
-        for (float t = params.temperature; t < 1.0f + 1e-6f; t += params.temperature_inc) {
-            temperatures.push_back(t);
-        }
-    } else {
-        temperatures.push_back(params.temperature);
+    double e_min = INFINITY;
+    for (int i = hw; i < n - hw; ++i) {
+        e_min = std::min(e_min, sum[i + hw + 1] - sum[i - hw]);
     }
 
-    // initialize the decoders
-    int n_decoders = 1;
-
-    switch (params.strategy) {
-        case WHISPER_SAMPLING_GREEDY:
-            {
-                n_decoders = params.greedy.best_of;
-            } break;
-        case WHISPER_SAMPLING_BEAM_SEARCH:
-            {
-                n_decoders = std::max(params.greedy.best_of, params.beam_search.beam_size);
-            } break;
-    };
-
-    n_decoders = std::max(1, n_decoders);
+    const double e_thold = 1.1*e_min + 1e-6;
 
-    if (n_decoders > WHISPER_MAX_DECODERS) {
-        WHISPER_LOG_ERROR("%s: too many decoders requested (%d), max = %d\n", __func__, n_decoders, WHISPER_MAX_DECODERS);
-        return -4;
+    int i_best = n/2;
+    int n_best = 0;
+    int i_run  = -1;
+    for (int i = hw; i <= n - hw; ++i) {
+        const bool quiet = i < n - hw && sum[i + hw + 1] - sum[i - hw] <= e_thold;
+        if (quiet && i_run < 0) {
+            i_run = i;
+        }
+        if (!quiet && i_run >= 0) {
+            if (i - i_run > n_best) {
+                n_best = i - i_run;
+                i_best = (i_run + i - 1)/2;
+            }
+            i_run = -1;
+        }
     }
 
-    // TAGS: WHISPER_DECODER_INIT
-    for (int j = 1; j < n_decoders; j++) {
-        auto & decoder = state->decoders[j];
-
-        decoder.sequence.tokens.reserve(state->decoders[0].sequence.tokens.capacity());
-
-        decoder.probs.resize   (ctx->vocab.n_vocab);
-        decoder.logits.resize  (ctx->vocab.n_vocab);
-        decoder.logprobs.resize(ctx->vocab.n_vocab);
-        decoder.logits_id.reserve(ctx->model.hparams.n_vocab);
-
-        decoder.rng = std::mt19937(j);
-    }
+    return i_beg + i_best;
+}
 
-    // the accumulated text context split into static (prompt_past0) and dynamic (prompt_past1)
-    auto & prompt_past0 = state->prompt_past0;
-    auto & prompt_past1 = state->prompt_past1;
-    if (params.no_context) {
-        prompt_past0.clear();
-        prompt_past1.clear();
+static std::string whisper_segment_text(struct whisper_context * ctx, const whisper_full_params & params, const whisper_segment & segment) {
+    std::string text;
+    for (const auto & token : segment.tokens) {
+        if (params.print_special || token.id < whisper_token_eot(ctx)) {
+            text += whisper_token_to_str(ctx, token.id);
+        }
     }
 
-    // calculate the maximum context budget for prompt history
-    const int max_prompt_ctx = std::min(params.n_max_text_ctx, whisper_n_text_ctx(ctx)/2);
-
-    // prepare prompt
-    {
-        std::vector<whisper_token> prompt_tokens;
+    return text;
+}
 
-        // tokenize the initial prompt
-        if (!params.prompt_tokens && params.initial_prompt) {
-            prompt_tokens.resize(1024);
-            int n_needed = whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size());
-            if (n_needed < 0) {
-                prompt_tokens.resize(-n_needed);
-                n_needed = whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size());
+// time of the text token with index i_text in the segment: the token-level timestamp if there is one,
+// otherwise interpolated from the number of text tokens
+static int64_t whisper_segment_token_time(struct whisper_context * ctx, const whisper_segment & segment, int i_text, bool end) {
+    int n_text = 0;
+    for (const auto & token : segment.tokens) {
+        if (token.id < whisper_token_eot(ctx)) {
+            if (n_text == i_text) {
+                const int64_t t = end ? token.t1 : token.t0;
+                if (t >= 0) {
+                    return std::min(segment.t1, std::max(segment.t0, t));
+                }
             }
-            prompt_tokens.resize(n_needed);
-            params.prompt_tokens   = prompt_tokens.data();
-            params.prompt_n_tokens = prompt_tokens.size();
+            n_text++;
         }
-        if (params.prompt_tokens && params.prompt_n_tokens > 0) {
-            if (params.carry_initial_prompt) {
-                if (prompt_past0.empty()) {
-                    const int max_tokens = std::max(1, max_prompt_ctx - 1);
+    }
 
-                    if (params.prompt_n_tokens > max_tokens) {
-                        WHISPER_LOG_WARN("%s: initial prompt is too long (%d tokens), will use only the last %d tokens\n",
-                                        __func__, params.prompt_n_tokens, max_tokens);
-                    }
+    return segment.t0 + (segment.t1 - segment.t0)*(i_text + (end ? 1 : 0))/std::max(1, n_text);
+}
 
-                    const int n_tokens = std::min(params.prompt_n_tokens, max_tokens);
-                    prompt_past0.assign(params.prompt_tokens + (params.prompt_n_tokens - n_tokens), params.prompt_tokens + params.prompt_n_tokens);
-                }
-            } else {
-                for (int i = 0; i < params.prompt_n_tokens; ++i) {
-                    prompt_past1.push_back(params.prompt_tokens[i]);
+// merge the results of the next chunk (src, in absolute time) into dst
+// both chunks decoded the audio in [t_ov0, t_ov1] around the split point t_split
+// the text tokens of the overlap are aligned on their longest common run and the second copy is dropped
+// if the two decodes do not agree on at least a few tokens, each side keeps the segments on its side of t_split
+// returns true if the chunks were aligned on the tokens
+static bool whisper_stitch_segments(
+        struct whisper_context * ctx,
+   const whisper_full_params & params,
+ std::vector<whisper_segment> & dst,
+ std::vector<whisper_segment> & src,
+                       int64_t   t_ov0,
+                       int64_t   t_ov1,
+                       int64_t   t_split) {
+    const int n_min_match = 3;
+
+    struct token_ref {
+        int i_segment;
+        int i_token;
+        int i_text; // index among the text tokens of the segment
+    };
+
+    const auto collect = [&](const std::vector<whisper_segment> & segments, int i0, int i1, std::vector<token_ref> & refs) {
+        for (int i = i0; i < i1; ++i) {
+            int i_text = 0;
+            for (int j = 0; j < (int) segments[i].tokens.size(); ++j) {
+                if (segments[i].tokens[j].id < whisper_token_eot(ctx)) {
+                    refs.push_back({ i, j, i_text++ });
                 }
-                std::rotate(prompt_past1.begin(), prompt_past1.end() - params.prompt_n_tokens, prompt_past1.end());
             }
         }
+    };
+
+    // the segments that reach into the overlap
+    int a0 = dst.size();
+    while (a0 > 0 && dst[a0 - 1].t1 > t_ov0) {
+        a0--;
     }
 
-    // overwrite audio_ctx, max allowed is hparams.n_audio_ctx
-    if (params.audio_ctx > whisper_n_audio_ctx(ctx)) {
-        WHISPER_LOG_ERROR("%s: audio_ctx is larger than the maximum allowed (%d > %d)\n", __func__, params.audio_ctx, whisper_n_audio_ctx(ctx));
-        return -5;
+    int b1 = 0;
+    while (b1 < (int) src.size() && src[b1].t0 < t_ov1) {
+        b1++;
     }
-    state->exp_n_audio_ctx = params.audio_ctx;
 
-    // these tokens determine the task that will be performed
-    std::vector<whisper_token> prompt_init = { whisper_token_sot(ctx), };
+    std::vector<token_ref> ta;
+    std::vector<token_ref> tb;
 
-    if (whisper_is_multilingual(ctx)) {
-        const int lang_id = whisper_lang_id(params.language);
-        state->lang_id = lang_id;
-        prompt_init.push_back(whisper_token_lang(ctx, lang_id));
-        if (params.translate) {
-            prompt_init.push_back(whisper_token_translate(ctx));
-        } else {
-            prompt_init.push_back(whisper_token_transcribe(ctx));
-        }
-    }
+    collect(dst, a0, dst.size(), ta);
+    collect(src, 0,  b1,         tb);
 
-    // first release distilled models require the "no_timestamps" token
+    // longest common run of token ids
+    int n_best = 0;
+    int a_best = 0;
+    int b_best = 0;
     {
-        const bool is_distil = ctx->model.hparams.n_text_layer == 2 && ctx->model.hparams.n_vocab != 51866;
-        if (is_distil && !params.no_timestamps) {
-            WHISPER_LOG_WARN("%s: using first release distilled models - forcing no_timestamps\n", __func__);
-            params.no_timestamps = true;
+        std::vector<int> run_prev(tb.size() + 1, 0);
+        std::vector<int> run_cur (tb.size() + 1, 0);
+
+        for (int ia = 0; ia < (int) ta.size(); ++ia) {
+            const whisper_token id = dst[ta[ia].i_segment].tokens[ta[ia].i_token].id;
+            for (int ib = 0; ib < (int) tb.size(); ++ib) {
+                run_cur[ib + 1] = src[tb[ib].i_segment].tokens[tb[ib].i_token].id == id ? run_prev[ib] + 1 : 0;
+                if (run_cur[ib + 1] > n_best) {
+                    n_best = run_cur[ib + 1];
+                    a_best = ia + 1 - n_best;
+                    b_best = ib + 1 - n_best;
+                }
+            }
+            std::swap(run_prev, run_cur);
         }
     }
 
-    if (params.no_timestamps) {
-        prompt_init.push_back(whisper_token_not(ctx));
-    }
+    if (n_best < n_min_match) {
+        while ((int) dst.size() > a0 && (dst.back().t0 + dst.back().t1)/2 >= t_split) {
+            dst.pop_back();
+        }
 
-    int seek = seek_start;
+        int n_drop = 0;
+        while (n_drop < b1 && (src[n_drop].t0 + src[n_drop].t1)/2 < t_split) {
+            n_drop++;
+        }
+        src.erase(src.begin(), src.begin() + n_drop);
 
-    std::vector<whisper_token> prompt;
-    prompt.reserve(whisper_n_text_ctx(ctx));
+        return false;
+    }
 
-    struct beam_candidate {
-        int decoder_idx;
-        int seek_delta;
+    // cut in the middle of the common run: dst keeps the tokens before the cut, src the tokens from the cut on
+    const token_ref cut_a = ta[a_best + n_best/2];
+    const token_ref cut_b = tb[b_best + n_best/2];
 
-        bool has_ts;
+    {
+        auto & segment = dst[cut_a.i_segment];
 
-        whisper_sequence sequence;
-        whisper_grammar grammar;
-    };
+        if (cut_a.i_text > 0) {
+            segment.t1 = whisper_segment_token_time(ctx, segment, cut_a.i_text - 1, true);
+        }
+        segment.tokens.erase(segment.tokens.begin() + cut_a.i_token, segment.tokens.end());
+        segment.text = whisper_segment_text(ctx, params, segment);
 
-    std::vector<std::vector<beam_candidate>> bc_per_dec(n_decoders);
-    std::vector<beam_candidate> beam_candidates;
+        dst.resize(cut_a.i_segment + (segment.text.empty() ? 0 : 1));
+    }
 
-    // main loop
-    while (true) {
-        if (params.progress_callback) {
-            const int progress_cur = (100*(seek - seek_start))/(seek_end - seek_start);
+    {
+        auto & segment = src[cut_b.i_segment];
 
-            params.progress_callback(
-                ctx, state, progress_cur, params.progress_callback_user_data);
-        }
+        segment.t0 = whisper_segment_token_time(ctx, segment, cut_b.i_text, false);
+        segment.tokens.erase(segment.tokens.begin(), segment.tokens.begin() + cut_b.i_token);
+        segment.text = whisper_segment_text(ctx, params, segment);
 
-        // if only 100ms left, then stop
-        if (seek + delta_min >= seek_end) {
-            break;
-        }
+        src.erase(src.begin(), src.begin() + cut_b.i_segment + (segment.text.empty() ? 1 : 0));
+    }
 
-        if (params.encoder_begin_callback) {
-            if (params.encoder_begin_callback(ctx, state, params.encoder_begin_callback_user_data) == false) {
-                WHISPER_LOG_ERROR("%s: encoder_begin_callback returned false - aborting\n", __func__);
-                break;
-            }
-        }
+    return true;
+}
 
-        // encode audio features starting at offset seek
-        if (!whisper_encode_internal(*ctx, *state, seek, params.n_threads, params.abort_callback, params.abort_callback_user_data)) {
-            WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
-            return -6;
-        }
+int whisper_full_parallel(
+        struct whisper_context * ctx,
+        struct whisper_full_params params,
+        const float * samples,
+        int n_samples,
+        int n_processors) {
 
-        // if there is a very short audio segment left to process, we remove any past prompt since it tends
-        // to confuse the decoder and often make it repeat or hallucinate stuff
-        if (seek > seek_start && seek + 500 >= seek_end) {
-            prompt_past0.clear();
-            prompt_past1.clear();
+    if (n_processors == 1) {
+        return whisper_full(ctx, params, samples, n_samples);
+    }
+
+    std::vector<float> vad_samples;
+    if (params.vad) {
+        WHISPER_LOG_INFO("%s: VAD is enabled, processing speech segments only\n", __func__);
+        if (!whisper_vad(ctx, ctx->state, params, samples, n_samples, vad_samples)) {
+            WHISPER_LOG_ERROR("%s: failed to compute VAD\n", __func__);
+            return -1;
         }
+        if (vad_samples.empty()) {
+            return 0;
+        }
+        samples = vad_samples.data();
+        n_samples = vad_samples.size();
+    }
 
-        int best_decoder_id = 0;
+    // prepare separate states for each thread
+    // the calling thread uses the default state of the context
+    std::vector<whisper_state*> states;
 
-        for (int it = 0; it < (int) temperatures.size(); ++it) {
-            const float t_cur = temperatures[it];
+    const int offset_samples = (WHISPER_SAMPLE_RATE*params.offset_ms)/1000;
+    const int end_samples    = params.duration_ms > 0 ? (int) std::min<int64_t>(n_samples, offset_samples + (int64_t) WHISPER_SAMPLE_RATE*params.duration_ms/1000) : n_samples;
 
-            int n_decoders_cur = 1;
+    if (end_samples <= offset_samples) {
+        WHISPER_LOG_ERROR("%s: offset %dms is past the end of the audio\n", __func__, params.offset_ms);
+        return -1;
+    }
 
-            switch (params.strategy) {
-                case whisper_sampling_strategy::WHISPER_SAMPLING_GREEDY:
-                    {
-                        if (t_cur > 0.0f) {
-                            n_decoders_cur = params.greedy.best_of;
-                        }
-                    } break;
-                case whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH:
-                    {
-                        if (t_cur > 0.0f) {
-                            n_decoders_cur = params.greedy.best_of;
-                        } else {
-                            n_decoders_cur = params.beam_search.beam_size;
-                        }
-                    } break;
-            };
+    // the audio is cut in many windows that the states pick from a shared queue, so a window that needs
+    // temperature fallbacks does not hold up the others
+    // each window, including the overlap, fits in a single encoder pass - with short audio, there is
+    // one window per processor instead
+    const int n_half_overlap = std::max(0, (int) std::min<int64_t>(WHISPER_CHUNK_SIZE*WHISPER_SAMPLE_RATE/4, (int64_t) WHISPER_SAMPLE_RATE*params.parallel.overlap_ms/2000));
+    const int n_window_max   = WHISPER_CHUNK_SIZE*WHISPER_SAMPLE_RATE - 2*n_half_overlap;
 
-            n_decoders_cur = std::max(1, n_decoders_cur);
+    const int n_chunks = std::max<int>(n_processors, (end_samples - offset_samples + n_window_max - 1)/n_window_max);
+    const int n_chunk  = (end_samples - offset_samples)/n_chunks;
 
-            WHISPER_LOG_DEBUG("\n%s: strategy = %d, decoding with %d decoders, temperature = %.2f\n", __func__, params.strategy, n_decoders_cur, t_cur);
+    // how far a split may move towards silence, and half of the audio decoded by both chunks around a split
+    // both are capped so that only neighbouring chunks overlap
+    const int n_search  = std::min(n_chunk/4, (int) std::min<int64_t>(WHISPER_CHUNK_SIZE*WHISPER_SAMPLE_RATE, std::max<int64_t>(0, (int64_t) WHISPER_SAMPLE_RATE*params.parallel.search_ms/1000)));
+    const int n_overlap = std::min(n_chunk/4, n_half_overlap);
 
-            // TAGS: WHISPER_DECODER_INIT
-            for (int j = 0; j < n_decoders_cur; ++j) {
-                auto & decoder = state->decoders[j];
+    // chunk ic is [splits[ic], splits[ic + 1]), extended by n_overlap on the inner sides
+    std::vector<int> splits(n_chunks + 1);
 
-                decoder.sequence.tokens.clear();
-                decoder.sequence.result_len       = 0;
-                decoder.sequence.sum_logprobs_all = 0.0;
-                decoder.sequence.sum_logprobs     = -INFINITY;
-                decoder.sequence.avg_logprobs     = -INFINITY;
-                decoder.sequence.entropy          = 0.0;
-                decoder.sequence.score            = -INFINITY;
+    splits[0]        = offset_samples;
+    splits[n_chunks] = end_samples;
 
-                decoder.seek_delta = 100*WHISPER_CHUNK_SIZE;
+    for (int ic = 1; ic < n_chunks; ++ic) {
+        const int prev = splits[ic - 1];
 
-                decoder.failed    = false;
-                decoder.completed = false;
-                decoder.has_ts    = false;
+        // an equal share of the remaining audio, moved to a pause without making this chunk or the remaining ones too long
+        const int target = prev + (end_samples - prev)/(n_chunks - ic + 1);
 
-                if (params.grammar_rules != nullptr) {
-                    decoder.grammar = whisper_grammar_init(params.grammar_rules, params.n_grammar_rules, params.i_start_rule);
-                } else {
-                    decoder.grammar = {};
-                }
-            }
+        const int i_lo = std::max(target - n_search, std::max(prev + n_overlap, end_samples - (n_chunks - ic)*n_window_max));
+        const int i_hi = std::min(target + n_search, prev + n_window_max);
 
-            // init prompt and kv cache for the current iteration
-            // TODO: do not recompute the prompt if it is the same as previous time
-            {
-                prompt.clear();
+        splits[ic] = i_hi - i_lo > 2*WHISPER_SAMPLE_RATE/10 ? whisper_find_quiet_point(samples, i_lo, i_hi) : target;
+    }
 
-                if (params.n_max_text_ctx > 0 && t_cur < WHISPER_HISTORY_CONDITIONING_TEMP_CUTOFF) {
-                    const bool can_take0 = params.carry_initial_prompt && !prompt_past0.empty();
-                    const bool can_take1 = !prompt_past1.empty();
+    for (int i = 0; i < n_processors - 1; ++i) {
+        states.push_back(whisper_init_state(ctx));
+        if (states.back() == nullptr) {
+            WHISPER_LOG_ERROR("%s: failed to initialize state %d\n", __func__, i + 1);
+            states.pop_back();
+            for (auto * state : states) {
+                whisper_free_state(state);
+            }
+            return -1;
+        }
+    }
 
-                    if (max_prompt_ctx > 0 && (can_take0 || can_take1)) {
-                        // Always start with previous token marker to connect continuity
-                        prompt.push_back(whisper_token_prev(ctx));
+    std::vector<std::vector<whisper_segment>> results(n_chunks);
 
-                        // Take static tokens (initial prompt) first
-                        int n_take0 = 0;
-                        if (can_take0) {
-                            n_take0 = prompt_past0.size();
-                            prompt.insert(prompt.end(), prompt_past0.end() - n_take0, prompt_past0.end());
-                        }
+    std::atomic<int> ret(0);
+    std::atomic<int> i_next(0);
 
-                        // Fill remaining budget with dynamic tokens (rolling context)
-                        const int n_take1 = std::min<int>(max_prompt_ctx - n_take0 - 1, prompt_past1.size());
-                        prompt.insert(prompt.end(), prompt_past1.end() - n_take1, prompt_past1.end());
-                    }
-                }
+    int lang_id = -1;
 
-                // init new transcription with sot, language (opt) and task tokens
-                prompt.insert(prompt.end(), prompt_init.begin(), prompt_init.end());
+    int        n_done = 0;
+    std::mutex mutex_progress;
 
-                // print the prompt
-                WHISPER_LOG_DEBUG("\n\n");
-                for (int i = 0; i < (int) prompt.size(); i++) {
-                    WHISPER_LOG_DEBUG("%s: prompt[%d] = %s\n", __func__, i, ctx->vocab.id_to_token.at(prompt[i]).c_str());
-                }
-                WHISPER_LOG_DEBUG("\n\n");
+    ctx->pool.parallel_for(n_processors, [&](int ip) {
+        whisper_state * state = ip == 0 ? ctx->state : states[ip - 1];
 
-                // recreate the KV cache if the number of decoders has changed
-                if (state->kv_self_n_dec < n_decoders_cur) {
-                    WHISPER_LOG_DEBUG("%s: recreating KV cache: n_decoders_cur = %d\n", __func__, n_decoders_cur);
+        int ic_last = -1;
 
-                    whisper_kv_cache_free(state->kv_self);
+        for (int ic = i_next++; ic < n_chunks; ic = i_next++) {
+            const int start_samples = splits[ic] - (ic > 0 ? n_overlap : 0);
+            const int n_samples_cur = std::min(end_samples, splits[ic + 1] + n_overlap) - start_samples;
 
-                    // overallocate to workaround KV cache fragmentation issues
-                    const int factor = n_decoders_cur > 1 ? n_decoders_cur + 2 : 1;
+            // the text context of the state is that of the last window it decoded. it is kept only if this window
+            // directly follows it, otherwise the decoder would be prompted with the text of unrelated audio
+            if (ic != ic_last + 1) {
+                state->prompt_past0.clear();
+                state->prompt_past1.clear();
+            }
+            ic_last = ic;
 
-                    if (!whisper_kv_cache_init(state->kv_self, state->backends[0], ctx->itype,
-                                ctx->model.hparams.n_text_state,
-                                ctx->model.hparams.n_text_layer,
-                                GGML_PAD(ctx->model.hparams.n_text_ctx, 256)*factor)) {
-                        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
-                        whisper_free_state(state);
-                        return -7;
-                    }
+            auto params_cur = params;
 
-                    state->kv_self_n_dec = n_decoders_cur;
-                }
+            params_cur.offset_ms   = 0;
+            params_cur.duration_ms = 0;
 
-                whisper_kv_cache_clear(state->kv_self);
+            params_cur.print_progress = false;
+            params_cur.print_realtime = false;
 
-                whisper_batch_prep_legacy(state->batch, prompt.data(), prompt.size(), 0, 0);
+            // the segments are reported once the chunks are merged
+            params_cur.new_segment_callback = nullptr;
+            params_cur.new_segment_callback_user_data = nullptr;
 
-                if (!whisper_decode_internal(*ctx, *state, state->batch, params.n_threads, false, params.abort_callback, params.abort_callback_user_data)) {
-                    WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
-                    return -8;
-                }
+            params_cur.progress_callback = nullptr;
+            params_cur.progress_callback_user_data = nullptr;
 
-                // Calculate no_speech probability after first decode.
-                // This has to be done before any logit filtering. Hence we cannot use the probs from the whisper_process_logits.
-                {
-                    const int n_logits = ctx->vocab.id_to_token.size();
-                    std::vector<float> logprobs(n_logits);
-                    std::vector<float> probs(n_logits);
+            const int ret_cur = whisper_full_with_state(ctx, state, std::move(params_cur), samples + start_samples, n_samples_cur);
+            if (ret_cur != 0) {
+                WHISPER_LOG_ERROR("%s: failed to process chunk %d (%d)\n", __func__, ic, ret_cur);
 
-                    whisper_compute_logprobs(state->logits, n_logits, logprobs);
-                    whisper_compute_probs(state->logits, n_logits, logprobs, probs);
-                    state->no_speech_prob = probs[whisper_token_nosp(ctx)];
-                }
+                int expected = 0;
+                ret.compare_exchange_strong(expected, ret_cur);
+            }
 
-                {
-                    const int64_t t_start_sample_us = ggml_time_us();
+            // correct the segment and token timestamps taking into account the start of the chunk
+            const int64_t t_shift = (100ll*start_samples)/WHISPER_SAMPLE_RATE;
 
-                    state->decoders[0].i_batch = prompt.size() - 1;
+            for (auto & result : state->result_all) {
+                result.t0 += t_shift;
+                result.t1 += t_shift;
 
-                    whisper_process_logits(*ctx, *state, state->decoders[0], params, t_cur);
+                for (auto & token : result.tokens) {
+                    token.t0    = token.t0    < 0 ? token.t0    : token.t0    + t_shift;
+                    token.t1    = token.t1    < 0 ? token.t1    : token.t1    + t_shift;
+                    token.t_dtw = token.t_dtw < 0 ? token.t_dtw : token.t_dtw + t_shift;
+                }
+            }
 
-                    for (int j = 1; j < n_decoders_cur; ++j) {
-                        auto & decoder = state->decoders[j];
+            results[ic] = std::move(state->result_all);
+            state->result_all.clear();
 
-                        whisper_kv_cache_seq_cp(state->kv_self, 0, j, -1, -1);
+            if (ic == 0) {
+                lang_id = state->lang_id;
+            }
 
-                        memcpy(decoder.probs.data(),    state->decoders[0].probs.data(),    decoder.probs.size()*sizeof(decoder.probs[0]));
-                        memcpy(decoder.logits.data(),   state->decoders[0].logits.data(),   decoder.logits.size()*sizeof(decoder.logits[0]));
-                        memcpy(decoder.logprobs.data(), state->decoders[0].logprobs.data(), decoder.logprobs.size()*sizeof(decoder.logprobs[0]));
-                    }
+            {
+                std::lock_guard<std::mutex> lock(mutex_progress);
 
-                    state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                n_done++;
+
+                if (params.progress_callback) {
+                    params.progress_callback(ctx, ctx->state, (100*n_done)/n_chunks, params.progress_callback_user_data);
                 }
             }
+        }
+    });
 
-            for (int i = 0, n_max = whisper_n_text_ctx(ctx)/2 - 4; i < n_max; ++i) {
-                const int64_t t_start_sample_us = ggml_time_us();
+    auto & result_all = ctx->state->result_all;
 
-                if (params.strategy == whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH) {
-                    for (auto & bc : bc_per_dec) {
-                        bc.clear();
-                    }
-                }
+    result_all = std::move(results[0]);
+    ctx->state->lang_id = lang_id;
 
-                // sampling
-                // TODO: avoid memory allocations, optimize, avoid threads?
-                {
-                    std::atomic<int> j_cur(0);
+    if (params.new_segment_callback && n_overlap == 0 && !result_all.empty()) {
+        params.new_segment_callback(ctx, ctx->state, result_all.size(), params.new_segment_callback_user_data);
+    }
 
-                    auto process = [&]() {
-                        while (true) {
-                            const int j = j_cur.fetch_add(1);
+    std::vector<bool> aligned(n_chunks, false);
 
-                            if (j >= n_decoders_cur) {
-                                break;
-                            }
+    // combine the results of the chunks in order
+    for (int ic = 1; ic < n_chunks; ++ic) {
+        auto & results_i = results[ic];
 
-                            auto & decoder = state->decoders[j];
+        if (n_overlap > 0) {
+            aligned[ic] = whisper_stitch_segments(ctx, params, result_all, results_i,
+                    (100ll*(splits[ic] - n_overlap))/WHISPER_SAMPLE_RATE,
+                    (100ll*(splits[ic] + n_overlap))/WHISPER_SAMPLE_RATE,
+                    (100ll*(splits[ic]            ))/WHISPER_SAMPLE_RATE);
+        }
 
-                            if (decoder.completed || decoder.failed) {
-                                continue;
-                            }
+        for (auto& result : results_i) {
+            // make sure that segments are not overlapping
+            if (!result_all.empty()) {
+                result.t0 = std::max(result.t0, result_all.back().t1);
+            }
 
-                            switch (params.strategy) {
-                                case whisper_sampling_strategy::WHISPER_SAMPLING_GREEDY:
-                                    {
-                                        if (t_cur < 1e-6f) {
-                                            decoder.sequence.tokens.push_back(whisper_sample_token(*ctx, decoder, true));
-                                        } else {
-                                            decoder.sequence.tokens.push_back(whisper_sample_token(*ctx, decoder, false));
-                                        }
+            result_all.push_back(std::move(result));
 
-                                        decoder.sequence.sum_logprobs_all += decoder.sequence.tokens.back().plog;
-                                    } break;
-                                case whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH:
-                                    {
-                                        const auto tokens_new = whisper_sample_token_topk(*ctx, decoder, params.beam_search.beam_size);
+            // call the new_segment_callback for each segment
+            if (params.new_segment_callback && n_overlap == 0) {
+                params.new_segment_callback(ctx, ctx->state, 1, params.new_segment_callback_user_data);
+            }
+        }
+    }
 
-                                        for (const auto & token : tokens_new) {
-                                            bc_per_dec[j].push_back({ j, decoder.seek_delta, decoder.has_ts, decoder.sequence, decoder.grammar, });
-                                            bc_per_dec[j].back().sequence.tokens.push_back(token);
-                                            bc_per_dec[j].back().sequence.sum_logprobs_all += token.plog;
-                                        }
-                                    } break;
-                            };
-                        }
-                    };
+    // the stitched segments are final only now
+    if (params.new_segment_callback && n_overlap > 0 && !result_all.empty()) {
+        params.new_segment_callback(ctx, ctx->state, result_all.size(), params.new_segment_callback_user_data);
+    }
 
-                    const int n_threads = std::min(params.n_threads, n_decoders_cur);
+    // the timings are the totals over all states, so that the per-run averages stay meaningful
+    for (auto * state : states) {
+        ctx->state->t_mel_us += state->t_mel_us;
 
-                    if (n_threads == 1) {
-                        process();
-                    } else {
-                        std::vector<std::thread> threads(n_threads - 1);
+        ctx->state->t_sample_us += state->t_sample_us;
+        ctx->state->t_encode_us += state->t_encode_us;
+        ctx->state->t_decode_us += state->t_decode_us;
+        ctx->state->t_batchd_us += state->t_batchd_us;
+        ctx->state->t_prompt_us += state->t_prompt_us;
 
-                        for (int t = 0; t < n_threads - 1; ++t) {
-                            threads[t] = std::thread(process);
-                        }
+        ctx->state->n_sample += state->n_sample;
+        ctx->state->n_encode += state->n_encode;
+        ctx->state->n_decode += state->n_decode;
+        ctx->state->n_batchd += state->n_batchd;
+        ctx->state->n_prompt += state->n_prompt;
+        ctx->state->n_fail_p += state->n_fail_p;
+        ctx->state->n_fail_h += state->n_fail_h;
 
-                        process();
+        whisper_free_state(state);
+    }
 
-                        for (int t = 0; t < n_threads - 1; ++t) {
-                            threads[t].join();
-                        }
-                    }
-                }
+    // print information about the audio boundaries
+    if (n_overlap > 0) {
+        WHISPER_LOG_INFO("%s: the audio has been split into %d chunks overlapping by %d ms at the following times:\n", __func__, n_chunks, (2000*n_overlap)/WHISPER_SAMPLE_RATE);
+        for (int ic = 1; ic < n_chunks; ++ic) {
+            WHISPER_LOG_INFO("%s: split %d - %s (%s)\n", __func__, ic, to_timestamp((100ll*splits[ic])/WHISPER_SAMPLE_RATE).c_str(),
+                    aligned[ic] ? "stitched on the tokens" : "no common tokens, cut at the split");
+        }
+    } else {
+        WHISPER_LOG_WARN("\n");
+        WHISPER_LOG_WARN("%s: the audio has been split into %d chunks at the following times:\n", __func__, n_chunks);
+        for (int ic = 1; ic < n_chunks; ++ic) {
+            WHISPER_LOG_WARN("%s: split %d - %s\n", __func__, ic, to_timestamp((100ll*splits[ic])/WHISPER_SAMPLE_RATE).c_str());
+        }
+        WHISPER_LOG_WARN("%s: the transcription quality may be degraded near these boundaries (see whisper_full_params.parallel)\n", __func__);
+    }
 
-                beam_candidates.clear();
-                for (const auto & bc : bc_per_dec) {
-                    beam_candidates.insert(beam_candidates.end(), bc.begin(), bc.end());
+    return ret.load();
+}
 
-                    if (!bc.empty()) {
-                        state->n_sample += 1;
-                    }
-                }
+struct whisper_decoder_batch {
+    whisper_context * ctx = nullptr;
 
-                // for beam-search, choose the top candidates and update the KV caches
-                if (params.strategy == whisper_sampling_strategy::WHISPER_SAMPLING_BEAM_SEARCH) {
-                    std::sort(
-                            beam_candidates.begin(),
-                            beam_candidates.end(),
-                            [](const beam_candidate & a, const beam_candidate & b) {
-                        if (a.sequence.sum_logprobs_all != b.sequence.sum_logprobs_all) {
-                            return a.sequence.sum_logprobs_all > b.sequence.sum_logprobs_all;
-                        }
-                        return a.decoder_idx < b.decoder_idx;
-                    });
+    // owns the self-attention KV cache shared by the requests, the batch, the logits and the decoder compute buffer
+    whisper_state * host = nullptr;
 
-                    uint32_t cur_c = 0;
+    int n_max_tokens = 0;
 
-                    for (int j = 0; j < n_decoders_cur; ++j) {
-                        auto & decoder = state->decoders[j];
+    struct request {
+        whisper_state * state = nullptr; // nullptr - the id is free
 
-                        if (decoder.completed || decoder.failed) {
-                            continue;
-                        }
+        whisper_full_params params;
 
-                        if (cur_c >= beam_candidates.size()) {
-                            cur_c = 0;
-                        }
+        std::vector<whisper_token> prompt;
 
-                        auto & cur = beam_candidates[cur_c++];
+        int n_past   = 0; // number of tokens of the request in the KV cache (0 - waiting for the prefill)
+        int seek     = 0; // mel offset of the window in kv_cross
+        int seek_end = 0;
+        int status   = 0; // 0 - running, 1 - done, -1 - failed
+    };
 
-                        while (beam_candidates.size() > cur_c && whisper_sequence_tokens_equal(beam_candidates[cur_c].sequence, cur.sequence) && i > 0) {
-                            ++cur_c;
-                        }
+    // the id of a request is its sequence in the KV cache
+    std::vector<request> requests;
 
-                        decoder.seek_delta = cur.seek_delta;
-                        decoder.has_ts     = cur.has_ts;
-                        decoder.sequence   = cur.sequence;
-                        decoder.grammar    = cur.grammar;
+    // requests in the current decoder call and the tokens of each
+    std::vector<int>                ids;
+    std::vector<whisper_cross_span> spans;
+};
 
-                        whisper_kv_cache_seq_cp(state->kv_self, cur.decoder_idx, WHISPER_MAX_DECODERS + j, -1, -1);
+// split the decoded tokens of a finished request in segments, as whisper_full_with_state() does for a window
+static void whisper_decoder_batch_segments(
+        whisper_context & ctx,
+          whisper_state & state,
+    const whisper_full_params & params,
+                    int   seek,
+                    int   seek_delta) {
+    const auto & tokens_cur = state.decoders[0].sequence.tokens;
 
-                        WHISPER_LOG_DEBUG("%s: beam search: decoder %d: from decoder %d: token = %10s, plog = %8.5f, sum_logprobs = %8.5f\n",
-                                __func__, j, cur.decoder_idx, ctx->vocab.id_to_token.at(decoder.sequence.tokens.back().id).c_str(), decoder.sequence.tokens.back().plog, decoder.sequence.sum_logprobs_all);
-                    }
+    auto & result_all = state.result_all;
 
-                    for (int j = 0; j < n_decoders_cur; ++j) {
-                        auto & decoder = state->decoders[j];
+    if (tokens_cur.empty() || ctx.model.n_loaded == 0) {
+        return;
+    }
 
-                        if (decoder.completed || decoder.failed) {
-                            continue;
-                        }
+    const whisper_token token_beg = whisper_token_beg(&ctx);
 
-                        whisper_kv_cache_seq_rm(state->kv_self, j,                           -1, -1);
-                        whisper_kv_cache_seq_cp(state->kv_self, WHISPER_MAX_DECODERS + j, j, -1, -1);
-                        whisper_kv_cache_seq_rm(state->kv_self, WHISPER_MAX_DECODERS + j,    -1, -1);
-                    }
-                }
+    int  i0 = 0;
+    auto t0 = seek + 2*(tokens_cur.front().tid - token_beg);
 
-                // update the decoder state
-                // - check if the sequence is completed
-                // - check if the sequence is failed
-                // - update sliding window based on timestamp tokens
-                for (int j = 0; j < n_decoders_cur; ++j) {
-                    auto & decoder = state->decoders[j];
+    std::string text;
+    bool speaker_turn_next = false;
 
-                    if (decoder.completed || decoder.failed) {
-                        continue;
-                    }
+    const auto push_segment = [&](int64_t t1, int i1) {
+        result_all.push_back({ t0, t1, text, state.no_speech_prob, {}, speaker_turn_next });
+        for (int j = i0; j < i1; j++) {
+            result_all.back().tokens.push_back(tokens_cur[j]);
+        }
 
-                    auto & has_ts     = decoder.has_ts;
-                    auto & failed     = decoder.failed;
-                    auto & completed  = decoder.completed;
-                    auto & seek_delta = decoder.seek_delta;
-                    auto & result_len = decoder.sequence.result_len;
+        if (params.new_segment_callback) {
+            params.new_segment_callback(&ctx, &state, 1, params.new_segment_callback_user_data);
+        }
+    };
 
-                    {
-                        const auto & token = decoder.sequence.tokens.back();
+    for (int i = 0; i < (int) tokens_cur.size(); i++) {
+        if (params.print_special || tokens_cur[i].id < whisper_token_eot(&ctx)) {
+            text += whisper_token_to_str(&ctx, tokens_cur[i].id);
+        }
 
-                        // timestamp token - update sliding window
-                        if (token.id > whisper_token_beg(ctx)) {
-                            const int seek_delta_new = 2*(token.id - whisper_token_beg(ctx));
+        // [TDRZ] record if speaker turn was predicted after current segment
+        if (params.tdrz_enable && tokens_cur[i].id == whisper_token_solm(&ctx)) {
+            speaker_turn_next = true;
+        }
 
-                            // do not allow to go back in time
-                            if (has_ts && seek_delta > seek_delta_new && result_len < i) {
-                                WHISPER_LOG_DEBUG("%s: decoder %d: failed due to seek_delta (%d > %d)\n", __func__, j, seek_delta, seek_delta_new);
-                                failed = true; // TODO: maybe this is not a failure ?
-                                continue;
-                            }
+        if (tokens_cur[i].id > token_beg && !params.single_segment) {
+            const auto t1 = seek + 2*(tokens_cur[i].tid - token_beg);
 
-                            seek_delta = seek_delta_new;
-                            result_len = i + 1;
-                            has_ts = true;
-                        }
+            if (!text.empty()) {
+                push_segment(t1, i + 1);
+            }
+            text = "";
+            while (i < (int) tokens_cur.size() && tokens_cur[i].id > token_beg) {
+                i++;
+            }
+            i--;
+            t0 = t1;
+            i0 = i + 1;
+            speaker_turn_next = false;
+        }
+    }
 
-                        whisper_grammar_accept_token(*ctx, decoder.grammar, token.id);
+    if (!text.empty()) {
+        push_segment(seek + seek_delta, tokens_cur.size());
+    }
+}
 
-#ifdef WHISPER_DEBUG
-                        {
-                            const auto tt = token.pt > 0.10 ? ctx->vocab.id_to_token.at(token.tid) : "[?]";
-                            WHISPER_LOG_DEBUG("%s: id = %3d, decoder = %d, token = %6d, p = %6.3f, ts = %10s, %6.3f, result_len = %4d '%s'\n",
-                                    __func__, i, j, token.id, token.p, tt.c_str(), token.pt, result_len, ctx->vocab.id_to_token.at(token.id).c_str());
-                        }
-#endif
+// update a request after sampling its i-th token - the same end conditions as in whisper_full_with_state()
+static void whisper_decoder_batch_update(
+        whisper_context & ctx,
+        whisper_decoder_batch::request & req) {
+    const auto & params = req.params;
 
-                        // end of segment
-                        if (token.id == whisper_token_eot(ctx) ||               // end of text token
-                           (params.max_tokens > 0 && i >= params.max_tokens) || // max tokens per segment reached
-                           (has_ts && seek + seek_delta + delta_min >= seek_end)       // end of audio reached (100ms)
-                           ) {
-                            if (result_len == 0 && !params.no_timestamps) {
-                                if (seek + seek_delta + delta_min >= seek_end) {
-                                    result_len = i + 1;
-                                } else {
-                                    WHISPER_LOG_DEBUG("%s: decoder %d failed (result_len = 0)\n", __func__, j);
-                                    failed = true;
-                                    continue;
-                                }
-                            }
+    auto & state   = *req.state;
+    auto & decoder = state.decoders[0];
 
-                            if (params.single_segment || params.no_timestamps) {
-                                result_len = i + 1;
-                                seek_delta = 100*WHISPER_CHUNK_SIZE;
-                            }
+    auto & has_ts     = decoder.has_ts;
+    auto & failed     = decoder.failed;
+    auto & completed  = decoder.completed;
+    auto & seek_delta = decoder.seek_delta;
+    auto & result_len = decoder.sequence.result_len;
 
-                            WHISPER_LOG_DEBUG("%s: decoder %d completed\n", __func__, j);
-                            completed = true;
-                            continue;
-                        }
+    const int i     = decoder.sequence.tokens.size() - 1;
+    const int n_max = whisper_n_text_ctx(&ctx)/2 - 4;
 
-                        // TESTS: if no tensors are loaded, it means we are running tests
-                        if (ctx->model.n_loaded == 0) {
-                            seek_delta = 100*WHISPER_CHUNK_SIZE;
-                            completed = true;
-                            continue;
-                        }
-                    }
+    // if length of spectrogram is less than 100ms (10 frames), then return
+    const int delta_min = 10;
 
-                    // sometimes, the decoding can get stuck in a repetition loop
-                    // this is an attempt to mitigate such cases - we flag the decoding as failed and use a fallback strategy
-                    if (i == n_max - 1 && (result_len == 0 || seek_delta < 100*WHISPER_CHUNK_SIZE/2)) {
-                        WHISPER_LOG_DEBUG("%s: decoder %d: failed due to repetition loop\n", __func__, j);
-                        failed = true;
-                        continue;
-                    }
-                }
+    const auto & token = decoder.sequence.tokens.back();
 
-                // check if all decoders have finished (i.e. completed or failed)
-                {
-                    bool completed_all = true;
+    // timestamp token - update sliding window
+    if (token.id > whisper_token_beg(&ctx)) {
+        const int seek_delta_new = 2*(token.id - whisper_token_beg(&ctx));
 
-                    for (int j = 0; j < n_decoders_cur; ++j) {
-                        auto & decoder = state->decoders[j];
+        // do not allow to go back in time
+        if (has_ts && seek_delta > seek_delta_new && result_len < i) {
+            failed = true;
+        } else {
+            seek_delta = seek_delta_new;
+            result_len = i + 1;
+            has_ts = true;
+        }
+    }
 
-                        if (decoder.completed || decoder.failed) {
-                            continue;
-                        }
+    if (!failed) {
+        whisper_grammar_accept_token(ctx, decoder.grammar, token.id);
 
-                        completed_all = false;
-                    }
+        // end of segment
+        if (token.id == whisper_token_eot(&ctx) ||
+           (params.max_tokens > 0 && i >= params.max_tokens) ||
+           (has_ts && req.seek + seek_delta + delta_min >= req.seek_end)) {
+            if (result_len == 0 && !params.no_timestamps) {
+                if (req.seek + seek_delta + delta_min >= req.seek_end) {
+                    result_len = i + 1;
+                } else {
+                    failed = true;
+                }
+            }
 
-                    if (completed_all) {
-                        break;
-                    }
+            if (!failed) {
+                if (params.single_segment || params.no_timestamps) {
+                    result_len = i + 1;
+                    seek_delta = 100*WHISPER_CHUNK_SIZE;
                 }
 
-                state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                completed = true;
+            }
+        } else if (ctx.model.n_loaded == 0) {
+            seek_delta = 100*WHISPER_CHUNK_SIZE;
+            completed = true;
+        } else if (i == n_max - 1) {
+            // stuck in a repetition loop?
+            if (result_len == 0 || seek_delta < 100*WHISPER_CHUNK_SIZE/2) {
+                failed = true;
+            } else {
+                completed = true;
+            }
+        }
+    }
 
-                // obtain logits for the next token
-                {
-                    auto & batch = state->batch;
+    if (failed) {
+        req.status = -1;
+        return;
+    }
 
-                    batch.n_tokens = 0;
+    if (!completed) {
+        return;
+    }
 
-                    const int n_past = prompt.size() + i;
+    decoder.sequence.tokens.resize(result_len);
+    whisper_sequence_score(params, decoder.sequence);
 
-                    for (int j = 0; j < n_decoders_cur; ++j) {
-                        auto & decoder = state->decoders[j];
+    if (decoder.sequence.result_len > 32 && decoder.sequence.entropy < params.entropy_thold) {
+        state.n_fail_h++;
+        req.status = -1;
+        return;
+    }
 
-                        if (decoder.failed || decoder.completed) {
-                            continue;
-                        }
+    // whisper_full_with_state() falls back to the next temperature in this case, unless there is none
+    const bool has_fallback = params.temperature_inc > 0.0f && params.temperature + params.temperature_inc < 1.0f + 1e-6f;
 
-                        //WHISPER_LOG_DEBUG("%s: decoder %d: token %d, seek_delta %d\n", __func__, j, decoder.sequence.tokens.back().id, decoder.seek_delta);
+    if (has_fallback && decoder.sequence.avg_logprobs < params.logprob_thold && state.no_speech_prob < params.no_speech_thold) {
+        state.n_fail_p++;
+        req.status = -1;
+        return;
+    }
 
-                        decoder.i_batch = batch.n_tokens;
+    const bool is_no_speech = (state.no_speech_prob > params.no_speech_thold &&
+        decoder.sequence.avg_logprobs < params.logprob_thold);
 
-                        batch.token   [batch.n_tokens]    = decoder.sequence.tokens.back().id;
-                        batch.pos     [batch.n_tokens]    = n_past;
-                        batch.n_seq_id[batch.n_tokens]    = 1;
-                        batch.seq_id  [batch.n_tokens][0] = j;
-                        batch.logits  [batch.n_tokens]    = 1;
-                        batch.n_tokens++;
-                    }
+    if (!is_no_speech) {
+        whisper_decoder_batch_segments(ctx, state, params, req.seek, seek_delta);
+    }
 
-                    assert(batch.n_tokens > 0);
+    req.status = 1;
+}
 
-                    if (!whisper_decode_internal(*ctx, *state, state->batch, params.n_threads, false, params.abort_callback, params.abort_callback_user_data)) {
-                        WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
-                        return -9;
-                    }
+struct whisper_decoder_batch * whisper_decoder_batch_init(struct whisper_context * ctx, int n_max_requests, int n_max_tokens) {
+    const auto & hparams = ctx->model.hparams;
 
-                    const int64_t t_start_sample_us = ggml_time_us();
+    if (n_max_requests < 1) {
+        WHISPER_LOG_ERROR("%s: invalid number of requests %d\n", __func__, n_max_requests);
+        return nullptr;
+    }
 
-                    // TODO: avoid memory allocations, optimize, avoid threads?
-                    {
-                        std::atomic<int> j_cur(0);
+    // every request adds its cross-attention to the graph
+    const int n_max_nodes = (WHISPER_MAX_NODES - 64*hparams.n_text_layer)/(12*hparams.n_text_layer);
+    if (n_max_requests > n_max_nodes) {
+        WHISPER_LOG_WARN("%s: number of requests %d exceeds the graph size, using %d\n", __func__, n_max_requests, n_max_nodes);
+        n_max_requests = n_max_nodes;
+    }
 
-                        auto process = [&]() {
-                            while (true) {
-                                const int j = j_cur.fetch_add(1);
+    if (n_max_tokens <= 0) {
+        n_max_tokens = hparams.n_text_ctx;
+    }
+    n_max_tokens = std::max(n_max_tokens, n_max_requests);
 
-                                if (j >= n_decoders_cur) {
-                                    break;
-                                }
+    whisper_decoder_batch * batch = new whisper_decoder_batch;
 
-                                auto & decoder = state->decoders[j];
+    batch->ctx          = ctx;
+    batch->host         = new whisper_state;
+    batch->n_max_tokens = n_max_tokens;
 
-                                if (decoder.failed || decoder.completed) {
-                                    continue;
-                                }
+    batch->requests.resize(n_max_requests);
 
-                                whisper_process_logits(*ctx, *state, decoder, params, t_cur);
-                            }
-                        };
+    whisper_state & host = *batch->host;
 
-                        const int n_threads = std::min(params.n_threads, n_decoders_cur);
+    host.backends = whisper_backend_init(ctx->params);
+    if (host.backends.empty()) {
+        WHISPER_LOG_ERROR("%s: whisper_backend_init() failed\n", __func__);
+        whisper_decoder_batch_free(batch);
+        return nullptr;
+    }
 
-                        if (n_threads == 1) {
-                            process();
-                        } else {
-                            std::vector<std::thread> threads(n_threads - 1);
+    // a request uses at most n_text_ctx cells, as a decoder of whisper_full_with_state()
+    if (!whisper_kv_self_init(*ctx, host, n_max_requests)) {
+        WHISPER_LOG_ERROR("%s: whisper_kv_cache_init() failed for self-attention cache\n", __func__);
+        whisper_decoder_batch_free(batch);
+        return nullptr;
+    }
 
-                            for (int t = 0; t < n_threads - 1; ++t) {
-                                threads[t] = std::thread(process);
-                            }
+    {
+        const size_t memory_size = ggml_nbytes(host.kv_self.k) + ggml_nbytes(host.kv_self.v);
+        WHISPER_LOG_INFO("%s: kv self size  = %7.2f MB (%d cells, k %s, v %s)\n", __func__, memory_size / 1e6,
+                (int) host.kv_self.size, ggml_type_name(host.kv_self.k->type), ggml_type_name(host.kv_self.v->type));
+    }
 
-                            process();
+    host.batch = whisper_batch_init(n_max_tokens, 1);
 
-                            for (int t = 0; t < n_threads - 1; ++t) {
-                                threads[t].join();
-                            }
-                        }
-                    }
+    return batch;
+}
 
-                    state->t_sample_us += ggml_time_us() - t_start_sample_us;
-                }
-            }
+void whisper_decoder_batch_free(struct whisper_decoder_batch * batch) {
+    if (batch) {
+        whisper_free_state(batch->host);
 
-            // rank the resulting sequences and select the best one
-            {
-                double best_score = -INFINITY;
+        delete batch;
+    }
+}
 
-                for (int j = 0; j < n_decoders_cur; ++j) {
-                    auto & decoder = state->decoders[j];
+int whisper_decoder_batch_add(struct whisper_decoder_batch * batch, struct whisper_state * state, struct whisper_full_params params) {
+    whisper_context * ctx = batch->ctx;
 
-                    if (decoder.failed) {
-                        continue;
-                    }
+    if (params.strategy != WHISPER_SAMPLING_GREEDY || params.token_timestamps) {
+        WHISPER_LOG_ERROR("%s: only greedy sampling without token timestamps is supported\n", __func__);
+        return -1;
+    }
 
-                    decoder.sequence.tokens.resize(decoder.sequence.result_len);
-                    whisper_sequence_score(params, decoder.sequence);
+    if (state->enc_mel_offset < 0) {
+        WHISPER_LOG_ERROR("%s: the state has not been encoded\n", __func__);
+        return -1;
+    }
 
-                    WHISPER_LOG_DEBUG("%s: decoder %2d: score = %8.5f, result_len = %3d, avg_logprobs = %8.5f, entropy = %8.5f\n",
-                            __func__, j, decoder.sequence.score, decoder.sequence.result_len, decoder.sequence.avg_logprobs, decoder.sequence.entropy);
+    if (whisper_is_multilingual(ctx) && (params.language == nullptr || whisper_lang_id(params.language) < 0)) {
+        WHISPER_LOG_ERROR("%s: the language of the request has to be set\n", __func__);
+        return -1;
+    }
 
-                    if (decoder.sequence.result_len > 32 && decoder.sequence.entropy < params.entropy_thold) {
-                        WHISPER_LOG_DEBUG("%s: decoder %2d: failed due to entropy %8.5f < %8.5f\n",
-                                __func__, j, decoder.sequence.entropy, params.entropy_thold);
+    int id = -1;
+    for (int i = 0; i < (int) batch->requests.size(); ++i) {
+        if (batch->requests[i].state == nullptr) {
+            id = i;
+            break;
+        }
+    }
 
-                        decoder.failed = true;
-                        state->n_fail_h++;
+    if (id < 0) {
+        return -1;
+    }
 
-                        continue;
-                    }
+    auto & req = batch->requests[id];
 
-                    if (best_score < decoder.sequence.score) {
-                        best_score = decoder.sequence.score;
-                        best_decoder_id = j;
-                    }
-                }
+    auto & prompt = req.prompt;
 
-                WHISPER_LOG_DEBUG("%s: best decoder = %d\n", __func__, best_decoder_id);
+    prompt.clear();
+
+    // the initial prompt as context of the window
+    {
+        std::vector<whisper_token> prompt_tokens;
+
+        if (!params.prompt_tokens && params.initial_prompt) {
+            prompt_tokens.resize(1024);
+            int n_needed = whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size());
+            if (n_needed < 0) {
+                prompt_tokens.resize(-n_needed);
+                n_needed = whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size());
             }
+            prompt_tokens.resize(n_needed);
+            params.prompt_tokens   = prompt_tokens.data();
+            params.prompt_n_tokens = prompt_tokens.size();
+        }
 
-            bool success = true;
+        const int max_prompt_ctx = std::min(params.n_max_text_ctx, whisper_n_text_ctx(ctx)/2);
 
-            // was the decoding successful for the current temperature?
-            // do fallback only if:
-            // - we are not at the last temperature
-            if (it != (int) temperatures.size() - 1) {
-                const auto & decoder = state->decoders[best_decoder_id];
+        if (params.prompt_tokens && params.prompt_n_tokens > 0 && params.n_max_text_ctx > 0 && max_prompt_ctx > 0 && params.temperature < WHISPER_HISTORY_CONDITIONING_TEMP_CUTOFF) {
+            const int n_take = std::min(params.prompt_n_tokens, max_prompt_ctx - 1);
 
-                if (decoder.failed ||
-                    (decoder.sequence.avg_logprobs < params.logprob_thold && state->no_speech_prob < params.no_speech_thold)) {
-                    WHISPER_LOG_DEBUG("%s: failed due to avg_logprobs %8.5f < %8.5f and no_speech_prob %8.5f < %8.5f\n", __func__, decoder.sequence.avg_logprobs, params.logprob_thold, state->no_speech_prob, params.no_speech_thold);
-                    success = false;
-                    state->n_fail_p++;
-                }
-            }
+            prompt.push_back(whisper_token_prev(ctx));
+            prompt.insert(prompt.end(), params.prompt_tokens + params.prompt_n_tokens - n_take, params.prompt_tokens + params.prompt_n_tokens);
+        }
 
-            if (success) {
-                //for (auto & token : ctx->decoders[best_decoder_id].sequence.tokens) {
-                //    WHISPER_LOG_DEBUG("%s: token = %d, p = %6.3f, pt = %6.3f, ts = %s, str = %s\n", __func__, token.id, token.p, token.pt, ctx->vocab.id_to_token.at(token.tid).c_str(), ctx->vocab.id_to_token.at(token.id).c_str());
-                //}
+        params.prompt_tokens   = nullptr;
+        params.prompt_n_tokens = 0;
+        params.initial_prompt  = nullptr;
+    }
 
-                break;
-            }
+    // these tokens determine the task that will be performed
+    prompt.push_back(whisper_token_sot(ctx));
+
+    if (whisper_is_multilingual(ctx)) {
+        state->lang_id = whisper_lang_id(params.language);
+        prompt.push_back(whisper_token_lang(ctx, state->lang_id));
+        if (params.translate) {
+            prompt.push_back(whisper_token_translate(ctx));
+        } else {
+            prompt.push_back(whisper_token_transcribe(ctx));
+        }
+    }
 
-            WHISPER_LOG_DEBUG("\n%s: failed to decode with temperature = %.2f\n", __func__, t_cur);
+    // first release distilled models require the "no_timestamps" token
+    {
+        const bool is_distil = ctx->model.hparams.n_text_layer == 2 && ctx->model.hparams.n_vocab != 51866;
+        if (is_distil && !params.no_timestamps) {
+            params.no_timestamps = true;
         }
+    }
 
-        // output results through a user-provided callback
-        {
-            const auto & best_decoder = state->decoders[best_decoder_id];
+    if (params.no_timestamps) {
+        prompt.push_back(whisper_token_not(ctx));
+    }
 
-            auto seek_delta = best_decoder.seek_delta;
-            const auto result_len = best_decoder.sequence.result_len;
+    whisper_logits_mask_init(*ctx, params, state->logits_mask);
 
-            const auto & tokens_cur = best_decoder.sequence.tokens;
+    if ((int) prompt.size() > batch->n_max_tokens) {
+        WHISPER_LOG_ERROR("%s: the prompt is longer than the batch (%d > %d tokens)\n", __func__, (int) prompt.size(), batch->n_max_tokens);
+        return -1;
+    }
 
-            // [EXPERIMENTAL] Token-level timestamps with DTW
-            const auto n_segments_before = state->result_all.size();
+    // TAGS: WHISPER_DECODER_INIT
+    {
+        auto & decoder = state->decoders[0];
 
-            const bool is_no_speech = (state->no_speech_prob > params.no_speech_thold &&
-                best_decoder.sequence.avg_logprobs < params.logprob_thold);
+        decoder.sequence.tokens.clear();
+        decoder.sequence.result_len       = 0;
+        decoder.sequence.sum_logprobs_all = 0.0;
+        decoder.sequence.sum_logprobs     = -INFINITY;
+        decoder.sequence.avg_logprobs     = -INFINITY;
+        decoder.sequence.entropy          = 0.0;
+        decoder.sequence.score            = -INFINITY;
 
-            //WHISPER_LOG_DEBUG("prompt_init.size() = %d, prompt.size() = %d, result_len = %d, seek_delta = %d\n", prompt_init.size(), prompt.size(), result_len, seek_delta);
+        decoder.seek_delta = 100*WHISPER_CHUNK_SIZE;
 
-            // update prompt_past1
-            prompt_past1.clear();
-            if (!params.carry_initial_prompt && !prompt.empty() && prompt.front() == whisper_token_prev(ctx)) {
-                prompt_past1.insert(prompt_past1.end(), prompt.begin() + 1, prompt.end() - prompt_init.size());
-            }
+        decoder.failed    = false;
+        decoder.completed = false;
+        decoder.has_ts    = false;
 
-            // Add newly decoded tokens to the rolling context
-            if (!is_no_speech) {
-                for (int i = 0; i < result_len; ++i) {
-                    prompt_past1.push_back(tokens_cur[i].id);
-                }
-            }
+        if (params.grammar_rules != nullptr) {
+            decoder.grammar = whisper_grammar_init(params.grammar_rules, params.n_grammar_rules, params.i_start_rule);
+        } else {
+            decoder.grammar = {};
+        }
+    }
 
-            if (!tokens_cur.empty() && ctx->model.n_loaded > 0 && !is_no_speech) {
-                int  i0 = 0;
-                auto t0 = seek + 2*(tokens_cur.front().tid - whisper_token_beg(ctx));
+    state->result_all.clear();
 
-                std::string text;
-                bool speaker_turn_next = false;
+    req.state    = state;
+    req.params   = params;
+    req.n_past   = 0;
+    req.seek     = state->enc_mel_offset;
+    req.seek_end = whisper_n_len_from_state(state);
+    req.status   = 0;
 
-                for (int i = 0; i < (int) tokens_cur.size(); i++) {
-                    //printf("%s: %18s %6.3f %18s %6.3f\n", __func__,
-                    //        ctx->vocab.id_to_token[tokens_cur[i].id].c_str(), tokens_cur[i].p,
-                    //        ctx->vocab.id_to_token[tokens_cur[i].tid].c_str(), tokens_cur[i].pt);
+    return id;
+}
 
-                    if (params.print_special || tokens_cur[i].id < whisper_token_eot(ctx)) {
-                        text += whisper_token_to_str(ctx, tokens_cur[i].id);
-                    }
+int whisper_decoder_batch_step(struct whisper_decoder_batch * batch, int n_threads) {
+    whisper_context & ctx  = *batch->ctx;
+    whisper_state   & host = *batch->host;
 
-                    // [TDRZ] record if speaker turn was predicted after current segment
-                    if (params.tdrz_enable && tokens_cur[i].id == whisper_token_solm(ctx)) {
-                        speaker_turn_next = true;
-                    }
+    auto & requests = batch->requests;
+    auto & ids      = batch->ids;
+    auto & spans    = batch->spans;
 
-                    if (tokens_cur[i].id > whisper_token_beg(ctx) && !params.single_segment) {
-                        const auto t1 = seek + 2*(tokens_cur[i].tid - whisper_token_beg(ctx));
+    const int n_vocab = ctx.vocab.n_vocab;
 
-                        if (!text.empty()) {
-                            const auto tt0 = t0;
-                            const auto tt1 = t1;
+    // one token for each running request, then the prompts of the new requests that fit in the batch
+    ids.clear();
 
-                            if (params.print_realtime) {
-                                if (params.print_timestamps) {
-                                    printf("[%s --> %s]  %s\n", to_timestamp(tt0).c_str(), to_timestamp(tt1).c_str(), text.c_str());
-                                } else {
-                                    printf("%s", text.c_str());
-                                    fflush(stdout);
-                                }
-                            }
+    int n_tokens = 0;
 
-                            //printf("tt0 = %d, tt1 = %d, text = %s, token = %s, token_id = %d, tid = %d\n", tt0, tt1, text.c_str(), ctx->vocab.id_to_token[tokens_cur[i].id].c_str(), tokens_cur[i].id, tokens_cur[i].tid);
+    for (int id = 0; id < (int) requests.size(); ++id) {
+        if (requests[id].state != nullptr && requests[id].status == 0 && requests[id].n_past > 0) {
+            ids.push_back(id);
+            n_tokens++;
+        }
+    }
 
-                            result_all.push_back({ tt0, tt1, text, state->no_speech_prob, {}, speaker_turn_next });
-                            for (int j = i0; j <= i; j++) {
-                                result_all.back().tokens.push_back(tokens_cur[j]);
-                            }
+    for (int id = 0; id < (int) requests.size(); ++id) {
+        const auto & req = requests[id];
 
-                            int n_new = 1;
+        if (req.state != nullptr && req.status == 0 && req.n_past == 0 && n_tokens + (int) req.prompt.size() <= batch->n_max_tokens) {
+            ids.push_back(id);
+            n_tokens += req.prompt.size();
+        }
+    }
 
-                            if (params.token_timestamps) {
-                                whisper_exp_compute_token_level_timestamps(
-                                        *ctx, *state, result_all.size() - 1, params.thold_pt, params.thold_ptsum);
+    if (ids.empty()) {
+        return 0;
+    }
 
-                                if (params.max_len > 0) {
-                                    n_new = whisper_wrap_segment(*ctx, *state, params.max_len, params.split_on_word);
-                                }
-                            }
-                            if (params.new_segment_callback && !ctx->params.dtw_token_timestamps) {
-                                params.new_segment_callback(ctx, state, n_new, params.new_segment_callback_user_data);
-                            }
-                        }
-                        text = "";
-                        while (i < (int) tokens_cur.size() && tokens_cur[i].id > whisper_token_beg(ctx)) {
-                            i++;
-                        }
-                        i--;
-                        t0 = t1;
-                        i0 = i + 1;
-                        speaker_turn_next = false;
-                    }
-                }
+    // the compute buffer is reserved for the worst case on the first call - the graph needs a cross-attention cache
+    if (host.sched_decode.sched == nullptr) {
+        const whisper_kv_cache * kv_cross = &requests[ids[0]].state->kv_cross;
 
-                if (!text.empty()) {
-                    const auto t1 = seek + seek_delta;
+        const bool ok = whisper_sched_graph_init(host.sched_decode, host.backends,
+                [&]() {
+                    const int n_max = requests.size();
 
-                    const auto tt0 = t0;
-                    const auto tt1 = t1;
+                    whisper_batch_prep_legacy(host.batch, nullptr, batch->n_max_tokens, 0, 0);
 
-                    if (params.print_realtime) {
-                        if (params.print_timestamps) {
-                            printf("[%s --> %s]  %s\n", to_timestamp(tt0).c_str(), to_timestamp(tt1).c_str(), text.c_str());
-                        } else {
-                            printf("%s", text.c_str());
-                            fflush(stdout);
-                        }
+                    spans.clear();
+                    spans.push_back({ kv_cross, ctx.model.hparams.n_audio_ctx, 0, batch->n_max_tokens - n_max + 1 });
+                    for (int i = 1; i < n_max; ++i) {
+                        spans.push_back({ kv_cross, ctx.model.hparams.n_audio_ctx, batch->n_max_tokens - n_max + i, 1 });
                     }
 
-                    result_all.push_back({ tt0, tt1, text, state->no_speech_prob, {}, speaker_turn_next });
-                    for (int j = i0; j < (int) tokens_cur.size(); j++) {
-                        result_all.back().tokens.push_back(tokens_cur[j]);
-                    }
+                    return whisper_build_graph_decoder(ctx, host, host.batch, false, true, &spans);
+                });
 
-                    int n_new = 1;
+        if (!ok) {
+            WHISPER_LOG_ERROR("%s: failed to init decoder allocator\n", __func__);
+            return -1;
+        }
 
-                    if (params.token_timestamps) {
-                        whisper_exp_compute_token_level_timestamps(
-                                *ctx, *state, result_all.size() - 1, params.thold_pt, params.thold_ptsum);
+        WHISPER_LOG_INFO("%s: compute buffer (decode x%d) = %7.2f MB\n", __func__, (int) requests.size(), whisper_sched_size(host.sched_decode) / 1e6);
+    }
 
-                        if (params.max_len > 0) {
-                            n_new = whisper_wrap_segment(*ctx, *state, params.max_len, params.split_on_word);
-                        }
-                    }
-                    if (params.new_segment_callback && !ctx->params.dtw_token_timestamps) {
-                        params.new_segment_callback(ctx, state, n_new, params.new_segment_callback_user_data);
-                    }
-                }
+    // a decoder call takes contiguous free cells of the KV cache - if the cache is fragmented, the requests
+    // are decoded in several calls
+    for (size_t k = 0; k < ids.size(); ) {
+        int n_free = 0;
+        {
+            int n_run = 0;
+            for (const auto & cell : host.kv_self.cells) {
+                n_run  = cell.pos < 0 ? n_run + 1 : 0;
+                n_free = std::max(n_free, n_run);
             }
+        }
 
-            // FIXME: will timestamp offsets be correct?
-            // [EXPERIMENTAL] Token-level timestamps with DTW
-            {
-                const int n_segments = state->result_all.size() - n_segments_before;
-                if (ctx->params.dtw_token_timestamps && n_segments) {
-                    const int n_frames = std::min(std::min(WHISPER_CHUNK_SIZE * 100, seek_delta), seek_end - seek);
-                    whisper_exp_compute_token_level_timestamps_dtw(
-                            ctx, state, params, result_all.size() - n_segments, n_segments, seek, n_frames, 7, params.n_threads);
-                    if (params.new_segment_callback) {
-                        for (int seg = (int) result_all.size() - n_segments; seg < n_segments; seg++) {
-                            params.new_segment_callback(ctx, state, seg, params.new_segment_callback_user_data);
-                        }
-                    }
-                }
-            }
+        auto & hbatch = host.batch;
 
-            // ref: https://github.com/ggml-org/whisper.cpp/pull/2629
-            const bool single_timestamp_ending = tokens_cur.size() > 1 &&
-                tokens_cur[tokens_cur.size() - 2].id < whisper_token_beg(ctx) &&
-                tokens_cur[tokens_cur.size() - 1].id > whisper_token_beg(ctx);
-            if (single_timestamp_ending) {
-                WHISPER_LOG_DEBUG("single timestamp ending - skip entire chunk\n");
-                seek_delta = std::min(seek_end - seek, WHISPER_CHUNK_SIZE * 100);
-            }
+        hbatch.n_tokens = 0;
 
-            // update audio window
-            seek += seek_delta;
+        spans.clear();
 
-            WHISPER_LOG_DEBUG("seek = %d, seek_delta = %d\n", seek, seek_delta);
-        }
-    }
+        const size_t k0 = k;
 
-    return 0;
-}
+        for (; k < ids.size(); ++k) {
+            auto & req = requests[ids[k]];
 
-int whisper_full(
-        struct whisper_context * ctx,
-    struct whisper_full_params   params,
-                   const float * samples,
-                           int   n_samples) {
+            const int n = req.n_past == 0 ? req.prompt.size() : 1;
 
-    std::vector<float> vad_samples;
-    if (params.vad) {
-        WHISPER_LOG_INFO("%s: VAD is enabled, processing speech segments only\n", __func__);
-        if (!whisper_vad(ctx, ctx->state, params, samples, n_samples, vad_samples)) {
-            WHISPER_LOG_ERROR("%s: failed to compute VAD\n", __func__);
-            return -1;
-        }
-        if (vad_samples.empty()) {
-            ctx->state->result_all.clear();
-            return 0;
-        }
-        samples = vad_samples.data();
-        n_samples = vad_samples.size();
-    }
-    return whisper_full_with_state(ctx, ctx->state, params, samples, n_samples);
-}
+            if (hbatch.n_tokens + n > n_free) {
+                break;
+            }
 
-int whisper_full_parallel(
-        struct whisper_context * ctx,
-        struct whisper_full_params params,
-        const float * samples,
-        int n_samples,
-        int n_processors) {
+            for (int i = 0; i < n; ++i) {
+                const int j = hbatch.n_tokens + i;
 
-    if (n_processors == 1) {
-        return whisper_full(ctx, params, samples, n_samples);
-    }
+                hbatch.token   [j]    = req.n_past == 0 ? req.prompt[i] : req.state->decoders[0].sequence.tokens.back().id;
+                hbatch.pos     [j]    = req.n_past + i;
+                hbatch.n_seq_id[j]    = 1;
+                hbatch.seq_id  [j][0] = ids[k];
+                hbatch.logits  [j]    = i == n - 1;
+            }
 
-    std::vector<float> vad_samples;
-    if (params.vad) {
-        WHISPER_LOG_INFO("%s: VAD is enabled, processing speech segments only\n", __func__);
-        if (!whisper_vad(ctx, ctx->state, params, samples, n_samples, vad_samples)) {
-            WHISPER_LOG_ERROR("%s: failed to compute VAD\n", __func__);
-            return -1;
+            const int n_audio_ctx = req.state->exp_n_audio_ctx > 0 ? req.state->exp_n_audio_ctx : ctx.model.hparams.n_audio_ctx;
+
+            spans.push_back({ &req.state->kv_cross, n_audio_ctx, hbatch.n_tokens, n });
+
+            req.state->decoders[0].i_batch = hbatch.n_tokens + n - 1;
+
+            hbatch.n_tokens += n;
         }
-        if (vad_samples.empty()) {
-            return 0;
+
+        if (k == k0) {
+            WHISPER_LOG_ERROR("%s: no space in the KV cache for request %d\n", __func__, ids[k]);
+            requests[ids[k]].status = -1;
+            k++;
+            continue;
         }
-        samples = vad_samples.data();
-        n_samples = vad_samples.size();
-    }
-    int ret = 0;
 
-    // prepare separate states for each thread
-    std::vector<whisper_state*> states;
+        const int64_t t_start_us = ggml_time_us();
 
-    const int offset_samples = (WHISPER_SAMPLE_RATE*params.offset_ms)/1000;
-    const int n_samples_per_processor = (n_samples - offset_samples)/n_processors;
+        if (!whisper_decode_internal(ctx, host, hbatch, n_threads, false, nullptr, nullptr, &spans)) {
+            WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
+            return -2;
+        }
 
-    // the calling thread will process the first chunk
-    // while the other threads will process the remaining chunks
+        // the decoder time is shared evenly between the requests
+        const int64_t t_decode_us = (ggml_time_us() - t_start_us)/(k - k0);
 
-    std::vector<std::thread> workers(n_processors - 1);
-    for (int i = 0; i < n_processors - 1; ++i) {
-        // create a new state for each thread
-        states.push_back(whisper_init_state(ctx));
+        for (size_t i = k0; i < k; ++i) {
+            auto & req = requests[ids[i]];
 
-        const int start_samples = offset_samples + (i + 1)*n_samples_per_processor;
-        const int n_samples_cur = (i == n_processors - 2) ? n_samples - start_samples : n_samples_per_processor;
+            if (req.n_past == 0) {
+                req.state->t_prompt_us += t_decode_us;
+                req.state->n_prompt    += req.prompt.size();
 
-        auto params_cur = params;
+                // no_speech probability before any logit filtering
+                std::vector<float> logits(host.logits.begin() + req.state->decoders[0].i_batch*n_vocab, host.logits.begin() + (req.state->decoders[0].i_batch + 1)*n_vocab);
+                std::vector<float> logprobs(n_vocab);
+                std::vector<float> probs(n_vocab);
 
-        params_cur.offset_ms = 0;
-        params_cur.print_progress = false;
-        params_cur.print_realtime = false;
+                whisper_compute_logprobs(logits, n_vocab, logprobs);
+                whisper_compute_probs(logits, n_vocab, logprobs, probs);
+                req.state->no_speech_prob = probs[whisper_token_nosp(&ctx)];
 
-        params_cur.new_segment_callback = nullptr;
-        params_cur.new_segment_callback_user_data = nullptr;
+                req.n_past = req.prompt.size();
+            } else {
+                req.state->t_decode_us += t_decode_us;
+                req.state->n_decode++;
 
-        params_cur.progress_callback = nullptr;
-        params_cur.progress_callback_user_data = nullptr;
+                req.n_past++;
+            }
+        }
 
-        workers[i] = std::thread(whisper_full_with_state, ctx, states[i], std::move(params_cur), samples + start_samples, n_samples_cur);
-    }
+        // sample the next token of each request
+        {
+            std::atomic<size_t> i_cur(k0);
 
-    {
-        auto params_cur = params;
+            auto process = [&]() {
+                while (true) {
+                    const size_t i = i_cur.fetch_add(1);
 
-        // We need to disable the print real-time for this one as well, otherwise it will show only for the first chunk.
-        params_cur.print_realtime = false;
+                    if (i >= k) {
+                        break;
+                    }
 
-        // Run the first transformation using default state but only for the first chunk.
-        ret = whisper_full_with_state(ctx, ctx->state, std::move(params_cur), samples, offset_samples + n_samples_per_processor);
-    }
+                    auto & req     = requests[ids[i]];
+                    auto & decoder = req.state->decoders[0];
 
-    for (int i = 0; i < n_processors - 1; ++i) {
-        workers[i].join();
-    }
+                    const int64_t t_start_sample_us = ggml_time_us();
 
-    const int64_t offset_t = (int64_t) params.offset_ms/10.0;
+                    whisper_process_logits(ctx, host, decoder, req.params, req.state->logits_mask, req.params.temperature);
 
-    // combine results into result_state->result_all from all other states
-    for (int i = 0; i < n_processors - 1; ++i) {
-        auto& results_i = states[i]->result_all;
+                    decoder.sequence.tokens.push_back(whisper_sample_token(ctx, decoder, req.params.temperature < 1e-6f));
+                    decoder.sequence.sum_logprobs_all += decoder.sequence.tokens.back().plog;
 
-        for (auto& result : results_i) {
-            // correct the segment timestamp taking into account the offset
-            result.t0 += 100 * ((i + 1) * n_samples_per_processor) / WHISPER_SAMPLE_RATE + offset_t;
-            result.t1 += 100 * ((i + 1) * n_samples_per_processor) / WHISPER_SAMPLE_RATE + offset_t;
+                    req.state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                    req.state->n_sample++;
+                }
+            };
 
-            // make sure that segments are not overlapping
-            if (!ctx->state->result_all.empty()) {
-                result.t0 = std::max(result.t0, ctx->state->result_all.back().t1);
-            }
+            ctx.pool.parallel_for(std::max(1, std::min<int>(n_threads, k - k0)), [&](int) { process(); });
+        }
 
-            ctx->state->result_all.push_back(std::move(result));
+        for (size_t i = k0; i < k; ++i) {
+            whisper_decoder_batch_update(ctx, requests[ids[i]]);
+        }
+    }
 
-            // call the new_segment_callback for each segment
-            if (params.new_segment_callback) {
-                params.new_segment_callback(ctx, ctx->state, 1, params.new_segment_callback_user_data);
-            }
+    int n_running = 0;
+    for (const auto & req : requests) {
+        if (req.state != nullptr && req.status == 0) {
+            n_running++;
         }
+    }
 
-        ctx->state->t_mel_us += states[i]->t_mel_us;
+    return n_running;
+}
 
-        ctx->state->t_sample_us += states[i]->t_sample_us;
-        ctx->state->t_encode_us += states[i]->t_encode_us;
-        ctx->state->t_decode_us += states[i]->t_decode_us;
-        ctx->state->t_batchd_us += states[i]->t_batchd_us;
-        ctx->state->t_prompt_us += states[i]->t_prompt_us;
+int whisper_decoder_batch_status(struct whisper_decoder_batch * batch, int id) {
+    if (id < 0 || id >= (int) batch->requests.size() || batch->requests[id].state == nullptr) {
+        return -1;
+    }
 
-        ctx->state->n_sample += states[i]->n_sample;
-        ctx->state->n_encode += states[i]->n_encode;
-        ctx->state->n_decode += states[i]->n_decode;
-        ctx->state->n_batchd += states[i]->n_batchd;
-        ctx->state->n_prompt += states[i]->n_prompt;
+    return batch->requests[id].status;
+}
 
-        whisper_free_state(states[i]);
+void whisper_decoder_batch_remove(struct whisper_decoder_batch * batch, int id) {
+    if (id < 0 || id >= (int) batch->requests.size()) {
+        return;
     }
 
-    // average the timings
-    ctx->state->t_mel_us    /= n_processors;
-    ctx->state->t_sample_us /= n_processors;
-    ctx->state->t_encode_us /= n_processors;
-    ctx->state->t_decode_us /= n_processors;
+    whisper_kv_cache_seq_rm(batch->host->kv_self, id, -1, -1);
 
-    // print information about the audio boundaries
-    WHISPER_LOG_WARN("\n");
-    WHISPER_LOG_WARN("%s: the audio has been split into %d chunks at the following times:\n", __func__, n_processors);
-    for (int i = 0; i < n_processors - 1; ++i) {
-        WHISPER_LOG_WARN("%s: split %d - %s\n", __func__, (i + 1), to_timestamp(100*((i + 1)*n_samples_per_processor)/WHISPER_SAMPLE_RATE + offset_t).c_str());
+    if (batch->requests[id].state != nullptr) {
+        batch->requests[id].state->decoders[0].grammar = {};
     }
-    WHISPER_LOG_WARN("%s: the transcription quality may be degraded near these boundaries\n", __func__);
 
-    return ret;
+    batch->requests[id].state = nullptr;
+    batch->requests[id].prompt.clear();
 }
 
 int whisper_full_n_segments_from_state(struct whisper_state * state) {
@@ -8023,11 +11585,11 @@ int whisper_full_n_tokens(struct whisper_context * ctx, int i_segment) {
 }
 
 const char * whisper_full_get_token_text_from_state(struct whisper_context * ctx, struct whisper_state * state, int i_segment, int i_token) {
-    return ctx->vocab.id_to_token[state->result_all[i_segment].tokens[i_token].id].c_str();
+    return ctx->vocab.token_text(state->result_all[i_segment].tokens[i_token].id);
 }
 
 const char* whisper_full_get_token_text(struct whisper_context * ctx, int i_segment, int i_token) {
-    return ctx->vocab.id_to_token[ctx->state->result_all[i_segment].tokens[i_token].id].c_str();
+    return ctx->vocab.token_text(ctx->state->result_all[i_segment].tokens[i_token].id);
 }
 
 whisper_token whisper_full_get_token_id_from_state(struct whisper_state * state, int i_segment, int i_token) {
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Test script to verify whisper_tokenize() against the reference tokenizer.
+
+This script tests the built libwhisper.so with a multilingual model converted by
+models/convert-pt-to-ggml.py to ensure:
+1. Non-ASCII text (emoji, Devanagari, punctuation, ...) gives the token ids of the
+   reference tokenizer (tiktoken with whisper/assets/multilingual.tiktoken)
+2. The bytes of the tokens give back the text
+
+Usage:
+    python test_tokenizer.py [artifact_dir] [model_path]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bindings", "python"))
+
+import whisper_xeon as wx
+
+
+# token ids of tiktoken's encode_ordinary() with multilingual.tiktoken
+REFERENCE = [
+    ("emoji 😀👍 test",                               [36221, 4013, 20732, 222, 31017, 235, 1500]),
+    ("हिन्दी भाषा",                                   [44500, 33279, 35082, 27099, 3941, 99, 31881, 8485, 255, 17937, 3941, 115, 17937]),
+    ("one — two",                                    [546, 3466, 732]),
+    ("‘quoted’ and “double”",                        [913, 246, 358, 23325, 913, 247, 293, 1059, 250, 67, 33147, 913, 251]),
+    ("Xin chào các bạn, tôi là người Việt Nam.",     [55, 259, 417, 20807, 13250, 14647, 11, 22336, 3684, 15898, 32936, 10684, 13]),
+    ("日本語のテキストです。",                          [27311, 31348, 2972, 22985, 15535, 40498, 4767, 1543]),
+    ("Привет, мир!",                                 [43971, 31259, 11, 20536, 0]),
+    ("عربي ٣٤٥",                                     [3615, 2288, 21292, 1447, 96, 149, 97, 149, 98]),
+    ("naïve café straße",                            [629, 15487, 303, 25118, 2148, 11451]),
+    (" 🎉🎉",                                         [19034, 231, 28864, 231]),
+]
+
+# the token of the byte 0x80 in the tiktoken vocabularies
+TOKEN_BYTE_0X80 = 222
+
+
+class TokenizerTest:
+    def __init__(self, artifact_dir, model_path=None):
+        self.artifact_dir = os.path.abspath(artifact_dir)
+        self.model_path = model_path
+        self.ctx = None
+
+    def load_library(self):
+        """Load libwhisper.so (and its ggml dependencies) through the whisper_xeon package."""
+        try:
+            wx.load_library(self.artifact_dir)
+            print(f"  ✓ Loaded libwhisper.so")
+            return True
+        except Exception as e:
+            print(f"  ✗ Failed to load libwhisper.so: {e}")
+            return False
+
+    def find_model(self):
+        """Find the model file in artifact directory."""
+        if self.model_path:
+            return self.model_path
+        for f in os.listdir(self.artifact_dir):
+            if f.endswith('.bin') and 'ggml' in f:
+                return os.path.join(self.artifact_dir, f)
+        return None
+
+    def load_model(self):
+        """Load a multilingual whisper model with a byte-level vocabulary."""
+        model_path = self.find_model()
+        if not model_path:
+            print(f"  ✗ No model file found in {self.artifact_dir}")
+            return False
+
+        print(f"  Loading model: {os.path.basename(model_path)}")
+
+        try:
+            self.ctx = wx.Context(model_path)
+        except Exception as e:
+            print(f"  ✗ Failed to load model: {e}")
+            return False
+
+        if not self.ctx.is_multilingual:
+            print(f"  ✗ The reference ids are those of the multilingual vocabulary, use a multilingual model")
+            return False
+
+        if self.ctx.token_to_bytes(TOKEN_BYTE_0X80) != b"\x80":
+            print(f"  ✗ The model stores the tokens that are not valid UTF-8 as U+FFFD (e.g. for-tests-ggml-*.bin),")
+            print(f"    use a model converted by models/convert-pt-to-ggml.py")
+            return False
+
+        print(f"  ✓ Model loaded successfully")
+        return True
+
+    def test_reference_ids(self):
+        """Compare the tokens of non-ASCII text with the reference tokenizer."""
+        ok = True
+        for text, expected in REFERENCE:
+            tokens = self.ctx.tokenize(text)
+            if tokens != expected:
+                print(f"  ✗ {text!r}: {tokens} != {expected}")
+                ok = False
+            else:
+                print(f"  ✓ {text!r}: {len(tokens)} tokens")
+        return ok
+
+    def test_round_trip(self):
+        """Check that the bytes of the tokens give back the text."""
+        ok = True
+        for text, _ in REFERENCE:
+            data = b"".join(self.ctx.token_to_bytes(t) for t in self.ctx.tokenize(text))
+            if data != text.encode("utf-8"):
+                print(f"  ✗ {text!r}: decoded to {data!r}")
+                ok = False
+        if ok:
+            print(f"  ✓ {len(REFERENCE)} texts decoded back")
+        return ok
+
+    def cleanup(self):
+        """Free resources."""
+        if self.ctx:
+            self.ctx.close()
+            self.ctx = None
+
+    def run_all_tests(self):
+        """Run all tokenizer tests."""
+        print(f"\n{'='*60}")
+        print(f"Tokenizer Test")
+        print(f"Artifact directory: {self.artifact_dir}")
+        print(f"{'='*60}\n")
+
+        tests = [
+            ("Loading library", self.load_library),
+            ("Loading model", self.load_model),
+            ("Token ids of non-ASCII text", self.test_reference_ids),
+            ("Tokens decode back to the text", self.test_round_trip),
+        ]
+
+        passed = 0
+        failed = 0
+
+        for test_name, test_func in tests:
+            print(f"\n[TEST] {test_name}")
+            try:
+                if test_func():
+                    passed += 1
+                    print(f"  → PASSED")
+                else:
+                    failed += 1
+                    print(f"  → FAILED")
+                    if test_name in ["Loading library", "Loading model"]:
+                        print("  Stopping tests due to critical failure")
+                        break
+            except Exception as e:
+                failed += 1
+                print(f"  → FAILED with exception: {e}")
+                import traceback
+                traceback.print_exc()
+
+        self.cleanup()
+
+        print(f"\n{'='*60}")
+        print(f"Results: {passed} passed, {failed} failed")
+        print(f"{'='*60}")
+
+        return failed == 0
+
+
+def main():
+    artifact_dir = sys.argv[1] if len(sys.argv) > 1 else "artifacts/whisper_base_xeon"
+    model_path   = sys.argv[2] if len(sys.argv) > 2 else None
+
+    if not os.path.isdir(artifact_dir):
+        print(f"Directory not found: {artifact_dir}")
+        sys.exit(1)
+
+    tester = TokenizerTest(artifact_dir, model_path)
+    success = tester.run_all_tests()
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
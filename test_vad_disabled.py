@@ -11,191 +11,47 @@ Usage:
     python test_vad_disabled.py [artifact_dir]
 """
 
-import ctypes
+import array
 import os
 import sys
 import math
 
-# Constants from whisper.h
-WHISPER_SAMPLE_RATE = 16000
-WHISPER_SAMPLING_GREEDY = 0
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bindings", "python"))
+
+import whisper_xeon as wx
 
 
 def generate_test_audio(duration_sec=2.0, frequency=440.0):
     """Generate a simple sine wave audio for testing."""
-    n_samples = int(WHISPER_SAMPLE_RATE * duration_sec)
-    samples = []
-    for i in range(n_samples):
-        t = i / WHISPER_SAMPLE_RATE
-        sample = 0.3 * math.sin(2 * math.pi * frequency * t)
-        samples.append(sample)
-    return (ctypes.c_float * n_samples)(*samples), n_samples
-
-
-# Define whisper_full_params structure (simplified - key fields only)
-# This matches the C struct layout for x86_64 Linux
-class WhisperFullParams(ctypes.Structure):
-    _fields_ = [
-        ("strategy", ctypes.c_int),
-        ("n_threads", ctypes.c_int),
-        ("n_max_text_ctx", ctypes.c_int),
-        ("offset_ms", ctypes.c_int),
-        ("duration_ms", ctypes.c_int),
-        
-        ("translate", ctypes.c_bool),
-        ("no_context", ctypes.c_bool),
-        ("no_timestamps", ctypes.c_bool),
-        ("single_segment", ctypes.c_bool),
-        ("print_special", ctypes.c_bool),
-        ("print_progress", ctypes.c_bool),
-        ("print_realtime", ctypes.c_bool),
-        ("print_timestamps", ctypes.c_bool),
-        
-        ("token_timestamps", ctypes.c_bool),
-        ("_pad1", ctypes.c_byte * 3),  # padding
-        ("thold_pt", ctypes.c_float),
-        ("thold_ptsum", ctypes.c_float),
-        ("max_len", ctypes.c_int),
-        ("split_on_word", ctypes.c_bool),
-        ("_pad2", ctypes.c_byte * 3),
-        ("max_tokens", ctypes.c_int),
-        
-        ("debug_mode", ctypes.c_bool),
-        ("_pad3", ctypes.c_byte * 3),
-        ("audio_ctx", ctypes.c_int),
-        
-        ("tdrz_enable", ctypes.c_bool),
-        ("_pad4", ctypes.c_byte * 7),
-        
-        ("suppress_regex", ctypes.c_char_p),
-        ("initial_prompt", ctypes.c_char_p),
-        ("carry_initial_prompt", ctypes.c_bool),
-        ("_pad5", ctypes.c_byte * 7),
-        ("prompt_tokens", ctypes.c_void_p),
-        ("prompt_n_tokens", ctypes.c_int),
-        ("_pad6", ctypes.c_byte * 4),
-        
-        ("language", ctypes.c_char_p),
-        ("detect_language", ctypes.c_bool),
-        
-        ("suppress_blank", ctypes.c_bool),
-        ("suppress_nst", ctypes.c_bool),
-        ("_pad7", ctypes.c_byte * 5),
-        
-        ("temperature", ctypes.c_float),
-        ("max_initial_ts", ctypes.c_float),
-        ("length_penalty", ctypes.c_float),
-        
-        ("temperature_inc", ctypes.c_float),
-        ("entropy_thold", ctypes.c_float),
-        ("logprob_thold", ctypes.c_float),
-        ("no_speech_thold", ctypes.c_float),
-        
-        ("greedy_best_of", ctypes.c_int),
-        
-        ("beam_size", ctypes.c_int),
-        ("patience", ctypes.c_float),
-        
-        # Callbacks (all void pointers)
-        ("new_segment_callback", ctypes.c_void_p),
-        ("new_segment_callback_user_data", ctypes.c_void_p),
-        ("progress_callback", ctypes.c_void_p),
-        ("progress_callback_user_data", ctypes.c_void_p),
-        ("encoder_begin_callback", ctypes.c_void_p),
-        ("encoder_begin_callback_user_data", ctypes.c_void_p),
-        ("abort_callback", ctypes.c_void_p),
-        ("abort_callback_user_data", ctypes.c_void_p),
-        ("logits_filter_callback", ctypes.c_void_p),
-        ("logits_filter_callback_user_data", ctypes.c_void_p),
-        
-        ("grammar_rules", ctypes.c_void_p),
-        ("n_grammar_rules", ctypes.c_size_t),
-        ("i_start_rule", ctypes.c_size_t),
-        ("grammar_penalty", ctypes.c_float),
-        ("_pad8", ctypes.c_byte * 4),
-        
-        # VAD params - these are what we're testing
-        ("vad", ctypes.c_bool),
-        ("_pad9", ctypes.c_byte * 7),
-        ("vad_model_path", ctypes.c_char_p),
-        
-        # whisper_vad_params struct
-        ("vad_threshold", ctypes.c_float),
-        ("vad_min_speech_duration_ms", ctypes.c_int),
-        ("vad_min_silence_duration_ms", ctypes.c_int),
-        ("vad_max_speech_duration_s", ctypes.c_float),
-        ("vad_speech_pad_ms", ctypes.c_int),
-        ("vad_samples_overlap", ctypes.c_float),
-    ]
+    n_samples = int(wx.SAMPLE_RATE * duration_sec)
+    samples = array.array('f', (0.3 * math.sin(2 * math.pi * frequency * i / wx.SAMPLE_RATE) for i in range(n_samples)))
+    return samples, n_samples
 
 
 class WhisperTest:
     def __init__(self, artifact_dir):
         self.artifact_dir = os.path.abspath(artifact_dir)
-        self.lib = None
         self.ctx = None
         
-    def load_dependencies(self):
-        """Load ggml dependencies first."""
-        deps = ["libggml-base.so.0", "libggml-cpu.so.0", "libggml.so.0"]
-        for dep in deps:
-            dep_path = os.path.join(self.artifact_dir, dep)
-            if os.path.exists(dep_path):
-                try:
-                    ctypes.CDLL(dep_path, mode=ctypes.RTLD_GLOBAL)
-                    print(f"  ✓ Loaded dependency: {dep}")
-                except Exception as e:
-                    print(f"  ✗ Failed to load {dep}: {e}")
-                    return False
-        return True
-    
     def load_library(self):
-        """Load libwhisper.so."""
+        """Load libwhisper.so (and its ggml dependencies) through the whisper_xeon package."""
         lib_path = os.path.join(self.artifact_dir, "libwhisper.so")
         if not os.path.exists(lib_path):
             print(f"  ✗ Library not found: {lib_path}")
             return False
         
         try:
-            self.lib = ctypes.CDLL(lib_path)
+            wx.load_library(self.artifact_dir)
             print(f"  ✓ Loaded libwhisper.so")
             return True
         except Exception as e:
             print(f"  ✗ Failed to load libwhisper.so: {e}")
             return False
     
-    def setup_functions(self):
-        """Setup ctypes function signatures."""
-        # whisper_init_from_file (deprecated but simpler)
-        self.lib.whisper_init_from_file.restype = ctypes.c_void_p
-        self.lib.whisper_init_from_file.argtypes = [ctypes.c_char_p]
-        
-        # whisper_full_default_params - returns struct by value
-        self.lib.whisper_full_default_params.restype = WhisperFullParams
-        self.lib.whisper_full_default_params.argtypes = [ctypes.c_int]
-        
-        # whisper_full - takes struct by value
-        self.lib.whisper_full.restype = ctypes.c_int
-        self.lib.whisper_full.argtypes = [
-            ctypes.c_void_p,  # ctx
-            WhisperFullParams,  # params (by value)
-            ctypes.POINTER(ctypes.c_float),  # samples
-            ctypes.c_int  # n_samples
-        ]
-        
-        # whisper_full_n_segments
-        self.lib.whisper_full_n_segments.restype = ctypes.c_int
-        self.lib.whisper_full_n_segments.argtypes = [ctypes.c_void_p]
-        
-        # whisper_full_get_segment_text
-        self.lib.whisper_full_get_segment_text.restype = ctypes.c_char_p
-        self.lib.whisper_full_get_segment_text.argtypes = [ctypes.c_void_p, ctypes.c_int]
-        
-        # whisper_free
-        self.lib.whisper_free.restype = None
-        self.lib.whisper_free.argtypes = [ctypes.c_void_p]
-        
-        print("  ✓ Function signatures configured")
+    def check_layout(self):
+        """Check that the params mirror was generated from the library."""
+        params = wx.FullParams(wx.SAMPLING_GREEDY)
+        print(f"  ✓ whisper_full_params layout loaded from library ({len(dir(params))} fields)")
         return True
     
     def find_model(self):
@@ -215,13 +71,9 @@ class WhisperTest:
         print(f"  Loading model: {os.path.basename(model_path)}")
         
         try:
-            self.ctx = self.lib.whisper_init_from_file(model_path.encode('utf-8'))
+            self.ctx = wx.Context(model_path)
         except Exception as e:
-            print(f"  ✗ Exception loading model: {e}")
-            return False
-        
-        if not self.ctx:
-            print(f"  ✗ Failed to load model (ctx is NULL)")
+            print(f"  ✗ Failed to load model: {e}")
             return False
         
         print(f"  ✓ Model loaded successfully")
@@ -232,32 +84,22 @@ class WhisperTest:
         print("\n  Testing whisper_full() with vad=false...")
         
         samples, n_samples = generate_test_audio(duration_sec=1.0)
-        print(f"  Generated {n_samples} test samples ({n_samples/WHISPER_SAMPLE_RATE:.1f}s)")
-        
-        # Get default params
-        params = self.lib.whisper_full_default_params(WHISPER_SAMPLING_GREEDY)
+        print(f"  Generated {n_samples} test samples ({n_samples/wx.SAMPLE_RATE:.1f}s)")
         
-        # Explicitly set VAD to false
-        params.vad = False
-        params.vad_model_path = None
+        # Get default params and explicitly set VAD to false
+        params = wx.FullParams(wx.SAMPLING_GREEDY, vad=False, vad_model_path=None)
         
         print(f"  params.vad = {params.vad}")
         print("  Calling whisper_full()...")
         
         try:
-            result = self.lib.whisper_full(self.ctx, params, samples, n_samples)
-        except Exception as e:
-            print(f"  ✗ Exception in whisper_full: {e}")
-            return False
-        
-        if result != 0:
-            print(f"  ✗ whisper_full returned error code: {result}")
+            segments = self.ctx.transcribe(samples, params)
+        except wx.WhisperError as e:
+            print(f"  ✗ {e}")
             return False
         
-        print(f"  ✓ whisper_full() returned success (code: {result})")
-        
-        n_segments = self.lib.whisper_full_n_segments(self.ctx)
-        print(f"  ✓ Got {n_segments} segments")
+        print(f"  ✓ whisper_full() returned success")
+        print(f"  ✓ Got {len(segments)} segments")
         
         return True
     
@@ -266,42 +108,32 @@ class WhisperTest:
         print("\n  Testing whisper_full() with vad=true (should work if VAD disabled at compile time)...")
         
         samples, n_samples = generate_test_audio(duration_sec=1.0)
-        print(f"  Generated {n_samples} test samples ({n_samples/WHISPER_SAMPLE_RATE:.1f}s)")
-        
-        # Get default params
-        params = self.lib.whisper_full_default_params(WHISPER_SAMPLING_GREEDY)
+        print(f"  Generated {n_samples} test samples ({n_samples/wx.SAMPLE_RATE:.1f}s)")
         
         # Set VAD to true - this would fail if VAD is enabled but model not found
-        params.vad = True
-        params.vad_model_path = None  # No model path
+        params = wx.FullParams(wx.SAMPLING_GREEDY, vad=True, vad_model_path=None)  # No model path
         
         print(f"  params.vad = {params.vad} (intentionally set to true)")
         print("  Calling whisper_full()...")
         
         try:
-            result = self.lib.whisper_full(self.ctx, params, samples, n_samples)
-        except Exception as e:
-            print(f"  ✗ Exception in whisper_full: {e}")
-            return False
-        
-        if result != 0:
-            print(f"  ✗ whisper_full returned error code: {result}")
-            if result == -1:
+            segments = self.ctx.transcribe(samples, params)
+        except wx.WhisperError as e:
+            print(f"  ✗ {e}")
+            if "(-1)" in str(e):
                 print("    VAD error! This means VAD is NOT disabled at compile time.")
             return False
         
         print(f"  ✓ whisper_full() returned success even with vad=true!")
         print("    This confirms VAD code path is disabled at compile time.")
-        
-        n_segments = self.lib.whisper_full_n_segments(self.ctx)
-        print(f"  ✓ Got {n_segments} segments")
+        print(f"  ✓ Got {len(segments)} segments")
         
         return True
     
     def cleanup(self):
         """Free resources."""
         if self.ctx:
-            self.lib.whisper_free(self.ctx)
+            self.ctx.close()
             self.ctx = None
     
     def run_all_tests(self):
@@ -312,9 +144,8 @@ class WhisperTest:
         print(f"{'='*60}\n")
         
         tests = [
-            ("Loading dependencies", self.load_dependencies),
             ("Loading library", self.load_library),
-            ("Setting up functions", self.setup_functions),
+            ("Checking struct layout", self.check_layout),
             ("Loading model", self.load_model),
             ("Transcription with vad=false", self.test_transcription_vad_false),
             ("Transcription with vad=true (VAD bypass test)", self.test_transcription_vad_true),
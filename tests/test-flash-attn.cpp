@@ -0,0 +1,202 @@
+// compare the CPU flash attention kernels with attention computed from the KQ matrix (mul_mat + soft_max + mul_mat)
+//
+// the batches of at least GGML_FA_TILE_Q/4 queries run through the tiled kernel of ggml/src/ggml-cpu/ops.cpp, which
+// is not in upstream ggml, the others through the one query at a time kernel. the cases cover several head sizes,
+// masks and numbers of keys that are not a multiple of the tiles
+//
+// usage: test-flash-attn [n_threads]
+
+#include "ggml.h"
+#include "ggml-cpu.h"
+
+#include <cmath>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <random>
+#include <vector>
+
+enum test_mask {
+    TEST_MASK_NONE,
+    TEST_MASK_CAUSAL, // the last query sees all keys, each one before it one key less
+    TEST_MASK_HOLES,  // causal, and every 7th key is masked for all queries
+};
+
+static const char * test_mask_name(test_mask mask) {
+    switch (mask) {
+        case TEST_MASK_NONE:   return "none";
+        case TEST_MASK_CAUSAL: return "causal";
+        case TEST_MASK_HOLES:  return "holes";
+    }
+    return "?";
+}
+
+// the values of a tensor of type as they are seen by the kernels: rounded to the type and converted back to F32
+static std::vector<float> test_round(const std::vector<float> & data, ggml_type type, int64_t n_per_row) {
+    if (type == GGML_TYPE_F32) {
+        return data;
+    }
+
+    const int64_t nrows = data.size()/n_per_row;
+
+    std::vector<uint8_t> tmp(nrows*ggml_row_size(type, n_per_row));
+    ggml_quantize_chunk(type, data.data(), tmp.data(), 0, nrows, n_per_row, nullptr);
+
+    std::vector<float> res(data.size());
+    ggml_get_type_traits(type)->to_float(tmp.data(), res.data(), res.size());
+
+    return res;
+}
+
+// max abs difference of the output of ggml_flash_attn_ext() and of the reference
+static double test_case(int64_t D, int64_t N, int64_t KV, int64_t H, test_mask mask, ggml_type type_kv, int n_threads) {
+    std::mt19937 rng(D*1000003 + N*1009 + KV);
+    std::uniform_real_distribution<float> dist(-1.0f, 1.0f);
+
+    const auto rand_data = [&](int64_t n) {
+        std::vector<float> res(n);
+        for (auto & x : res) {
+            x = dist(rng);
+        }
+        return res;
+    };
+
+    const std::vector<float> q_data = rand_data(D*N*H);
+    const std::vector<float> k_data = rand_data(D*KV*H);
+    const std::vector<float> v_data = rand_data(D*KV*H);
+
+    // the mask has GGML_KQ_MASK_PAD rows more than needed and they are -INF, as in whisper.cpp
+    const int64_t n_mask = GGML_PAD(N, GGML_KQ_MASK_PAD);
+
+    std::vector<float> m_data(KV*n_mask, -INFINITY);
+    for (int64_t i = 0; i < N; ++i) {
+        for (int64_t j = 0; j < KV; ++j) {
+            bool masked = false;
+            if (mask == TEST_MASK_CAUSAL || mask == TEST_MASK_HOLES) {
+                masked = j > i + KV - N;
+            }
+            if (mask == TEST_MASK_HOLES) {
+                masked = masked || (j % 7 == 3 && j != i + KV - N);
+            }
+            m_data[i*KV + j] = masked ? -INFINITY : 0.0f;
+        }
+    }
+
+    ggml_init_params ip = {
+        /*.mem_size   =*/ (size_t) 64*ggml_tensor_overhead() + sizeof(float)*(size_t) (8*D*KV*H + 4*D*N*H + 2*KV*N*H + 2*KV*n_mask) + (1u << 20),
+        /*.mem_buffer =*/ nullptr,
+        /*.no_alloc   =*/ false,
+    };
+
+    ggml_context * ctx = ggml_init(ip);
+
+    ggml_tensor * q = ggml_new_tensor_3d(ctx, GGML_TYPE_F32, D, N,  H);
+    ggml_tensor * k = ggml_new_tensor_3d(ctx, type_kv,       D, KV, H);
+    ggml_tensor * v = ggml_new_tensor_3d(ctx, type_kv,       D, KV, H);
+    ggml_tensor * m = ggml_new_tensor_2d(ctx, GGML_TYPE_F16, KV, n_mask);
+
+    memcpy(q->data, q_data.data(), ggml_nbytes(q));
+    ggml_quantize_chunk(type_kv, k_data.data(), k->data, 0, KV*H, D, nullptr);
+    ggml_quantize_chunk(type_kv, v_data.data(), v->data, 0, KV*H, D, nullptr);
+    ggml_fp32_to_fp16_row(m_data.data(), (ggml_fp16_t *) m->data, m_data.size());
+
+    // the reference sees the same rounded keys and values
+    ggml_tensor * k_ref = ggml_new_tensor_3d(ctx, GGML_TYPE_F32, D, KV, H);
+    ggml_tensor * v_ref = ggml_new_tensor_3d(ctx, GGML_TYPE_F32, D, KV, H);
+    ggml_tensor * m_ref = ggml_new_tensor_2d(ctx, GGML_TYPE_F32, KV, N);
+
+    {
+        const std::vector<float> k_rnd = test_round(k_data, type_kv, D);
+        const std::vector<float> v_rnd = test_round(v_data, type_kv, D);
+
+        memcpy(k_ref->data, k_rnd.data(),  ggml_nbytes(k_ref));
+        memcpy(v_ref->data, v_rnd.data(),  ggml_nbytes(v_ref));
+        memcpy(m_ref->data, m_data.data(), ggml_nbytes(m_ref));
+    }
+
+    const float scale = 1.0f/sqrtf((float) D);
+
+    ggml_tensor * kq  = ggml_mul_mat(ctx, k_ref, q);
+    ggml_tensor * sm  = ggml_soft_max_ext(ctx, kq, mask == TEST_MASK_NONE ? nullptr : m_ref, scale, 0.0f);
+    ggml_tensor * vt  = ggml_cont(ctx, ggml_transpose(ctx, v_ref));
+    ggml_tensor * ref = ggml_mul_mat(ctx, vt, sm); // [D, N, H]
+
+    ggml_tensor * fa = ggml_flash_attn_ext(ctx, q, k, v, mask == TEST_MASK_NONE ? nullptr : m, scale, 0.0f, 0.0f); // [D, H, N]
+    ggml_flash_attn_ext_set_prec(fa, GGML_PREC_F32);
+
+    ggml_cgraph * gf = ggml_new_graph(ctx);
+    ggml_build_forward_expand(gf, ref);
+    ggml_build_forward_expand(gf, fa);
+
+    double max_diff = INFINITY;
+
+    if (ggml_graph_compute_with_ctx(ctx, gf, n_threads) == GGML_STATUS_SUCCESS) {
+        max_diff = 0.0;
+        for (int64_t h = 0; h < H; ++h) {
+            for (int64_t i = 0; i < N; ++i) {
+                for (int64_t d = 0; d < D; ++d) {
+                    const float a = ((const float *) ref->data)[(h*N + i)*D + d];
+                    const float b = ((const float *) fa ->data)[(i*H + h)*D + d];
+
+                    // NaN compares false, so it fails the test
+                    const double diff = fabs(a - b);
+                    max_diff = diff <= max_diff ? max_diff : diff;
+                }
+            }
+        }
+    }
+
+    ggml_free(ctx);
+
+    return max_diff;
+}
+
+int main(int argc, char ** argv) {
+    const int n_threads = argc > 1 ? atoi(argv[1]) : 2;
+
+    ggml_cpu_init();
+
+    const int64_t   head_sizes[] = { 64, 80, 128 };
+    const int64_t   n_queries[]  = { 1, 7, 8, 33, 100 };
+    const int64_t   n_keys[]     = { 1, 63, 65, 130, 1500 };
+    const test_mask masks[]      = { TEST_MASK_NONE, TEST_MASK_CAUSAL, TEST_MASK_HOLES };
+    const ggml_type types_kv[]   = { GGML_TYPE_F16, GGML_TYPE_Q8_0, GGML_TYPE_F32 };
+
+    // the one query at a time kernel rounds the queries to the type of the keys, the tiled kernel does not
+    const double thold_f16 = 2e-3;
+    const double thold_f32 = 1e-5;
+
+    int n_tests  = 0;
+    int n_failed = 0;
+
+    for (int64_t D : head_sizes) {
+        for (int64_t N : n_queries) {
+            for (int64_t KV : n_keys) {
+                for (test_mask mask : masks) {
+                    for (ggml_type type_kv : types_kv) {
+                        if (KV < N && mask != TEST_MASK_NONE) {
+                            continue; // the first queries would not see any key
+                        }
+                        if (D % ggml_blck_size(type_kv) != 0) {
+                            continue;
+                        }
+
+                        const double diff  = test_case(D, N, KV, 3, mask, type_kv, n_threads);
+                        const double thold = type_kv == GGML_TYPE_F32 || N >= 8 ? thold_f32 : thold_f16;
+
+                        n_tests++;
+                        if (!(diff <= thold)) {
+                            n_failed++;
+                            printf("FAIL: D = %3d, N = %3d, KV = %4d, mask = %6s, type = %4s: max diff %g > %g\n",
+                                    (int) D, (int) N, (int) KV, test_mask_name(mask), ggml_type_name(type_kv), diff, thold);
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    printf("%d of %d flash attention tests passed\n", n_tests - n_failed, n_tests);
+
+    return n_failed == 0 ? 0 : 1;
+}